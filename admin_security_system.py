@@ -19,6 +19,8 @@ from telegram.ext import (
 )
 from sqlalchemy import text
 
+from utils.user_status_cache import USER_STATUS_CACHE
+
 # إعداد التسجيل
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,8 @@ class AdminSecurityManager:
     def __init__(self, admin_ids: List[int]):
         self.admin_ids = set(admin_ids)
         self.blocked_users = {}  # نسخة احتياطية في الذاكرة
+        self._session_factory = None  # sessionmaker واحد يُعاد استخدامه لكل الفحوصات
+        self._session_engine = None
         
         # رسائل النظام
         self.messages = {
@@ -43,21 +47,26 @@ class AdminSecurityManager:
         try:
             db_manager = context.bot_data.get("DB_MANAGER")
             if db_manager:
-                logger.info(f"تم العثور على DB_MANAGER من النوع: {type(db_manager)}")
+                logger.debug(f"تم العثور على DB_MANAGER من النوع: {type(db_manager)}")
                 
                 # محاولة الحصول على الجلسة بطرق مختلفة
                 if hasattr(db_manager, 'get_session'):
                     session = db_manager.get_session()
-                    logger.info("تم الحصول على الجلسة من get_session()")
+                    logger.debug("تم الحصول على الجلسة من get_session()")
                     return session
                 elif hasattr(db_manager, 'session'):
-                    logger.info("تم الحصول على الجلسة من session")
+                    logger.debug("تم الحصول على الجلسة من session")
                     return db_manager.session
+                elif getattr(db_manager, 'SessionLocal', None) is not None:
+                    return db_manager.SessionLocal()
                 elif hasattr(db_manager, 'engine'):
-                    logger.info("تم الحصول على الجلسة من engine")
-                    from sqlalchemy.orm import sessionmaker
-                    Session = sessionmaker(bind=db_manager.engine)
-                    return Session()
+                    # إنشاء sessionmaker مرة واحدة لكل engine بدلاً من كل فحص
+                    if self._session_factory is None or self._session_engine is not db_manager.engine:
+                        from sqlalchemy.orm import sessionmaker
+                        self._session_factory = sessionmaker(bind=db_manager.engine)
+                        self._session_engine = db_manager.engine
+                        logger.info("تم إنشاء sessionmaker من engine")
+                    return self._session_factory()
                 else:
                     # طباعة جميع الخصائص المتاحة للتشخيص
                     available_attrs = [attr for attr in dir(db_manager) if not attr.startswith('_')]
@@ -75,7 +84,11 @@ class AdminSecurityManager:
         return user_id in self.admin_ids
     
     def is_user_blocked(self, user_id: int, context: CallbackContext) -> bool:
-        """التحقق من حظر المستخدم"""
+        """التحقق من حظر المستخدم (من الذاكرة المؤقتة إن كانت حديثة)"""
+        cached = USER_STATUS_CACHE.lookup(user_id, "blocked")
+        if cached is not None:
+            return cached["blocked"]
+        generation = USER_STATUS_CACHE.generation
         try:
             session = self.get_db_session(context)
             if not session:
@@ -89,7 +102,9 @@ class AdminSecurityManager:
                     {"user_id": user_id}
                 ).fetchone()
                 
-                return result is not None
+                blocked = result is not None
+                USER_STATUS_CACHE.store(user_id, generation=generation, blocked=blocked)
+                return blocked
                 
             except Exception as e:
                 logger.error(f"خطأ في التحقق من حظر المستخدم {user_id}: {e}")
@@ -137,6 +152,7 @@ class AdminSecurityManager:
                     }
                 )
                 session.commit()
+                USER_STATUS_CACHE.invalidate(user_id, "blocked")
                 
                 logger.info(f"تم حظر المستخدم {user_id} بواسطة المدير {admin_id}")
                 return True
@@ -179,6 +195,7 @@ class AdminSecurityManager:
                     {"admin_id": admin_id, "user_id": user_id}
                 )
                 session.commit()
+                USER_STATUS_CACHE.invalidate(user_id, "blocked")
                 
                 logger.info(f"تم إلغاء حظر المستخدم {user_id} بواسطة المدير {admin_id}")
                 return True
@@ -266,7 +283,7 @@ class AdminSecurityManager:
         if check_registration:
             # استيراد دوال التحقق من التسجيل
             try:
-                from handlers.registration import is_user_fully_registered, get_user_info
+                from handlers.registration import get_user_status_async
                 
                 db_manager = context.bot_data.get("DB_MANAGER")
                 if not db_manager:
@@ -281,8 +298,8 @@ class AdminSecurityManager:
                     return False
                 
                 # التحقق من التسجيل
-                user_info = get_user_info(db_manager, user_id)
-                if not is_user_fully_registered(user_info):
+                user_status = await get_user_status_async(db_manager, user_id)
+                if not user_status["registered"]:
                     logger.warning(f"[SECURITY] المستخدم {user_id} غير مسجل")
                     try:
                         await context.bot.send_message(
@@ -126,6 +126,7 @@ try:
             admin_untag_all_execute_callback,
             admin_report_weekly_callback,
             admin_report_monthly_callback,
+            admin_report_cancel_callback,
             admin_report_certificates_callback,
             admin_report_notify_callback,
             admin_report_notify_confirm_callback,
@@ -166,7 +167,7 @@ try:
             EXAM_SCHEDULE_INPUT,
         )
         # إضافة استيراد أدوات تصدير بيانات المستخدمين
-        from handlers.admin_tools.admin_commands import export_users_command
+        from handlers.admin_tools.admin_commands import export_users_command, clear_question_cache_command
         from database.manager_definition import DatabaseManager 
         logger.info("Successfully imported new admin tools (edit/broadcast) and DatabaseManager class.")
         new_admin_tools_loaded = True # Set flag based on successful import
@@ -219,6 +220,13 @@ async def post_initialize_db_manager(application: Application) -> None:
     Uses global 'new_admin_tools_loaded', 'DatabaseManager', 'DATABASE_URL', 'logger'.
     """
     logger.info("Executing post_initialize_db_manager to set DB_MANAGER in bot_data...")
+
+    # Tables, functions and indexes used by database.manager (kept out of import time)
+    try:
+        from database.manager import ensure_database_schema
+        ensure_database_schema()
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to ensure database schema: {e}", exc_info=True)
     
     current_db_manager_in_bot_data = None # Default to None
     
@@ -244,6 +252,142 @@ async def post_initialize_db_manager(application: Application) -> None:
     application.bot_data["DB_MANAGER"] = current_db_manager_in_bot_data
     logger.info(f"post_initialize_db_manager: DB_MANAGER in application.bot_data is now type: {type(application.bot_data.get('DB_MANAGER'))}")
 
+    # Start the chart render workers early and resolve their fonts before the first stats request
+    try:
+        from utils.chart_service import init_chart_service
+        await init_chart_service()
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to start chart render workers: {e}", exc_info=True)
+
+    # Open the psycopg2 pool's minimum connections before the first update arrives
+    try:
+        from database.connection import get_pool
+        get_pool().warm_up()
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to warm up DB connection pool: {e}", exc_info=True)
+
+    # Open the shared keep-alive HTTP session used by utils.api_client.fetch_from_api
+    try:
+        from utils.api_client import init_api_session
+        await init_api_session()
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to open shared API session: {e}", exc_info=True)
+
+    # Convert user_data written before questions were stored as IDs, and log the footprint change.
+    # Only PicklePersistence loads every user here; PostgresPersistence loads users lazily and
+    # compacts each one as it is loaded (PostgresPersistence.refresh_user_data).
+    if isinstance(application.persistence, PicklePersistence):
+        try:
+            from utils.persistence_report import build_footprint_report, compact_user_data
+            report = build_footprint_report(application.user_data)
+            for user_data in application.user_data.values():
+                compact_user_data(user_data, inplace=True)
+            logger.info(f"post_initialize_db_manager: user_data footprint before={report['before']} after={report['after']}")
+        except Exception as e:
+            logger.error(f"post_initialize_db_manager: Failed to compact persisted user_data: {e}", exc_info=True)
+
+    # Convert older quizzes into quiz_answers and user aggregates (resumable, runs once)
+    try:
+        from database.backfill import schedule_backfills
+        schedule_backfills(application)
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to schedule history backfill: {e}", exc_info=True)
+
+    # Build the question catalogue in the background and keep it refreshed
+    try:
+        from utils.question_catalogue import schedule_question_catalogue
+        schedule_question_catalogue(application)
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to schedule question catalogue: {e}", exc_info=True)
+
+    # Batch touches (last_activity, last_interaction_date) and broadcast read receipts
+    try:
+        from database.write_behind import schedule_write_behind
+        schedule_write_behind(application)
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to schedule write-behind flush: {e}", exc_info=True)
+
+    # Continue broadcasts, certificates and notifications interrupted by the last shutdown
+    try:
+        from utils.broadcast_engine import schedule_broadcast_resume
+        schedule_broadcast_resume(application)
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to schedule broadcast resume: {e}", exc_info=True)
+
+    # Telegram file_ids of question/option images (loaded from the DB, prewarmed into the storage chat)
+    try:
+        from utils.image_cache import schedule_image_cache
+        schedule_image_cache(application)
+    except Exception as e:
+        logger.error(f"post_initialize_db_manager: Failed to schedule image cache: {e}", exc_info=True)
+
+async def post_shutdown_cleanup(application: Application) -> None:
+    """Releases process-wide resources (API session, chart workers, buffered writes, DB executor, DB connection pool) when the bot stops."""
+    logger.info("Executing post_shutdown_cleanup...")
+    try:
+        from utils.chart_service import get_chart_stats, shutdown_chart_service
+        logger.info(f"post_shutdown_cleanup: Chart render stats: {get_chart_stats()}")
+        shutdown_chart_service()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error shutting down chart render workers: {e}", exc_info=True)
+    try:
+        from utils.api_client import close_api_session, get_api_stats
+        logger.info(f"post_shutdown_cleanup: API client stats: {get_api_stats()}")
+        await close_api_session()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error closing shared API session: {e}", exc_info=True)
+    try:
+        from utils.report_jobs import REPORT_JOBS
+        REPORT_JOBS.shutdown()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error stopping report jobs: {e}", exc_info=True)
+    try:
+        from utils.user_status_cache import USER_STATUS_CACHE
+        logger.info(f"post_shutdown_cleanup: User status cache stats: {USER_STATUS_CACHE.stats()}")
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error reading user status cache stats: {e}", exc_info=True)
+    try:
+        from utils.quiz_timer import QUIZ_TIMERS
+        logger.info(f"post_shutdown_cleanup: Quiz timer stats: {QUIZ_TIMERS.stats()}")
+        await QUIZ_TIMERS.stop()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error stopping quiz timers: {e}", exc_info=True)
+    try:
+        from utils.image_cache import IMAGE_CACHE
+        logger.info(f"post_shutdown_cleanup: Image file_id cache stats: {IMAGE_CACHE.stats()}")
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error reading image cache stats: {e}", exc_info=True)
+    try:
+        from utils.broadcast_engine import BROADCAST_ENGINE
+        saved = BROADCAST_ENGINE.persist_now()
+        logger.info(f"post_shutdown_cleanup: Saved {saved} broadcast results; stats: {BROADCAST_ENGINE.stats()}")
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error saving broadcast progress: {e}", exc_info=True)
+    try:
+        from utils.rate_governor import GOVERNOR
+        logger.info(f"post_shutdown_cleanup: Outbound rate governor stats: {GOVERNOR.stats()}")
+        await GOVERNOR.stop()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error stopping rate governor: {e}", exc_info=True)
+    try:
+        from database.write_behind import WRITE_BEHIND, get_write_behind_stats
+        flushed = WRITE_BEHIND.flush()
+        logger.info(f"post_shutdown_cleanup: Flushed {flushed} write-behind entries; stats: {get_write_behind_stats()}")
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error flushing write-behind queue: {e}", exc_info=True)
+    try:
+        from database.async_manager import get_db_executor_stats, shutdown_db_executor
+        logger.info(f"post_shutdown_cleanup: DB executor stats: {get_db_executor_stats()}")
+        shutdown_db_executor()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error shutting down DB executor: {e}", exc_info=True)
+    try:
+        from database.connection import close_pool, get_pool_stats
+        logger.info(f"post_shutdown_cleanup: DB connection pool stats: {get_pool_stats()}")
+        close_pool()
+    except Exception as e:
+        logger.error(f"post_shutdown_cleanup: Error closing DB connection pool: {e}", exc_info=True)
+
 async def error_handler(update: object, context: CallbackContext) -> None:
     """Log Errors caused by Updates."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -300,8 +444,25 @@ def main() -> None:
         persistence_dir = os.path.join(project_root, 'persistence')
         os.makedirs(persistence_dir, exist_ok=True)
         persistence_file = os.path.join(persistence_dir, 'bot_conversation_persistence.pkl')
-        persistence = PicklePersistence(filepath=persistence_file)
-        logger.info(f"PicklePersistence configured at {persistence_file}. All ConversationHandlers should be persistent=False.")
+        try:
+            from config import PERSISTENCE_BACKEND
+        except ImportError:
+            PERSISTENCE_BACKEND = "postgres"
+        if PERSISTENCE_BACKEND == "postgres" and DATABASE_URL:
+            try:
+                from database.persistence import PostgresPersistence, ensure_persistence_table
+                if ensure_persistence_table():
+                    # Per-key rows in Postgres; the old pickle file is imported once into an empty table
+                    persistence = PostgresPersistence(legacy_pickle_path=persistence_file)
+                    logger.info("PostgresPersistence configured (per-key rows, batched writes, lazy per-user loads).")
+                else:
+                    logger.warning("bot_persistence table unavailable. Falling back to PicklePersistence.")
+            except Exception as pg_pers_exc:
+                logger.error(f"Error configuring PostgresPersistence: {pg_pers_exc}. Falling back to PicklePersistence.", exc_info=True)
+                persistence = None
+        if persistence is None:
+            persistence = PicklePersistence(filepath=persistence_file)
+            logger.info(f"PicklePersistence configured at {persistence_file}. All ConversationHandlers should be persistent=False.")
     except Exception as pers_exc:
         logger.error(f"Error configuring persistence: {pers_exc}. Proceeding without persistence.", exc_info=True)
         persistence = None
@@ -325,6 +486,8 @@ def main() -> None:
         # Add the post_init hook HERE
         app_builder = app_builder.post_init(post_initialize_db_manager)
         logger.info("post_initialize_db_manager hook added to ApplicationBuilder.")
+        app_builder = app_builder.post_shutdown(post_shutdown_cleanup)
+        logger.info("post_shutdown_cleanup hook added to ApplicationBuilder.")
 
         if job_queue:
             app_builder = app_builder.job_queue(job_queue)
@@ -525,6 +688,7 @@ def main() -> None:
         # === Report, Certificates & Notifications handlers ===
         application.add_handler(CallbackQueryHandler(admin_report_weekly_callback, pattern=r"^admin_report_weekly$"))
         application.add_handler(CallbackQueryHandler(admin_report_monthly_callback, pattern=r"^admin_report_monthly$"))
+        application.add_handler(CallbackQueryHandler(admin_report_cancel_callback, pattern=r"^admin_report_cancel:"))
         application.add_handler(CallbackQueryHandler(admin_report_certificates_callback, pattern=r"^admin_report_certificates$"))
         application.add_handler(CallbackQueryHandler(admin_report_notify_callback, pattern=r"^admin_report_notify$"))
         application.add_handler(CallbackQueryHandler(admin_report_notify_confirm_callback, pattern=r"^admin_report_notify_confirm$"))
@@ -606,6 +770,13 @@ def main() -> None:
         except NameError:
             logger.warning("export_users_command not found, skipping addition.")
 
+        # Admin command to drop the cached question bank after the API content changes
+        try:
+            application.add_handler(CommandHandler("clear_cache", clear_question_cache_command))
+            logger.info("Clear question cache command handler added.")
+        except NameError:
+            logger.warning("clear_question_cache_command not found, skipping addition.")
+
         logger.info("New admin tools (edit/broadcast) ConversationHandlers and related handlers added.")
     else:
         logger.warning("New admin tools (edit/broadcast) were not imported, skipping their addition.")
@@ -625,11 +796,9 @@ def main() -> None:
             if now - last < 600:  # فحص مرة كل 10 دقائق فقط
                 return
             _auto_track_cache[user.id] = now
-            try:
-                from database.manager import auto_track_broadcast_read
-            except ImportError:
-                from manager import auto_track_broadcast_read
-            auto_track_broadcast_read(user.id)
+            # يُكتب مع دفعة الـ write-behind التالية بدل INSERT...SELECT على حلقة الأحداث
+            from database.write_behind import mark_recent_broadcasts_read
+            mark_recent_broadcasts_read(user.id)
         except Exception:
             pass
 
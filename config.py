@@ -91,14 +91,106 @@ FEEDBACK_DELAY = 1.5
 # Number of options per question (assuming multiple choice)
 NUM_OPTIONS = 4
 
+# Shared quiz timer engine (utils/quiz_timer.py)
+QUIZ_TIMER_TICK = float(os.environ.get("QUIZ_TIMER_TICK", 1.0)) # Seconds between ticks of the timer wheel
+QUIZ_TIMER_WHEEL_SIZE = int(os.environ.get("QUIZ_TIMER_WHEEL_SIZE", 512)) # Slots in the timing wheel (longer deadlines wrap around)
+QUIZ_TIMER_EDIT_CONCURRENCY = int(os.environ.get("QUIZ_TIMER_EDIT_CONCURRENCY", 20)) # Countdown edits sent in parallel per tick
+
+# Outbound Telegram rate governor (utils/rate_governor.py)
+OUTBOUND_GOVERNOR_ENABLED = os.environ.get("OUTBOUND_GOVERNOR_ENABLED", "true").lower() in ("1", "true", "yes") # Route sends/edits through the governor
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 28)) # Messages per second for the whole bot (Telegram: ~30)
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1.0)) # Messages per second per private chat
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", 3)) # Messages a chat may send back to back
+OUTBOUND_GROUP_PER_MINUTE = int(os.environ.get("OUTBOUND_GROUP_PER_MINUTE", 20)) # Messages per minute per group/channel
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 2)) # RetryAfter retries before the error reaches the caller
+OUTBOUND_COUNTDOWN_MAX_WAIT = float(os.environ.get("OUTBOUND_COUNTDOWN_MAX_WAIT", 4)) # Seconds a countdown edit may wait before it is dropped
+
 # --- API Settings --- 
 
 API_TIMEOUT = 15 # Timeout in seconds for API requests
 
+# Shared aiohttp session (utils/api_client.py)
+API_CONNECTOR_LIMIT = int(os.environ.get("API_CONNECTOR_LIMIT", 100)) # Max simultaneous connections to the API
+API_CONNECTOR_LIMIT_PER_HOST = int(os.environ.get("API_CONNECTOR_LIMIT_PER_HOST", 30)) # Max simultaneous connections per host
+API_KEEPALIVE_TIMEOUT = float(os.environ.get("API_KEEPALIVE_TIMEOUT", 30)) # Seconds an idle keep-alive connection is kept open
+API_DNS_CACHE_TTL = int(os.environ.get("API_DNS_CACHE_TTL", 300)) # Seconds DNS results for API_BASE_URL are cached
+API_FETCH_CONCURRENCY = int(os.environ.get("API_FETCH_CONCURRENCY", 8)) # Max parallel requests in one fetch_many_from_api batch
+
+# Question-bank cache in front of the API (utils/api_cache.py)
+API_CACHE_TTL = int(os.environ.get("API_CACHE_TTL", 900)) # Seconds a cached response is served without revalidation
+API_CACHE_STALE_TTL = int(os.environ.get("API_CACHE_STALE_TTL", 86400)) # Extra seconds a stale response is served while revalidating
+API_CACHE_MAX_ENTRIES = int(os.environ.get("API_CACHE_MAX_ENTRIES", 500)) # Max cached endpoints
+
+# Pre-indexed question catalogue (utils/question_catalogue.py)
+QUESTION_CATALOGUE_REFRESH_INTERVAL = int(os.environ.get("QUESTION_CATALOGUE_REFRESH_INTERVAL", 1800)) # Seconds between background rebuilds
+QUESTION_CATALOGUE_FETCH_CONCURRENCY = int(os.environ.get("QUESTION_CATALOGUE_FETCH_CONCURRENCY", 8)) # Parallel API requests while building
+QUESTION_CATALOGUE_RETRY_DELAY = int(os.environ.get("QUESTION_CATALOGUE_RETRY_DELAY", 60)) # Seconds before retrying a failed build
+
 # --- Database Settings --- 
 
 # Connection details are handled via DATABASE_URL
 
+# psycopg2 connection pool (database/connection.py)
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10)) # Max seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = int(os.environ.get("DB_POOL_MAX_LIFETIME", 1800)) # Recycle connections older than this (seconds)
+DB_POOL_HEALTHCHECK_IDLE = int(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", 30)) # Ping connections idle longer than this (seconds)
+
+# Async facade over DatabaseManager (database/async_manager.py)
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", DB_POOL_MAX_SIZE)) # Threads running blocking DB calls (never more than pool size)
+DB_CALL_TIMEOUT = float(os.environ.get("DB_CALL_TIMEOUT", 15)) # Default per-call timeout (seconds) for awaited DB calls
+DB_WRITE_TIMEOUT = float(os.environ.get("DB_WRITE_TIMEOUT", 30)) # Timeout for quiz start/end writes
+
+# Saved quizzes (database/saved_quizzes_db.py)
+SAVED_QUIZZES_POOL_SIZE = int(os.environ.get("SAVED_QUIZZES_POOL_SIZE", 2)) # Connections kept by the shared SQLAlchemy engine of saved quizzes
+SAVED_QUIZZES_MAX_OVERFLOW = int(os.environ.get("SAVED_QUIZZES_MAX_OVERFLOW", 3)) # Extra connections opened at peak
+
+# Bot persistence (database/persistence.py)
+PERSISTENCE_BACKEND = os.environ.get("PERSISTENCE_BACKEND", "postgres").lower() # "postgres" or "pickle"
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", 30)) # Seconds between PTB persistence update cycles
+PERSISTENCE_BATCH_DELAY = float(os.environ.get("PERSISTENCE_BATCH_DELAY", 1.0)) # Seconds to collect dirty keys into one batched write
+
+# History backfill of derived tables (database/backfill.py)
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", 500)) # quiz_results rows per backfill batch
+BACKFILL_PAUSE_SECONDS = float(os.environ.get("BACKFILL_PAUSE_SECONDS", 0.5)) # Pause between batches
+BACKFILL_START_DELAY = int(os.environ.get("BACKFILL_START_DELAY", 60)) # Seconds after startup before the backfill runs
+
+# Chart rendering process pool (utils/chart_service.py)
+CHART_RENDER_WORKERS = int(os.environ.get("CHART_RENDER_WORKERS", 2)) # Worker processes drawing matplotlib charts
+CHART_RENDER_TIMEOUT = float(os.environ.get("CHART_RENDER_TIMEOUT", 20)) # Seconds before a chart render is abandoned
+CHART_CACHE_MAX_ENTRIES = int(os.environ.get("CHART_CACHE_MAX_ENTRIES", 2000)) # Charts (PNG or Telegram file_id) kept in the LRU cache
+CHART_CACHE_MAX_BYTES = int(os.environ.get("CHART_CACHE_MAX_BYTES", 32 * 1024 * 1024)) # Memory cap for cached PNG bytes
+
+# Admin report jobs (utils/report_jobs.py)
+REPORT_PROGRESS_INTERVAL = float(os.environ.get("REPORT_PROGRESS_INTERVAL", 3)) # Min seconds between progress edits of the admin's message
+
+# Access checks (utils/user_status_cache.py)
+USER_STATUS_CACHE_TTL = float(os.environ.get("USER_STATUS_CACHE_TTL", 120)) # Seconds a user's registered/grade/is_my_student/blocked status is reused
+USER_STATUS_CACHE_MAX_ENTRIES = int(os.environ.get("USER_STATUS_CACHE_MAX_ENTRIES", 20000)) # Users kept in the status cache
+
+# Write-behind queue for touches and read receipts (database/write_behind.py)
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", 5)) # Seconds between batched flushes
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 500)) # Keys in one channel that trigger an early flush
+WRITE_BEHIND_MAX_BACKLOG = int(os.environ.get("WRITE_BEHIND_MAX_BACKLOG", 50000)) # Keys kept per channel while flushes fail (oldest dropped)
+
+# Broadcast engine (utils/broadcast_engine.py)
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25)) # Messages per second across all running broadcasts (Telegram allows ~30)
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8)) # Concurrent senders per broadcast job
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get("BROADCAST_MAX_ATTEMPTS", 3)) # Tries per recipient on network errors (flood waits don't count)
+BROADCAST_PERSIST_INTERVAL = float(os.environ.get("BROADCAST_PERSIST_INTERVAL", 2)) # Seconds between saves of per-recipient results
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 3)) # Min seconds between progress edits of the admin's message
+BROADCAST_RESUME_DELAY = int(os.environ.get("BROADCAST_RESUME_DELAY", 10)) # Seconds after startup before unfinished broadcasts resume
+
+# Telegram file_id cache for question/option images (utils/image_cache.py)
+IMAGE_STORAGE_CHAT_ID = os.environ.get("IMAGE_STORAGE_CHAT_ID") # Chat/channel the prewarm job uploads bank images to (prewarm is off when unset)
+IMAGE_PREWARM_START_DELAY = int(os.environ.get("IMAGE_PREWARM_START_DELAY", 120)) # Seconds after startup before the first prewarm pass
+IMAGE_PREWARM_INTERVAL = int(os.environ.get("IMAGE_PREWARM_INTERVAL", 3600)) # Seconds between prewarm passes (new or changed images only)
+IMAGE_PREWARM_BATCH = int(os.environ.get("IMAGE_PREWARM_BATCH", 10)) # Images per uploaded media group (Telegram allows 2-10)
+IMAGE_PREWARM_PAUSE = float(os.environ.get("IMAGE_PREWARM_PAUSE", 3)) # Seconds between media groups sent to the storage chat
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.environ.get("IMAGE_DOWNLOAD_CONCURRENCY", 5)) # Parallel image downloads while prewarming
+IMAGE_REVALIDATE_AFTER = int(os.environ.get("IMAGE_REVALIDATE_AFTER", 7 * 86400)) # Seconds before a cached image is downloaded again to compare its content hash
+
 # --- Other Constants --- 
 
 # Define any other constants needed across modules
@@ -21,6 +21,7 @@ from telegram.ext import (
     filters
 )
 from final_weekly_report import FinalWeeklyReportGenerator
+from utils.report_jobs import REPORT_JOBS
 
 logger = logging.getLogger(__name__)
 
@@ -289,6 +290,14 @@ async def custom_days_received(update: Update, context: ContextTypes.DEFAULT_TYP
 # ============================================================
 #  إنشاء التقرير
 # ============================================================
+def _build_custom_report(start_date, end_date, user_filter):
+    """ينشئ ملف التقرير (مع أو بدون فلتر) ويعيد مساره؛ يعمل على عامل التقارير"""
+    report_generator = FinalWeeklyReportGenerator()
+    if user_filter and user_filter.get('my_students'):
+        return report_generator.create_filtered_excel_report(start_date, end_date, user_filter)
+    return report_generator.create_final_excel_report(start_date, end_date)
+
+
 async def generate_custom_report(update_or_query, context: ContextTypes.DEFAULT_TYPE, days: int, wait_msg=None):
     """إنشاء التقرير المخصص (مع أو بدون فلتر)"""
     try:
@@ -300,13 +309,8 @@ async def generate_custom_report(update_or_query, context: ContextTypes.DEFAULT_
         
         logger.info(f"إنشاء تقرير: {target_label} | الفترة: {start_date.date()} إلى {end_date.date()}")
         
-        report_generator = FinalWeeklyReportGenerator()
-        
-        # اختيار نوع التقرير
-        if user_filter and user_filter.get('my_students'):
-            report_path = report_generator.create_filtered_excel_report(start_date, end_date, user_filter)
-        else:
-            report_path = report_generator.create_final_excel_report(start_date, end_date)
+        # التقرير يُنشأ على عامل التقارير (REPORT_JOBS) حتى لا يتزامن pyplot مع تقرير آخر ولا يوقف البوت
+        report_path = await REPORT_JOBS.run(_build_custom_report, start_date, end_date, user_filter)
         
         success_message = (
             f"✅ تم إنشاء التقرير بنجاح\n\n"
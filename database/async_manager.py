@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Async facade over the blocking DatabaseManager.
+
+Handlers run on the bot's asyncio event loop, while DatabaseManager
+(database/manager.py) talks to Postgres through blocking psycopg2 calls.
+run_db() moves each call onto a bounded thread pool (sized to the
+connection pool) and enforces a per-call timeout, so a slow query delays
+only the update that issued it instead of freezing every chat.
+
+Usage:
+    from database.async_manager import run_db
+
+    count = await run_db(DB_MANAGER.get_total_users_count, default=0)
+
+On timeout or exception the call returns ``default`` (None unless given),
+matching how DatabaseManager itself reports failures.  A timed-out call is
+not interrupted: it keeps its worker thread until the query finishes.
+
+``timeout`` and ``default`` always belong to run_db. If the DB function has
+a parameter of the same name, run_db raises TypeError instead of silently
+taking the argument; bind it with functools.partial (or positionally).
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import DB_EXECUTOR_WORKERS, DB_CALL_TIMEOUT
+except ImportError:
+    DB_EXECUTOR_WORKERS = 10
+    DB_CALL_TIMEOUT = 15
+
+_executor = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "in_flight": 0,
+    "timeouts": 0,
+    "errors": 0,
+    "total_seconds": 0.0,
+}
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Returns the shared executor for blocking DB calls, creating it on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=max(1, DB_EXECUTOR_WORKERS), thread_name_prefix="db-worker")
+                logger.info(f"[DB Async] Created DB executor with {DB_EXECUTOR_WORKERS} workers.")
+    return _executor
+
+def _track(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+_UNSET = object()
+
+@functools.lru_cache(maxsize=256)
+def _keyword_parameters(func) -> tuple:
+    """(names of positional parameters in order, names func accepts by keyword)"""
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return (), frozenset()
+    positional = tuple(p.name for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD))
+    keyword = frozenset(p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+    return positional, keyword
+
+def _reject_option_clash(func, args, options) -> None:
+    """TypeError if a run_db option was passed whose name func also takes (and args did not fill)."""
+    if not options:
+        return
+    try:
+        positional, keyword = _keyword_parameters(func)
+    except TypeError:  # unhashable callable
+        return
+    clashes = [name for name in options if name in keyword and name not in positional[:len(args)]]
+    if clashes:
+        name = getattr(func, "__name__", repr(func))
+        raise TypeError(f"run_db({name}): {', '.join(clashes)} is both a run_db option and a parameter of {name}; "
+                        f"bind it with functools.partial")
+
+async def run_db(func, *args, timeout=_UNSET, default=_UNSET, **kwargs):
+    """Runs a blocking DB function in the executor and awaits it.
+
+    Returns ``default`` if the call exceeds ``timeout`` seconds
+    (DB_CALL_TIMEOUT when None) or raises. Raises TypeError if ``timeout`` or
+    ``default`` is given and func has a parameter with that name.
+    """
+    _reject_option_clash(func, args, [option for option, value in (("timeout", timeout), ("default", default)) if value is not _UNSET])
+    timeout = DB_CALL_TIMEOUT if timeout is None or timeout is _UNSET else timeout
+    default = None if default is _UNSET else default
+    name = getattr(func, "__name__", repr(func))
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    _track("calls")
+    _track("in_flight")
+    try:
+        future = loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout=timeout)
+    except asyncio.TimeoutError:
+        _track("timeouts")
+        logger.error(f"[DB Async] {name} timed out after {timeout}s. Returning default.")
+        return default
+    except Exception as e:
+        _track("errors")
+        logger.error(f"[DB Async] {name} failed: {e}", exc_info=True)
+        return default
+    finally:
+        _track("in_flight", -1)
+        _track("total_seconds", time.monotonic() - started)
+
+def get_db_executor_stats() -> dict:
+    """Executor call, timeout and latency counters for monitoring."""
+    with _stats_lock:
+        stats = dict(_stats)
+    calls = stats["calls"]
+    stats["avg_ms"] = round(stats.pop("total_seconds") / calls * 1000, 2) if calls else 0.0
+    stats["workers"] = DB_EXECUTOR_WORKERS
+    return stats
+
+def shutdown_db_executor(wait=True):
+    """Stops the DB executor (call on shutdown, before closing the connection pool)."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+            logger.info("[DB Async] DB executor shut down.")
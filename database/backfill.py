@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Background backfill of derived tables from quiz_results history.
+
+quiz_answers and user_quiz_aggregates / user_quiz_daily are maintained by
+end_quiz_session for new quizzes; this job converts older history in small
+batches (by result_id / user_id) on the DB executor, so the bot keeps
+serving students meanwhile. Progress is kept in bot_settings, so a restart
+resumes where it stopped and a finished backfill is not repeated. Batches
+are idempotent (ON CONFLICT DO NOTHING / full recompute per student).
+"""
+
+import asyncio
+import logging
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import BACKFILL_BATCH_SIZE, BACKFILL_PAUSE_SECONDS, BACKFILL_START_DELAY
+except ImportError:
+    BACKFILL_BATCH_SIZE = 500
+    BACKFILL_PAUSE_SECONDS = 0.5
+    BACKFILL_START_DELAY = 60
+
+from .async_manager import run_db
+from .manager import (
+    backfill_quiz_answers_batch, backfill_user_aggregates_batch, get_bot_setting, set_bot_setting,
+    QUIZ_ANSWERS_CURSOR_KEY, USER_AGGREGATES_CURSOR_KEY,
+)
+
+_DONE = "done"
+
+
+async def _run_backfill(name, batch_func, cursor_key, batch_size, pause) -> int:
+    """Runs batch_func(after, batch_size) until history is exhausted, saving the cursor after every batch.
+
+    Returns the total reported by the batches.
+    """
+    cursor = await run_db(get_bot_setting, cursor_key, "0", default=None)
+    if cursor is None or cursor == _DONE:
+        return 0
+    try:
+        after = int(cursor)
+    except ValueError:
+        after = 0
+
+    logger.info(f"[Backfill] {name} backfill starting after id {after}.")
+    total = 0
+    while True:
+        last_id, count = await run_db(batch_func, after, batch_size, default=(after, None))
+        if count is None:
+            logger.error(f"[Backfill] {name} backfill stopped at id {after}; will resume next start.")
+            return total
+        if last_id is None:
+            await run_db(set_bot_setting, cursor_key, _DONE)
+            logger.info(f"[Backfill] {name} backfill finished: {total} rows.")
+            return total
+        total += count
+        after = last_id
+        await run_db(set_bot_setting, cursor_key, str(after))
+        # Leave pool connections for live traffic between batches
+        await asyncio.sleep(pause)
+
+
+async def backfill_quiz_answers(batch_size: int = BACKFILL_BATCH_SIZE, pause: float = BACKFILL_PAUSE_SECONDS) -> int:
+    """Copies answers of all completed quizzes into quiz_answers. Returns the number of answers added."""
+    return await _run_backfill("quiz_answers", backfill_quiz_answers_batch, QUIZ_ANSWERS_CURSOR_KEY, batch_size, pause)
+
+
+async def backfill_user_aggregates(batch_size: int = BACKFILL_BATCH_SIZE, pause: float = BACKFILL_PAUSE_SECONDS) -> int:
+    """Rebuilds user_quiz_aggregates / user_quiz_daily for every student. Returns the number of students.
+
+    Stats and leaderboards keep using quiz_results until this has finished once
+    (DatabaseManager.user_aggregates_ready).
+    """
+    return await _run_backfill("user_quiz_aggregates", backfill_user_aggregates_batch, USER_AGGREGATES_CURSOR_KEY, batch_size, pause)
+
+
+async def backfill_job(context) -> None:
+    """JobQueue callback (run once after startup)."""
+    for backfill in (backfill_user_aggregates, backfill_quiz_answers):
+        try:
+            await backfill()
+        except Exception as e:
+            logger.error(f"[Backfill] {backfill.__name__} failed: {e}", exc_info=True)
+
+
+def schedule_backfills(application) -> None:
+    """Schedules the one-off history backfill a little after startup."""
+    if application.job_queue:
+        application.job_queue.run_once(backfill_job, when=BACKFILL_START_DELAY, name="db_history_backfill")
+    else:
+        logger.warning("[Backfill] No JobQueue; history backfill not scheduled.")
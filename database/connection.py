@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
-"""Handles database connection setup."""
+"""Handles database connection setup.
+
+connect_db() opens a single raw psycopg2 connection (caller closes it).
+get_pooled_connection() / release_connection() borrow from a process-wide
+bounded pool so hot paths (database/manager.py) reuse authenticated SSL
+connections instead of paying a full handshake per statement.
+"""
 
 import psycopg2
+import psycopg2.extensions
 import logging
+import threading
+import time
+from collections import deque
 from urllib.parse import urlparse
 
 # Import config variables
@@ -15,6 +25,18 @@ except ImportError:
     logger.error("Failed to import config. DATABASE_URL might be missing.")
     DATABASE_URL = None # Ensure it exists, even if None
 
+try:
+    from config import (
+        DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+        DB_POOL_MAX_LIFETIME, DB_POOL_HEALTHCHECK_IDLE
+    )
+except ImportError:
+    DB_POOL_MIN_SIZE = 1
+    DB_POOL_MAX_SIZE = 10
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_MAX_LIFETIME = 1800
+    DB_POOL_HEALTHCHECK_IDLE = 30
+
 def connect_db():
     """Connects to the PostgreSQL database using the DATABASE_URL from config."""
     if not DATABASE_URL:
@@ -51,6 +73,232 @@ def connect_db():
         logger.error(f"[DB Connection] Error parsing database URL: {e}")
         return None
 
+
+class ConnectionPool:
+    """Thread-safe bounded pool of psycopg2 connections.
+
+    - At most ``max_size`` connections exist at once; callers wait up to
+      ``timeout`` seconds for a free one and get None on exhaustion.
+    - Connections older than ``max_lifetime`` are closed and replaced.
+    - Connections idle longer than ``healthcheck_idle`` are pinged with
+      ``SELECT 1`` before being handed out.
+    """
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.healthcheck_idle = healthcheck_idle
+
+        self._cond = threading.Condition()
+        self._idle = deque()      # (conn, last_used) — most recently used on the right
+        self._created_at = {}     # conn -> monotonic creation time
+        self._size = 0            # idle + checked out + being opened
+        self._closed = False
+        self._stats = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "recycled_max_lifetime": 0,
+            "healthcheck_failures": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "exhausted": 0,
+            "total_wait_seconds": 0.0,
+        }
+
+    # --- internal helpers ---
+    def _open(self):
+        conn = connect_db()
+        if conn is not None:
+            with self._cond:
+                self._created_at[conn] = time.monotonic()
+                self._stats["connections_opened"] += 1
+        return conn
+
+    def _discard(self, conn):
+        """Closes a connection and frees its slot in the pool."""
+        try:
+            if conn is not None and not conn.closed:
+                conn.close()
+        except Exception as e:
+            logger.debug(f"[DB Pool] Error closing connection: {e}")
+        with self._cond:
+            self._created_at.pop(conn, None)
+            self._size -= 1
+            self._stats["connections_closed"] += 1
+            self._cond.notify()
+
+    def _is_expired(self, conn):
+        created = self._created_at.get(conn)
+        return created is None or (self.max_lifetime and time.monotonic() - created > self.max_lifetime)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"[DB Pool] Health check failed, replacing connection: {e}")
+            with self._cond:
+                self._stats["healthcheck_failures"] += 1
+            return False
+
+    # --- public API ---
+    def getconn(self):
+        """Borrows a connection, opening one if below max_size. Returns None on failure/exhaustion."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        entry = None
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1 # Reserve the slot before opening outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["exhausted"] += 1
+                    logger.warning(f"[DB Pool] Pool exhausted: {self._size}/{self.max_size} connections busy for {self.timeout}s.")
+                    return None
+                if not waited:
+                    self._stats["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._stats["checkouts"] += 1
+            self._stats["total_wait_seconds"] += time.monotonic() - started
+
+        if entry is not None:
+            conn, last_used = entry
+            if self._is_expired(conn):
+                with self._cond:
+                    self._stats["recycled_max_lifetime"] += 1
+            elif self._is_healthy(conn, last_used):
+                return conn
+            # Replace the stale connection but keep its slot
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self._cond:
+                self._created_at.pop(conn, None)
+                self._stats["connections_closed"] += 1
+
+        conn = self._open()
+        if conn is None:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Returns a borrowed connection; broken, expired or closed-pool connections are closed instead."""
+        if conn is None:
+            return
+        if discard or self._closed or conn.closed or self._is_expired(conn):
+            if not conn.closed and self._is_expired(conn):
+                with self._cond:
+                    self._stats["recycled_max_lifetime"] += 1
+            self._discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback() # Never hand out a connection with an open/aborted transaction
+        except Exception as e:
+            logger.warning(f"[DB Pool] Could not reset connection state, discarding: {e}")
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def warm_up(self):
+        """Opens min_size connections ahead of the first request."""
+        conns = [self.getconn() for _ in range(self.min_size)]
+        for conn in conns:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+        logger.info("[DB Pool] Connection pool closed.")
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+            })
+        checkouts = stats["checkouts"]
+        stats["avg_wait_ms"] = round(stats.pop("total_wait_seconds") / checkouts * 1000, 2) if checkouts else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the process-wide ConnectionPool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+                logger.info(f"[DB Pool] Created connection pool (min={_pool.min_size}, max={_pool.max_size}, lifetime={_pool.max_lifetime}s).")
+    return _pool
+
+def get_pooled_connection():
+    """Borrows a connection from the shared pool. Must be returned with release_connection()."""
+    if not DATABASE_URL:
+        logger.error("[DB Connection] DATABASE_URL is not set. Cannot connect.")
+        return None
+    return get_pool().getconn()
+
+def release_connection(conn, discard=False):
+    """Returns a connection obtained from get_pooled_connection() to the pool (closes it if the pool is already closed)."""
+    if conn is None:
+        return
+    pool = _pool
+    if pool is None:
+        # Late release after close_pool(): don't create a new pool for a connection it never issued
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f"[DB Pool] Error closing connection released after pool shutdown: {e}")
+        return
+    pool.putconn(conn, discard=discard)
+
+def get_pool_stats() -> dict:
+    """Pool size, usage and exhaustion counters for monitoring."""
+    return get_pool().stats() if _pool is not None else {}
+
+def close_pool():
+    """Closes every pooled connection (call on shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
 # Optional: Test connection if run directly
 if __name__ == "__main__":
     logger.info("Attempting to connect to database directly...")
@@ -61,4 +309,3 @@ if __name__ == "__main__":
         logger.info("Direct connection closed.")
     else:
         logger.error("Direct connection failed.")
-
@@ -24,6 +24,7 @@ import uuid # Added for generating UUIDs
 try:
     from config import logger
     from .connection import connect_db # Assuming connection.py is in the same directory (database/)
+    from .connection import get_pooled_connection, release_connection
 except ImportError:
     logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger(__name__)
@@ -31,17 +32,44 @@ except ImportError:
     def connect_db(): # Dummy for fallback
         logger.error("Dummy connect_db called!")
         return None
+    def get_pooled_connection(): # Dummy for fallback
+        logger.error("Dummy get_pooled_connection called!")
+        return None
+    def release_connection(conn, discard=False): # Dummy for fallback
+        if conn:
+            conn.close()
+
+from .write_behind import touch_last_interaction
+from . import student_search
 
 class DatabaseManager:
     """Handles all database operations, including user data, quiz structure, and results."""
 
     def __init__(self):
         """Initializes the DatabaseManager."""
+        self._user_aggregates_ready = False
+        self._quiz_answers_ready = False
         logger.info("[DB Manager V18] Initialized.")
 
+    def user_aggregates_ready(self) -> bool:
+        """True once user_quiz_aggregates has been backfilled from history (cached after the first True)."""
+        if not self._user_aggregates_ready:
+            self._user_aggregates_ready = get_bot_setting(USER_AGGREGATES_CURSOR_KEY, None) == "done"
+        return self._user_aggregates_ready
+
+    def quiz_answers_ready(self) -> bool:
+        """True once quiz_answers has been backfilled from history (cached after the first True)."""
+        if not self._quiz_answers_ready:
+            self._quiz_answers_ready = get_bot_setting(QUIZ_ANSWERS_CURSOR_KEY, None) == "done"
+        return self._quiz_answers_ready
+
+    def _quiz_answers_source(self) -> str:
+        """quiz_answers، أو قبل اكتمال نسخ السجل القديم: answers_details مفكوكة بنفس الأعمدة حتى لا تنقص النتائج"""
+        return "quiz_answers" if self.quiz_answers_ready() else f"({_QUIZ_ANSWERS_FROM_DETAILS_SQL})"
+
     def _execute_query(self, query, params=None, fetch_one=False, fetch_all=False, commit=False):
-        """Helper function to execute database queries with connection handling."""
-        conn = connect_db()
+        """Helper function to execute database queries on a pooled connection."""
+        conn = get_pooled_connection()
         if not conn:
             logger.error("[DB Manager V18] Failed to get database connection for query.")
             return None
@@ -78,7 +106,7 @@ class DatabaseManager:
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_connection(conn)
 
     def register_or_update_user(self, user_id: int, first_name: str, last_name: str | None, username: str | None, language_code: str | None):
         logger.info(f"[DB User V18] Registering/updating user: id={user_id}, name={first_name}, username={username}")
@@ -156,8 +184,8 @@ class DatabaseManager:
     def start_quiz_session_and_get_id(self, user_id: int, quiz_type: str, quiz_scope_id: int | None, 
                                       quiz_name: str, total_questions: int, start_time: datetime, score: int, initial_percentage: float, initial_time_taken_seconds: int) -> str | None:
         logger.info(f"[DB Session V18] Starting new quiz session for user {user_id}, type: {quiz_type}, name: {quiz_name}, questions: {total_questions}")
-        # Ensure last_interaction_date is updated when a quiz starts
-        self.register_or_update_user(user_id, "", None, None, None) # Minimal update to touch last_interaction_date
+        # Ensure last_interaction_date is updated when a quiz starts (batched, see database/write_behind.py)
+        touch_last_interaction(user_id)
 
         session_uuid = str(uuid.uuid4())
         query_insert_start = """
@@ -187,8 +215,8 @@ class DatabaseManager:
                            user_id: int # Added user_id to update last_interaction_date
                            ):
         logger.info(f"[DB Results V18] Ending quiz session {quiz_session_uuid}: Score={score}, Wrong={wrong_answers}, Skipped={skipped_answers}, Percentage={score_percentage:.2f}%")
-        # Ensure last_interaction_date is updated when a quiz ends
-        self.register_or_update_user(user_id, "", None, None, None) # Minimal update to touch last_interaction_date
+        # Ensure last_interaction_date is updated when a quiz ends (batched, see database/write_behind.py)
+        touch_last_interaction(user_id)
 
         query_update_end = """
         UPDATE quiz_results 
@@ -205,26 +233,73 @@ class DatabaseManager:
         params = (score, wrong_answers, skipped_answers, score_percentage,
                   completed_at, time_taken_seconds, answers_details_json,
                   quiz_session_uuid)
-        success = self._execute_query(query_update_end, params, commit=True)
+        # تحديث النتيجة وتجميعات الطالب في نفس المعاملة (transaction)
+        success = None
+        conn = get_pooled_connection()
+        if not conn:
+            logger.error("[DB Results V18] Failed to get database connection for ending quiz session.")
+        else:
+            cur = None
+            try:
+                cur = conn.cursor()
+                # قفل لكل طالب حتى لا يتداخل التحديث مع إعادة بناء تجميعاته
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (user_id,))
+                cur.execute("SELECT result_id, completed_at FROM quiz_results WHERE quiz_id_uuid = %s FOR UPDATE", (quiz_session_uuid,))
+                previous = cur.fetchone()
+                cur.execute(query_update_end, params)
+                if cur.rowcount == 0:
+                    logger.warning(f"[DB Results V18] No quiz_results row found for session {quiz_session_uuid}; nothing to end.")
+                    conn.rollback()
+                else:
+                    result_id, previous_completed_at = previous
+                    if previous_completed_at is None:
+                        _add_result_to_user_aggregates(cur, result_id)
+                    else:
+                        # الاختبار انتهى سابقاً: إعادة حساب تجميعات الطالب بدل الإضافة مرتين
+                        _rebuild_user_aggregates(cur, [user_id])
+                    conn.commit()
+                    success = True
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f"[DB Results V18] Error ending quiz session {quiz_session_uuid}: {error}", exc_info=True)
+                conn.rollback()
+            finally:
+                if cur: cur.close()
+                release_connection(conn)
         if success:
             logger.info(f"[DB Results V18] Successfully updated (ended) quiz session {quiz_session_uuid} in DB.")
+            inserted = record_quiz_answers(quiz_session_uuid)
+            logger.info(f"[DB Results V18] Recorded {inserted} answers in quiz_answers for session {quiz_session_uuid}.")
         else:
             logger.error(f"[DB Results V18] Failed to update (end) quiz session {quiz_session_uuid} in DB.")
         return success
 
     def get_user_overall_stats(self, user_id: int):
         logger.info(f"[DB Stats V18] Fetching overall stats for user_id: {user_id}")
-        query = """
-        SELECT 
-            COUNT(result_id) as total_quizzes_taken,
-            COALESCE(SUM(score), 0) as total_correct_answers, 
-            COALESCE(SUM(total_questions), 0) as total_questions_attempted,
-            COALESCE(AVG(score_percentage), 0.0) as average_score_percentage,
-            COALESCE(MAX(score_percentage), 0.0) as highest_score_percentage,
-            COALESCE(SUM(time_taken_seconds), 0) as total_time_seconds
-        FROM quiz_results
-        WHERE user_id = %s AND completed_at IS NOT NULL;
-        """
+        if self.user_aggregates_ready():
+            # تجميعات محدثة عند إنهاء كل اختبار: قراءة صف واحد بالمفتاح
+            query = """
+            SELECT 
+                total_quizzes as total_quizzes_taken,
+                total_correct as total_correct_answers,
+                total_questions as total_questions_attempted,
+                avg_percentage as average_score_percentage,
+                max_percentage as highest_score_percentage,
+                total_time_seconds
+            FROM user_quiz_aggregates
+            WHERE user_id = %s;
+            """
+        else:
+            query = """
+            SELECT 
+                COUNT(result_id) as total_quizzes_taken,
+                COALESCE(SUM(score), 0) as total_correct_answers, 
+                COALESCE(SUM(total_questions), 0) as total_questions_attempted,
+                COALESCE(AVG(percentage), 0.0) as average_score_percentage,
+                COALESCE(MAX(percentage), 0.0) as highest_score_percentage,
+                COALESCE(SUM(time_taken_seconds), 0) as total_time_seconds
+            FROM quiz_results
+            WHERE user_id = %s AND completed_at IS NOT NULL;
+            """
         stats = self._execute_query(query, (user_id,), fetch_one=True)
         logger.info(f"[DB Stats V18] Raw overall stats for user {user_id}: {stats}")
         if stats and stats.get("total_quizzes_taken", 0) > 0:
@@ -270,21 +345,37 @@ class DatabaseManager:
 
     def get_leaderboard(self, limit: int = 10):
         logger.info(f"[DB Stats V18] Fetching top {limit} users for leaderboard.")
-        query = """
-        SELECT 
-            r.user_id,
-            COALESCE(u.full_name, u.username, u.first_name, CAST(r.user_id AS VARCHAR)) as user_display_name,
-            AVG(r.score_percentage) as average_score_percentage,
-            COUNT(r.result_id) as total_quizzes_taken,
-            SUM(r.score) as total_correct
-        FROM quiz_results r
-        LEFT JOIN users u ON r.user_id = u.user_id
-        WHERE r.completed_at IS NOT NULL AND r.score_percentage IS NOT NULL
-        GROUP BY r.user_id, u.full_name, u.username, u.first_name
-        HAVING COUNT(r.result_id) > 0 
-        ORDER BY average_score_percentage DESC, total_quizzes_taken DESC
-        LIMIT %s;
-        """
+        if self.user_aggregates_ready():
+            # أول {limit} صفوف من فهرس الترتيب بدل GROUP BY على كل النتائج
+            query = """
+            SELECT 
+                a.user_id,
+                COALESCE(u.full_name, u.username, u.first_name, CAST(a.user_id AS VARCHAR)) as user_display_name,
+                a.avg_percentage as average_score_percentage,
+                a.total_quizzes as total_quizzes_taken,
+                a.total_correct
+            FROM user_quiz_aggregates a
+            LEFT JOIN users u ON a.user_id = u.user_id
+            WHERE a.total_quizzes > 0
+            ORDER BY a.avg_percentage DESC, a.total_quizzes DESC
+            LIMIT %s;
+            """
+        else:
+            query = """
+            SELECT 
+                r.user_id,
+                COALESCE(u.full_name, u.username, u.first_name, CAST(r.user_id AS VARCHAR)) as user_display_name,
+                AVG(r.percentage) as average_score_percentage,
+                COUNT(r.result_id) as total_quizzes_taken,
+                SUM(r.score) as total_correct
+            FROM quiz_results r
+            LEFT JOIN users u ON r.user_id = u.user_id
+            WHERE r.completed_at IS NOT NULL AND r.percentage IS NOT NULL
+            GROUP BY r.user_id, u.full_name, u.username, u.first_name
+            HAVING COUNT(r.result_id) > 0 
+            ORDER BY average_score_percentage DESC, total_quizzes_taken DESC
+            LIMIT %s;
+            """
         leaderboard = self._execute_query(query, (limit,), fetch_all=True)
         logger.info(f"[DB Stats V18] Raw leaderboard data (limit {limit}): {leaderboard}")
         if leaderboard:
@@ -305,35 +396,69 @@ class DatabaseManager:
             Dict with rank, total_users, avg_score, total_quizzes
         """
         logger.info(f"[DB Rank] Fetching rank for user {user_id}, weekly={weekly}")
-        date_filter = "AND r.completed_at >= (CURRENT_DATE - INTERVAL '6 days')" if weekly else ""
-        query = f"""
-        WITH user_scores AS (
+        if self.user_aggregates_ready() and not weekly:
+            # المركز = 1 + عدد الطلاب الأعلى (نفس RANK() على avg ثم عدد الاختبارات):
+            # مقارنة الصف (avg, count) تُقرأ من فهرس idx_user_quiz_aggregates_rank وحده (index-only)
+            # وتتوقف عند صف الطالب، بدل تجميع الجدول كله في CTE لكل طلب
+            query = """
             SELECT 
-                r.user_id,
-                AVG(r.score_percentage) as avg_score,
-                COUNT(r.result_id) as total_quizzes,
-                SUM(r.score) as total_correct
-            FROM quiz_results r
-            WHERE r.completed_at IS NOT NULL 
-              AND r.score_percentage IS NOT NULL
-              {date_filter}
-            GROUP BY r.user_id
-            HAVING COUNT(r.result_id) > 0
-        ),
-        ranked AS (
+                (SELECT COUNT(*) FROM user_quiz_aggregates s
+                 WHERE (s.avg_percentage, s.total_quizzes) > (me.avg_percentage, me.total_quizzes)
+                   AND s.total_quizzes > 0) + 1 as rank,
+                (SELECT COUNT(*) FROM user_quiz_aggregates WHERE total_quizzes > 0) as total_users,
+                me.avg_percentage as avg_score, me.total_quizzes, me.total_correct
+            FROM user_quiz_aggregates me
+            WHERE me.user_id = %s AND me.total_quizzes > 0;
+            """
+        elif self.user_aggregates_ready():
+            # الأسبوعي: مجموع حاويات آخر 7 أيام (طلاب الأسبوع فقط، لا يمكن فهرسته مسبقاً)
+            query = """
+            WITH user_scores AS (
+                SELECT user_id, SUM(sum_percentage) / SUM(quizzes) as avg_score,
+                       SUM(quizzes) as total_quizzes, SUM(sum_score) as total_correct
+                FROM user_quiz_daily
+                WHERE day >= (CURRENT_DATE - INTERVAL '6 days')
+                GROUP BY user_id
+                HAVING SUM(quizzes) > 0
+            ),
+            me AS (SELECT * FROM user_scores WHERE user_id = %s)
             SELECT 
-                user_id,
-                avg_score,
-                total_quizzes,
-                total_correct,
-                RANK() OVER (ORDER BY avg_score DESC, total_quizzes DESC) as rank,
-                COUNT(*) OVER () as total_users
-            FROM user_scores
-        )
-        SELECT rank, total_users, avg_score, total_quizzes, total_correct
-        FROM ranked
-        WHERE user_id = %s;
-        """
+                (SELECT COUNT(*) FROM user_scores s
+                 WHERE (s.avg_score, s.total_quizzes) > (me.avg_score, me.total_quizzes)) + 1 as rank,
+                (SELECT COUNT(*) FROM user_scores) as total_users,
+                me.avg_score, me.total_quizzes, me.total_correct
+            FROM me;
+            """
+        else:
+            date_filter = "AND r.completed_at >= (CURRENT_DATE - INTERVAL '6 days')" if weekly else ""
+            query = f"""
+            WITH user_scores AS (
+                SELECT 
+                    r.user_id,
+                    AVG(r.percentage) as avg_score,
+                    COUNT(r.result_id) as total_quizzes,
+                    SUM(r.score) as total_correct
+                FROM quiz_results r
+                WHERE r.completed_at IS NOT NULL 
+                  AND r.percentage IS NOT NULL
+                  {date_filter}
+                GROUP BY r.user_id
+                HAVING COUNT(r.result_id) > 0
+            ),
+            ranked AS (
+                SELECT 
+                    user_id,
+                    avg_score,
+                    total_quizzes,
+                    total_correct,
+                    RANK() OVER (ORDER BY avg_score DESC, total_quizzes DESC) as rank,
+                    COUNT(*) OVER () as total_users
+                FROM user_scores
+            )
+            SELECT rank, total_users, avg_score, total_quizzes, total_correct
+            FROM ranked
+            WHERE user_id = %s;
+            """
         result = self._execute_query(query, (user_id,), fetch_one=True)
         if result:
             return result
@@ -460,28 +585,26 @@ class DatabaseManager:
 
     def get_detailed_question_stats(self, time_filter="all"):
         logger.info(f"[DB Admin Stats V18] Fetching detailed question stats for filter: {time_filter}")
-        time_condition = self._get_time_filter_condition(time_filter, "qr.completed_at")
+        time_condition = self._get_time_filter_condition(time_filter, "qa.answered_at")
+        if self.quiz_answers_ready():
+            text_column, texts_join, group_by = "qt.question_text", "JOIN", "qa.question_id, qt.question_text"
+        else:
+            # نصوص الأسئلة القديمة قد لا تكون في question_texts بعد: نأخذها من answers_details
+            text_column, texts_join, group_by = "MAX(COALESCE(NULLIF(qt.question_text, ''), qa.question_text))", "LEFT JOIN", "qa.question_id"
 
         query = f"""
-        WITH question_performance AS (
-            SELECT 
-                (answer_detail ->> 'question_id') as question_id_text, 
-                (answer_detail ->> 'question_text') as question_text, 
-                (answer_detail ->> 'is_correct')::boolean as is_correct,
-                (answer_detail ->> 'time_taken')::float as time_taken_seconds
-            FROM quiz_results qr, jsonb_array_elements(qr.answers_details) as answer_detail
-            WHERE qr.completed_at IS NOT NULL {time_condition} AND qr.answers_details IS NOT NULL AND jsonb_typeof(qr.answers_details) = 'array'
-        )
         SELECT 
-            qp.question_id_text, 
-            qp.question_text, 
+            qa.question_id as question_id_text, 
+            {text_column} as question_text, 
             COUNT(*) as times_answered, 
-            SUM(CASE WHEN qp.is_correct THEN 1 ELSE 0 END) as times_correct, 
-            SUM(CASE WHEN NOT qp.is_correct THEN 1 ELSE 0 END) as times_incorrect, 
-            AVG(qp.time_taken_seconds) as avg_time_seconds
-        FROM question_performance qp
-        WHERE qp.question_text IS NOT NULL AND qp.question_text <> '' -- Ensure question_text is present
-        GROUP BY qp.question_id_text, qp.question_text
+            SUM(CASE WHEN qa.is_correct THEN 1 ELSE 0 END) as times_correct, 
+            SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) as times_incorrect, 
+            AVG(qa.time_taken) as avg_time_seconds
+        FROM {self._quiz_answers_source()} qa
+        {texts_join} question_texts qt ON qt.question_id = qa.question_id
+        WHERE qa.answered_at IS NOT NULL {time_condition}
+        GROUP BY {group_by}
+        HAVING {text_column} IS NOT NULL AND {text_column} <> '' -- Ensure question_text is present
         ORDER BY times_incorrect DESC, times_answered DESC;
         """
         raw_results = self._execute_query(query, fetch_all=True)
@@ -517,31 +640,27 @@ class DatabaseManager:
             List of dicts with question_id, question_text, times_wrong, times_answered
         """
         logger.info(f"[DB Weakness] Fetching weak questions for user {user_id}, limit {limit}")
-        query = """
-        WITH user_answers AS (
+        query = f"""
+        WITH user_questions AS (
             SELECT 
-                (answer_detail ->> 'question_id') as question_id,
-                (answer_detail ->> 'question_text') as question_text,
-                (answer_detail ->> 'is_correct')::boolean as is_correct,
-                (answer_detail ->> 'status') as status
-            FROM quiz_results qr, jsonb_array_elements(qr.answers_details) as answer_detail
-            WHERE qr.user_id = %s 
-              AND qr.completed_at IS NOT NULL 
-              AND qr.answers_details IS NOT NULL 
-              AND jsonb_typeof(qr.answers_details) = 'array'
-              AND (answer_detail ->> 'status') = 'answered'
+                qa.question_id,
+                COUNT(*) as times_answered,
+                SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) as times_wrong
+            FROM {self._quiz_answers_source()} qa
+            WHERE qa.user_id = %s 
+              AND qa.status = 'answered'
+            GROUP BY qa.question_id
+            HAVING SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) > 0
         )
         SELECT 
-            question_id,
-            question_text,
-            COUNT(*) as times_answered,
-            SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) as times_wrong,
-            ROUND(SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END)::numeric / COUNT(*)::numeric * 100, 1) as error_rate
-        FROM user_answers
-        WHERE question_id IS NOT NULL
-        GROUP BY question_id, question_text
-        HAVING SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) > 0
-        ORDER BY error_rate DESC, times_wrong DESC
+            uq.question_id,
+            qt.question_text,
+            uq.times_answered,
+            uq.times_wrong,
+            ROUND(uq.times_wrong::numeric / uq.times_answered::numeric * 100, 1) as error_rate
+        FROM user_questions uq
+        LEFT JOIN question_texts qt ON qt.question_id = uq.question_id
+        ORDER BY error_rate DESC, uq.times_wrong DESC
         LIMIT %s;
         """
         results = self._execute_query(query, (user_id, limit), fetch_all=True)
@@ -561,31 +680,20 @@ class DatabaseManager:
             List of dicts with quiz_scope_id, quiz_type, total_wrong, total_answered, error_rate
         """
         logger.info(f"[DB Weakness] Fetching weakness by unit for user {user_id}")
-        query = """
-        WITH user_answers AS (
-            SELECT 
-                qr.quiz_scope_id,
-                qr.quiz_type,
-                (answer_detail ->> 'question_id') as question_id,
-                (answer_detail ->> 'is_correct')::boolean as is_correct,
-                (answer_detail ->> 'status') as status
-            FROM quiz_results qr, jsonb_array_elements(qr.answers_details) as answer_detail
-            WHERE qr.user_id = %s 
-              AND qr.completed_at IS NOT NULL 
-              AND qr.answers_details IS NOT NULL 
-              AND jsonb_typeof(qr.answers_details) = 'array'
-              AND (answer_detail ->> 'status') = 'answered'
-        )
+        query = f"""
         SELECT 
-            quiz_scope_id,
-            quiz_type,
+            qr.quiz_scope_id,
+            qr.quiz_type,
             COUNT(*) as total_answered,
-            SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) as total_wrong,
-            ROUND(SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END)::numeric / NULLIF(COUNT(*), 0)::numeric * 100, 1) as error_rate
-        FROM user_answers
-        WHERE quiz_scope_id IS NOT NULL
-        GROUP BY quiz_scope_id, quiz_type
-        HAVING SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) > 0
+            SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) as total_wrong,
+            ROUND(SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END)::numeric / NULLIF(COUNT(*), 0)::numeric * 100, 1) as error_rate
+        FROM {self._quiz_answers_source()} qa
+        JOIN quiz_results qr ON qr.result_id = qa.result_id
+        WHERE qa.user_id = %s 
+          AND qa.status = 'answered'
+          AND qr.quiz_scope_id IS NOT NULL
+        GROUP BY qr.quiz_scope_id, qr.quiz_type
+        HAVING SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) > 0
         ORDER BY error_rate DESC, total_wrong DESC;
         """
         results = self._execute_query(query, (user_id,), fetch_all=True)
@@ -604,27 +712,17 @@ class DatabaseManager:
             List of dicts with question_id, times_wrong
         """
         logger.info(f"[DB Weakness] Fetching weak questions for user {user_id}, scope {quiz_scope_id}")
-        query = """
-        WITH user_answers AS (
-            SELECT 
-                (answer_detail ->> 'question_id') as question_id,
-                (answer_detail ->> 'is_correct')::boolean as is_correct,
-                (answer_detail ->> 'status') as status
-            FROM quiz_results qr, jsonb_array_elements(qr.answers_details) as answer_detail
-            WHERE qr.user_id = %s 
-              AND qr.quiz_scope_id = %s
-              AND qr.completed_at IS NOT NULL 
-              AND qr.answers_details IS NOT NULL 
-              AND jsonb_typeof(qr.answers_details) = 'array'
-              AND (answer_detail ->> 'status') = 'answered'
-        )
+        query = f"""
         SELECT 
-            question_id,
-            SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) as times_wrong
-        FROM user_answers
-        WHERE question_id IS NOT NULL
-        GROUP BY question_id
-        HAVING SUM(CASE WHEN NOT is_correct THEN 1 ELSE 0 END) > 0
+            qa.question_id,
+            SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) as times_wrong
+        FROM {self._quiz_answers_source()} qa
+        JOIN quiz_results qr ON qr.result_id = qa.result_id
+        WHERE qa.user_id = %s 
+          AND qr.quiz_scope_id = %s
+          AND qa.status = 'answered'
+        GROUP BY qa.question_id
+        HAVING SUM(CASE WHEN NOT qa.is_correct THEN 1 ELSE 0 END) > 0
         ORDER BY times_wrong DESC
         LIMIT %s;
         """
@@ -714,23 +812,41 @@ class DatabaseManager:
             List of dicts with user info and scores
         """
         logger.info(f"[DB Leaderboard] Fetching weekly leaderboard, limit {limit}")
-        query = """
-        SELECT 
-            r.user_id,
-            COALESCE(u.full_name, u.username, u.first_name, CAST(r.user_id AS VARCHAR)) as user_display_name,
-            AVG(r.score_percentage) as average_score_percentage,
-            COUNT(r.result_id) as total_quizzes_taken,
-            SUM(r.score) as total_correct
-        FROM quiz_results r
-        LEFT JOIN users u ON r.user_id = u.user_id
-        WHERE r.completed_at IS NOT NULL 
-          AND r.score_percentage IS NOT NULL
-          AND r.completed_at >= (CURRENT_DATE - INTERVAL '6 days')
-        GROUP BY r.user_id, u.full_name, u.username, u.first_name
-        HAVING COUNT(r.result_id) > 0 
-        ORDER BY average_score_percentage DESC, total_quizzes_taken DESC
-        LIMIT %s;
-        """
+        if self.user_aggregates_ready():
+            # مجموع الحاويات اليومية لآخر 7 أيام (طلاب الأسبوع فقط)
+            query = """
+            SELECT 
+                d.user_id,
+                COALESCE(u.full_name, u.username, u.first_name, CAST(d.user_id AS VARCHAR)) as user_display_name,
+                SUM(d.sum_percentage) / SUM(d.quizzes) as average_score_percentage,
+                SUM(d.quizzes) as total_quizzes_taken,
+                SUM(d.sum_score) as total_correct
+            FROM user_quiz_daily d
+            LEFT JOIN users u ON d.user_id = u.user_id
+            WHERE d.day >= (CURRENT_DATE - INTERVAL '6 days')
+            GROUP BY d.user_id, u.full_name, u.username, u.first_name
+            HAVING SUM(d.quizzes) > 0 
+            ORDER BY average_score_percentage DESC, total_quizzes_taken DESC
+            LIMIT %s;
+            """
+        else:
+            query = """
+            SELECT 
+                r.user_id,
+                COALESCE(u.full_name, u.username, u.first_name, CAST(r.user_id AS VARCHAR)) as user_display_name,
+                AVG(r.percentage) as average_score_percentage,
+                COUNT(r.result_id) as total_quizzes_taken,
+                SUM(r.score) as total_correct
+            FROM quiz_results r
+            LEFT JOIN users u ON r.user_id = u.user_id
+            WHERE r.completed_at IS NOT NULL 
+              AND r.percentage IS NOT NULL
+              AND r.completed_at >= (CURRENT_DATE - INTERVAL '6 days')
+            GROUP BY r.user_id, u.full_name, u.username, u.first_name
+            HAVING COUNT(r.result_id) > 0 
+            ORDER BY average_score_percentage DESC, total_quizzes_taken DESC
+            LIMIT %s;
+            """
         leaderboard = self._execute_query(query, (limit,), fetch_all=True)
         logger.info(f"[DB Leaderboard] Weekly leaderboard: {len(leaderboard) if leaderboard else 0} users")
         return leaderboard if leaderboard else []
@@ -751,13 +867,16 @@ class DatabaseManager:
     def delete_user_account(self, user_id: int) -> dict:
         """حذف حساب المستخدم وجميع بياناته بالكامل"""
         logger.info(f"[DB Delete] Starting account deletion for user {user_id}")
-        conn = connect_db()
+        conn = get_pooled_connection()
         if not conn:
             return {'success': False, 'error': 'لا يوجد اتصال بقاعدة البيانات'}
         try:
             cur = conn.cursor()
             cur.execute("SELECT COUNT(*) FROM quiz_results WHERE user_id = %s", (user_id,))
             quiz_count = cur.fetchone()[0]
+            cur.execute("DELETE FROM quiz_answers WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM user_quiz_aggregates WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM user_quiz_daily WHERE user_id = %s", (user_id,))
             cur.execute("DELETE FROM quiz_results WHERE user_id = %s", (user_id,))
             cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
             conn.commit()
@@ -769,7 +888,7 @@ class DatabaseManager:
             return {'success': False, 'error': str(e)}
         finally:
             if cur: cur.close()
-            if conn: conn.close()
+            if conn: release_connection(conn)
 
 DB_MANAGER = DatabaseManager()
 logger.info("[DB Manager V18] Global DB_MANAGER instance created.")
@@ -778,13 +897,16 @@ logger.info("[DB Manager V18] Global DB_MANAGER instance created.")
 def delete_user_account(user_id):
     """حذف حساب المستخدم وجميع بياناته — دالة مستقلة"""
     logger.info(f"[DB Delete] Starting account deletion for user {user_id}")
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn:
         return {'success': False, 'error': 'لا يوجد اتصال بقاعدة البيانات'}
     try:
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM quiz_results WHERE user_id = %s", (user_id,))
         quiz_count = cur.fetchone()[0]
+        cur.execute("DELETE FROM quiz_answers WHERE user_id = %s", (user_id,))
+        cur.execute("DELETE FROM user_quiz_aggregates WHERE user_id = %s", (user_id,))
+        cur.execute("DELETE FROM user_quiz_daily WHERE user_id = %s", (user_id,))
         cur.execute("DELETE FROM quiz_results WHERE user_id = %s", (user_id,))
         cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
         conn.commit()
@@ -796,7 +918,7 @@ def delete_user_account(user_id):
         return {'success': False, 'error': str(e)}
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 # ============================================================
@@ -805,7 +927,7 @@ def delete_user_account(user_id):
 
 def ensure_exam_schedule_table():
     """إنشاء جدول مواعيد التحصيلي إذا ما كان موجود"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn:
         return
     try:
@@ -833,14 +955,12 @@ def ensure_exam_schedule_table():
         conn.rollback()
     finally:
         if cur: cur.close()
-        if conn: conn.close()
-
-ensure_exam_schedule_table()
+        if conn: release_connection(conn)
 
 
 def get_exam_periods(status_filter=None):
     """جلب فترات الاختبار"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return []
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -855,13 +975,13 @@ def get_exam_periods(status_filter=None):
         return []
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def add_exam_period(period_name, exam_start, exam_end, reg_boys=None, reg_girls=None,
                     late_reg=None, last_reg=None, status='active', notes=None):
     """إضافة فترة اختبار جديدة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -880,12 +1000,12 @@ def add_exam_period(period_name, exam_start, exam_end, reg_boys=None, reg_girls=
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def update_exam_period_status(period_id, new_status):
     """تغيير حالة فترة الاختبار"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -899,12 +1019,12 @@ def update_exam_period_status(period_id, new_status):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def delete_exam_period(period_id):
     """حذف فترة اختبار"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -917,7 +1037,7 @@ def delete_exam_period(period_id):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 # ============================================================
@@ -926,7 +1046,7 @@ def delete_exam_period(period_id):
 
 def ensure_deleted_accounts_table():
     """إنشاء جدول الحسابات المحذوفة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn:
         return
     try:
@@ -946,14 +1066,12 @@ def ensure_deleted_accounts_table():
         conn.rollback()
     finally:
         if cur: cur.close()
-        if conn: conn.close()
-
-ensure_deleted_accounts_table()
+        if conn: release_connection(conn)
 
 
 def record_account_deletion(user_id, full_name=None):
     """تسجيل حذف الحساب"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -966,12 +1084,12 @@ def record_account_deletion(user_id, full_name=None):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def check_deletion_cooldown(user_id, cooldown_days=7):
     """التحقق هل المستخدم حذف حسابه مؤخراً — يرجع None إذا مافي حظر"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return None
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1001,7 +1119,7 @@ def check_deletion_cooldown(user_id, cooldown_days=7):
         return None
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 # ============================================================
@@ -1010,7 +1128,7 @@ def check_deletion_cooldown(user_id, cooldown_days=7):
 
 def ensure_bot_settings_table():
     """إنشاء جدول إعدادات البوت"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn:
         return
     try:
@@ -1034,14 +1152,12 @@ def ensure_bot_settings_table():
         conn.rollback()
     finally:
         if cur: cur.close()
-        if conn: conn.close()
-
-ensure_bot_settings_table()
+        if conn: release_connection(conn)
 
 
 def get_bot_setting(key, default='off'):
     """جلب إعداد من جدول الإعدادات"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return default
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1053,12 +1169,12 @@ def get_bot_setting(key, default='off'):
         return default
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def set_bot_setting(key, value):
     """تعديل إعداد في جدول الإعدادات"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -1075,7 +1191,7 @@ def set_bot_setting(key, value):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 # ============================================================
@@ -1084,7 +1200,7 @@ def set_bot_setting(key, value):
 
 def ensure_study_tables():
     """إنشاء جداول خطط المذاكرة + جداول تتبع الإشعارات"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn:
         return
     try:
@@ -1152,14 +1268,12 @@ def ensure_study_tables():
         conn.rollback()
     finally:
         if cur: cur.close()
-        if conn: conn.close()
-
-ensure_study_tables()
+        if conn: release_connection(conn)
 
 
 def create_study_plan(user_id, subject, num_weeks, start_date, rest_days_list=None):
     """إنشاء خطة مذاكرة جديدة مع أيام الراحة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return None
     if rest_days_list is None:
         rest_days_list = []
@@ -1200,12 +1314,12 @@ def create_study_plan(user_id, subject, num_weeks, start_date, rest_days_list=No
         return None
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_active_study_plan(user_id):
     """جلب الخطة النشطة للمستخدم"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return None
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1221,12 +1335,12 @@ def get_active_study_plan(user_id):
         return None
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_study_plan_days(plan_id, week_number=None):
     """جلب أيام خطة المذاكرة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return []
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1247,12 +1361,12 @@ def get_study_plan_days(plan_id, week_number=None):
         return []
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def update_study_day(day_id, is_completed=True, pages=None, notes=None):
     """تحديث يوم في خطة المذاكرة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -1269,12 +1383,12 @@ def update_study_day(day_id, is_completed=True, pages=None, notes=None):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def toggle_study_day(day_id):
     """تبديل حالة يوم (تم/لم يتم)"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -1292,12 +1406,12 @@ def toggle_study_day(day_id):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_study_plan_stats(plan_id):
     """إحصائيات خطة المذاكرة — تستثني أيام الراحة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return {}
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1328,12 +1442,12 @@ def get_study_plan_stats(plan_id):
         return {}
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def delete_study_plan(plan_id):
     """حذف خطة مذاكرة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -1346,12 +1460,12 @@ def delete_study_plan(plan_id):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_study_schedule_report(only_my_students=False):
     """تقرير شامل عن استخدام جداول المذاكرة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return []
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1393,7 +1507,7 @@ def get_study_schedule_report(only_my_students=False):
         return []
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 # ============================================================
@@ -1402,7 +1516,7 @@ def get_study_schedule_report(only_my_students=False):
 
 def create_broadcast_record(message_text, target_type='all', target_filter=None, sent_count=0):
     """تسجيل إشعار جديد"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return None
     try:
         cur = conn.cursor()
@@ -1420,12 +1534,12 @@ def create_broadcast_record(message_text, target_type='all', target_filter=None,
         return None
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def record_broadcast_read(broadcast_id, user_id):
     """تسجيل قراءة إشعار"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return False
     try:
         cur = conn.cursor()
@@ -1441,12 +1555,12 @@ def record_broadcast_read(broadcast_id, user_id):
         return False
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_broadcast_read_stats(broadcast_id):
     """إحصائيات قراءة إشعار معين"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return {}
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1483,12 +1597,12 @@ def get_broadcast_read_stats(broadcast_id):
         return {}
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def get_recent_broadcasts(limit=10):
     """قائمة آخر الإشعارات مع إحصائيات القراءة"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return []
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -1507,12 +1621,12 @@ def get_recent_broadcasts(limit=10):
         return []
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
 def auto_track_broadcast_read(user_id):
     """تسجيل قراءة تلقائية — يتحقق من إشعارات آخر 48 ساعة اللي ما قرأها المستخدم"""
-    conn = connect_db()
+    conn = get_pooled_connection()
     if not conn: return
     try:
         cur = conn.cursor()
@@ -1541,4 +1655,712 @@ def auto_track_broadcast_read(user_id):
         conn.rollback()
     finally:
         if cur: cur.close()
-        if conn: conn.close()
+        if conn: release_connection(conn)
+
+
+# ============================================================
+#  مهام الإرسال الجماعي (broadcast_jobs + broadcast_recipients)
+#  حالة كل مستلم محفوظة، فيُستأنف الإرسال بعد إعادة التشغيل من حيث توقف
+# ============================================================
+
+BROADCAST_JOB_UNFINISHED = ('queued', 'running')
+
+def ensure_broadcast_job_tables():
+    """إنشاء جداول مهام الإرسال + عمود is_active للمستخدمين الذين لا يمكن الوصول إليهم"""
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                kind VARCHAR(30) NOT NULL,
+                payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                total INTEGER NOT NULL DEFAULT 0,
+                admin_chat_id BIGINT,
+                progress_message_id BIGINT,
+                created_by BIGINT,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                user_id BIGINT NOT NULL,
+                payload JSONB,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                sent_at TIMESTAMPTZ,
+                PRIMARY KEY (job_id, seq)
+            );
+        """)
+        # الاستئناف يقرأ المستلمين المتبقين فقط
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending ON broadcast_recipients (job_id, seq) WHERE status = 'pending';")
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;")
+        conn.commit()
+        logger.info("[DB] broadcast_jobs & broadcast_recipients tables ensured")
+    except Exception as e:
+        logger.error(f"[DB] Error creating broadcast job tables: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def create_broadcast_job(kind, recipients, payload=None, admin_chat_id=None, progress_message_id=None, created_by=None):
+    """
+    إنشاء مهمة إرسال مع مستلميها في معاملة واحدة.
+    recipients: قائمة (user_id, payload أو None). يرجع رقم المهمة أو None عند الخطأ
+    """
+    conn = get_pooled_connection()
+    if not conn: return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO broadcast_jobs (kind, payload, status, total, admin_chat_id, progress_message_id, created_by)
+            VALUES (%s, %s::jsonb, 'running', %s, %s, %s, %s) RETURNING id
+        """, (kind, json.dumps(payload or {}, ensure_ascii=False), len(recipients),
+              admin_chat_id, progress_message_id, created_by))
+        job_id = cur.fetchone()[0]
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO broadcast_recipients (job_id, seq, user_id, payload) VALUES %s",
+            [(job_id, seq, user_id, json.dumps(item, ensure_ascii=False) if item is not None else None)
+             for seq, (user_id, item) in enumerate(recipients)],
+            template="(%s, %s, %s, %s::jsonb)",
+            page_size=1000,
+        )
+        conn.commit()
+        logger.info(f"[DB Broadcast] Job {job_id} ({kind}) created with {len(recipients)} recipients")
+        return job_id
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error creating {kind} job: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def get_unfinished_broadcast_jobs():
+    """مهام الإرسال التي لم تكتمل (للاستئناف بعد إعادة التشغيل)"""
+    conn = get_pooled_connection()
+    if not conn: return []
+    cur = None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("""
+            SELECT id, kind, payload, total, admin_chat_id, progress_message_id, created_by
+            FROM broadcast_jobs WHERE status IN %s ORDER BY id
+        """, (BROADCAST_JOB_UNFINISHED,))
+        return [dict(r) for r in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error loading unfinished jobs: {e}")
+        return []
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def get_pending_broadcast_recipients(job_id):
+    """المستلمون الذين لم يُرسل لهم بعد: [(seq, user_id, payload)]. None عند الخطأ"""
+    conn = get_pooled_connection()
+    if not conn: return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT seq, user_id, payload FROM broadcast_recipients
+            WHERE job_id = %s AND status = 'pending' ORDER BY seq
+        """, (job_id,))
+        return cur.fetchall()
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error loading pending recipients of job {job_id}: {e}")
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def record_broadcast_results(job_id, results, inactive_user_ids=()):
+    """
+    حفظ نتائج دفعة من المستلمين بجملة واحدة: results = [(seq, status, attempts, error)].
+    inactive_user_ids: مستخدمون لا يمكن الوصول إليهم (chat not found / حظر البوت) → is_active = FALSE
+    """
+    if not results:
+        return True
+    conn = get_pooled_connection()
+    if not conn: return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE broadcast_recipients AS r
+            SET status = v.status, attempts = v.attempts, error = v.error,
+                sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE r.sent_at END
+            FROM unnest(%s::int[], %s::text[], %s::int[], %s::text[]) AS v(seq, status, attempts, error)
+            WHERE r.job_id = %s AND r.seq = v.seq
+        """, ([r[0] for r in results], [r[1] for r in results], [r[2] for r in results],
+              [r[3] for r in results], job_id))
+        if inactive_user_ids:
+            cur.execute("UPDATE users SET is_active = FALSE WHERE user_id = ANY(%s::bigint[])",
+                        (sorted(set(inactive_user_ids)),))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error saving {len(results)} results of job {job_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def finish_broadcast_job(job_id, status='done'):
+    """إغلاق مهمة إرسال ويرجع ملخصها: عدد كل حالة + أول 15 فشل"""
+    conn = get_pooled_connection()
+    if not conn: return None
+    cur = None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("UPDATE broadcast_jobs SET status = %s, finished_at = NOW() WHERE id = %s", (status, job_id))
+        cur.execute("SELECT status, COUNT(*) AS cnt FROM broadcast_recipients WHERE job_id = %s GROUP BY status", (job_id,))
+        counts = {r['status']: r['cnt'] for r in cur.fetchall()}
+        cur.execute("""
+            SELECT user_id, payload, status, error FROM broadcast_recipients
+            WHERE job_id = %s AND status IN ('failed', 'inactive')
+            ORDER BY seq LIMIT 15
+        """, (job_id,))
+        failures = [dict(r) for r in cur.fetchall()]
+        conn.commit()
+        return {'counts': counts, 'failures': failures}
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error finishing job {job_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def set_broadcast_job_message(job_id, admin_chat_id, progress_message_id):
+    """رسالة التقدم الحالية للمهمة (تتغير عند الاستئناف)"""
+    conn = get_pooled_connection()
+    if not conn: return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE broadcast_jobs SET admin_chat_id = %s, progress_message_id = %s WHERE id = %s",
+                    (admin_chat_id, progress_message_id, job_id))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"[DB Broadcast] Error updating progress message of job {job_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+# ============================================================
+#  جدول إجابات الاختبارات (quiz_answers)
+#  صف لكل إجابة بدل فك answers_details (JSONB) في كل استعلام
+# ============================================================
+
+QUIZ_ANSWERS_CURSOR_KEY = "quiz_answers_backfill_cursor"
+
+# {where} يحدد صفوف quiz_results المصدر (اختبار واحد عند الإنهاء، أو دفعة في الـ backfill)
+_QUIZ_ANSWERS_INSERT_SQL = """
+    INSERT INTO quiz_answers (result_id, answer_index, user_id, question_id, is_correct, status, time_taken, answered_at)
+    SELECT
+        qr.result_id,
+        (ad.ord - 1)::int,
+        qr.user_id,
+        ad.value ->> 'question_id',
+        COALESCE(ad.value -> 'is_correct' = 'true'::jsonb, FALSE),
+        ad.value ->> 'status',
+        CASE WHEN jsonb_typeof(ad.value -> 'time_taken') = 'number' THEN (ad.value ->> 'time_taken')::real END,
+        qr.completed_at
+    FROM quiz_results qr
+    CROSS JOIN LATERAL jsonb_array_elements(
+        CASE WHEN jsonb_typeof(qr.answers_details) = 'array' THEN qr.answers_details ELSE '[]'::jsonb END
+    ) WITH ORDINALITY AS ad(value, ord)
+    WHERE {where}
+      AND qr.completed_at IS NOT NULL
+      AND jsonb_typeof(ad.value) = 'object'
+      AND (ad.value ->> 'question_id') IS NOT NULL
+    ON CONFLICT (result_id, answer_index) DO NOTHING;
+"""
+
+# قبل اكتمال الـ backfill: نفس صفوف quiz_answers (بنفس قواعد الإدراج أعلاه) مفكوكة من answers_details،
+# مع نص السؤال لأن question_texts قد لا يغطي السجل القديم بعد. شروط المستدعي (user_id ...) تُدفع إلى داخلها
+_QUIZ_ANSWERS_FROM_DETAILS_SQL = """
+    SELECT
+        qr.result_id,
+        (ad.ord - 1)::int AS answer_index,
+        qr.user_id,
+        ad.value ->> 'question_id' AS question_id,
+        COALESCE(ad.value -> 'is_correct' = 'true'::jsonb, FALSE) AS is_correct,
+        ad.value ->> 'status' AS status,
+        CASE WHEN jsonb_typeof(ad.value -> 'time_taken') = 'number' THEN (ad.value ->> 'time_taken')::real END AS time_taken,
+        qr.completed_at AS answered_at,
+        ad.value ->> 'question_text' AS question_text
+    FROM quiz_results qr
+    CROSS JOIN LATERAL jsonb_array_elements(
+        CASE WHEN jsonb_typeof(qr.answers_details) = 'array' THEN qr.answers_details ELSE '[]'::jsonb END
+    ) WITH ORDINALITY AS ad(value, ord)
+    WHERE qr.completed_at IS NOT NULL
+      AND jsonb_typeof(ad.value) = 'object'
+      AND (ad.value ->> 'question_id') IS NOT NULL
+"""
+
+_QUESTION_TEXTS_UPSERT_SQL = """
+    INSERT INTO question_texts (question_id, question_text, correct_option_text, updated_at)
+    SELECT DISTINCT ON (ad.value ->> 'question_id')
+        ad.value ->> 'question_id',
+        ad.value ->> 'question_text',
+        ad.value ->> 'correct_option_text',
+        NOW()
+    FROM quiz_results qr
+    CROSS JOIN LATERAL jsonb_array_elements(
+        CASE WHEN jsonb_typeof(qr.answers_details) = 'array' THEN qr.answers_details ELSE '[]'::jsonb END
+    ) AS ad(value)
+    WHERE {where}
+      AND jsonb_typeof(ad.value) = 'object'
+      AND (ad.value ->> 'question_id') IS NOT NULL
+      AND COALESCE(ad.value ->> 'question_text', '') <> ''
+    ORDER BY ad.value ->> 'question_id', COALESCE(ad.value ->> 'status' = 'answered', FALSE) DESC, qr.result_id DESC
+    ON CONFLICT (question_id) DO UPDATE
+        SET question_text = EXCLUDED.question_text,
+            correct_option_text = EXCLUDED.correct_option_text,
+            updated_at = NOW()
+        WHERE question_texts.question_text IS DISTINCT FROM EXCLUDED.question_text
+           OR question_texts.correct_option_text IS DISTINCT FROM EXCLUDED.correct_option_text;
+"""
+
+
+def ensure_quiz_answers_table():
+    """إنشاء جدول quiz_answers (صف لكل إجابة) وجدول نصوص الأسئلة مع الفهارس"""
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS quiz_answers (
+                result_id BIGINT NOT NULL,
+                answer_index INTEGER NOT NULL,
+                user_id BIGINT NOT NULL,
+                question_id VARCHAR(100) NOT NULL,
+                is_correct BOOLEAN NOT NULL DEFAULT FALSE,
+                status VARCHAR(40),
+                time_taken REAL,
+                answered_at TIMESTAMP,
+                PRIMARY KEY (result_id, answer_index)
+            );
+        """)
+        # نقاط ضعف الطالب + حذف الحساب
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_quiz_answers_user_status_question ON quiz_answers (user_id, status, question_id, is_correct);")
+        # إحصائيات الأسئلة والتقارير حسب الفترة
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_quiz_answers_answered_at ON quiz_answers (answered_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_quiz_answers_question_answered_at ON quiz_answers (question_id, answered_at);")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS question_texts (
+                question_id VARCHAR(100) PRIMARY KEY,
+                question_text TEXT,
+                correct_option_text TEXT,
+                updated_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+        conn.commit()
+        logger.info("[DB] quiz_answers & question_texts tables ensured")
+    except Exception as e:
+        logger.error(f"[DB] Error creating quiz_answers table: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def record_quiz_answers(quiz_session_uuid):
+    """نسخ إجابات اختبار منتهٍ من answers_details إلى quiz_answers. يرجع عدد الصفوف أو None عند الخطأ"""
+    conn = get_pooled_connection()
+    if not conn:
+        return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(_QUIZ_ANSWERS_INSERT_SQL.format(where="qr.quiz_id_uuid = %s"), (quiz_session_uuid,))
+        inserted = cur.rowcount
+        cur.execute(_QUESTION_TEXTS_UPSERT_SQL.format(where="qr.quiz_id_uuid = %s"), (quiz_session_uuid,))
+        conn.commit()
+        return inserted
+    except Exception as e:
+        logger.error(f"[DB QuizAnswers] Error recording answers for session {quiz_session_uuid}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def backfill_quiz_answers_batch(after_result_id=0, batch_size=500):
+    """يعبّئ quiz_answers لدفعة من quiz_results القديمة (بعد after_result_id).
+
+    يرجع (آخر result_id تمت معالجته، عدد الإجابات المضافة)، أو (None, 0) عند انتهاء
+    السجل، أو (after_result_id, None) عند الخطأ. آمن للتكرار (ON CONFLICT DO NOTHING).
+    """
+    conn = get_pooled_connection()
+    if not conn:
+        return after_result_id, None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT result_id FROM quiz_results
+            WHERE result_id > %s AND completed_at IS NOT NULL AND answers_details IS NOT NULL
+            ORDER BY result_id
+            LIMIT %s
+        """, (after_result_id, batch_size))
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            return None, 0
+        where = "qr.result_id = ANY(%s)"
+        cur.execute(_QUIZ_ANSWERS_INSERT_SQL.format(where=where), (ids,))
+        inserted = cur.rowcount
+        cur.execute(_QUESTION_TEXTS_UPSERT_SQL.format(where=where), (ids,))
+        conn.commit()
+        return ids[-1], inserted
+    except Exception as e:
+        logger.error(f"[DB QuizAnswers] Backfill batch after result_id {after_result_id} failed: {e}")
+        conn.rollback()
+        return after_result_id, None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+# ============================================================
+#  تجميعات الطالب (user_quiz_aggregates + user_quiz_daily)
+#  تُحدَّث عند إنهاء كل اختبار بدل إعادة تجميع quiz_results في كل طلب
+# ============================================================
+
+# v2: التجميعات تُحسب من عمود percentage الذي يكتبه end_quiz_session (كانت من score_percentage) فتُعاد من البداية
+USER_AGGREGATES_CURSOR_KEY = "user_quiz_aggregates_v2_backfill_cursor"
+
+
+def ensure_user_aggregates_tables():
+    """إنشاء جدول تجميعات الطالب وجدول الحاويات اليومية مع فهرس الترتيب"""
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_quiz_aggregates (
+                user_id BIGINT PRIMARY KEY,
+                total_quizzes INTEGER NOT NULL DEFAULT 0,
+                total_correct INTEGER NOT NULL DEFAULT 0,
+                total_questions INTEGER NOT NULL DEFAULT 0,
+                sum_percentage DOUBLE PRECISION NOT NULL DEFAULT 0,
+                avg_percentage DOUBLE PRECISION NOT NULL DEFAULT 0,
+                max_percentage DOUBLE PRECISION NOT NULL DEFAULT 0,
+                total_time_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                last_completed_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+        # ترتيب لوحة الصدارة ومركز الطالب
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_quiz_aggregates_rank ON user_quiz_aggregates (avg_percentage DESC, total_quizzes DESC);")
+        # حاويات يومية: لوحة الأسبوع = مجموع آخر 7 أيام
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_quiz_daily (
+                user_id BIGINT NOT NULL,
+                day DATE NOT NULL,
+                quizzes INTEGER NOT NULL DEFAULT 0,
+                sum_score INTEGER NOT NULL DEFAULT 0,
+                sum_percentage DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_quiz_daily_day ON user_quiz_daily (day);")
+        conn.commit()
+        logger.info("[DB] user_quiz_aggregates & user_quiz_daily tables ensured")
+    except Exception as e:
+        logger.error(f"[DB] Error creating user aggregates tables: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def _add_result_to_user_aggregates(cur, result_id):
+    """إضافة نتيجة اختبار منتهٍ إلى تجميعات صاحبها (داخل معاملة المستدعي)؛ النتيجة بلا percentage لا تُحسب، كاستعلامات الترتيب"""
+    cur.execute("""
+        INSERT INTO user_quiz_aggregates AS a (
+            user_id, total_quizzes, total_correct, total_questions, sum_percentage,
+            avg_percentage, max_percentage, total_time_seconds, last_completed_at, updated_at
+        )
+        SELECT user_id, 1, COALESCE(score, 0), COALESCE(total_questions, 0), COALESCE(percentage, 0),
+               COALESCE(percentage, 0), COALESCE(percentage, 0), COALESCE(time_taken_seconds, 0), completed_at, NOW()
+        FROM quiz_results
+        WHERE result_id = %s AND completed_at IS NOT NULL AND percentage IS NOT NULL
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_quizzes = a.total_quizzes + 1,
+            total_correct = a.total_correct + EXCLUDED.total_correct,
+            total_questions = a.total_questions + EXCLUDED.total_questions,
+            sum_percentage = a.sum_percentage + EXCLUDED.sum_percentage,
+            avg_percentage = (a.sum_percentage + EXCLUDED.sum_percentage) / (a.total_quizzes + 1),
+            max_percentage = GREATEST(a.max_percentage, EXCLUDED.max_percentage),
+            total_time_seconds = a.total_time_seconds + EXCLUDED.total_time_seconds,
+            last_completed_at = GREATEST(a.last_completed_at, EXCLUDED.last_completed_at),
+            updated_at = NOW();
+    """, (result_id,))
+    cur.execute("""
+        INSERT INTO user_quiz_daily AS d (user_id, day, quizzes, sum_score, sum_percentage)
+        SELECT user_id, completed_at::date, 1, COALESCE(score, 0), COALESCE(percentage, 0)
+        FROM quiz_results
+        WHERE result_id = %s AND completed_at IS NOT NULL AND percentage IS NOT NULL
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            quizzes = d.quizzes + 1,
+            sum_score = d.sum_score + EXCLUDED.sum_score,
+            sum_percentage = d.sum_percentage + EXCLUDED.sum_percentage;
+    """, (result_id,))
+
+
+def _rebuild_user_aggregates(cur, user_ids):
+    """إعادة حساب تجميعات مجموعة طلاب من quiz_results (داخل معاملة المستدعي)"""
+    cur.execute("DELETE FROM user_quiz_aggregates WHERE user_id = ANY(%s)", (list(user_ids),))
+    cur.execute("""
+        INSERT INTO user_quiz_aggregates (
+            user_id, total_quizzes, total_correct, total_questions, sum_percentage,
+            avg_percentage, max_percentage, total_time_seconds, last_completed_at, updated_at
+        )
+        SELECT user_id, COUNT(*), COALESCE(SUM(score), 0), COALESCE(SUM(total_questions), 0),
+               COALESCE(SUM(percentage), 0), COALESCE(SUM(percentage), 0) / COUNT(*),
+               COALESCE(MAX(percentage), 0), COALESCE(SUM(time_taken_seconds), 0), MAX(completed_at), NOW()
+        FROM quiz_results
+        WHERE user_id = ANY(%s) AND completed_at IS NOT NULL AND percentage IS NOT NULL
+        GROUP BY user_id;
+    """, (list(user_ids),))
+    cur.execute("DELETE FROM user_quiz_daily WHERE user_id = ANY(%s)", (list(user_ids),))
+    cur.execute("""
+        INSERT INTO user_quiz_daily (user_id, day, quizzes, sum_score, sum_percentage)
+        SELECT user_id, completed_at::date, COUNT(*), COALESCE(SUM(score), 0), COALESCE(SUM(percentage), 0)
+        FROM quiz_results
+        WHERE user_id = ANY(%s) AND completed_at IS NOT NULL AND percentage IS NOT NULL
+        GROUP BY user_id, completed_at::date;
+    """, (list(user_ids),))
+
+
+def backfill_user_aggregates_batch(after_user_id=0, batch_size=500):
+    """يعيد بناء تجميعات دفعة من الطلاب (بعد after_user_id) من quiz_results.
+
+    نفس عقد backfill_quiz_answers_batch: (آخر user_id، عدد الطلاب)، (None, 0) عند
+    الانتهاء، أو (after_user_id, None) عند الخطأ.
+    """
+    conn = get_pooled_connection()
+    if not conn:
+        return after_user_id, None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT DISTINCT user_id FROM quiz_results
+            WHERE user_id > %s AND completed_at IS NOT NULL
+            ORDER BY user_id
+            LIMIT %s
+        """, (after_user_id, batch_size))
+        user_ids = [row[0] for row in cur.fetchall()]
+        if not user_ids:
+            return None, 0
+        # نفس قفل end_quiz_session، بترتيب ثابت لتجنب الـ deadlock
+        cur.execute("SELECT pg_advisory_xact_lock(u) FROM unnest(%s::bigint[]) AS u ORDER BY u", (user_ids,))
+        _rebuild_user_aggregates(cur, user_ids)
+        conn.commit()
+        return user_ids[-1], len(user_ids)
+    except Exception as e:
+        logger.error(f"[DB Aggregates] Backfill batch after user_id {after_user_id} failed: {e}")
+        conn.rollback()
+        return after_user_id, None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+# ============================================================
+#  بحث الطلاب للأدمن (database/student_search.py)
+#  فهارس trigram على الاسم المطبّع + البريد + الجوال، والتجميعات من user_quiz_aggregates
+# ============================================================
+
+_student_search_trgm = False
+
+def ensure_student_search_indexes():
+    """إنشاء دوال التطبيع وفهارس البحث (pg_trgm إن أمكن، وإلا فهرس tsvector للبادئات)"""
+    global _student_search_trgm
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        _student_search_trgm = student_search.create_search_objects(cur)
+        conn.commit()
+        logger.info(f"[DB] Student search indexes ensured ({'pg_trgm' if _student_search_trgm else 'tsvector prefix only'})")
+    except Exception as e:
+        logger.error(f"[DB] Error creating student search indexes: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def search_students(query, limit=10):
+    """بحث مرتّب بالاسم (مع التطبيع) أو البريد أو الجوال أو رقم ID. يرجع قائمة صفوف أو None عند الخطأ"""
+    conn = get_pooled_connection()
+    if not conn: return None
+    cur = None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        rows = student_search.search_students(cur, query, limit, trgm=_student_search_trgm,
+                                              aggregates_ready=DB_MANAGER.user_aggregates_ready())
+        return [dict(r) for r in rows]
+    except Exception as e:
+        logger.error(f"[DB Search] Error searching students for {query!r}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+# ============================================================
+#  كاش file_id لصور الأسئلة والخيارات (utils/image_cache.py)
+#  الكتابة عبر قناة image_file_id في write_behind
+# ============================================================
+
+def ensure_telegram_image_cache_table():
+    """إنشاء جدول الربط بين رابط الصورة و file_id الخاص بتيليجرام"""
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_image_cache (
+                url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                content_hash TEXT,
+                checked_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_telegram_image_cache_hash ON telegram_image_cache (content_hash)")
+        conn.commit()
+        logger.info("[DB] telegram_image_cache table ensured")
+    except Exception as e:
+        logger.error(f"[DB] Error creating telegram_image_cache table: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def ensure_report_rollup_tables():
+    """إنشاء جداول اللقطات اليومية للتقرير الأسبوعي (final_weekly_report.close_report_days)"""
+    conn = get_pooled_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS report_daily_user_stats (
+                day DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                quiz_count INTEGER NOT NULL,
+                percentage_count INTEGER NOT NULL,
+                percentage_sum DOUBLE PRECISION NOT NULL,
+                positive_count INTEGER NOT NULL,
+                positive_sum DOUBLE PRECISION NOT NULL,
+                percentage_min DOUBLE PRECISION,
+                percentage_max DOUBLE PRECISION,
+                questions_sum DOUBLE PRECISION NOT NULL,
+                time_count INTEGER NOT NULL,
+                time_sum DOUBLE PRECISION NOT NULL,
+                last_completed_at TIMESTAMPTZ,
+                PRIMARY KEY (day, user_id)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS report_daily_question_stats (
+                day DATE NOT NULL,
+                question_id VARCHAR(100) NOT NULL,
+                total_attempts INTEGER NOT NULL,
+                correct_attempts INTEGER NOT NULL,
+                wrong_attempts INTEGER NOT NULL,
+                skipped_count INTEGER NOT NULL,
+                first_answer BIGINT[] NOT NULL,
+                wrong_answers TEXT[] NOT NULL,
+                wrong_answer_ids BIGINT[] NOT NULL,
+                PRIMARY KEY (day, question_id)
+            )
+        """)
+        conn.commit()
+        logger.info("[DB] report rollup tables ensured")
+    except Exception as e:
+        logger.error(f"[DB] Error creating report rollup tables: {e}")
+        conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def get_telegram_image_cache():
+    """كل الصور المرفوعة: [(url, file_id, content_hash, checked_at epoch)] أو None عند الخطأ"""
+    conn = get_pooled_connection()
+    if not conn: return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT url, file_id, content_hash, EXTRACT(EPOCH FROM checked_at)::float8
+            FROM telegram_image_cache
+        """)
+        return cur.fetchall()
+    except Exception as e:
+        logger.error(f"[DB] Error loading telegram_image_cache: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        if conn: release_connection(conn)
+
+
+def ensure_database_schema():
+    """Creates or migrates every table, function and index used by this module.
+
+    Called once from the bot's post_init, never at import time, so importing
+    database.manager (for example when a chart worker re-imports bot.py) has no
+    DDL or connection side effects.
+    """
+    ensure_exam_schedule_table()
+    ensure_deleted_accounts_table()
+    ensure_bot_settings_table()
+    ensure_study_tables()
+    ensure_broadcast_job_tables()
+    ensure_quiz_answers_table()
+    ensure_user_aggregates_tables()
+    ensure_student_search_indexes()
+    ensure_telegram_image_cache_table()
+    ensure_report_rollup_tables()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""Postgres-backed persistence for python-telegram-bot.
+
+Replaces the single persistence/bot_conversation_persistence.pkl file, which
+PicklePersistence rewrites in full whenever any user's data changes. Here
+every user_data / chat_data entry is its own row in ``bot_persistence``:
+
+- Only dirty keys are written: each entry is pickled when PTB hands it over
+  and skipped if the bytes match what was last written.
+- Writes are batched: changes collected during one PTB update cycle go out
+  as a single multi-row upsert (plus one multi-row delete) after
+  PERSISTENCE_BATCH_DELAY seconds, on the DB executor.
+- user_data / chat_data are loaded lazily: nothing per-user is read at
+  startup; a user's row is read the first time PTB refreshes that user's
+  data (i.e. their first update after a restart).
+- On first start against an empty table the old pickle file is imported once.
+- Each user's data is compacted (compact_user_data) when it is first loaded,
+  converting entries written before questions were stored as IDs.
+
+Note: because of lazy loading, ``application.user_data`` only holds users
+seen since the last restart.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import psycopg2
+import psycopg2.extras
+from telegram.ext import BasePersistence, PersistenceInput
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_BATCH_DELAY
+except ImportError:
+    PERSISTENCE_UPDATE_INTERVAL = 30
+    PERSISTENCE_BATCH_DELAY = 1.0
+
+try:
+    from config import DB_WRITE_TIMEOUT
+except ImportError:
+    DB_WRITE_TIMEOUT = 30
+
+from .connection import get_pooled_connection, release_connection
+from .async_manager import run_db
+from utils.persistence_report import compact_user_data
+
+TABLE_NAME = "bot_persistence"
+
+KIND_USER = "user_data"
+KIND_CHAT = "chat_data"
+KIND_BOT = "bot_data"
+KIND_CALLBACK = "callback_data"
+_SINGLETON_KEY = ""
+
+_DELETE = object()  # pending-write marker for a dropped key
+
+
+def _conversation_kind(name: str) -> str:
+    return f"conversation:{name}"
+
+
+def _dumps(value, label):
+    try:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        logger.error(f"[Persistence] Could not pickle {label}: {e}. Entry not saved.")
+        return None
+
+
+def _loads(blob, label, default=None):
+    try:
+        return pickle.loads(bytes(blob))
+    except Exception as e:
+        logger.error(f"[Persistence] Could not unpickle {label}: {e}. Using default.")
+        return default
+
+
+def _digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+# --- blocking storage helpers (run on the DB executor) ---
+
+def ensure_persistence_table() -> bool:
+    """Creates the bot_persistence table if needed."""
+    conn = get_pooled_connection()
+    if not conn:
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                kind VARCHAR(100) NOT NULL,
+                key VARCHAR(200) NOT NULL,
+                data BYTEA NOT NULL,
+                updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (kind, key)
+            );
+        """)
+        conn.commit()
+        logger.info(f"[Persistence] {TABLE_NAME} table ensured")
+        return True
+    except Exception as e:
+        logger.error(f"[Persistence] Error creating {TABLE_NAME} table: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur: cur.close()
+        release_connection(conn)
+
+
+def _select_rows(kind, key=None):
+    """[(key, data)] for one kind (optionally one key). Returns None on error."""
+    conn = get_pooled_connection()
+    if not conn:
+        return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        if key is None:
+            cur.execute(f"SELECT key, data FROM {TABLE_NAME} WHERE kind = %s", (kind,))
+        else:
+            cur.execute(f"SELECT key, data FROM {TABLE_NAME} WHERE kind = %s AND key = %s", (kind, key))
+        return cur.fetchall()
+    except Exception as e:
+        logger.error(f"[Persistence] Error reading {kind}/{key}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        release_connection(conn)
+
+
+def _table_is_empty():
+    conn = get_pooled_connection()
+    if not conn:
+        return None
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SELECT 1 FROM {TABLE_NAME} LIMIT 1")
+        return cur.fetchone() is None
+    except Exception as e:
+        logger.error(f"[Persistence] Error checking {TABLE_NAME}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if cur: cur.close()
+        release_connection(conn)
+
+
+def _write_batch(upserts, deletes) -> bool:
+    """One transaction: multi-row upsert of [(kind, key, bytes)] and multi-row delete of [(kind, key)]."""
+    conn = get_pooled_connection()
+    if not conn:
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        if upserts:
+            psycopg2.extras.execute_values(
+                cur,
+                f"""INSERT INTO {TABLE_NAME} (kind, key, data, updated_at) VALUES %s
+                    ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()""",
+                [(kind, key, psycopg2.Binary(blob)) for kind, key, blob in upserts],
+                template="(%s, %s, %s, NOW())",
+                page_size=500,
+            )
+        if deletes:
+            psycopg2.extras.execute_values(
+                cur,
+                f"""DELETE FROM {TABLE_NAME} AS t USING (VALUES %s) AS d(kind, key)
+                    WHERE t.kind = d.kind AND t.key = d.key""",
+                deletes,
+                page_size=500,
+            )
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"[Persistence] Batch write failed ({len(upserts)} upserts, {len(deletes)} deletes): {e}")
+        conn.rollback()
+        return False
+    finally:
+        if cur: cur.close()
+        release_connection(conn)
+
+
+class PostgresPersistence(BasePersistence):
+    """BasePersistence storing each user/chat/conversation entry as its own row in Postgres."""
+
+    def __init__(self, store_data: PersistenceInput = None, update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+                 batch_delay: float = PERSISTENCE_BATCH_DELAY, legacy_pickle_path: str = None):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.batch_delay = batch_delay
+        self.legacy_pickle_path = legacy_pickle_path
+        self._ready = False
+        self._ready_lock = asyncio.Lock()
+        self._written = {}        # (kind, key) -> digest of the last bytes written / read
+        self._loaded = set()      # (kind, key) whose stored row has been merged into memory
+        self._pending = {}        # (kind, key) -> bytes, or _DELETE
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+        self._stats = {
+            "lazy_loads": 0,
+            "writes": 0,
+            "deletes": 0,
+            "skipped_unchanged": 0,
+            "batches": 0,
+            "failed_batches": 0,
+        }
+
+    # --- setup ---
+    async def _ensure_ready(self):
+        if self._ready:
+            return
+        async with self._ready_lock:
+            if self._ready:
+                return
+            if not await run_db(ensure_persistence_table, default=False):
+                raise RuntimeError(f"[Persistence] {TABLE_NAME} table is not available.")
+            if self.legacy_pickle_path and os.path.exists(self.legacy_pickle_path):
+                if await run_db(_table_is_empty, default=False):
+                    await self._import_legacy_pickle(self.legacy_pickle_path)
+            self._ready = True
+
+    async def _import_legacy_pickle(self, path):
+        """One-time import of a PicklePersistence file (single-file mode) into the table."""
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.error(f"[Persistence] Could not read legacy pickle {path}: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        try:
+            from utils.persistence_report import compact_user_data
+        except ImportError:
+            compact_user_data = None
+
+        upserts = []
+        for user_id, user_data in (data.get("user_data") or {}).items():
+            if compact_user_data and isinstance(user_data, dict):
+                user_data = compact_user_data(user_data)
+            blob = _dumps(user_data, f"legacy user_data {user_id}")
+            if blob is not None:
+                upserts.append((KIND_USER, str(user_id), blob))
+        for chat_id, chat_data in (data.get("chat_data") or {}).items():
+            blob = _dumps(chat_data, f"legacy chat_data {chat_id}")
+            if blob is not None:
+                upserts.append((KIND_CHAT, str(chat_id), blob))
+        if data.get("bot_data"):
+            blob = _dumps(data["bot_data"], "legacy bot_data")
+            if blob is not None:
+                upserts.append((KIND_BOT, _SINGLETON_KEY, blob))
+        for name, states in (data.get("conversations") or {}).items():
+            for conv_key, state in states.items():
+                blob = _dumps(state, f"legacy conversation {name}")
+                if blob is not None:
+                    upserts.append((_conversation_kind(name), json.dumps(list(conv_key)), blob))
+
+        if await run_db(_write_batch, upserts, [], timeout=max(DB_WRITE_TIMEOUT, 120), default=False):
+            logger.info(f"[Persistence] Imported {len(upserts)} entries from legacy pickle {path}.")
+        else:
+            logger.error(f"[Persistence] Import of legacy pickle {path} failed; starting empty.")
+
+    # --- loading ---
+    async def _load_one(self, kind, key, default=None):
+        """Reads one entry. Returns (found, value); found is None if the read failed."""
+        rows = await run_db(_select_rows, kind, key, default=None)
+        if rows is None:
+            return None, default
+        if not rows:
+            return False, default
+        blob = bytes(rows[0][1])
+        self._written[(kind, key)] = _digest(blob)
+        return True, _loads(blob, f"{kind}/{key}", default)
+
+    async def _merge_stored(self, kind, key, live: dict) -> bool:
+        """Fills keys missing from the live dict with the stored ones (live values win)."""
+        if (kind, key) in self._loaded:
+            return True
+        found, stored = await self._load_one(kind, key)
+        if found is None:
+            return False
+        if found and isinstance(stored, dict):
+            for k, v in stored.items():
+                live.setdefault(k, v)
+        self._loaded.add((kind, key))
+        self._stats["lazy_loads"] += 1
+        return True
+
+    async def get_user_data(self):
+        await self._ensure_ready()
+        return {}  # loaded per user in refresh_user_data
+
+    async def get_chat_data(self):
+        await self._ensure_ready()
+        return {}  # loaded per chat in refresh_chat_data
+
+    async def get_bot_data(self):
+        await self._ensure_ready()
+        found, value = await self._load_one(KIND_BOT, _SINGLETON_KEY, default={})
+        return value if isinstance(value, dict) else {}
+
+    async def get_callback_data(self):
+        await self._ensure_ready()
+        found, value = await self._load_one(KIND_CALLBACK, _SINGLETON_KEY, default=None)
+        return value
+
+    async def get_conversations(self, name):
+        await self._ensure_ready()
+        kind = _conversation_kind(name)
+        rows = await run_db(_select_rows, kind, default=None) or []
+        conversations = {}
+        for key, blob in rows:
+            blob = bytes(blob)
+            self._written[(kind, key)] = _digest(blob)
+            conversations[tuple(json.loads(key))] = _loads(blob, f"{kind}/{key}")
+        return conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        key = str(user_id)
+        first_load = (KIND_USER, key) not in self._loaded
+        if await self._merge_stored(KIND_USER, key, user_data) and first_load:
+            # Entries written before questions were stored as IDs (see utils/persistence_report.py)
+            compact_user_data(user_data, inplace=True)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._merge_stored(KIND_CHAT, str(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass  # bot_data is loaded once at startup and only changed in this process
+
+    # --- writing ---
+    def _stage(self, kind, key, value, label):
+        blob = _dumps(value, label)
+        if blob is None:
+            return
+        digest = _digest(blob)
+        if self._written.get((kind, key)) == digest and (kind, key) not in self._pending:
+            self._stats["skipped_unchanged"] += 1
+            return
+        self._written[(kind, key)] = digest
+        self._pending[(kind, key)] = blob
+        self._schedule_flush()
+
+    def _stage_delete(self, kind, key):
+        self._written.pop((kind, key), None)
+        self._pending[(kind, key)] = _DELETE
+        self._schedule_flush()
+
+    async def _update_mapping(self, kind, key, data, label):
+        if (kind, key) not in self._loaded:
+            if not data:
+                return  # never loaded and nothing new: don't overwrite the stored row with {}
+            if not await self._merge_stored(kind, key, data):
+                logger.warning(f"[Persistence] Skipping write of {label}: stored row could not be read.")
+                return
+        self._stage(kind, key, data, label)
+
+    async def update_user_data(self, user_id, data):
+        await self._update_mapping(KIND_USER, str(user_id), data, f"user_data {user_id}")
+
+    async def update_chat_data(self, chat_id, data):
+        await self._update_mapping(KIND_CHAT, str(chat_id), data, f"chat_data {chat_id}")
+
+    async def update_bot_data(self, data):
+        self._stage(KIND_BOT, _SINGLETON_KEY, data, "bot_data")
+
+    async def update_callback_data(self, data):
+        self._stage(KIND_CALLBACK, _SINGLETON_KEY, data, "callback_data")
+
+    async def update_conversation(self, name, key, new_state):
+        kind, conv_key = _conversation_kind(name), json.dumps(list(key))
+        if new_state is None:
+            self._stage_delete(kind, conv_key)
+        else:
+            self._stage(kind, conv_key, new_state, f"conversation {name}")
+
+    async def drop_user_data(self, user_id):
+        self._loaded.discard((KIND_USER, str(user_id)))
+        self._stage_delete(KIND_USER, str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded.discard((KIND_CHAT, str(chat_id)))
+        self._stage_delete(KIND_CHAT, str(chat_id))
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # Let the rest of PTB's update cycle stage its keys so they share one batch
+        while True:
+            await asyncio.sleep(self.batch_delay)
+            if not await self._write_pending() or not self._pending:
+                break
+
+    async def _write_pending(self) -> bool:
+        async with self._write_lock:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, {}
+            upserts = [(kind, key, blob) for (kind, key), blob in batch.items() if blob is not _DELETE]
+            deletes = [(kind, key) for (kind, key), blob in batch.items() if blob is _DELETE]
+            ok = await run_db(_write_batch, upserts, deletes, timeout=DB_WRITE_TIMEOUT, default=False)
+            self._stats["batches"] += 1
+            if ok:
+                self._stats["writes"] += len(upserts)
+                self._stats["deletes"] += len(deletes)
+                logger.debug(f"[Persistence] Wrote {len(upserts)} entries, deleted {len(deletes)}.")
+                return True
+            # Keep the batch for the next attempt; newer staged values take precedence
+            self._stats["failed_batches"] += 1
+            for item, blob in batch.items():
+                if item not in self._pending:
+                    self._pending[item] = blob
+                    if blob is not _DELETE:
+                        self._written.pop(item, None)
+            return False
+
+    async def flush(self):
+        """Writes everything still pending (PTB calls this on shutdown)."""
+        await self._write_pending()
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        if self._pending:
+            logger.error(f"[Persistence] {len(self._pending)} entries could not be written on shutdown.")
+        logger.info(f"[Persistence] Flushed. Stats: {self.stats()}")
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        stats["loaded"] = len(self._loaded)
+        return stats
@@ -1,56 +1,117 @@
 """
 إدارة الاختبارات المحفوظة في قاعدة البيانات
 Saved Quizzes Database Management
+
+كل العمليات تستخدم محركاً واحداً للعملية (get_engine) بدل إنشاء محرك وتجمع
+اتصالات جديد مع كل حفظ أو عرض أو استكمال.
+
+الاختبار المحفوظ يخزن معرفات الأسئلة وترتيب الخيارات وإجابات مضغوطة فقط؛
+نص السؤال والخيارات والصور تُستعاد من QUESTION_CATALOGUE عند الاستكمال
+(handlers/quiz.py). الصفوف القديمة التي تحمل questions_data كاملة ما زالت تُقرأ، وتُخزن الأسئلة
+كاملة بالطريقة نفسها عندما لا يمكن استعادتها من الفهرس أو من source_endpoint.
 """
 
 import logging
 import json
+import threading
 from datetime import datetime, timezone, timedelta
 from typing import Dict, List, Optional
-from sqlalchemy import Column, Integer, String, Text, DateTime, create_engine
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index, create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from config import DATABASE_URL, logger
 
+try:
+    from config import SAVED_QUIZZES_POOL_SIZE, SAVED_QUIZZES_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME
+except ImportError:
+    SAVED_QUIZZES_POOL_SIZE = 2
+    SAVED_QUIZZES_MAX_OVERFLOW = 3
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_MAX_LIFETIME = 1800
+
 Base = declarative_base()
 
 
 class SavedQuiz(Base):
     """نموذج جدول الاختبارات المحفوظة"""
     __tablename__ = 'saved_quizzes'
-    
+    __table_args__ = (
+        # قائمة "استكمال الاختبار": اختبارات المستخدم الأحدث أولاً
+        Index("idx_saved_quizzes_user_saved_at", "user_id", "saved_at"),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, nullable=False, index=True)
     quiz_id = Column(String(255), nullable=False, unique=True, index=True)
     quiz_name = Column(String(500), nullable=False)
     quiz_type = Column(String(100), nullable=False)
     quiz_scope_id = Column(String(255), nullable=False)
-    questions_data = Column(Text, nullable=False)  # JSON string
+    questions_data = Column(Text, nullable=True)  # JSON string (الصفوف القديمة فقط)
+    question_ids = Column(Text, nullable=True)  # JSON: ["q1", "q2", ...]
+    option_orders = Column(Text, nullable=True)  # JSON: [["o1", "o2", ...], ...] لكل سؤال
+    source_endpoint = Column(String(500), nullable=True)  # مصدر الأسئلة في الـ API إن لم تكن في الفهرس
     current_question_index = Column(Integer, nullable=False, default=0)
     score = Column(Integer, nullable=False, default=0)
-    answers = Column(Text, nullable=False)  # JSON string
+    answers = Column(Text, nullable=False)  # JSON: [[question_id, chosen_option_id, is_correct, time_taken, status], ...]
     total_questions = Column(Integer, nullable=False)
     quiz_start_time = Column(String(255), nullable=True)  # ISO format string
     db_quiz_session_id = Column(String(255), nullable=True)
     saved_at = Column(DateTime, nullable=False, default=datetime.utcnow)
-    
+
     def __repr__(self):
         return f"<SavedQuiz(id={self.id}, user_id={self.user_id}, quiz_name='{self.quiz_name}', progress={self.current_question_index}/{self.total_questions})>"
 
 
+_engine = None
+_Session = None
+_engine_lock = threading.Lock()
+_table_ready = False
+
+
+def get_engine():
+    """محرك SQLAlchemy واحد للعملية (مع تجمع اتصالاته)، يُنشأ عند أول استخدام"""
+    global _engine, _Session
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                database_url = DATABASE_URL
+                if database_url and database_url.startswith("postgres://"):
+                    database_url = database_url.replace("postgres://", "postgresql://", 1)
+                engine = create_engine(
+                    database_url,
+                    pool_size=SAVED_QUIZZES_POOL_SIZE,
+                    max_overflow=SAVED_QUIZZES_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT,
+                    pool_recycle=DB_POOL_MAX_LIFETIME,
+                    pool_pre_ping=True,
+                )
+                _Session = sessionmaker(bind=engine, expire_on_commit=False)
+                _engine = engine
+                logger.info(f"[SavedQuizzes DB] Created shared engine (pool_size={SAVED_QUIZZES_POOL_SIZE}, max_overflow={SAVED_QUIZZES_MAX_OVERFLOW}).")
+    return _engine
+
+
 def get_db_session():
-    """إنشاء جلسة قاعدة بيانات"""
-    engine = create_engine(DATABASE_URL)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    """جلسة من المحرك المشترك (الجدول يُنشأ ويُرقّى عند أول استخدام)"""
+    get_engine()
+    if not _table_ready:
+        create_saved_quizzes_table()
+    return _Session()
 
 
 def create_saved_quizzes_table():
-    """إنشاء جدول الاختبارات المحفوظة إذا لم يكن موجوداً"""
+    """إنشاء جدول الاختبارات المحفوظة إذا لم يكن موجوداً، وترقية الجداول القديمة للتخزين المضغوط"""
+    global _table_ready
     try:
-        engine = create_engine(DATABASE_URL)
-        Base.metadata.create_all(engine, tables=[SavedQuiz.__table__])
+        with get_engine().begin() as conn:
+            Base.metadata.create_all(conn, tables=[SavedQuiz.__table__])
+            conn.execute(text("ALTER TABLE saved_quizzes ADD COLUMN IF NOT EXISTS question_ids TEXT"))
+            conn.execute(text("ALTER TABLE saved_quizzes ADD COLUMN IF NOT EXISTS option_orders TEXT"))
+            conn.execute(text("ALTER TABLE saved_quizzes ADD COLUMN IF NOT EXISTS source_endpoint VARCHAR(500)"))
+            conn.execute(text("ALTER TABLE saved_quizzes ALTER COLUMN questions_data DROP NOT NULL"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_saved_quizzes_user_saved_at ON saved_quizzes (user_id, saved_at)"))
+        _table_ready = True
         logger.info("[SavedQuizzes DB] جدول saved_quizzes تم إنشاؤه أو التحقق من وجوده بنجاح")
         return True
     except Exception as e:
@@ -58,30 +119,84 @@ def create_saved_quizzes_table():
         return False
 
 
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def pack_questions(questions_data: List[Dict]) -> tuple:
+    """
+    معرفات الأسئلة وترتيب خيارات كل سؤال فقط (بدون نصوص أو صور)
+
+    Returns:
+        (question_ids, option_orders)
+    """
+    question_ids = []
+    option_orders = []
+    for question in questions_data:
+        question_ids.append(str(question.get("question_id", "")))
+        option_orders.append([str(opt.get("option_id")) for opt in question.get("options", [])])
+    return question_ids, option_orders
+
+
+def pack_answers(answers: List[Dict]) -> List[list]:
+    """
+    الإجابات بشكل مضغوط: [question_id, chosen_option_id, is_correct, time_taken, status]
+    النصوص تُعاد من الأسئلة عند الاستكمال (QuizLogic.restore_saved_answers)
+    """
+    return [
+        [ans.get("question_id"), ans.get("chosen_option_id"), 1 if ans.get("is_correct") else 0,
+         ans.get("time_taken"), ans.get("status")]
+        for ans in answers
+    ]
+
+
 def save_quiz_to_db(user_id: int, quiz_data: Dict) -> bool:
     """
     حفظ اختبار في قاعدة البيانات
-    
+
     Args:
         user_id: معرف المستخدم
-        quiz_data: بيانات الاختبار (نفس الهيكل المستخدم في context.user_data)
-    
+        quiz_data: بيانات الاختبار (نفس الهيكل المستخدم في context.user_data)؛
+            questions_data و answers تُضغط قبل التخزين إذا كانت questions_in_catalogue
+            صحيحة أو عُرف source_endpoint، وإلا تُخزن كاملة كالصفوف القديمة
+
     Returns:
         True إذا تم الحفظ بنجاح، False خلاف ذلك
     """
+    session = None
     try:
         session = get_db_session()
-        
+        question_ids, option_orders = pack_questions(quiz_data["questions_data"])
+        source_endpoint = quiz_data.get("source_endpoint")
+
         # التحقق من وجود اختبار بنفس quiz_id
         existing_quiz = session.query(SavedQuiz).filter_by(quiz_id=quiz_data["quiz_id"]).first()
-        
+        legacy_row = existing_quiz is not None and existing_quiz.questions_data is not None
+
+        # التخزين المضغوط فقط إذا أمكن استعادة الأسئلة لاحقاً: كلها في الفهرس، أو (لصف جديد) مصدرها معروف.
+        # الصف القديم لا يفقد questions_data إلا إذا وُجدت كل أسئلته في الفهرس.
+        compact = bool(quiz_data.get("questions_in_catalogue")) or (bool(source_endpoint) and not legacy_row)
+        if compact:
+            packed_answers = _dumps(pack_answers(quiz_data["answers"]))
+        else:
+            packed_answers = json.dumps(quiz_data["answers"], ensure_ascii=False)
+
         if existing_quiz:
-            # تحديث الاختبار الموجود
+            # تحديث الاختبار الموجود (ويُحوَّل الصف القديم للتخزين المضغوط إن أمكن)
             existing_quiz.current_question_index = quiz_data["current_question_index"]
             existing_quiz.score = quiz_data["score"]
-            existing_quiz.answers = json.dumps(quiz_data["answers"], ensure_ascii=False)
+            existing_quiz.answers = packed_answers
+            existing_quiz.source_endpoint = source_endpoint
+            if compact:
+                existing_quiz.question_ids = _dumps(question_ids)
+                existing_quiz.option_orders = _dumps(option_orders)
+                existing_quiz.questions_data = None
+            elif not legacy_row:
+                existing_quiz.question_ids = None
+                existing_quiz.option_orders = None
+                existing_quiz.questions_data = json.dumps(quiz_data["questions_data"], ensure_ascii=False)
             existing_quiz.saved_at = datetime.now(timezone.utc)
-            logger.info(f"[SavedQuizzes DB] تحديث اختبار محفوظ: quiz_id={quiz_data['quiz_id']}, user={user_id}")
+            logger.info(f"[SavedQuizzes DB] تحديث اختبار محفوظ: quiz_id={quiz_data['quiz_id']}, user={user_id}, compact={compact}")
         else:
             # إنشاء اختبار جديد
             new_quiz = SavedQuiz(
@@ -90,172 +205,215 @@ def save_quiz_to_db(user_id: int, quiz_data: Dict) -> bool:
                 quiz_name=quiz_data["quiz_name"],
                 quiz_type=quiz_data["quiz_type"],
                 quiz_scope_id=quiz_data["quiz_scope_id"],
-                questions_data=json.dumps(quiz_data["questions_data"], ensure_ascii=False),
+                questions_data=None if compact else json.dumps(quiz_data["questions_data"], ensure_ascii=False),
+                question_ids=_dumps(question_ids) if compact else None,
+                option_orders=_dumps(option_orders) if compact else None,
+                source_endpoint=source_endpoint,
                 current_question_index=quiz_data["current_question_index"],
                 score=quiz_data["score"],
-                answers=json.dumps(quiz_data["answers"], ensure_ascii=False),
+                answers=packed_answers,
                 total_questions=quiz_data["total_questions"],
                 quiz_start_time=quiz_data.get("quiz_start_time"),
                 db_quiz_session_id=quiz_data.get("db_quiz_session_id"),
                 saved_at=datetime.now(timezone.utc)
             )
             session.add(new_quiz)
-            logger.info(f"[SavedQuizzes DB] حفظ اختبار جديد: quiz_id={quiz_data['quiz_id']}, user={user_id}")
-        
+            logger.info(f"[SavedQuizzes DB] حفظ اختبار جديد: quiz_id={quiz_data['quiz_id']}, user={user_id}, compact={compact}")
+
         session.commit()
-        session.close()
         return True
-        
+
     except Exception as e:
         logger.error(f"[SavedQuizzes DB] خطأ في حفظ الاختبار: {e}", exc_info=True)
-        try:
+        if session is not None:
             session.rollback()
-            session.close()
-        except:
-            pass
         return False
+    finally:
+        if session is not None:
+            session.close()
 
 
 def get_saved_quizzes_for_user(user_id: int) -> Dict[str, Dict]:
     """
-    استرجاع جميع الاختبارات المحفوظة لمستخدم معين
-    
+    استرجاع ملخص الاختبارات المحفوظة لمستخدم معين (الأحدث أولاً، بدون الأسئلة والإجابات)
+
     Args:
         user_id: معرف المستخدم
-    
+
     Returns:
-        قاموس بنفس هيكل context.user_data["saved_quizzes"]
-        {quiz_id: {quiz_data}}
+        {quiz_id: {quiz_id, quiz_name, quiz_type, quiz_scope_id, current_question_index,
+                   score, total_questions, saved_at}}
+        الاختبار الكامل للاستكمال: load_saved_quiz
     """
+    session = None
     try:
         session = get_db_session()
-        
-        saved_quizzes = session.query(SavedQuiz).filter_by(user_id=user_id).all()
-        
+
+        rows = (
+            session.query(SavedQuiz.quiz_id, SavedQuiz.quiz_name, SavedQuiz.quiz_type, SavedQuiz.quiz_scope_id,
+                          SavedQuiz.current_question_index, SavedQuiz.score, SavedQuiz.total_questions,
+                          SavedQuiz.saved_at)
+            .filter(SavedQuiz.user_id == user_id)
+            .order_by(SavedQuiz.saved_at.desc())
+            .all()
+        )
+
         result = {}
-        for quiz in saved_quizzes:
-            result[quiz.quiz_id] = {
-                "quiz_id": quiz.quiz_id,
-                "quiz_name": quiz.quiz_name,
-                "quiz_type": quiz.quiz_type,
-                "quiz_scope_id": quiz.quiz_scope_id,
-                "questions_data": json.loads(quiz.questions_data),
-                "current_question_index": quiz.current_question_index,
-                "score": quiz.score,
-                "answers": json.loads(quiz.answers),
-                "total_questions": quiz.total_questions,
-                "quiz_start_time": quiz.quiz_start_time,
-                "db_quiz_session_id": quiz.db_quiz_session_id,
-                "saved_at": quiz.saved_at.isoformat() if quiz.saved_at else None
+        for row in rows:
+            result[row.quiz_id] = {
+                "quiz_id": row.quiz_id,
+                "quiz_name": row.quiz_name,
+                "quiz_type": row.quiz_type,
+                "quiz_scope_id": row.quiz_scope_id,
+                "current_question_index": row.current_question_index,
+                "score": row.score,
+                "total_questions": row.total_questions,
+                "saved_at": row.saved_at.isoformat() if row.saved_at else None
             }
-        
-        session.close()
+
         logger.info(f"[SavedQuizzes DB] تم استرجاع {len(result)} اختبار محفوظ للمستخدم {user_id}")
         return result
-        
+
     except Exception as e:
         logger.error(f"[SavedQuizzes DB] خطأ في استرجاع الاختبارات المحفوظة: {e}", exc_info=True)
-        try:
-            session.close()
-        except:
-            pass
         return {}
+    finally:
+        if session is not None:
+            session.close()
+
+
+def load_saved_quiz(user_id: int, quiz_id: str) -> Optional[Dict]:
+    """
+    استرجاع اختبار محفوظ واحد للاستكمال
+
+    Args:
+        user_id: معرف المستخدم (لا يُعاد اختبار مستخدم آخر)
+        quiz_id: معرف الاختبار
+
+    Returns:
+        بيانات الاختبار، أو None إن لم يوجد. مع compact=True تحمل question_ids و option_orders
+        و answers مضغوطة (pack_answers)؛ الصفوف القديمة تحمل questions_data و answers كاملة.
+    """
+    session = None
+    try:
+        session = get_db_session()
+        quiz = session.query(SavedQuiz).filter_by(quiz_id=quiz_id, user_id=user_id).first()
+        if quiz is None:
+            return None
+
+        compact = quiz.question_ids is not None
+        return {
+            "quiz_id": quiz.quiz_id,
+            "quiz_name": quiz.quiz_name,
+            "quiz_type": quiz.quiz_type,
+            "quiz_scope_id": quiz.quiz_scope_id,
+            "compact": compact,
+            "question_ids": json.loads(quiz.question_ids) if compact else None,
+            "option_orders": json.loads(quiz.option_orders) if compact and quiz.option_orders else None,
+            "source_endpoint": quiz.source_endpoint,
+            "questions_data": None if compact else json.loads(quiz.questions_data),
+            "current_question_index": quiz.current_question_index,
+            "score": quiz.score,
+            "answers": json.loads(quiz.answers),
+            "total_questions": quiz.total_questions,
+            "quiz_start_time": quiz.quiz_start_time,
+            "db_quiz_session_id": quiz.db_quiz_session_id,
+            "saved_at": quiz.saved_at.isoformat() if quiz.saved_at else None
+        }
+
+    except Exception as e:
+        logger.error(f"[SavedQuizzes DB] خطأ في استرجاع الاختبار المحفوظ {quiz_id}: {e}", exc_info=True)
+        return None
+    finally:
+        if session is not None:
+            session.close()
 
 
 def delete_saved_quiz(quiz_id: str) -> bool:
     """
     حذف اختبار محفوظ من قاعدة البيانات
-    
+
     Args:
         quiz_id: معرف الاختبار
-    
+
     Returns:
         True إذا تم الحذف بنجاح، False خلاف ذلك
     """
+    session = None
     try:
         session = get_db_session()
-        
-        quiz = session.query(SavedQuiz).filter_by(quiz_id=quiz_id).first()
-        
-        if quiz:
-            session.delete(quiz)
-            session.commit()
+
+        deleted = session.query(SavedQuiz).filter_by(quiz_id=quiz_id).delete(synchronize_session=False)
+        session.commit()
+
+        if deleted:
             logger.info(f"[SavedQuizzes DB] تم حذف الاختبار المحفوظ: quiz_id={quiz_id}")
-            session.close()
             return True
-        else:
-            logger.warning(f"[SavedQuizzes DB] لم يتم العثور على الاختبار للحذف: quiz_id={quiz_id}")
-            session.close()
-            return False
-        
+        logger.warning(f"[SavedQuizzes DB] لم يتم العثور على الاختبار للحذف: quiz_id={quiz_id}")
+        return False
+
     except Exception as e:
         logger.error(f"[SavedQuizzes DB] خطأ في حذف الاختبار المحفوظ: {e}", exc_info=True)
-        try:
+        if session is not None:
             session.rollback()
-            session.close()
-        except:
-            pass
         return False
+    finally:
+        if session is not None:
+            session.close()
 
 
 def get_saved_quiz_count_for_user(user_id: int) -> int:
     """
     الحصول على عدد الاختبارات المحفوظة لمستخدم معين
-    
+
     Args:
         user_id: معرف المستخدم
-    
+
     Returns:
         عدد الاختبارات المحفوظة
     """
+    session = None
     try:
         session = get_db_session()
-        count = session.query(SavedQuiz).filter_by(user_id=user_id).count()
-        session.close()
-        return count
+        return session.query(SavedQuiz).filter_by(user_id=user_id).count()
     except Exception as e:
         logger.error(f"[SavedQuizzes DB] خطأ في حساب الاختبارات المحفوظة: {e}", exc_info=True)
-        try:
-            session.close()
-        except:
-            pass
         return 0
+    finally:
+        if session is not None:
+            session.close()
 
 
 def delete_old_saved_quizzes(days: int = 30) -> int:
     """
     حذف الاختبارات المحفوظة القديمة (تنظيف تلقائي)
-    
+
     Args:
         days: عدد الأيام (الاختبارات الأقدم من هذا العدد سيتم حذفها)
-    
+
     Returns:
         عدد الاختبارات المحذوفة
     """
+    session = None
     try:
         session = get_db_session()
-        
+
         cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
-        
-        old_quizzes = session.query(SavedQuiz).filter(SavedQuiz.saved_at < cutoff_date).all()
-        count = len(old_quizzes)
-        
-        for quiz in old_quizzes:
-            session.delete(quiz)
-        
+
+        # جملة DELETE واحدة بدل تحميل الصفوف وحذفها واحداً واحداً
+        count = session.query(SavedQuiz).filter(SavedQuiz.saved_at < cutoff_date).delete(synchronize_session=False)
         session.commit()
-        session.close()
-        
+
         if count > 0:
             logger.info(f"[SavedQuizzes DB] تم حذف {count} اختبار محفوظ قديم (أقدم من {days} يوم)")
-        
+
         return count
-        
+
     except Exception as e:
         logger.error(f"[SavedQuizzes DB] خطأ في حذف الاختبارات القديمة: {e}", exc_info=True)
-        try:
+        if session is not None:
             session.rollback()
-            session.close()
-        except:
-            pass
         return 0
+    finally:
+        if session is not None:
+            session.close()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Indexed student search for the admin panel.
+
+search_student_input_handler used to run ``full_name ILIKE '%q%'`` joined to
+a GROUP BY over every quiz_results row of the matches: a sequential scan of
+users plus an aggregation of their whole history on every search, and
+"احمد" did not find "أحمد".
+
+- normalize_arabic(text) (SQL, IMMUTABLE) folds hamza forms of alef, alef
+  maqsura, ta marbuta, hamza on waw/yeh, Persian yeh/kaf, Arabic-Indic digits,
+  removes diacritics and tatweel, lowercases and squeezes spaces.
+  normalize_phone(text) keeps the digits only.
+- users.search_name is a STORED generated column = normalize_arabic(full_name),
+  so ranking the matches does not re-run the regexes per row and no writer
+  has to change.
+- GIN trigram indexes (pg_trgm) on search_name,
+  lower(email) and normalize_phone(phone) of registered users serve substring
+  LIKE and the fuzzy word-similarity operator (<%), so typos still match.
+  When pg_trgm cannot be installed, a GIN tsvector index over the
+  normalized name serves word-prefix search instead ("احم" finds
+  "أحمد علي") and btree text_pattern_ops indexes serve email/phone prefixes.
+- Only the fields the query can match are searched (letters: name; ASCII
+  without spaces: email; 3+ digits: phone; all digits: also user_id), so
+  every OR arm has an index.
+- Results are ranked: exact name, then name or word prefix, then word
+  similarity, then name. The limited page is joined to
+  user_quiz_aggregates (or, until its backfill is done, to a per-user
+  LATERAL over quiz_results), never the other way round.
+
+The query is normalized by the same SQL function as the stored column, so
+both sides always agree. Changing normalize_arabic requires recomputing
+search_name (UPDATE users SET full_name = full_name) and a REINDEX.
+
+Functions here take a cursor; database/manager.py wraps them with pooled
+connections (ensure_student_search_indexes, search_students); the admin toggle
+reuses get_student_details on its own cursor.
+"""
+
+import re
+
+# المصدر → الهدف (حرف بحرف لـ translate)
+ARABIC_FOLD_FROM = "أإآٱىیکةؤئ" + "٠١٢٣٤٥٦٧٨٩" + "۰۱۲۳۴۵۶۷۸۹"
+ARABIC_FOLD_TO = "ااااييكهوي" + "0123456789" + "0123456789"
+# التشكيل + الألف الخنجرية + التطويل
+ARABIC_STRIP_CLASS = "[\u064b-\u065f\u0670\u0640]"
+_ARABIC_STRIP_RE = re.compile(ARABIC_STRIP_CLASS)
+
+MIN_PHONE_DIGITS = 3
+
+_FUNCTIONS_SQL = [
+    f"""
+    CREATE OR REPLACE FUNCTION normalize_arabic(value TEXT) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT btrim(regexp_replace(lower(regexp_replace(
+            translate(COALESCE(value, ''), '{ARABIC_FOLD_FROM}', '{ARABIC_FOLD_TO}'),
+            '{ARABIC_STRIP_CLASS}', '', 'g')), '\\s+', ' ', 'g'))
+    $$;
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION normalize_phone(value TEXT) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT regexp_replace(translate(COALESCE(value, ''), '{ARABIC_FOLD_FROM}', '{ARABIC_FOLD_TO}'), '[^0-9]', '', 'g')
+    $$;
+    """,
+]
+
+# البحث يشمل المسجلين فقط → فهارس جزئية أصغر
+_SEARCH_NAME_COLUMN_SQL = """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS search_name TEXT
+    GENERATED ALWAYS AS (normalize_arabic(full_name)) STORED
+"""
+_FTS_INDEXES_SQL = [
+    """CREATE INDEX IF NOT EXISTS idx_users_search_name_fts
+       ON users USING gin (to_tsvector('simple', search_name)) WHERE is_registered = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_users_search_email_prefix
+       ON users (lower(email) text_pattern_ops) WHERE is_registered = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_users_search_phone_prefix
+       ON users (normalize_phone(phone) text_pattern_ops) WHERE is_registered = TRUE""",
+]
+_TRGM_INDEXES_SQL = [
+    """CREATE INDEX IF NOT EXISTS idx_users_search_name_trgm
+       ON users USING gin (search_name gin_trgm_ops) WHERE is_registered = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_users_search_email_trgm
+       ON users USING gin (lower(email) gin_trgm_ops) WHERE is_registered = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_users_search_phone_trgm
+       ON users USING gin (normalize_phone(phone) gin_trgm_ops) WHERE is_registered = TRUE""",
+]
+
+_AGGREGATES_JOIN = """
+    LEFT JOIN user_quiz_aggregates a ON a.user_id = m.user_id
+"""
+_AGGREGATES_COLUMNS = """
+    COALESCE(a.total_quizzes, 0) AS quiz_count,
+    ROUND(a.avg_percentage::numeric, 1) AS avg_score,
+    a.last_completed_at AS last_quiz
+"""
+# قبل اكتمال نسخ التجميعات: تجميع نتائج الطلاب المعروضين فقط
+# (نفس مصدر user_quiz_aggregates: عمود percentage والنتائج التي لها نسبة فقط)
+_LIVE_AGGREGATES_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS total_quizzes, AVG(percentage) AS avg_percentage,
+               MAX(completed_at) AS last_completed_at
+        FROM quiz_results qr
+        WHERE qr.user_id = m.user_id AND qr.completed_at IS NOT NULL AND qr.percentage IS NOT NULL
+    ) a ON TRUE
+"""
+
+_STUDENT_COLUMNS = """
+    u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered,
+    COALESCE(u.is_my_student, FALSE) AS is_my_student
+"""
+
+_SEARCH_SQL = """
+    SELECT m.user_id, m.full_name, m.email, m.phone, m.grade, m.is_registered, m.is_my_student,
+           {aggregate_columns}
+    FROM (
+        SELECT {student_columns},
+               COALESCE(u.user_id = %(user_id)s, FALSE) AS id_match,
+               (u.search_name = normalize_arabic(%(q)s)) AS exact_match,
+               (u.search_name LIKE normalize_arabic(%(q_like)s) || '%%'
+                OR u.search_name LIKE '%% ' || normalize_arabic(%(q_like)s) || '%%') AS prefix_match,
+               {similarity} AS similarity
+        FROM users u
+        WHERE {where}
+        ORDER BY id_match DESC, exact_match DESC, prefix_match DESC, similarity DESC, u.full_name
+        LIMIT %(limit)s
+    ) m
+    {aggregates_join}
+    ORDER BY m.id_match DESC, m.exact_match DESC, m.prefix_match DESC, m.similarity DESC, m.full_name
+"""
+
+# شروط المطابقة لكل حقل: (مع pg_trgm: أي جزء من النص، بدونه: بادئة يخدمها فهرس)
+_MATCHES = {
+    "name": {
+        True: """u.search_name LIKE '%%' || normalize_arabic(%(q_like)s) || '%%'
+                 OR normalize_arabic(%(q)s) <%% u.search_name""",
+        False: "to_tsvector('simple', u.search_name) @@ to_tsquery('simple', normalize_arabic(%(q_prefix)s))",
+    },
+    "email": {
+        True: "lower(u.email) LIKE '%%' || lower(%(q_like)s) || '%%'",
+        False: "lower(u.email) LIKE lower(%(q_like)s) || '%%'",
+    },
+    "phone": {
+        True: "normalize_phone(u.phone) LIKE '%%' || %(phone)s || '%%'",
+        False: "normalize_phone(u.phone) LIKE %(phone)s || '%%'",
+    },
+}
+
+_DETAILS_SQL = """
+    SELECT m.*, {aggregate_columns}
+    FROM (SELECT {student_columns} FROM users u WHERE u.user_id = %s) m
+    {aggregates_join}
+"""
+
+
+def create_search_objects(cur) -> bool:
+    """Creates the normalization functions and search indexes. Returns True when pg_trgm is available.
+
+    Runs inside the caller's transaction; a missing pg_trgm (no privilege to
+    install it) only skips the trigram indexes.
+    """
+    cur.execute("SAVEPOINT student_search_trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("RELEASE SAVEPOINT student_search_trgm")
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT student_search_trgm")
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    trgm = cur.fetchone()[0]
+    for statement in _FUNCTIONS_SQL:
+        cur.execute(statement)
+    cur.execute(_SEARCH_NAME_COLUMN_SQL)
+    for statement in (_TRGM_INDEXES_SQL if trgm else _FTS_INDEXES_SQL):
+        cur.execute(statement)
+    return trgm
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _aggregates_sql(aggregates_ready: bool) -> dict:
+    return {
+        "aggregate_columns": _AGGREGATES_COLUMNS,
+        "aggregates_join": _AGGREGATES_JOIN if aggregates_ready else _LIVE_AGGREGATES_JOIN,
+        "student_columns": _STUDENT_COLUMNS,
+    }
+
+
+def build_search_sql(params: dict, trgm: bool, aggregates_ready: bool) -> str | None:
+    """SQL for search_params(); only the fields the query can match are searched, each through its own index."""
+    fields = [field for field in _MATCHES if params[field]]
+    where = []
+    if params["user_id"] is not None:
+        where.append("u.user_id = %(user_id)s")
+    if fields:
+        where.append("(u.is_registered = TRUE AND ({}))".format(
+            " OR ".join(f"({_MATCHES[field][trgm]})" for field in fields)))
+    if not where:
+        return None
+    return _SEARCH_SQL.format(
+        where="\n           OR ".join(where),
+        similarity="word_similarity(normalize_arabic(%(q)s), u.search_name)" if trgm else "0",
+        **_aggregates_sql(aggregates_ready),
+    )
+
+
+def search_params(query: str, limit: int) -> dict:
+    """Query parameters. name/email/phone are set only when the query can match that field."""
+    # التشكيل والتطويل يُحذفان هنا كما في normalize_arabic، فلا تبقى كلمة فارغة بعد التطبيع
+    query = " ".join(_ARABIC_STRIP_RE.sub("", query).split())
+    digits = "".join(str(int(ch)) for ch in query if ch.isdecimal())   # أرقام عربية أو لاتينية
+    has_letters = any(ch.isalpha() for ch in query)
+    # كل كلمة كبادئة: "احم عل" → 'احم':* & 'عل':*
+    words = ["".join(ch for ch in word if ch.isalnum()) for word in query.split()]
+    prefix = " & ".join(f"{word}:*" for word in words if word)
+    return {
+        "q": query,
+        "q_like": _escape_like(query),
+        "q_prefix": prefix,
+        "user_id": int(digits) if query.isdecimal() and len(digits) <= 18 else None,
+        "name": has_letters,
+        "email": query.isascii() and any(ch.isalnum() for ch in query) and " " not in query,
+        "phone": digits if len(digits) >= MIN_PHONE_DIGITS and not has_letters else None,
+        "limit": limit,
+    }
+
+
+def search_students(cur, query: str, limit: int = 10, trgm: bool = True, aggregates_ready: bool = True) -> list:
+    """Ranked students matching query (name, email, phone or user_id), with their quiz aggregates."""
+    params = search_params(query, limit)
+    sql = build_search_sql(params, trgm, aggregates_ready)
+    if sql is None:
+        return []
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+def get_student_details(cur, user_id: int, aggregates_ready: bool = True):
+    """One student's card row (same columns as search_students), or None."""
+    cur.execute(_DETAILS_SQL.format(**_aggregates_sql(aggregates_ready)), (user_id,))
+    return cur.fetchone()
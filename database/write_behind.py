@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""Write-behind queue for idempotent "touch" and "mark read" writes.
+
+Several hot paths wrote one row per interaction on the request path:
+start/end of every quiz (register_or_update_user just to bump
+last_interaction_date), every guarded interaction (users.last_activity),
+bot.py's group-99 auto broadcast-read tracking (a blocking INSERT...SELECT
+on the event loop) and the "قرأت" button.
+
+WRITE_BEHIND keeps these events in memory, one entry per key (the latest
+timestamp wins), and writes each channel as one multi-row statement over
+unnest() arrays:
+
+- every WRITE_BEHIND_FLUSH_INTERVAL seconds (JobQueue job, on the DB executor),
+- as soon as a channel holds WRITE_BEHIND_MAX_PENDING keys,
+- and once more on shutdown (flush()).
+
+A failed flush puts its entries back (merged with newer ones) for the next
+attempt; beyond WRITE_BEHIND_MAX_BACKLOG keys per channel the oldest are
+dropped, since every event here is safe to lose. stats() exposes queue
+depth, peak depth, coalescing and flush latency per channel.
+
+Touches only UPDATE existing users rows, so a flush after an account
+deletion does not re-create the user.
+
+The image_file_id channel persists utils/image_cache.py's URL -> Telegram
+file_id map the same way (losing an entry only costs one re-upload).
+"""
+
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_MAX_BACKLOG
+except ImportError:
+    WRITE_BEHIND_FLUSH_INTERVAL = 5
+    WRITE_BEHIND_MAX_PENDING = 500
+    WRITE_BEHIND_MAX_BACKLOG = 50000
+
+from .connection import get_pooled_connection, release_connection
+
+
+class _Channel:
+    """Pending entries of one kind of write: key -> latest value."""
+
+    def __init__(self, name, flush_func):
+        self.name = name
+        self.flush_func = flush_func    # flush_func(cur, batch: dict) -> rows written
+        self.pending = {}
+        self.first_pending_at = None
+        self.stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "keys_flushed": 0,
+            "rows_written": 0,
+            "failed_flushes": 0,
+            "dropped": 0,
+            "peak_pending": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    def merge(self, key, value) -> None:
+        if key not in self.pending:
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending[key] = value
+            self.stats["peak_pending"] = max(self.stats["peak_pending"], len(self.pending))
+            return
+        self.stats["coalesced"] += 1
+        previous = self.pending[key]
+        if value is not None and (previous is None or previous < value):
+            self.pending[key] = value
+
+
+class WriteBehindQueue:
+    """Named channels of coalesced writes, flushed in batches off the request path."""
+
+    def __init__(self, interval=WRITE_BEHIND_FLUSH_INTERVAL, max_pending=WRITE_BEHIND_MAX_PENDING,
+                 max_backlog=WRITE_BEHIND_MAX_BACKLOG):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._loop = None           # event loop of the bot, set by attach()
+        self._early_flush = False   # an early (size-triggered) flush is already scheduled
+        self._background = set()
+
+    def register(self, name: str, flush_func) -> None:
+        self._channels[name] = _Channel(name, flush_func)
+
+    def enqueue(self, name: str, key, value=None) -> None:
+        """Records one event; safe from the event loop and from DB executor threads."""
+        channel = self._channels[name]
+        with self._lock:
+            channel.stats["enqueued"] += 1
+            channel.merge(key, value)
+            full = len(channel.pending) >= self.max_pending and not self._early_flush
+            if full:
+                self._early_flush = True
+        if full:
+            self._request_early_flush()
+
+    def _request_early_flush(self) -> None:
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self._early_flush = False
+            return
+        try:
+            loop.call_soon_threadsafe(self._start_early_flush)
+        except RuntimeError:
+            self._early_flush = False
+
+    def _start_early_flush(self) -> None:
+        task = asyncio.ensure_future(self.flush_async())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _take(self, channel: _Channel) -> dict:
+        with self._lock:
+            batch, channel.pending = channel.pending, {}
+            channel.first_pending_at = None
+        return batch
+
+    def _requeue(self, channel: _Channel, batch: dict) -> None:
+        with self._lock:
+            # الدفعة الفاشلة أولاً (الأقدم)، ثم ما وصل أثناء المحاولة
+            merged = dict(batch)
+            for key, value in channel.pending.items():
+                current = merged.get(key)
+                if key not in merged or (value is not None and (current is None or current < value)):
+                    merged[key] = value
+            channel.pending = merged
+            if channel.first_pending_at is None:
+                channel.first_pending_at = time.monotonic()
+            overflow = len(channel.pending) - self.max_backlog
+            if overflow > 0:
+                # dict order: requeued (oldest) keys first
+                for key in list(channel.pending)[:overflow]:
+                    del channel.pending[key]
+                channel.stats["dropped"] += overflow
+                logger.warning(f"[WriteBehind] {channel.name}: backlog over {self.max_backlog}, dropped {overflow} oldest entries.")
+
+    def _flush_channel(self, conn, channel: _Channel) -> int:
+        batch = self._take(channel)
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        cur = None
+        try:
+            cur = conn.cursor()
+            rows = channel.flush_func(cur, batch)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            self._requeue(channel, batch)
+            channel.stats["failed_flushes"] += 1
+            logger.error(f"[WriteBehind] {channel.name}: failed to flush {len(batch)} entries: {e}")
+            return 0
+        finally:
+            if cur: cur.close()
+        channel.stats["flushes"] += 1
+        channel.stats["keys_flushed"] += len(batch)
+        channel.stats["rows_written"] += max(rows or 0, 0)
+        channel.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        logger.debug(f"[WriteBehind] {channel.name}: flushed {len(batch)} entries ({rows} rows).")
+        return len(batch)
+
+    def flush(self, name: str | None = None) -> int:
+        """Blocking: writes the pending entries of one channel (or all). Returns the number of keys written."""
+        self._early_flush = False
+        channels = [self._channels[name]] if name else list(self._channels.values())
+        if not any(channel.pending for channel in channels):
+            return 0
+        conn = get_pooled_connection()
+        if not conn:
+            logger.warning("[WriteBehind] No DB connection; pending entries kept for the next flush.")
+            for channel in channels:
+                if channel.pending:
+                    channel.stats["failed_flushes"] += 1
+            return 0
+        try:
+            return sum(self._flush_channel(conn, channel) for channel in channels)
+        finally:
+            release_connection(conn)
+
+    async def flush_async(self) -> int:
+        """Runs flush() on the DB executor."""
+        from .async_manager import run_db
+        return await run_db(self.flush, default=0)
+
+    def attach(self, application) -> None:
+        """Schedules the periodic flush on the application's JobQueue (an asyncio task without one)."""
+        self._loop = asyncio.get_running_loop()
+        if application.job_queue:
+            application.job_queue.run_repeating(
+                flush_write_behind_job,
+                interval=self.interval,
+                first=self.interval,
+                name="write_behind_flush",
+            )
+        else:
+            logger.warning("[WriteBehind] No JobQueue; flushing from a background task.")
+            application.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush_async()
+
+    def depth(self) -> dict:
+        """Pending keys per channel."""
+        return {name: len(channel.pending) for name, channel in self._channels.items()}
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: dict(
+                    channel.stats,
+                    pending=len(channel.pending),
+                    oldest_pending_s=round(now - channel.first_pending_at, 1) if channel.first_pending_at else 0.0,
+                )
+                for name, channel in self._channels.items()
+            }
+
+
+# --- القنوات: كل قناة جملة واحدة متعددة الصفوف ---
+
+def _flush_last_activity(cur, batch: dict) -> int:
+    user_ids = sorted(batch)
+    cur.execute("""
+        UPDATE users AS u SET last_activity = v.touched_at, is_active = TRUE
+        FROM unnest(%s::bigint[], %s::timestamp[]) AS v(user_id, touched_at)
+        WHERE u.user_id = v.user_id
+          AND (u.last_activity IS NULL OR u.last_activity < v.touched_at)
+    """, (user_ids, [batch[user_id] for user_id in user_ids]))
+    return cur.rowcount
+
+
+def _flush_last_interaction(cur, batch: dict) -> int:
+    user_ids = sorted(batch)
+    cur.execute("""
+        UPDATE users AS u SET last_interaction_date = v.touched_at
+        FROM unnest(%s::bigint[], %s::timestamptz[]) AS v(user_id, touched_at)
+        WHERE u.user_id = v.user_id
+          AND (u.last_interaction_date IS NULL OR u.last_interaction_date < v.touched_at)
+    """, (user_ids, [batch[user_id] for user_id in user_ids]))
+    return cur.rowcount
+
+
+def _flush_broadcast_auto_reads(cur, batch: dict) -> int:
+    # نفس شروط auto_track_broadcast_read لكل المستخدمين دفعة واحدة
+    cur.execute("""
+        INSERT INTO broadcast_reads (broadcast_id, user_id)
+        SELECT b.id, u.user_id
+        FROM unnest(%s::bigint[]) AS v(user_id)
+        JOIN users u ON u.user_id = v.user_id
+        JOIN broadcasts b ON b.created_at > NOW() - INTERVAL '48 hours'
+        WHERE b.target_type = 'all'
+           OR (b.target_type = 'grade' AND b.target_filter = u.grade)
+           OR (b.target_type = 'my_students' AND COALESCE(u.is_my_student, FALSE) = TRUE)
+        ON CONFLICT (broadcast_id, user_id) DO NOTHING
+    """, (sorted(batch),))
+    if cur.rowcount > 0:
+        logger.info(f"[AutoTrack] {cur.rowcount} broadcasts auto-marked as read for {len(batch)} users")
+    return cur.rowcount
+
+
+def _flush_broadcast_reads(cur, batch: dict) -> int:
+    keys = sorted(batch)
+    cur.execute("""
+        INSERT INTO broadcast_reads (broadcast_id, user_id)
+        SELECT v.broadcast_id, v.user_id
+        FROM unnest(%s::int[], %s::bigint[]) AS v(broadcast_id, user_id)
+        ON CONFLICT (broadcast_id, user_id) DO NOTHING
+    """, ([k[0] for k in keys], [k[1] for k in keys]))
+    return cur.rowcount
+
+
+def _flush_image_file_ids(cur, batch: dict) -> int:
+    # value = (checked_at, seq, file_id, content_hash); file_id None = حذف (file_id رفضه تيليجرام)
+    stored = sorted(url for url, value in batch.items() if value[2])
+    deleted = sorted(url for url, value in batch.items() if not value[2])
+    rows = 0
+    if stored:
+        cur.execute("""
+            INSERT INTO telegram_image_cache (url, file_id, content_hash, checked_at)
+            SELECT v.url, v.file_id, v.content_hash, to_timestamp(v.checked_at)
+            FROM unnest(%s::text[], %s::text[], %s::text[], %s::float8[]) AS v(url, file_id, content_hash, checked_at)
+            ON CONFLICT (url) DO UPDATE SET file_id = EXCLUDED.file_id,
+                                            content_hash = EXCLUDED.content_hash,
+                                            checked_at = EXCLUDED.checked_at
+        """, (stored, [batch[url][2] for url in stored], [batch[url][3] for url in stored],
+              [batch[url][0] for url in stored]))
+        rows += cur.rowcount
+    if deleted:
+        cur.execute("DELETE FROM telegram_image_cache WHERE url = ANY(%s)", (deleted,))
+        rows += cur.rowcount
+    return rows
+
+
+WRITE_BEHIND = WriteBehindQueue()
+WRITE_BEHIND.register("last_activity", _flush_last_activity)
+WRITE_BEHIND.register("last_interaction", _flush_last_interaction)
+WRITE_BEHIND.register("broadcast_auto_read", _flush_broadcast_auto_reads)
+WRITE_BEHIND.register("broadcast_read", _flush_broadcast_reads)
+WRITE_BEHIND.register("image_file_id", _flush_image_file_ids)
+
+# يفصل بين حدثين لنفس الرابط في نفس اللحظة (القيم تُقارن كـ tuples)
+_image_event_seq = itertools.count()
+
+
+def touch_last_activity(user_id: int) -> None:
+    """users.last_activity (آخر تفاعل محمي) — يُكتب مع الدفعة التالية."""
+    WRITE_BEHIND.enqueue("last_activity", user_id, datetime.now())
+
+
+def touch_last_interaction(user_id: int) -> None:
+    """users.last_interaction_date (بدء/إنهاء اختبار) — يُكتب مع الدفعة التالية."""
+    WRITE_BEHIND.enqueue("last_interaction", user_id, datetime.now(timezone.utc))
+
+
+def mark_recent_broadcasts_read(user_id: int) -> None:
+    """قراءة تلقائية لإشعارات آخر 48 ساعة الموجهة للمستخدم."""
+    WRITE_BEHIND.enqueue("broadcast_auto_read", user_id)
+
+
+def mark_broadcast_read(broadcast_id: int, user_id: int) -> None:
+    """تسجيل قراءة إشعار معين (زر قرأت)."""
+    WRITE_BEHIND.enqueue("broadcast_read", (broadcast_id, user_id))
+
+
+def store_image_file_id(url: str, file_id: str | None, content_hash: str | None = None,
+                        checked_at: float | None = None) -> None:
+    """telegram_image_cache: file_id لرابط الصورة (None = حذف) — يُكتب مع الدفعة التالية."""
+    WRITE_BEHIND.enqueue("image_file_id", url,
+                         (checked_at or time.time(), next(_image_event_seq), file_id, content_hash))
+
+
+async def flush_write_behind_job(context) -> None:
+    """JobQueue callback: periodic flush of every channel."""
+    await WRITE_BEHIND.flush_async()
+
+
+def schedule_write_behind(application) -> None:
+    """Starts periodic flushing (call from post_init, on the event loop)."""
+    WRITE_BEHIND.attach(application)
+
+
+def get_write_behind_stats() -> dict:
+    """Queue depth, coalescing and flush counters per channel for monitoring."""
+    return WRITE_BEHIND.stats()
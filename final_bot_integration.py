@@ -131,6 +131,24 @@ async def final_report_status_command(update: Update, context: ContextTypes.DEFA
         logger.error(f"خطأ في أمر حالة التقارير النهائي: {e}")
         await update.message.reply_text("❌ حدث خطأ في عرض حالة النظام")
 
+async def _submit_report_job(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, done_text: str):
+    """يضيف التقرير إلى REPORT_JOBS (عامل التقارير الواحد) ويرد على المدير عند انتهائه"""
+    from utils.report_jobs import REPORT_JOBS, STATUS_DONE
+    
+    job, created = REPORT_JOBS.submit(kind, requested_by=update.effective_user.id)
+    if not created:
+        await update.message.reply_text("ℹ️ يوجد تقرير مماثل قيد التنفيذ، سيتم إعلامك عند انتهائه.")
+    
+    async def on_update(job):
+        if job.active:
+            return
+        if job.status == STATUS_DONE:
+            await update.message.reply_text(done_text)
+        else:
+            await update.message.reply_text(f"❌ لم يكتمل التقرير ({job.status}) — راجع السجلات (#{job.job_id})")
+    
+    context.application.create_task(REPORT_JOBS.watch(job, on_update))
+
 async def final_generate_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنشاء تقرير فوري نهائي ومحسن"""
     try:
@@ -147,13 +165,9 @@ async def final_generate_report_command(update: Update, context: ContextTypes.DE
         # رسالة البداية
         await update.message.reply_text("⏳ جاري إنشاء التقرير النهائي المحسن...")
         
-        # إنشاء التقرير
+        # إنشاء التقرير (مهمة على عامل التقارير)
         try:
-            scheduler = FinalWeeklyReportScheduler()
-            scheduler.generate_and_send_weekly_report()
-            
-            await update.message.reply_text("✅ تم إنشاء وإرسال التقرير النهائي بنجاح")
-                
+            await _submit_report_job(update, context, "weekly", "✅ تم إنشاء وإرسال التقرير النهائي بنجاح")
         except Exception as e:
             logger.error(f"خطأ في إنشاء التقرير النهائي: {e}")
             await update.message.reply_text(f"❌ خطأ في إنشاء التقرير: {str(e)}")
@@ -259,10 +273,8 @@ async def final_monthly_report_command(update: Update, context: ContextTypes.DEF
         
         await update.message.reply_text("⏳ جاري إنشاء التقرير الشهري (30 يوم)...")
         
-        scheduler = FinalWeeklyReportScheduler()
-        scheduler.generate_and_send_monthly_report()
-        
-        await update.message.reply_text(
+        await _submit_report_job(
+            update, context, "monthly",
             "✅ تم إنشاء وإرسال التقرير الشهري بنجاح\n"
             "📧 تم إرساله لإيميلك"
         )
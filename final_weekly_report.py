@@ -13,12 +13,13 @@ import schedule
 import time
 import threading
 import openpyxl.styles
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 from typing import Dict, List, Any, Optional, Tuple
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -27,6 +28,504 @@ import json
 
 logger = logging.getLogger(__name__)
 
+
+class ReportCancelled(Exception):
+    """يُرفع من دالة التقدم (progress) عند إلغاء إنشاء التقرير من المشرف"""
+
+
+def _report_progress(progress, fraction: float, stage: str):
+    """يبلغ عن مرحلة التقرير الحالية؛ دالة التقدم قد ترفع ReportCancelled لإيقاف التقرير"""
+    if progress:
+        progress(fraction, stage)
+
+
+# ============================================================
+#  بيانات التقرير في الذاكرة (استخراج واحد لكل تقرير)
+# ============================================================
+# كل المستخدمين (للإحصائيات العامة، تقدم الطلاب، الصفوف)
+_REPORT_USERS_SQL = """
+    SELECT 
+        user_id, username, first_name, last_name, full_name, grade,
+        first_seen_timestamp, last_active_timestamp, registration_date, last_activity
+    FROM users
+"""
+
+# نتائج الفترات الخام ({ranges})؛ answered_count يُحسب في القاعدة لنتائج الفترة فقط
+# (بدل جلب answers_details كاملة) ويبقى NULL إن لم توجد تفاصيل إجابات
+_REPORT_RESULTS_SQL = """
+    SELECT 
+        qr.result_id, qr.user_id, qr.filter_id, qr.quiz_name,
+        qr.total_questions, qr.score, qr.percentage, qr.time_taken_seconds,
+        qr.completed_at, qr.start_time,
+        CASE WHEN qr.completed_at >= :start_date
+                  AND jsonb_typeof(qr.answers_details) = 'array'
+                  AND jsonb_array_length(qr.answers_details) > 0
+             THEN (
+                SELECT COUNT(*)
+                FROM jsonb_array_elements(qr.answers_details) AS ad(value)
+                WHERE jsonb_typeof(ad.value) = 'object'
+                  AND strpos(COALESCE(ad.value ->> 'chosen_option_text', ''), 'تم إنهاء الاختبار') = 0
+             )
+        END AS answered_count
+    FROM quiz_results qr
+    WHERE {ranges}
+"""
+
+# لقطات الأيام المغلقة لكل طالب (report_daily_user_stats)
+_REPORT_DAILY_SQL = """
+    SELECT 
+        day, user_id, quiz_count, percentage_count, percentage_sum, positive_count, positive_sum,
+        percentage_min, percentage_max, questions_sum, time_count, time_sum, last_completed_at
+    FROM report_daily_user_stats
+    WHERE day BETWEEN :first_day AND :last_day
+"""
+
+_NUMERIC_RESULT_COLUMNS = ('total_questions', 'score', 'percentage', 'time_taken_seconds', 'answered_count')
+_USER_DATE_COLUMNS = ('first_seen_timestamp', 'last_active_timestamp', 'registration_date', 'last_activity')
+
+
+def _naive_datetimes(values: pd.Series) -> pd.Series:
+    """تحويل عمود تواريخ إلى datetime64 بدون timezone (بنفس التوقيت المحلي كما كان replace(tzinfo=None))"""
+    try:
+        converted = pd.to_datetime(values, errors='coerce')
+    except (TypeError, ValueError):
+        # خليط من تواريخ بـ timezone وبدونها
+        converted = pd.to_datetime(
+            values.map(lambda v: v.replace(tzinfo=None) if getattr(v, 'tzinfo', None) else v), errors='coerce')
+    if getattr(converted.dt, 'tz', None) is not None:
+        converted = converted.dt.tz_localize(None)
+    return converted
+
+
+def _number(value, default=0.0) -> float:
+    """قيمة رقمية من pandas (NaN/None → default)"""
+    if value is None or pd.isna(value):
+        return default
+    return float(value)
+
+
+def _scalar(value):
+    """NaN/NaT من pandas → None حتى تعمل `or` كما مع صفوف SQLAlchemy"""
+    return None if value is None or pd.isna(value) else value
+
+
+def _extract_quiz_topic(quiz_name) -> str:
+    """استخراج اسم الوحدة من اسم الاختبار"""
+    if not quiz_name:
+        return 'أخرى'
+    name = str(quiz_name)
+    # unit_quiz - كيمياء 2-2 - الطاقة والتغيرات
+    if ' - ' in name:
+        parts = name.split(' - ')
+        if len(parts) >= 2:
+            return parts[-1].strip()[:40]
+    if 'all_scope' in name:
+        return 'اختبار شامل'
+    if 'تقوية' in name:
+        # 🎯 تقوية: كيمياء -1 - المادة الخواص
+        if ':' in name:
+            after_colon = name.split(':')[-1].strip()
+            if ' - ' in after_colon:
+                return after_colon.split(' - ')[-1].strip()[:40]
+        return 'تقوية نقاط الضعف'
+    if 'عشوائي' in name:
+        return 'اختبار عشوائي'
+    return name[:40]
+
+
+class ReportFrame:
+    """جداول التقرير في الذاكرة: كل المستخدمين + نتائج الاختبارات الخام للفترات raw_ranges
+    + لقطات يومية لكل طالب (daily) للأيام rollup_span = (أول يوم، آخر يوم)؛ closed_through آخر يوم مغلق
+
+    تُبنى بعدد قليل من الاستعلامات، وتُحسب منها كل أوراق التقرير بعمليات pandas بدل استعلام لكل ورقة (ولكل طالب).
+    results/daily تحمل اسم/صف الطالب (has_user=False لنتيجة بلا مستخدم، is_teacher لحساب المعلم).
+    """
+
+    def __init__(self, users: pd.DataFrame, results: pd.DataFrame, raw_ranges: list, daily: pd.DataFrame = None,
+                 rollup_span: tuple = None, closed_through: date = None, seconds: float = 0.0):
+        self.users = users
+        self.results = results
+        self.raw_ranges = raw_ranges
+        self.daily = daily
+        self.rollup_span = rollup_span
+        self.closed_through = closed_through
+        self.seconds = seconds
+
+    @staticmethod
+    def _attach_users(rows: pd.DataFrame, users: pd.DataFrame) -> pd.DataFrame:
+        user_columns = users[['user_id', 'username', 'full_name', 'grade', 'is_teacher']].assign(has_user=True)
+        rows = rows.merge(user_columns, on='user_id', how='left')
+        rows['has_user'] = rows['has_user'].fillna(False).astype(bool)
+        rows['is_teacher'] = rows['is_teacher'].fillna(False).astype(bool)
+        for column in ('username', 'full_name', 'grade'):
+            rows[column] = rows[column].astype(object).where(rows[column].notna(), None)
+        return rows
+
+    @classmethod
+    def build(cls, users: pd.DataFrame, results: pd.DataFrame, raw_ranges: list, daily: pd.DataFrame = None,
+              rollup_span: tuple = None, closed_through: date = None, seconds: float = 0.0) -> 'ReportFrame':
+        """تجهيز أنواع الأعمدة ودمج بيانات المستخدم مع النتائج واللقطات"""
+        users = users.copy()
+        users['user_id'] = users['user_id'].astype('int64')
+        for column in _USER_DATE_COLUMNS:
+            users[column] = _naive_datetimes(users[column])
+        users['is_teacher'] = users['grade'].fillna('').eq('معلم')
+
+        results = results.copy()
+        results['user_id'] = results['user_id'].astype('int64')
+        for column in _NUMERIC_RESULT_COLUMNS:
+            results[column] = pd.to_numeric(results[column], errors='coerce').astype(float)
+        for column in ('completed_at', 'start_time'):
+            results[column] = _naive_datetimes(results[column])
+        results = cls._attach_users(results, users)
+
+        if daily is not None:
+            daily = daily.copy()
+            daily['user_id'] = daily['user_id'].astype('int64')
+            daily['day'] = pd.to_datetime(daily['day'])
+            daily['last_completed_at'] = _naive_datetimes(daily['last_completed_at'])
+            for column in _DAILY_SUM_COLUMNS + ('percentage_min', 'percentage_max'):
+                daily[column] = pd.to_numeric(daily[column], errors='coerce').astype(float)
+            daily = cls._attach_users(daily, users)
+        return cls(users, results, raw_ranges, daily, rollup_span, closed_through, seconds)
+
+    @property
+    def rows_read(self) -> int:
+        return len(self.users) + len(self.results) + (len(self.daily) if self.daily is not None else 0)
+
+    def covers(self, start_date: datetime, end_date: datetime) -> bool:
+        """نتائج [start_date, end_date] الخام كلها موجودة"""
+        return any(start <= start_date and end_date <= end for start, end in self.raw_ranges)
+
+    def covers_daily(self, start_date: datetime, end_date: datetime) -> bool:
+        """daily_stats تغطي [start_date, end_date] (لقطات + أجزاء خام)"""
+        days = _rollup_days(start_date, end_date, self.rollup_span)
+        return all(self.covers(start, end) for start, end in _raw_ranges(start_date, end_date, days))
+
+    def students(self) -> pd.DataFrame:
+        """المستخدمون بدون المعلمين"""
+        return self.users[~self.users['is_teacher']]
+
+    @staticmethod
+    def _filter_users(rows: pd.DataFrame, students_only: bool, joined: bool) -> pd.DataFrame:
+        mask = pd.Series(True, index=rows.index)
+        if joined:
+            mask &= rows['has_user']
+        if students_only:
+            mask &= ~rows['is_teacher']
+        return rows[mask]
+
+    def period(self, start_date: datetime, end_date: datetime, students_only: bool = True,
+               joined: bool = True) -> pd.DataFrame:
+        """نتائج الفترة [start_date, end_date]
+
+        joined: نتائج لها مستخدم فقط (مثل JOIN users)؛ students_only: بدون المعلمين
+        """
+        results = self.results
+        return self._filter_users(results[results['completed_at'].between(start_date, end_date)], students_only, joined)
+
+    def daily_stats(self, start_date: datetime, end_date: datetime, students_only: bool = True,
+                    joined: bool = True) -> pd.DataFrame:
+        """تجميع الفترة لكل طالب في كل يوم: الأيام الكاملة المغلقة من اللقطات، والباقي (أطراف الفترة واليوم الحالي) من النتائج الخام"""
+        days = _rollup_days(start_date, end_date, self.rollup_span)
+        parts = []
+        if days:
+            parts.append(self.daily[self.daily['day'].between(_day_start(days[0]), _day_start(days[1]))])
+        for start, end in _raw_ranges(start_date, end_date, days):
+            results = self.results
+            parts.append(_daily_user_stats(results[results['completed_at'].between(start, end)]))
+        rows = pd.concat(parts, ignore_index=True) if parts else _daily_user_stats(self.results.iloc[:0])
+        return self._filter_users(rows, students_only, joined)
+
+
+
+# ============================================================
+#  جدول إجابات التقرير (صف لكل إجابة) لتحليل الأسئلة
+# ============================================================
+# مفتاح تقدم نسخ السجل القديم إلى quiz_answers (database/backfill.py)
+_QUIZ_ANSWERS_BACKFILL_KEY = 'quiz_answers_backfill_cursor'
+
+# quiz_answers بعد اكتمال نسخ السجل القديم
+_ANSWERS_FROM_TABLE_SQL = """
+    SELECT result_id, answer_index, user_id, question_id, is_correct, status, answered_at
+    FROM quiz_answers
+    WHERE answered_at >= :start_date AND answered_at <= :end_date
+"""
+
+# قبل اكتمال النسخ: answers_details تُفك داخل القاعدة دفعة واحدة (بنفس قواعد إدراج quiz_answers)
+_ANSWERS_FROM_DETAILS_SQL = """
+    SELECT 
+        qr.result_id,
+        (ad.ord - 1)::int AS answer_index,
+        qr.user_id,
+        ad.value ->> 'question_id' AS question_id,
+        COALESCE(ad.value -> 'is_correct' = 'true'::jsonb, FALSE) AS is_correct,
+        ad.value ->> 'status' AS status,
+        qr.completed_at AS answered_at
+    FROM quiz_results qr
+    CROSS JOIN LATERAL jsonb_array_elements(qr.answers_details) WITH ORDINALITY AS ad(value, ord)
+    WHERE qr.completed_at >= :start_date AND qr.completed_at <= :end_date
+        AND jsonb_typeof(qr.answers_details) = 'array'
+        AND jsonb_typeof(ad.value) = 'object'
+        AND (ad.value ->> 'question_id') IS NOT NULL
+"""
+
+# ended = الطالب أنهى الاختبار قبل/عند السؤال (لا تُحسب محاولة)
+_ANSWER_OUTCOME_SQL = """
+        CASE WHEN a.status IN ('quiz_ended_by_user', 'not_reached_quiz_ended') THEN 'ended'
+             WHEN a.is_correct THEN 'correct'
+             ELSE 'wrong'
+        END"""
+
+# جدول مؤقت لمعاملة التقرير: كل الإجابات مرة واحدة + outcome
+_REPORT_ANSWERS_SQL = """
+    CREATE TEMP TABLE report_answers ON COMMIT DROP AS
+    SELECT a.*, """ + _ANSWER_OUTCOME_SQL + """ AS outcome
+    FROM ({source}) a
+"""
+
+# إحصائيات كل سؤال (محاولتان حقيقيتان على الأقل) مرتبة بمعدل الخطأ؛ first_answer = أول ظهور (result_id, answer_index)
+# {rollups}: إحصائيات الأيام المغلقة من report_daily_question_stats تُضاف إلى إجابات report_answers
+_QUESTION_STATS_SQL = """
+    SELECT 
+        question_id,
+        SUM(total_attempts)::int AS total_attempts,
+        SUM(correct_attempts)::int AS correct_attempts,
+        SUM(wrong_attempts)::int AS wrong_attempts,
+        SUM(skipped_count)::int AS skipped_count,
+        (MIN(first_answer))[1] AS first_result_id,
+        (MIN(first_answer))[2] AS first_answer_index
+    FROM (
+        {rollups}
+        SELECT 
+            question_id,
+            COUNT(*) FILTER (WHERE outcome <> 'ended') AS total_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'correct') AS correct_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'wrong') AS wrong_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'ended') AS skipped_count,
+            MIN(ARRAY[result_id, answer_index::bigint]) AS first_answer
+        FROM report_answers
+        GROUP BY question_id
+    ) per_question
+    GROUP BY question_id
+    HAVING SUM(total_attempts) >= :min_attempts
+    ORDER BY SUM(wrong_attempts)::float / SUM(total_attempts) DESC, SUM(total_attempts) DESC, question_id
+    LIMIT :limit
+"""
+
+_QUESTION_ROLLUPS_SQL = """
+        SELECT question_id, total_attempts, correct_attempts, wrong_attempts, skipped_count, first_answer
+        FROM report_daily_question_stats
+        WHERE day BETWEEN :first_day AND :last_day
+        UNION ALL
+"""
+
+
+def create_report_answers(conn, ranges, from_details: bool = False) -> None:
+    """إنشاء جدول report_answers المؤقت لإجابات الفترات ranges [(start, end)] (يُحذف بانتهاء المعاملة)"""
+    source = _ANSWERS_FROM_DETAILS_SQL if from_details else _ANSWERS_FROM_TABLE_SQL
+    conn.execute(text(_REPORT_ANSWERS_SQL.format(source=source) + " WITH NO DATA"),
+                 {'start_date': None, 'end_date': None})
+    insert = text("INSERT INTO report_answers SELECT a.*, " + _ANSWER_OUTCOME_SQL + " FROM (" + source + ") a")
+    for start_date, end_date in ranges:
+        conn.execute(insert, {'start_date': start_date, 'end_date': end_date})
+
+
+def question_answer_stats(conn, min_attempts: int = 2, limit: int = 20, days: tuple = None) -> list:
+    """أصعب الأسئلة من report_answers + لقطات الأيام days = (أول يوم، آخر يوم) إن وُجدت"""
+    params = {'min_attempts': min_attempts, 'limit': limit}
+    if days:
+        params.update(first_day=days[0], last_day=days[1])
+    sql = _QUESTION_STATS_SQL.format(rollups=_QUESTION_ROLLUPS_SQL if days else '')
+    return conn.execute(text(sql), params).fetchall()
+
+
+# ============================================================
+#  لقطات يومية مجمعة (report_daily_*)
+#  الأيام المنتهية لا تتغير؛ تُجمع مرة واحدة ثم تقرأ فترات المقارنة
+#  والتقارير الطويلة اللقطات + الأيام غير المكتملة فقط من السجل الخام
+# ============================================================
+# آخر يوم مغلق في اللقطات (YYYY-MM-DD)
+_REPORT_ROLLUPS_KEY = 'report_rollups_closed_through'
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+# الجداول report_daily_* تُنشأ مرة واحدة عند بدء البوت (database.manager.ensure_report_rollup_tables)
+
+# نتائج الأيام [first_day, next_day) لكل طالب في كل يوم (percentage_* تتجاهل NULL، positive_* الدرجات > 0)
+_CLOSE_USER_DAYS_SQL = """
+    INSERT INTO report_daily_user_stats (
+        day, user_id, quiz_count, percentage_count, percentage_sum, positive_count, positive_sum,
+        percentage_min, percentage_max, questions_sum, time_count, time_sum, last_completed_at
+    )
+    SELECT 
+        completed_at::date, user_id,
+        COUNT(*), COUNT(percentage), COALESCE(SUM(percentage), 0),
+        COUNT(*) FILTER (WHERE percentage > 0), COALESCE(SUM(percentage) FILTER (WHERE percentage > 0), 0),
+        MIN(percentage), MAX(percentage),
+        COALESCE(SUM(total_questions), 0),
+        COUNT(time_taken_seconds), COALESCE(SUM(time_taken_seconds), 0),
+        MAX(completed_at)
+    FROM quiz_results
+    WHERE completed_at >= :start_date AND completed_at <= :end_date AND user_id IS NOT NULL
+    GROUP BY completed_at::date, user_id
+"""
+
+# إحصائيات كل سؤال في كل يوم + أول 3 إجابات خاطئة مختلفة في اليوم (بترتيب أول ظهور)،
+# وهي تكفي لأول 3 إجابات خاطئة في أي مجموعة أيام
+_CLOSE_QUESTION_DAYS_SQL = """
+    WITH answers AS (
+        SELECT a.result_id, a.answer_index, a.question_id, a.answered_at::date AS day,
+            """ + _ANSWER_OUTCOME_SQL + """ AS outcome
+        FROM ({source}) a
+    ),
+    wrong AS (
+        SELECT 
+            day, question_id, chosen_text, first_seen,
+            ROW_NUMBER() OVER (PARTITION BY day, question_id ORDER BY first_seen) AS position
+        FROM (
+            SELECT 
+                a.day, a.question_id,
+                qr.answers_details -> a.answer_index ->> 'chosen_option_text' AS chosen_text,
+                MIN(a.result_id) AS first_seen
+            FROM answers a
+            JOIN quiz_results qr ON qr.result_id = a.result_id
+            WHERE a.outcome = 'wrong'
+            GROUP BY a.day, a.question_id, chosen_text
+        ) chosen
+        WHERE COALESCE(chosen_text, '') <> ''
+    )
+    INSERT INTO report_daily_question_stats (
+        day, question_id, total_attempts, correct_attempts, wrong_attempts, skipped_count,
+        first_answer, wrong_answers, wrong_answer_ids
+    )
+    SELECT 
+        s.day, s.question_id, s.total_attempts, s.correct_attempts, s.wrong_attempts, s.skipped_count,
+        s.first_answer, COALESCE(w.wrong_answers, ARRAY[]::text[]), COALESCE(w.wrong_answer_ids, ARRAY[]::bigint[])
+    FROM (
+        SELECT 
+            day, question_id,
+            COUNT(*) FILTER (WHERE outcome <> 'ended') AS total_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'correct') AS correct_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'wrong') AS wrong_attempts,
+            COUNT(*) FILTER (WHERE outcome = 'ended') AS skipped_count,
+            MIN(ARRAY[result_id, answer_index::bigint]) AS first_answer
+        FROM answers
+        GROUP BY day, question_id
+    ) s
+    LEFT JOIN (
+        SELECT 
+            day, question_id,
+            array_agg(chosen_text ORDER BY first_seen) AS wrong_answers,
+            array_agg(first_seen ORDER BY first_seen) AS wrong_answer_ids
+        FROM wrong
+        WHERE position <= 3
+        GROUP BY day, question_id
+    ) w ON w.day = s.day AND w.question_id = s.question_id
+"""
+
+
+def _day_start(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day)
+
+
+def close_report_days(conn, today: date, from_details: bool = False) -> tuple:
+    """تجميع الأيام المنتهية (حتى أمس) التي لم تدخل اللقطات بعد
+
+    today هو اليوم بنفس ساعة فترات التقرير (datetime.now() في بايثون) وليس CURRENT_DATE
+    في القاعدة، حتى لا يُغلق يوم ما زالت الفترات تعتبره اليوم الجاري.
+    يعيد (آخر يوم مغلق، عدد الأيام المضافة الآن). الأيام تُعاد كاملة (حذف ثم إدراج)،
+    وقفل advisory يمنع تقريرين من تجميع نفس الأيام معاً.
+    """
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {'key': _REPORT_ROLLUPS_KEY})
+    closed_through = today - timedelta(days=1)
+    stored = conn.execute(text("SELECT setting_value FROM bot_settings WHERE setting_key = :key"),
+                          {'key': _REPORT_ROLLUPS_KEY}).scalar()
+    if stored:
+        first_day = date.fromisoformat(stored) + timedelta(days=1)
+    else:
+        # أول تجميع: كل السجل
+        first_day = conn.execute(text("SELECT MIN(completed_at)::date FROM quiz_results")).scalar() or today
+    if first_day > closed_through:
+        return closed_through, 0
+    
+    params = {'start_date': _day_start(first_day), 'end_date': _day_start(today) - _ONE_MICROSECOND}
+    days = {'first_day': first_day, 'last_day': closed_through}
+    conn.execute(text("DELETE FROM report_daily_user_stats WHERE day BETWEEN :first_day AND :last_day"), days)
+    conn.execute(text("DELETE FROM report_daily_question_stats WHERE day BETWEEN :first_day AND :last_day"), days)
+    conn.execute(text(_CLOSE_USER_DAYS_SQL), params)
+    source = _ANSWERS_FROM_DETAILS_SQL if from_details else _ANSWERS_FROM_TABLE_SQL
+    conn.execute(text(_CLOSE_QUESTION_DAYS_SQL.format(source=source)), params)
+    conn.execute(text("""
+        INSERT INTO bot_settings (setting_key, setting_value, updated_at)
+        VALUES (:key, :value, NOW())
+        ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, updated_at = NOW()
+    """), {'key': _REPORT_ROLLUPS_KEY, 'value': closed_through.isoformat()})
+    return closed_through, (closed_through - first_day).days + 1
+
+
+def _rollup_days(start_date: datetime, end_date: datetime, span: tuple) -> tuple:
+    """الأيام الكاملة داخل [start_date, end_date] الموجودة في span = (أول يوم، آخر يوم): (أول، آخر) أو None"""
+    if not span:
+        return None
+    first_day = start_date.date() if start_date == _day_start(start_date.date()) else start_date.date() + timedelta(days=1)
+    # اليوم كامل إذا وصلت الفترة إلى آخر لحظة فيه (end_date مشمول)
+    last_day = (end_date + _ONE_MICROSECOND).date() - timedelta(days=1)
+    first_day, last_day = max(first_day, span[0]), min(last_day, span[1])
+    return (first_day, last_day) if first_day <= last_day else None
+
+
+def _raw_ranges(start_date: datetime, end_date: datetime, days: tuple) -> list:
+    """أجزاء [start_date, end_date] خارج أيام اللقطات days (تُقرأ من السجل الخام)"""
+    if not days:
+        return [(start_date, end_date)] if start_date <= end_date else []
+    ranges = []
+    before = _day_start(days[0]) - _ONE_MICROSECOND
+    if start_date <= before:
+        ranges.append((start_date, before))
+    after = _day_start(days[1] + timedelta(days=1))
+    if after <= end_date:
+        ranges.append((after, end_date))
+    return ranges
+
+
+def _merge_ranges(ranges) -> list:
+    """دمج الفترات المتداخلة/المتلاصقة"""
+    merged = []
+    for start_date, end_date in sorted(ranges):
+        if merged and start_date <= merged[-1][1] + _ONE_MICROSECOND:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end_date))
+        else:
+            merged.append((start_date, end_date))
+    return merged
+
+
+_DAILY_SUM_COLUMNS = ('quiz_count', 'percentage_count', 'percentage_sum', 'positive_count', 'positive_sum',
+                      'questions_sum', 'time_count', 'time_sum')
+
+
+def _daily_user_stats(results: pd.DataFrame) -> pd.DataFrame:
+    """نفس أعمدة report_daily_user_stats من نتائج خام (مع بيانات المستخدم المدمجة)"""
+    percentage = results['percentage']
+    rows = results.assign(day=results['completed_at'].dt.normalize(), positive=percentage.where(percentage > 0))
+    return rows.groupby(['day', 'user_id'], sort=False).agg(
+        quiz_count=('result_id', 'size'),
+        percentage_count=('percentage', 'count'),
+        percentage_sum=('percentage', 'sum'),
+        positive_count=('positive', 'count'),
+        positive_sum=('positive', 'sum'),
+        percentage_min=('percentage', 'min'),
+        percentage_max=('percentage', 'max'),
+        questions_sum=('total_questions', 'sum'),
+        time_count=('time_taken_seconds', 'count'),
+        time_sum=('time_taken_seconds', 'sum'),
+        last_completed_at=('completed_at', 'max'),
+        full_name=('full_name', 'first'),
+        grade=('grade', 'first'),
+        is_teacher=('is_teacher', 'first'),
+        has_user=('has_user', 'first'),
+    ).reset_index()
+
+
 class FinalWeeklyReportGenerator:
     """مولد التقارير الأسبوعية النهائي والمحسن"""
     
@@ -37,6 +536,9 @@ class FinalWeeklyReportGenerator:
             raise ValueError("متغير DATABASE_URL غير موجود")
         
         self.engine = create_engine(self.database_url)
+        # بيانات التقرير الجاري في الذاكرة (تُستخرج مرة واحدة في create_final_excel_report)
+        self._report_frame = None
+        self._quiz_answers_complete = False
         self.reports_dir = "final_reports"
         self.charts_dir = os.path.join(self.reports_dir, "charts")
         
@@ -79,6 +581,110 @@ class FinalWeeklyReportGenerator:
         except (TypeError, ValueError):
             return default
     
+    @staticmethod
+    def _week_windows(end_date: datetime, weeks: int = 4) -> list:
+        """آخر weeks أسابيع من الأقدم للأحدث [(بداية، نهاية)] (الحدود مشمولة)"""
+        return [(end_date - timedelta(weeks=weeks - w), end_date - timedelta(weeks=weeks - w - 1)) for w in range(weeks)]
+
+    @classmethod
+    def _comparison_windows(cls, start_date: datetime, end_date: datetime) -> tuple:
+        """فترات المقارنة في التقرير: الفترة السابقة (أسبوع قبل)، وأسابيع آخر شهر (التتبع الأسبوعي والمقارنة الشهرية)،
+        والأسبوعان قبل الأسبوع الحالي (الإنذار المبكر)"""
+        current_start = end_date - timedelta(weeks=1)
+        return ((start_date - timedelta(days=7), end_date - timedelta(days=7)),
+                *cls._week_windows(end_date),
+                (end_date - timedelta(weeks=3), current_start - _ONE_MICROSECOND),
+                (current_start, end_date))
+
+    def _close_report_rollups(self):
+        """تحديث اللقطات اليومية حتى أمس؛ يعيد آخر يوم مغلق، أو None عند الخطأ (فيُقرأ كل شيء من السجل الخام)"""
+        try:
+            started = time.time()
+            from_details = not self._quiz_answers_ready()
+            with self.engine.begin() as conn:
+                closed_through, added_days = close_report_days(conn, datetime.now().date(), from_details=from_details)
+            if added_days:
+                logger.info(f"تم تجميع {added_days} يوم في اللقطات اليومية (حتى {closed_through}) "
+                            f"في {time.time() - started:.2f} ثانية")
+            return closed_through
+        except Exception as e:
+            logger.warning(f"تعذر تحديث اللقطات اليومية، ستُقرأ الفترات من السجل الخام: {e}")
+            return None
+
+    def load_report_frame(self, start_date: datetime, end_date: datetime, comparisons: tuple = None,
+                          period_rows: bool = True) -> ReportFrame:
+        """استخراج بيانات التقرير مرة واحدة: المستخدمون + نتائج الفترة الخام + فترات المقارنة
+
+        فترات المقارنة (الافتراضي _comparison_windows) تُقرأ من اللقطات اليومية للأيام المغلقة،
+        ومن السجل الخام لأطرافها واليوم الحالي فقط. period_rows=False: بدون نتائج الفترة الخام.
+        """
+        if comparisons is None:
+            comparisons = self._comparison_windows(start_date, end_date)
+        closed_through = self._close_report_rollups() if comparisons else None
+        
+        # أجزاء فترات المقارنة داخل الفترة موجودة في نتائجها الخام؛ الباقي من اللقطات (من أول يوم كامل حتى آخر يوم مغلق)
+        if period_rows:
+            comparisons = [(start, min(end, start_date - _ONE_MICROSECOND)) for start, end in comparisons]
+        comparisons = [(start, end) for start, end in comparisons if start <= end]
+        span = None
+        if closed_through is not None:
+            window_days = [days for days in (_rollup_days(s, e, (date.min, closed_through)) for s, e in comparisons) if days]
+            if window_days:
+                span = (min(days[0] for days in window_days), max(days[1] for days in window_days))
+        raw_ranges = [(start_date, end_date)] if period_rows else []
+        for window_start, window_end in comparisons:
+            raw_ranges.extend(_raw_ranges(window_start, window_end, _rollup_days(window_start, window_end, span)))
+        raw_ranges = _merge_ranges(raw_ranges)
+        
+        started = time.time()
+        params = {'start_date': start_date}
+        for index, (range_start, range_end) in enumerate(raw_ranges):
+            params[f'range_start_{index}'], params[f'range_end_{index}'] = range_start, range_end
+        ranges_sql = ' OR '.join(
+            f'(qr.completed_at >= :range_start_{index} AND qr.completed_at <= :range_end_{index})'
+            for index in range(len(raw_ranges))
+        ) or 'FALSE'
+        daily = None
+        with self.engine.connect() as conn:
+            users_rows = conn.execute(text(_REPORT_USERS_SQL))
+            users = pd.DataFrame(users_rows.fetchall(), columns=list(users_rows.keys()), dtype=object)
+            results_rows = conn.execute(text(_REPORT_RESULTS_SQL.format(ranges=ranges_sql)), params)
+            results = pd.DataFrame(results_rows.fetchall(), columns=list(results_rows.keys()), dtype=object)
+            if span:
+                daily_rows = conn.execute(text(_REPORT_DAILY_SQL), {'first_day': span[0], 'last_day': span[1]})
+                daily = pd.DataFrame(daily_rows.fetchall(), columns=list(daily_rows.keys()), dtype=object)
+        frame = ReportFrame.build(users, results, raw_ranges, daily, span, closed_through, seconds=time.time() - started)
+        logger.info(f"تم استخراج بيانات التقرير: {len(frame.users)} مستخدم + {len(frame.results)} نتيجة "
+                    f"+ {len(daily) if daily is not None else 0} صف من اللقطات اليومية "
+                    f"({frame.rows_read} صف) في {frame.seconds:.2f} ثانية")
+        return frame
+
+    def _frame_for(self, start_date: datetime, end_date: datetime) -> ReportFrame:
+        """بيانات التقرير الجاري إن كانت تغطي الفترة، وإلا تُستخرج للفترة المطلوبة فقط"""
+        frame = self._report_frame
+        if frame is not None and frame.covers(start_date, end_date):
+            return frame
+        return self.load_report_frame(start_date, end_date, comparisons=())
+
+    def _daily_frame_for(self, *windows) -> ReportFrame:
+        """مثل _frame_for لكن لـ daily_stats على كل فترة في windows [(بداية، نهاية)]: اللقطات + أطراف كل فترة من السجل الخام"""
+        frame = self._report_frame
+        if frame is not None and all(frame.covers_daily(start, end) for start, end in windows):
+            return frame
+        return self.load_report_frame(windows[0][0], windows[-1][1], comparisons=windows, period_rows=False)
+    
+    def _quiz_answers_ready(self) -> bool:
+        """quiz_answers يغطي السجل كاملاً بعد انتهاء نسخ الاختبارات القديمة (يُحفظ بعد أول True)"""
+        if not self._quiz_answers_complete:
+            try:
+                with self.engine.connect() as conn:
+                    row = conn.execute(text("SELECT setting_value FROM bot_settings WHERE setting_key = :key"),
+                                       {'key': _QUIZ_ANSWERS_BACKFILL_KEY}).fetchone()
+                self._quiz_answers_complete = bool(row) and row.setting_value == 'done'
+            except Exception as e:
+                logger.warning(f"تعذر التحقق من اكتمال quiz_answers: {e}")
+        return self._quiz_answers_complete
+
     def get_previous_week_stats(self, current_start: datetime, current_end: datetime) -> Dict[str, Any]:
         """الحصول على إحصائيات الأسبوع السابق للمقارنة"""
         try:
@@ -88,46 +694,23 @@ class FinalWeeklyReportGenerator:
             
             logger.info(f"جاري حساب إحصائيات الأسبوع السابق: {previous_start.date()} إلى {previous_end.date()}")
             
-            with self.engine.connect() as conn:
-                # إحصائيات المستخدمين للأسبوع السابق
-                users_query = text("""
-                    SELECT 
-                        COUNT(CASE WHEN last_activity >= :start_date THEN 1 END) as active_users_previous_week,
-                        COUNT(CASE WHEN registration_date >= :start_date THEN 1 END) as new_users_previous_week
-                    FROM users
-                    WHERE COALESCE(grade, '') != 'معلم'
-                """)
-                
-                users_result = conn.execute(users_query, {
-                    'start_date': previous_start
-                }).fetchone()
-                
-                # إحصائيات الاختبارات للأسبوع السابق (بدون معلمين)
-                quiz_query = text("""
-                    SELECT 
-                        COUNT(*) as total_quizzes_previous_week,
-                        COUNT(DISTINCT qr.user_id) as unique_users_previous_week,
-                        AVG(CASE WHEN qr.percentage IS NOT NULL AND qr.percentage > 0 THEN qr.percentage END) as avg_percentage_previous_week,
-                        SUM(qr.total_questions) as total_questions_previous_week
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                """)
-                
-                quiz_result = conn.execute(quiz_query, {
-                    'start_date': previous_start,
-                    'end_date': previous_end
-                }).fetchone()
-                
-                return {
-                    'active_users_previous_week': users_result.active_users_previous_week or 0,
-                    'new_users_previous_week': users_result.new_users_previous_week or 0,
-                    'total_quizzes_previous_week': quiz_result.total_quizzes_previous_week or 0,
-                    'unique_users_previous_week': quiz_result.unique_users_previous_week or 0,
-                    'avg_percentage_previous_week': self.safe_float(quiz_result.avg_percentage_previous_week),
-                    'total_questions_previous_week': quiz_result.total_questions_previous_week or 0
-                }
+            frame = self._daily_frame_for((previous_start, previous_end))
+            
+            # إحصائيات المستخدمين للأسبوع السابق (بدون معلمين)
+            students = frame.students()
+            
+            # إحصائيات الاختبارات للأسبوع السابق (بدون معلمين) من اللقطات اليومية
+            daily = frame.daily_stats(previous_start, previous_end)
+            positive_count = daily['positive_count'].sum()
+            
+            return {
+                'active_users_previous_week': int((students['last_activity'] >= previous_start).sum()),
+                'new_users_previous_week': int((students['registration_date'] >= previous_start).sum()),
+                'total_quizzes_previous_week': int(daily['quiz_count'].sum()),
+                'unique_users_previous_week': int(daily['user_id'].nunique()),
+                'avg_percentage_previous_week': float(daily['positive_sum'].sum() / positive_count) if positive_count else 0.0,
+                'total_questions_previous_week': int(daily['questions_sum'].sum())
+            }
                 
         except Exception as e:
             logger.error(f"خطأ في حساب إحصائيات الأسبوع السابق: {e}")
@@ -227,31 +810,14 @@ class FinalWeeklyReportGenerator:
                 kpis['completion_rate'] = 0
             
             # معدل التفوق + معدل الخطر (بدون معلمين)
-            with self.engine.connect() as conn:
-                kpi_query = text("""
-                    SELECT 
-                        COUNT(CASE WHEN qr.percentage >= 80 THEN 1 END) as excellent_results,
-                        COUNT(CASE WHEN qr.percentage < 50 THEN 1 END) as at_risk_results,
-                        COUNT(*) as total_results
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                """)
-                
-                kpi_result = conn.execute(kpi_query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchone()
-                
-                if kpi_result.total_results > 0:
-                    total = float(kpi_result.total_results)
-                    kpis['excellence_rate'] = round(float(kpi_result.excellent_results) / total * 100, 2)
-                    kpis['at_risk_rate'] = round(float(kpi_result.at_risk_results) / total * 100, 2)
-                else:
-                    kpis['excellence_rate'] = 0
-                    kpis['at_risk_rate'] = 0
+            percentages = self._frame_for(start_date, end_date).period(start_date, end_date)['percentage']
+            if len(percentages) > 0:
+                total = float(len(percentages))
+                kpis['excellence_rate'] = round(float((percentages >= 80).sum()) / total * 100, 2)
+                kpis['at_risk_rate'] = round(float((percentages < 50).sum()) / total * 100, 2)
+            else:
+                kpis['excellence_rate'] = 0
+                kpis['at_risk_rate'] = 0
             
             # متوسط الوقت لكل سؤال
             avg_time = float(stats.get('avg_time_taken', 0))
@@ -343,58 +909,34 @@ class FinalWeeklyReportGenerator:
     def get_comprehensive_stats(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
         """الحصول على إحصائيات شاملة"""
         try:
-            with self.engine.connect() as conn:
-                # إحصائيات المستخدمين (بدون معلمين)
-                users_query = text("""
-                    SELECT 
-                        COUNT(*) as total_registered_users,
-                        COUNT(CASE WHEN last_activity >= :start_date THEN 1 END) as active_users_this_week,
-                        COUNT(CASE WHEN registration_date >= :start_date THEN 1 END) as new_users_this_week
-                    FROM users
-                    WHERE COALESCE(grade, '') != 'معلم'
-                """)
-                
-                users_result = conn.execute(users_query, {
-                    'start_date': start_date
-                }).fetchone()
-                
-                # إحصائيات الاختبارات (بدون معلمين)
-                quiz_query = text("""
-                    SELECT 
-                        COUNT(*) as total_quizzes_this_week,
-                        COUNT(DISTINCT qr.user_id) as unique_users_this_week,
-                        AVG(CASE WHEN qr.percentage IS NOT NULL AND qr.percentage > 0 THEN qr.percentage END) as avg_percentage_this_week,
-                        SUM(qr.total_questions) as total_questions_this_week,
-                        AVG(qr.time_taken_seconds) as avg_time_taken
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                """)
-                
-                quiz_result = conn.execute(quiz_query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchone()
-                
-                # حساب معدل المشاركة
-                total_users = users_result.total_registered_users or 0
-                active_users = users_result.active_users_this_week or 0
-                engagement_rate = (active_users / total_users * 100) if total_users > 0 else 0
-                
-                # معالجة متوسط الدرجات
-                avg_percentage_final = quiz_result.avg_percentage_this_week or 0
-                
-                return {
-                    'total_registered_users': total_users,
-                    'active_users_this_week': active_users,
-                    'new_users_this_week': users_result.new_users_this_week or 0,
-                    'engagement_rate': round(engagement_rate, 2),
-                    'total_quizzes_this_week': quiz_result.total_quizzes_this_week or 0,
-                    'avg_percentage_this_week': round(avg_percentage_final, 2),
-                    'total_questions_this_week': quiz_result.total_questions_this_week or 0,
-                    'avg_time_taken': round(quiz_result.avg_time_taken or 0, 2),
-                }
+            frame = self._frame_for(start_date, end_date)
+            
+            # إحصائيات المستخدمين (بدون معلمين)
+            students = frame.students()
+            total_users = len(students)
+            active_users = int((students['last_activity'] >= start_date).sum())
+            new_users = int((students['registration_date'] >= start_date).sum())
+            
+            # إحصائيات الاختبارات (بدون معلمين)
+            quizzes = frame.period(start_date, end_date)
+            percentages = quizzes['percentage']
+            
+            # حساب معدل المشاركة
+            engagement_rate = (active_users / total_users * 100) if total_users > 0 else 0
+            
+            # معالجة متوسط الدرجات
+            avg_percentage_final = _number(percentages[percentages > 0].mean())
+            
+            return {
+                'total_registered_users': total_users,
+                'active_users_this_week': active_users,
+                'new_users_this_week': new_users,
+                'engagement_rate': round(engagement_rate, 2),
+                'total_quizzes_this_week': len(quizzes),
+                'avg_percentage_this_week': round(avg_percentage_final, 2),
+                'total_questions_this_week': int(quizzes['total_questions'].sum()),
+                'avg_time_taken': round(_number(quizzes['time_taken_seconds'].mean()), 2),
+            }
                 
         except Exception as e:
             logger.error(f"خطأ في الحصول على الإحصائيات الشاملة: {e}")
@@ -403,287 +945,155 @@ class FinalWeeklyReportGenerator:
     def get_quiz_details(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
         """جلب تفاصيل جميع الاختبارات في الفترة المحددة"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        qr.result_id,
-                        qr.user_id,
-                        u.full_name,
-                        u.username,
-                        u.grade,
-                        qr.filter_id as quiz_id,
-                        qr.quiz_name as quiz_title,
-                        'كيمياء' as quiz_subject,
-                        qr.total_questions,
-                        qr.score as correct_answers,
-                        (qr.total_questions - qr.score) as wrong_answers,
-                        qr.percentage,
-                        qr.time_taken_seconds,
-                        qr.completed_at,
-                        qr.start_time as started_at
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                    ORDER BY qr.user_id, qr.completed_at DESC
-                """)
-                
-                result = conn.execute(query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                quiz_details = []
-                for row in result:
-                    # إزالة timezone من التواريخ
-                    completed_at_clean = row.completed_at
-                    if completed_at_clean and hasattr(completed_at_clean, 'tzinfo') and completed_at_clean.tzinfo:
-                        completed_at_clean = completed_at_clean.replace(tzinfo=None)
-                    
-                    started_at_clean = row.started_at
-                    if started_at_clean and hasattr(started_at_clean, 'tzinfo') and started_at_clean.tzinfo:
-                        started_at_clean = started_at_clean.replace(tzinfo=None)
-                    
-                    # حساب الوقت المستغرق بالدقائق
-                    time_minutes = round((row.time_taken_seconds or 0) / 60, 2) if row.time_taken_seconds else 0
-                    
-                    quiz_details.append({
-                        'result_id': row.result_id,
-                        'user_id': row.user_id,
-                        'full_name': row.full_name or 'غير محدد',
-                        'username': row.username or 'غير محدد',
-                        'grade': row.grade or 'غير محدد',
-                        'quiz_id': row.quiz_id or 'غير محدد',
-                        'quiz_title': row.quiz_title or f'اختبار رقم {row.quiz_id}',
-                        'quiz_subject': row.quiz_subject or 'غير محدد',
-                        'total_questions': row.total_questions or 0,
-                        'correct_answers': row.correct_answers or 0,
-                        'wrong_answers': row.wrong_answers or 0,
-                        'percentage': round(row.percentage or 0, 2),
-                        'time_taken_minutes': time_minutes,
-                        'completed_at': completed_at_clean,
-                        'started_at': started_at_clean
-                    })
-                
-                return quiz_details
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date, students_only=False)
+            quizzes = quizzes.sort_values(['user_id', 'completed_at'], ascending=[True, False], kind='stable')
+            wrong_answers = quizzes['total_questions'] - quizzes['score']
+            # الوقت المستغرق بالدقائق
+            time_minutes = (quizzes['time_taken_seconds'] / 60).round(2)
+            
+            quiz_details = []
+            for row, wrong, minutes in zip(quizzes.itertuples(index=False), wrong_answers, time_minutes):
+                quiz_id = _scalar(row.filter_id)
+                quiz_details.append({
+                    'result_id': row.result_id,
+                    'user_id': row.user_id,
+                    'full_name': row.full_name or 'غير محدد',
+                    'username': row.username or 'غير محدد',
+                    'grade': row.grade or 'غير محدد',
+                    'quiz_id': quiz_id or 'غير محدد',
+                    'quiz_title': _scalar(row.quiz_name) or f'اختبار رقم {quiz_id}',
+                    'quiz_subject': 'كيمياء',
+                    'total_questions': int(_number(row.total_questions)),
+                    'correct_answers': int(_number(row.score)),
+                    'wrong_answers': int(_number(wrong)),
+                    'percentage': round(_number(row.percentage), 2),
+                    'time_taken_minutes': _number(minutes) if row.time_taken_seconds else 0,
+                    'completed_at': _scalar(row.completed_at),
+                    'started_at': _scalar(row.start_time)
+                })
+            
+            return quiz_details
                 
         except Exception as e:
             logger.error(f"خطأ في جلب تفاصيل الاختبارات: {e}")
             return []
 
+    @staticmethod
+    def _improvement_trends(quizzes: pd.DataFrame) -> pd.Series:
+        """اتجاه التحسن لكل طالب: متوسط النصف الثاني من درجاته (بالترتيب الزمني) مقابل النصف الأول
+
+        يحتاج درجتين على الأقل؛ الطلاب الآخرون لا يظهرون في النتيجة (غير كافي)
+        """
+        scored = quizzes[quizzes['percentage'].notna()].sort_values(['user_id', 'completed_at'], kind='stable')
+        by_user = scored.groupby('user_id')
+        counts = by_user['percentage'].transform('size')
+        second_half = by_user.cumcount() >= counts // 2
+        halves = scored['percentage'].groupby([scored['user_id'], second_half]).mean().unstack()
+        halves = halves.reindex(columns=[False, True])
+        halves = halves[by_user.size().reindex(halves.index) >= 2]
+        
+        first_half_avg, second_half_avg = halves[False], halves[True]
+        diff = second_half_avg - first_half_avg
+        
+        # الحد الأدنى للتغيير يعتمد على المستوى
+        # طالب مستواه 90% → تغيير 3% يعتبر ملحوظ
+        # طالب مستواه 40% → يحتاج 8% عشان يعتبر تحسن حقيقي
+        avg_overall = (first_half_avg + second_half_avg) / 2
+        threshold = np.select([avg_overall >= 75, avg_overall >= 50], [3, 5], default=8)
+        trend = np.select([diff > threshold, diff < -threshold], ["متحسن", "متراجع"], default="مستقر")
+        return pd.Series(trend, index=halves.index, dtype=object)
+
     def get_user_progress_analysis(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
         """تحليل تقدم المستخدمين مع إضافة تفاصيل الإجابات الصحيحة"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        u.user_id,
-                        u.user_id as telegram_id,
-                        u.username,
-                        u.first_name,
-                        u.last_name,
-                        u.full_name,
-                        u.grade,
-                        u.first_seen_timestamp,
-                        u.last_active_timestamp,
-                        u.registration_date,
-                        u.last_activity,
-                        COUNT(qr.result_id) as total_quizzes,
-                        AVG(qr.percentage) as overall_avg_percentage,
-                        SUM(qr.total_questions) as total_questions_answered,
-                        SUM(qr.score) as total_correct_answers,
-                        SUM(qr.total_questions - qr.score) as total_wrong_answers,
-                        AVG(qr.time_taken_seconds) as avg_time_per_quiz,
-                        MAX(qr.completed_at) as last_quiz_date,
-                        MIN(qr.completed_at) as first_quiz_date
-                    FROM users u
-                    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id 
-                        AND qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                    GROUP BY u.user_id, u.username, u.first_name, u.last_name, u.full_name, 
-                             u.grade, u.first_seen_timestamp, u.last_active_timestamp,
-                             u.registration_date, u.last_activity
-                    ORDER BY overall_avg_percentage DESC NULLS LAST
-                """)
-                
-                result = conn.execute(query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                users_analysis = []
-                for row in result:
-                    avg_percentage = row.overall_avg_percentage or 0
-                    total_quizzes = row.total_quizzes or 0
-                    total_questions = row.total_questions_answered or 0
-                    user_grade = row.grade or 'غير محدد'
-                    
-                    # ══ مستوى الأداء: يعتمد على عدد الأسئلة (مو الاختبارات) ══
-                    if total_questions == 0:
-                        performance_level = "لا يوجد نشاط"
-                        confidence_level = "—"
-                    elif total_questions < 5:
-                        # بيانات غير كافية للتقييم
-                        performance_level = "بيانات قليلة"
-                        confidence_level = "غير كافية"
-                    elif total_questions < 15:
-                        # تقييم مبدئي
-                        confidence_level = "مبدئي"
-                        if avg_percentage >= 70:
-                            performance_level = "واعد"
-                        elif avg_percentage >= 50:
-                            performance_level = "مقبول"
-                        else:
-                            performance_level = "يحتاج متابعة"
-                    elif total_questions < 30:
-                        # تقييم أولي
-                        confidence_level = "أولي"
-                        if avg_percentage >= 80:
-                            performance_level = "جيد جداً"
-                        elif avg_percentage >= 65:
-                            performance_level = "جيد"
-                        elif avg_percentage >= 50:
-                            performance_level = "متوسط"
-                        else:
-                            performance_level = "ضعيف"
-                    else:
-                        # تقييم موثوق (30+ سؤال)
-                        confidence_level = "موثوق"
-                        if avg_percentage >= 85:
-                            performance_level = "ممتاز"
-                        elif avg_percentage >= 75:
-                            performance_level = "جيد جداً"
-                        elif avg_percentage >= 65:
-                            performance_level = "جيد"
-                        elif avg_percentage >= 50:
-                            performance_level = "متوسط"
-                        else:
-                            performance_level = "ضعيف"
-                    
-                    # ══ مستوى النشاط: يراعي العدد المطلق + المعدل الأسبوعي ══
-                    period_days = max((end_date - start_date).days, 1)
-                    period_weeks = max(period_days / 7, 1)
-                    quizzes_per_week = total_quizzes / period_weeks
-                    
-                    if total_quizzes == 0:
-                        activity_level = "غير نشط"
-                    elif total_quizzes == 1:
-                        activity_level = "تجربة واحدة"
-                    elif quizzes_per_week < 1:
-                        activity_level = "متقطع"
-                    elif quizzes_per_week < 3:
-                        activity_level = "منتظم"
-                    elif quizzes_per_week < 6:
-                        activity_level = "نشط"
-                    else:
-                        activity_level = "نشط جداً"
-                    
-                    # تحليل الاتجاه: يكفي 2 اختبار
-                    if total_quizzes >= 2:
-                        trend_query = text("""
-                            SELECT percentage
-                            FROM quiz_results 
-                            WHERE user_id = :user_id 
-                                AND completed_at >= :start_date 
-                                AND completed_at <= :end_date
-                                AND percentage IS NOT NULL
-                            ORDER BY completed_at ASC
-                        """)
-                        
-                        trend_result = conn.execute(trend_query, {
-                            'user_id': row.user_id,
-                            'start_date': start_date,
-                            'end_date': end_date
-                        }).fetchall()
-                        
-                        if len(trend_result) >= 2:
-                            scores = [self.safe_convert(r.percentage) for r in trend_result]
-                            mid = len(scores) // 2
-                            first_half_avg = sum(scores[:mid]) / mid if mid > 0 else 0
-                            second_half_avg = sum(scores[mid:]) / (len(scores) - mid) if (len(scores) - mid) > 0 else 0
-                            diff = second_half_avg - first_half_avg
-                            
-                            # الحد الأدنى للتغيير يعتمد على المستوى
-                            # طالب مستواه 90% → تغيير 3% يعتبر ملحوظ
-                            # طالب مستواه 40% → يحتاج 8% عشان يعتبر تحسن حقيقي
-                            avg_overall = (first_half_avg + second_half_avg) / 2
-                            if avg_overall >= 75:
-                                threshold = 3
-                            elif avg_overall >= 50:
-                                threshold = 5
-                            else:
-                                threshold = 8
-                            
-                            if diff > threshold:
-                                trend = "متحسن"
-                            elif diff < -threshold:
-                                trend = "متراجع"
-                            else:
-                                trend = "مستقر"
-                        else:
-                            trend = "غير كافي"
-                    else:
-                        trend = "غير كافي"
-                    
-                    # تحديد الاسم الكامل
-                    full_name = row.full_name
-                    if not full_name:
-                        full_name = f"{row.first_name or ''} {row.last_name or ''}".strip()
-                    if not full_name:
-                        full_name = row.username or 'غير محدد'
-                    
-                    # إزالة timezone من التواريخ لتوافق Excel
-                    first_seen_clean = row.first_seen_timestamp or row.registration_date
-                    if first_seen_clean and hasattr(first_seen_clean, 'tzinfo') and first_seen_clean.tzinfo:
-                        first_seen_clean = first_seen_clean.replace(tzinfo=None)
-                    
-                    last_active_clean = row.last_active_timestamp or row.last_activity
-                    if last_active_clean and hasattr(last_active_clean, 'tzinfo') and last_active_clean.tzinfo:
-                        last_active_clean = last_active_clean.replace(tzinfo=None)
-                    
-                    last_quiz_clean = row.last_quiz_date
-                    if last_quiz_clean and hasattr(last_quiz_clean, 'tzinfo') and last_quiz_clean.tzinfo:
-                        last_quiz_clean = last_quiz_clean.replace(tzinfo=None)
-                    
-                    first_quiz_clean = row.first_quiz_date
-                    if first_quiz_clean and hasattr(first_quiz_clean, 'tzinfo') and first_quiz_clean.tzinfo:
-                        first_quiz_clean = first_quiz_clean.replace(tzinfo=None)
-                    
-                    # حساب متوسط الأسئلة لكل اختبار
-                    avg_questions_per_quiz = 0
-                    if total_quizzes > 0:
-                        avg_questions_per_quiz = round((row.total_questions_answered or 0) / total_quizzes, 1)
-                    
-                    # حساب معدل الإجابات الصحيحة
-                    correct_answer_rate = 0
-                    if (row.total_questions_answered or 0) > 0:
-                        correct_answer_rate = round(((row.total_correct_answers or 0) / (row.total_questions_answered or 1)) * 100, 2)
-                    
-                    users_analysis.append({
-                        'user_id': row.user_id,
-                        'telegram_id': row.telegram_id,
-                        'username': row.username or 'غير محدد',
-                        'full_name': full_name,
-                        'grade': row.grade or 'غير محدد',
-                        'first_seen_timestamp': first_seen_clean,
-                        'last_active_timestamp': last_active_clean,
-                        'total_quizzes': total_quizzes,
-                        'overall_avg_percentage': round(avg_percentage, 2),
-                        'total_questions_answered': row.total_questions_answered or 0,
-                        'total_correct_answers': row.total_correct_answers or 0,
-                        'total_wrong_answers': row.total_wrong_answers or 0,
-                        'avg_questions_per_quiz': avg_questions_per_quiz,
-                        'correct_answer_rate': correct_answer_rate,
-                        'avg_time_per_quiz': round(self.safe_convert(row.avg_time_per_quiz), 2),
-                        'performance_level': performance_level,
-                        'confidence_level': confidence_level,
-                        'activity_level': activity_level,
-                        'improvement_trend': trend,
-                        'last_quiz_date': last_quiz_clean,
-                        'first_quiz_date': first_quiz_clean
-                    })
-                
-                return users_analysis
+            frame = self._frame_for(start_date, end_date)
+            quizzes = frame.period(start_date, end_date, students_only=False)
+            by_user = quizzes.groupby('user_id')
+            per_user = pd.DataFrame({
+                'total_quizzes': by_user.size(),
+                'overall_avg_percentage': by_user['percentage'].mean(),
+                'total_questions_answered': by_user['total_questions'].sum(),
+                'total_correct_answers': by_user['score'].sum(),
+                'total_wrong_answers': (quizzes['total_questions'] - quizzes['score']).groupby(quizzes['user_id']).sum(),
+                'avg_time_per_quiz': by_user['time_taken_seconds'].mean(),
+                'last_quiz_date': by_user['completed_at'].max(),
+                'first_quiz_date': by_user['completed_at'].min(),
+                'improvement_trend': self._improvement_trends(quizzes),
+            })
+            
+            # كل المستخدمين (LEFT JOIN): من لا نتائج له في الفترة يظهر بصفر اختبارات
+            users = frame.users.join(per_user, on='user_id')
+            users = users.sort_values('overall_avg_percentage', ascending=False, na_position='last', kind='stable')
+            
+            total_quizzes = users['total_quizzes'].fillna(0).astype(int)
+            avg_percentage = users['overall_avg_percentage'].fillna(0)
+            total_questions = users['total_questions_answered'].fillna(0).astype(int)
+            total_correct = users['total_correct_answers'].fillna(0).astype(int)
+            
+            # ══ مستوى الأداء: يعتمد على عدد الأسئلة (مو الاختبارات) ══
+            # أقل من 5 أسئلة: بيانات غير كافية، أقل من 15: تقييم مبدئي، أقل من 30: أولي، 30+: موثوق
+            initial = total_questions < 15
+            early = total_questions < 30
+            performance_level = np.select([
+                total_questions == 0,
+                total_questions < 5,
+                initial & (avg_percentage >= 70), initial & (avg_percentage >= 50), initial,
+                early & (avg_percentage >= 80), early & (avg_percentage >= 65), early & (avg_percentage >= 50), early,
+                avg_percentage >= 85, avg_percentage >= 75, avg_percentage >= 65, avg_percentage >= 50,
+            ], [
+                "لا يوجد نشاط",
+                "بيانات قليلة",
+                "واعد", "مقبول", "يحتاج متابعة",
+                "جيد جداً", "جيد", "متوسط", "ضعيف",
+                "ممتاز", "جيد جداً", "جيد", "متوسط",
+            ], default="ضعيف")
+            confidence_level = np.select(
+                [total_questions == 0, total_questions < 5, initial, early],
+                ["—", "غير كافية", "مبدئي", "أولي"], default="موثوق")
+            
+            # ══ مستوى النشاط: يراعي العدد المطلق + المعدل الأسبوعي ══
+            period_days = max((end_date - start_date).days, 1)
+            period_weeks = max(period_days / 7, 1)
+            quizzes_per_week = total_quizzes / period_weeks
+            activity_level = np.select([
+                total_quizzes == 0, total_quizzes == 1,
+                quizzes_per_week < 1, quizzes_per_week < 3, quizzes_per_week < 6,
+            ], ["غير نشط", "تجربة واحدة", "متقطع", "منتظم", "نشط"], default="نشط جداً")
+            
+            # تحديد الاسم الكامل
+            full_name = users['full_name'].fillna('')
+            full_name = full_name.where(
+                full_name != '', (users['first_name'].fillna('') + ' ' + users['last_name'].fillna('')).str.strip())
+            full_name = full_name.where(full_name != '', users['username'].fillna(''))
+            full_name = full_name.where(full_name != '', 'غير محدد')
+            
+            analysis = pd.DataFrame({
+                'user_id': users['user_id'],
+                'telegram_id': users['user_id'],
+                'username': users['username'].where(users['username'].fillna('') != '', 'غير محدد'),
+                'full_name': full_name,
+                'grade': users['grade'].where(users['grade'].fillna('') != '', 'غير محدد'),
+                'first_seen_timestamp': users['first_seen_timestamp'].fillna(users['registration_date']),
+                'last_active_timestamp': users['last_active_timestamp'].fillna(users['last_activity']),
+                'total_quizzes': total_quizzes,
+                'overall_avg_percentage': avg_percentage.round(2),
+                'total_questions_answered': total_questions,
+                'total_correct_answers': total_correct,
+                'total_wrong_answers': users['total_wrong_answers'].fillna(0).astype(int),
+                # متوسط الأسئلة لكل اختبار ومعدل الإجابات الصحيحة
+                'avg_questions_per_quiz': (total_questions / total_quizzes.where(total_quizzes > 0)).round(1).fillna(0),
+                'correct_answer_rate': (total_correct / total_questions.where(total_questions > 0) * 100).round(2).fillna(0),
+                'avg_time_per_quiz': users['avg_time_per_quiz'].fillna(0).round(2),
+                'performance_level': performance_level,
+                'confidence_level': confidence_level,
+                'activity_level': activity_level,
+                'improvement_trend': users['improvement_trend'].fillna("غير كافي"),
+                'last_quiz_date': users['last_quiz_date'],
+                'first_quiz_date': users['first_quiz_date']
+            })
+            
+            # قيم Python عادية (None بدل NaN/NaT) كما كانت من صفوف SQL
+            return analysis.astype(object).where(analysis.notna(), None).to_dict('records')
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل تقدم المستخدمين: {e}")
@@ -692,42 +1102,35 @@ class FinalWeeklyReportGenerator:
     def get_grade_performance_analysis(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
         """تحليل أداء الصفوف الدراسية"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        u.grade,
-                        COUNT(DISTINCT u.user_id) as total_students,
-                        COUNT(qr.result_id) as total_quizzes,
-                        AVG(qr.percentage) as avg_percentage,
-                        COUNT(DISTINCT CASE WHEN qr.completed_at >= :start_date THEN u.user_id END) as active_students
-                    FROM users u
-                    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id 
-                        AND qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                    WHERE u.grade IS NOT NULL AND u.grade != '' AND u.grade != 'معلم'
-                    GROUP BY u.grade
-                    ORDER BY u.grade
-                """)
-                
-                result = conn.execute(query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                grade_analysis = []
-                for row in result:
-                    participation_rate = (row.active_students / row.total_students * 100) if row.total_students > 0 else 0
-                    
-                    grade_analysis.append({
-                        'grade': row.grade,
-                        'total_students': row.total_students,
-                        'active_students': row.active_students or 0,
-                        'participation_rate': round(participation_rate, 2),
-                        'total_quizzes': row.total_quizzes or 0,
-                        'avg_percentage': round(row.avg_percentage or 0, 2)
-                    })
-                
-                return grade_analysis
+            frame = self._frame_for(start_date, end_date)
+            grades = frame.users['grade'].fillna('')
+            graded = frame.users.loc[(grades != '') & (grades != 'معلم'), ['user_id', 'grade']]
+            quizzes = frame.period(start_date, end_date, students_only=False)[['user_id', 'result_id', 'percentage']]
+            joined = graded.merge(quizzes, on='user_id', how='left')
+            
+            by_grade = joined.groupby('grade', sort=True)
+            summary = pd.DataFrame({
+                'total_students': by_grade['user_id'].nunique(),
+                'total_quizzes': by_grade['result_id'].count(),
+                'avg_percentage': by_grade['percentage'].mean(),
+                'active_students': joined[joined['result_id'].notna()].groupby('grade')['user_id'].nunique(),
+            })
+            
+            grade_analysis = []
+            for row in summary.itertuples():
+                active_students = int(_number(row.active_students))
+                participation_rate = (active_students / row.total_students * 100) if row.total_students > 0 else 0
+                
+                grade_analysis.append({
+                    'grade': row.Index,
+                    'total_students': int(row.total_students),
+                    'active_students': active_students,
+                    'participation_rate': round(participation_rate, 2),
+                    'total_quizzes': int(row.total_quizzes),
+                    'avg_percentage': round(_number(row.avg_percentage), 2)
+                })
+            
+            return grade_analysis
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل أداء الصفوف: {e}")
@@ -736,67 +1139,55 @@ class FinalWeeklyReportGenerator:
     def get_difficult_questions_analysis(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
         """تحليل الأسئلة الصعبة بناءً على نتائج الاختبارات"""
         try:
-            with self.engine.connect() as conn:
-                # بما أن جدول user_answers غير متوفر، سنحلل من quiz_results
-                query = text("""
-                    SELECT 
-                        qr.filter_id as question_set_id,
-                        qr.quiz_name,
-                        COUNT(*) as total_attempts,
-                        SUM(qr.score) as total_correct_answers,
-                        SUM(qr.total_questions) as total_questions_asked,
-                        CAST(
-                            ROUND(
-                                CAST((SUM(qr.score)::float / SUM(qr.total_questions)) * 100 AS NUMERIC), 2
-                            ) AS FLOAT
-                        ) as success_rate,
-                        AVG(qr.percentage) as avg_percentage
-                    FROM quiz_results qr
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND qr.total_questions > 0
-                    GROUP BY qr.filter_id, qr.quiz_name
-                    HAVING COUNT(*) >= 3  -- على الأقل 3 محاولات
-                    ORDER BY success_rate ASC, total_attempts DESC
-                    LIMIT 15
-                """)
-                
-                result = conn.execute(query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                difficult_questions = []
-                for row in result:
-                    success_rate = row.success_rate or 0
-                    
-                    # تحديد مستوى الصعوبة
-                    if success_rate < 30:
-                        difficulty_level = "صعب جداً"
-                        priority = "عالية"
-                    elif success_rate < 50:
-                        difficulty_level = "صعب"
-                        priority = "متوسطة"
-                    elif success_rate < 70:
-                        difficulty_level = "متوسط"
-                        priority = "منخفضة"
-                    else:
-                        difficulty_level = "سهل"
-                        priority = "منخفضة"
-                    
-                    difficult_questions.append({
-                        'question_set_id': row.question_set_id or 'غير محدد',
-                        'quiz_name': row.quiz_name or 'اختبار غير محدد',
-                        'total_attempts': row.total_attempts,
-                        'correct_answers': row.total_correct_answers or 0,
-                        'wrong_answers': (row.total_questions_asked or 0) - (row.total_correct_answers or 0),
-                        'success_rate': success_rate,
-                        'avg_percentage': round(row.avg_percentage or 0, 2),
-                        'difficulty_level': difficulty_level,
-                        'review_priority': priority
-                    })
-                
-                return difficult_questions
+            # بما أن جدول user_answers غير متوفر، سنحلل من quiz_results (كل النتائج، بدون ربط بالمستخدمين)
+            quizzes = self._frame_for(start_date, end_date).period(
+                start_date, end_date, students_only=False, joined=False)
+            quizzes = quizzes[quizzes['total_questions'] > 0]
+            
+            by_quiz = quizzes.groupby(['filter_id', 'quiz_name'], dropna=False, sort=False)
+            summary = pd.DataFrame({
+                'total_attempts': by_quiz.size(),
+                'total_correct_answers': by_quiz['score'].sum(min_count=1),
+                'total_questions_asked': by_quiz['total_questions'].sum(),
+                'avg_percentage': by_quiz['percentage'].mean(),
+            })
+            summary = summary[summary['total_attempts'] >= 3]  # على الأقل 3 محاولات
+            summary['success_rate'] = (summary['total_correct_answers'] / summary['total_questions_asked'] * 100).round(2)
+            summary = summary.sort_values(['success_rate', 'total_attempts'], ascending=[True, False],
+                                          na_position='last', kind='stable').head(15)
+            
+            difficult_questions = []
+            for (question_set_id, quiz_name), row in zip(summary.index, summary.itertuples(index=False)):
+                success_rate = _number(row.success_rate)
+                correct_answers = int(_number(row.total_correct_answers))
+                
+                # تحديد مستوى الصعوبة
+                if success_rate < 30:
+                    difficulty_level = "صعب جداً"
+                    priority = "عالية"
+                elif success_rate < 50:
+                    difficulty_level = "صعب"
+                    priority = "متوسطة"
+                elif success_rate < 70:
+                    difficulty_level = "متوسط"
+                    priority = "منخفضة"
+                else:
+                    difficulty_level = "سهل"
+                    priority = "منخفضة"
+                
+                difficult_questions.append({
+                    'question_set_id': _scalar(question_set_id) or 'غير محدد',
+                    'quiz_name': _scalar(quiz_name) or 'اختبار غير محدد',
+                    'total_attempts': int(row.total_attempts),
+                    'correct_answers': correct_answers,
+                    'wrong_answers': int(_number(row.total_questions_asked)) - correct_answers,
+                    'success_rate': success_rate,
+                    'avg_percentage': round(_number(row.avg_percentage), 2),
+                    'difficulty_level': difficulty_level,
+                    'review_priority': priority
+                })
+            
+            return difficult_questions
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل الأسئلة الصعبة: {e}")
@@ -805,87 +1196,24 @@ class FinalWeeklyReportGenerator:
     def get_individual_difficult_questions(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
         """تحليل الأسئلة الفردية الصعبة من تفاصيل الإجابات"""
         try:
-            with self.engine.connect() as conn:
-                # جلب تفاصيل الإجابات من quiz_results
-                query = text("""
-                    SELECT 
-                        qr.quiz_name,
-                        qr.answers_details,
-                        qr.completed_at
-                    FROM quiz_results qr
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND qr.answers_details IS NOT NULL
-                        AND qr.answers_details != '[]'
-                """)
-                
-                result = conn.execute(query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                # تحليل تفاصيل الأسئلة
-                question_stats = {}
+            # قبل اكتمال نسخ السجل القديم تُفك answers_details بدل quiz_answers حتى لا تنقص الإحصائيات
+            from_details = not self._quiz_answers_ready()
+            # الأيام المغلقة من لقطات الأسئلة اليومية، وأطراف الفترة واليوم الحالي من الإجابات الخام
+            frame = self._report_frame
+            closed_through = frame.closed_through if frame is not None else self._close_report_rollups()
+            days = _rollup_days(start_date, end_date, (date.min, closed_through) if closed_through else None)
+            with self.engine.begin() as conn:
+                # إجابات الأجزاء الخام تُستخرج مرة واحدة إلى report_answers، ثم الإحصائيات والتفاصيل منها
+                create_report_answers(conn, _raw_ranges(start_date, end_date, days), from_details=from_details)
+                
+                # محاولات حقيقية فقط (بدون المتجاوزة)، على الأقل 2 محاولة، أصعب 20 سؤال حسب معدل الخطأ
+                result = question_answer_stats(conn, min_attempts=2, limit=20, days=days)
                 
-                for row in result:
-                    try:
-                        import json
-                        answers_details = json.loads(row.answers_details) if isinstance(row.answers_details, str) else row.answers_details
-                        
-                        for answer in answers_details:
-                            if isinstance(answer, dict):
-                                question_id = answer.get('question_id')
-                                question_text = answer.get('question_text', 'غير محدد')
-                                is_correct = answer.get('is_correct', False)
-                                correct_option_text = answer.get('correct_option_text', 'غير محدد')
-                                chosen_option_text = answer.get('chosen_option_text', 'غير محدد')
-                                
-                                if not question_id:
-                                    continue
-                                
-                                # تهيئة إحصائيات السؤال
-                                if question_id not in question_stats:
-                                    question_stats[question_id] = {
-                                        'question_id': question_id,
-                                        'question_text': question_text,
-                                        'correct_answer': correct_option_text,
-                                        'quiz_name': row.quiz_name,
-                                        'total_attempts': 0,
-                                        'correct_attempts': 0,
-                                        'wrong_attempts': 0,
-                                        'skipped_count': 0,
-                                        'wrong_answers': []
-                                    }
-                                
-                                # ══ تجاهل الأسئلة اللي ما وصل لها الطالب ══
-                                if 'تم إنهاء الاختبار' in str(chosen_option_text):
-                                    question_stats[question_id]['skipped_count'] += 1
-                                    continue
-                                
-                                # محاولة حقيقية فقط
-                                question_stats[question_id]['total_attempts'] += 1
-                                
-                                if is_correct:
-                                    question_stats[question_id]['correct_attempts'] += 1
-                                else:
-                                    question_stats[question_id]['wrong_attempts'] += 1
-                                    if chosen_option_text and chosen_option_text not in question_stats[question_id]['wrong_answers']:
-                                        question_stats[question_id]['wrong_answers'].append(chosen_option_text)
-                    
-                    except Exception as parse_error:
-                        logger.warning(f"خطأ في تحليل تفاصيل الإجابات: {parse_error}")
-                        continue
-                
-                # تحويل إلى قائمة وترتيب حسب معدل الخطأ
                 difficult_questions = []
-                for question_id, stats in question_stats.items():
-                    # محاولات حقيقية فقط (بدون المتجاوزة)
-                    real_attempts = stats['total_attempts']
-                    if real_attempts < 2:  # على الأقل 2 محاولة حقيقية
-                        continue
-                    
-                    error_rate = (stats['wrong_attempts'] / real_attempts) * 100
-                    success_rate = (stats['correct_attempts'] / real_attempts) * 100
+                for row in result:
+                    real_attempts = self.safe_int(row.total_attempts)
+                    error_rate = (self.safe_int(row.wrong_attempts) / real_attempts) * 100
+                    success_rate = (self.safe_int(row.correct_attempts) / real_attempts) * 100
                     
                     # تحديد مستوى الصعوبة
                     if error_rate >= 70:
@@ -901,99 +1229,134 @@ class FinalWeeklyReportGenerator:
                         difficulty_level = "سهل"
                         priority = "منخفضة"
                     
-                    question_text_safe = stats['question_text'] if stats['question_text'] else 'غير محدد'
-                    question_text_display = question_text_safe[:100] + '...' if len(question_text_safe) > 100 else question_text_safe
-                    
-                    skipped = stats.get('skipped_count', 0)
-                    
                     difficult_questions.append({
-                        'question_id': question_id,
-                        'question_text': question_text_display,
-                        'quiz_name': stats['quiz_name'],
-                        'correct_answer': stats['correct_answer'],
+                        'question_id': row.question_id,
+                        'question_text': 'غير محدد',
+                        'quiz_name': None,
+                        'correct_answer': 'غير محدد',
                         'total_attempts': real_attempts,
-                        'correct_attempts': stats['correct_attempts'],
-                        'wrong_attempts': stats['wrong_attempts'],
-                        'skipped_count': skipped,
+                        'correct_attempts': self.safe_int(row.correct_attempts),
+                        'wrong_attempts': self.safe_int(row.wrong_attempts),
+                        'skipped_count': self.safe_int(row.skipped_count),
                         'error_rate': round(error_rate, 2),
                         'success_rate': round(success_rate, 2),
                         'difficulty_level': difficulty_level,
                         'review_priority': priority,
-                        'common_wrong_answers': ', '.join(stats['wrong_answers'][:3])
+                        'common_wrong_answers': '',
+                        'first_result_id': row.first_result_id,
+                        'first_answer_index': row.first_answer_index,
                     })
                 
-                # ترتيب حسب معدل الخطأ (الأصعب أولاً)
-                difficult_questions.sort(key=lambda x: x['error_rate'], reverse=True)
-                
-                return difficult_questions[:20]  # أصعب 20 سؤال
+                self._fill_difficult_question_details(conn, difficult_questions, days)
+                return difficult_questions
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل الأسئلة الفردية الصعبة: {e}")
             return []
     
+    def _fill_difficult_question_details(self, conn, difficult_questions: List[Dict[str, Any]], days: tuple = None) -> None:
+        """إضافة نص السؤال والإجابة الصحيحة واسم الاختبار والإجابات الخاطئة الشائعة للأسئلة المختارة فقط
+
+        days: أيام اللقطات (أول 3 إجابات خاطئة لكل يوم محفوظة فيها) بالإضافة إلى report_answers
+        """
+        if not difficult_questions:
+            return
+        question_ids = [q['question_id'] for q in difficult_questions]
+        
+        # اسم أول اختبار ظهر فيه السؤال، والنص من question_texts وإلا من أول إجابة له في answers_details
+        texts = {
+            row.question_id: row
+            for row in conn.execute(text("""
+                SELECT 
+                    w.question_id,
+                    qr.quiz_name,
+                    COALESCE(qt.question_text, qr.answers_details -> w.answer_index ->> 'question_text') AS question_text,
+                    COALESCE(qt.correct_option_text, qr.answers_details -> w.answer_index ->> 'correct_option_text') AS correct_option_text
+                FROM unnest(CAST(:ids AS text[]), CAST(:result_ids AS bigint[]), CAST(:indexes AS int[]))
+                    AS w(question_id, result_id, answer_index)
+                LEFT JOIN question_texts qt ON qt.question_id = w.question_id
+                LEFT JOIN quiz_results qr ON qr.result_id = w.result_id
+            """), {
+                'ids': question_ids,
+                'result_ids': [q.pop('first_result_id') for q in difficult_questions],
+                'indexes': [q.pop('first_answer_index') for q in difficult_questions],
+            }).fetchall()
+        }
+        # الإجابة المختارة تُقرأ مباشرة من موقعها في answers_details (answer_index) بدون فك المصفوفة كاملة
+        params = {'ids': question_ids}
+        rollups = ""
+        if days:
+            params.update(first_day=days[0], last_day=days[1])
+            rollups = """
+                UNION ALL
+                SELECT s.question_id, w.chosen_text, w.first_seen
+                FROM report_daily_question_stats s
+                CROSS JOIN LATERAL unnest(s.wrong_answers, s.wrong_answer_ids) AS w(chosen_text, first_seen)
+                WHERE s.day BETWEEN :first_day AND :last_day AND s.question_id = ANY(:ids)
+            """
+        wrong_answers = {}
+        for row in conn.execute(text("""
+            SELECT question_id, chosen_text, MIN(first_seen) AS first_seen
+            FROM (
+                SELECT 
+                    ra.question_id,
+                    qr.answers_details -> ra.answer_index ->> 'chosen_option_text' AS chosen_text,
+                    ra.result_id AS first_seen
+                FROM report_answers ra
+                JOIN quiz_results qr ON qr.result_id = ra.result_id
+                WHERE ra.question_id = ANY(:ids) AND ra.outcome = 'wrong'
+                """ + rollups + """
+            ) chosen
+            GROUP BY question_id, chosen_text
+            ORDER BY question_id, first_seen
+        """), params).fetchall():
+            if row.chosen_text:
+                wrong_answers.setdefault(row.question_id, []).append(row.chosen_text)
+        
+        for question in difficult_questions:
+            q_id = question['question_id']
+            text_row = texts.get(q_id)
+            question_text_safe = (text_row.question_text if text_row else None) or 'غير محدد'
+            question['question_text'] = question_text_safe[:100] + '...' if len(question_text_safe) > 100 else question_text_safe
+            question['correct_answer'] = (text_row.correct_option_text if text_row else None) or 'غير محدد'
+            question['quiz_name'] = text_row.quiz_name if text_row else None
+            question['common_wrong_answers'] = ', '.join(wrong_answers.get(q_id, [])[:3])
+    
     def get_time_patterns_analysis(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
         """تحليل أنماط الوقت والنشاط"""
         try:
-            with self.engine.connect() as conn:
-                # النشاط اليومي (بدون معلمين)
-                daily_query = text("""
-                    SELECT 
-                        DATE(qr.completed_at) as quiz_date,
-                        COUNT(*) as quiz_count,
-                        COUNT(DISTINCT qr.user_id) as unique_users
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    GROUP BY DATE(qr.completed_at)
-                    ORDER BY DATE(qr.completed_at)
-                """)
-                
-                daily_result = conn.execute(daily_query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                # النشاط حسب الساعة (بدون معلمين)
-                hourly_query = text("""
-                    SELECT 
-                        EXTRACT(HOUR FROM qr.completed_at) as hour,
-                        COUNT(*) as quiz_count
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    GROUP BY EXTRACT(HOUR FROM qr.completed_at)
-                    ORDER BY quiz_count DESC
-                    LIMIT 5
-                """)
-                
-                hourly_result = conn.execute(hourly_query, {
-                    'start_date': start_date,
-                    'end_date': end_date
-                }).fetchall()
-                
-                daily_activity = [
-                    {
-                        'date': row.quiz_date,
-                        'quiz_count': row.quiz_count,
-                        'unique_users': row.unique_users
-                    }
-                    for row in daily_result
-                ]
-                
-                peak_hours = [
-                    {
-                        'hour': int(row.hour),
-                        'quiz_count': row.quiz_count
-                    }
-                    for row in hourly_result
-                ]
-                
-                return {
-                    'daily_activity': daily_activity,
-                    'peak_hours': peak_hours
+            # بدون معلمين
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date)
+            completed = quizzes['completed_at']
+            
+            # النشاط اليومي
+            daily = quizzes.groupby(completed.dt.date).agg(
+                quiz_count=('result_id', 'size'), unique_users=('user_id', 'nunique'))
+            
+            # النشاط حسب الساعة (أعلى 5 ساعات)
+            hourly = quizzes.groupby(completed.dt.hour).size().sort_values(ascending=False, kind='stable').head(5)
+            
+            daily_activity = [
+                {
+                    'date': row.Index,
+                    'quiz_count': int(row.quiz_count),
+                    'unique_users': int(row.unique_users)
                 }
+                for row in daily.itertuples()
+            ]
+            
+            peak_hours = [
+                {
+                    'hour': int(hour),
+                    'quiz_count': int(quiz_count)
+                }
+                for hour, quiz_count in hourly.items()
+            ]
+            
+            return {
+                'daily_activity': daily_activity,
+                'peak_hours': peak_hours
+            }
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل أنماط الوقت: {e}")
@@ -1447,102 +1810,52 @@ class FinalWeeklyReportGenerator:
     def analyze_topic_performance(self, start_date: datetime, end_date: datetime) -> List[Dict]:
         """تحليل أداء كل طالب حسب الوحدة/الموضوع"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        u.user_id, u.full_name, u.grade,
-                        qr.quiz_name, qr.percentage, qr.score,
-                        qr.total_questions, qr.time_taken_seconds
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                        AND qr.quiz_name IS NOT NULL
-                    ORDER BY u.full_name, qr.quiz_name
-                """)
-                rows = conn.execute(query, {
-                    'start_date': start_date, 'end_date': end_date
-                }).fetchall()
-                
-                # استخراج اسم الوحدة من اسم الاختبار
-                def extract_topic(quiz_name):
-                    if not quiz_name:
-                        return 'أخرى'
-                    name = str(quiz_name)
-                    # unit_quiz - كيمياء 2-2 - الطاقة والتغيرات
-                    if ' - ' in name:
-                        parts = name.split(' - ')
-                        if len(parts) >= 3:
-                            return parts[-1].strip()[:40]
-                        elif len(parts) >= 2:
-                            return parts[-1].strip()[:40]
-                    if 'all_scope' in name:
-                        return 'اختبار شامل'
-                    if 'تقوية' in name:
-                        # 🎯 تقوية: كيمياء -1 - المادة الخواص
-                        if ':' in name:
-                            after_colon = name.split(':')[-1].strip()
-                            if ' - ' in after_colon:
-                                return after_colon.split(' - ')[-1].strip()[:40]
-                        return 'تقوية نقاط الضعف'
-                    if 'عشوائي' in name:
-                        return 'اختبار عشوائي'
-                    return name[:40]
-                
-                # تجميع حسب الطالب + الموضوع
-                student_topics = {}
-                for row in rows:
-                    uid = row.user_id
-                    topic = extract_topic(row.quiz_name)
-                    key = (uid, topic)
-                    
-                    if key not in student_topics:
-                        student_topics[key] = {
-                            'الاسم': row.full_name or 'غير محدد',
-                            'الصف': row.grade or '-',
-                            'الموضوع': topic,
-                            'المحاولات': 0,
-                            'مجموع_الدرجات': 0,
-                            'مجموع_الأسئلة': 0,
-                            'مجموع_الصحيحة': 0,
-                        }
-                    
-                    st = student_topics[key]
-                    st['المحاولات'] += 1
-                    st['مجموع_الدرجات'] += float(row.percentage or 0)
-                    st['مجموع_الأسئلة'] += int(row.total_questions or 0)
-                    st['مجموع_الصحيحة'] += int(row.score or 0)
-                
-                result = []
-                for key, st in student_topics.items():
-                    avg_pct = round(st['مجموع_الدرجات'] / st['المحاولات'], 1) if st['المحاولات'] > 0 else 0
-                    accuracy = round(st['مجموع_الصحيحة'] / st['مجموع_الأسئلة'] * 100, 1) if st['مجموع_الأسئلة'] > 0 else 0
-                    
-                    # تقييم المستوى في الموضوع
-                    if avg_pct >= 80:
-                        level = "ممتاز ✅"
-                    elif avg_pct >= 65:
-                        level = "جيد"
-                    elif avg_pct >= 50:
-                        level = "متوسط ⚠️"
-                    else:
-                        level = "ضعيف ❌"
-                    
-                    result.append({
-                        'الاسم': st['الاسم'],
-                        'الصف': st['الصف'],
-                        'الموضوع': st['الموضوع'],
-                        'المحاولات': st['المحاولات'],
-                        'الأسئلة': st['مجموع_الأسئلة'],
-                        'الصحيحة': st['مجموع_الصحيحة'],
-                        'متوسط الدرجة (%)': avg_pct,
-                        'الدقة (%)': accuracy,
-                        'المستوى': level,
-                    })
-                
-                result.sort(key=lambda x: (x['الاسم'], -x['متوسط الدرجة (%)']))
-                return result
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date)
+            quizzes = quizzes[quizzes['quiz_name'].notna()]
+            
+            # استخراج اسم الوحدة من اسم الاختبار (مرة لكل اسم اختبار)
+            topics = {name: _extract_quiz_topic(name) for name in quizzes['quiz_name'].unique()}
+            
+            # تجميع حسب الطالب + الموضوع
+            student_topics = quizzes.assign(topic=quizzes['quiz_name'].map(topics)).groupby(
+                ['user_id', 'topic'], sort=False).agg(
+                full_name=('full_name', 'first'),
+                grade=('grade', 'first'),
+                attempts=('result_id', 'size'),
+                percentage_sum=('percentage', 'sum'),
+                questions=('total_questions', 'sum'),
+                correct=('score', 'sum'),
+            )
+            
+            result = []
+            for (_, topic), st in zip(student_topics.index, student_topics.itertuples(index=False)):
+                avg_pct = round(st.percentage_sum / st.attempts, 1) if st.attempts > 0 else 0
+                accuracy = round(st.correct / st.questions * 100, 1) if st.questions > 0 else 0
+                
+                # تقييم المستوى في الموضوع
+                if avg_pct >= 80:
+                    level = "ممتاز ✅"
+                elif avg_pct >= 65:
+                    level = "جيد"
+                elif avg_pct >= 50:
+                    level = "متوسط ⚠️"
+                else:
+                    level = "ضعيف ❌"
+                
+                result.append({
+                    'الاسم': _scalar(st.full_name) or 'غير محدد',
+                    'الصف': _scalar(st.grade) or '-',
+                    'الموضوع': topic,
+                    'المحاولات': int(st.attempts),
+                    'الأسئلة': int(st.questions),
+                    'الصحيحة': int(st.correct),
+                    'متوسط الدرجة (%)': avg_pct,
+                    'الدقة (%)': accuracy,
+                    'المستوى': level,
+                })
+            
+            result.sort(key=lambda x: (x['الاسم'], -x['متوسط الدرجة (%)']))
+            return result
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل الأداء حسب المواضيع: {e}")
@@ -1554,100 +1867,73 @@ class FinalWeeklyReportGenerator:
     def get_weekly_student_tracking(self, end_date: datetime, weeks: int = 4) -> List[Dict]:
         """تتبع أداء كل طالب أسبوع بأسبوع"""
         try:
-            with self.engine.connect() as conn:
-                # جلب بيانات آخر 4 أسابيع
-                start_all = end_date - timedelta(weeks=weeks)
+            # بيانات آخر 4 أسابيع
+            week_windows = self._week_windows(end_date, weeks)
+            frame = self._daily_frame_for(*week_windows)
+            
+            # تقسيم حسب الأسابيع (من الأقدم للأحدث)
+            week_labels = []
+            for w in range(weeks, 0, -1):
+                label = f"أسبوع {weeks - w + 1}"
+                if w == 1:
+                    label = "الأسبوع الحالي"
+                week_labels.append(label)
+            
+            # لقطات كل أسبوع؛ نتيجة على حد أسبوعين تُحسب في الأقدم (بداية كل أسبوع غير مشمولة إلا الأقدم)
+            parts = []
+            for week, (week_start, week_end) in enumerate(week_windows):
+                if week > 0:
+                    week_start += _ONE_MICROSECOND
+                parts.append(frame.daily_stats(week_start, week_end).assign(week=week))
+            rows = pd.concat(parts, ignore_index=True)
+            
+            if rows.empty:
+                return []
+            
+            # متوسط كل طالب في كل أسبوع (الدرجة الفارغة = 0)
+            weekly = rows.groupby(['user_id', 'week'])[['percentage_sum', 'quiz_count']].sum()
+            week_stats = {
+                key: (percentage_sum / quiz_count, quiz_count)
+                for key, percentage_sum, quiz_count in weekly.itertuples()
+            }
+            students = rows.groupby('user_id', sort=False)[['full_name', 'grade']].first()
+            
+            # بناء الجدول النهائي
+            result = []
+            for uid, full_name, grade in students.itertuples():
+                row_data = {
+                    'الاسم': _scalar(full_name) or 'غير محدد',
+                    'الصف': _scalar(grade) or '-',
+                }
                 
-                query = text("""
-                    SELECT 
-                        u.user_id, u.full_name, u.grade,
-                        qr.percentage, qr.total_questions, qr.score,
-                        qr.completed_at
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    ORDER BY u.full_name, qr.completed_at
-                """)
-                rows = conn.execute(query, {
-                    'start_date': start_all, 'end_date': end_date
-                }).fetchall()
-                
-                if not rows:
-                    return []
-                
-                # تقسيم حسب الأسابيع
-                week_ranges = []
-                for w in range(weeks, 0, -1):
-                    w_end = end_date - timedelta(weeks=w-1)
-                    w_start = end_date - timedelta(weeks=w)
-                    label = f"أسبوع {weeks - w + 1}"
-                    if w == 1:
-                        label = "الأسبوع الحالي"
-                    week_ranges.append((w_start, w_end, label))
-                
-                # تجميع حسب الطالب
-                students = {}
-                for row in rows:
-                    uid = row.user_id
-                    if uid not in students:
-                        students[uid] = {
-                            'الاسم': row.full_name or 'غير محدد',
-                            'الصف': row.grade or '-',
-                            'weeks': {label: [] for _, _, label in week_ranges}
-                        }
-                    
-                    completed = row.completed_at
-                    if completed and hasattr(completed, 'tzinfo') and completed.tzinfo:
-                        completed = completed.replace(tzinfo=None)
-                    
-                    for w_start, w_end, label in week_ranges:
-                        if w_start <= completed <= w_end:
-                            students[uid]['weeks'][label].append({
-                                'pct': float(row.percentage or 0),
-                                'questions': int(row.total_questions or 0),
-                                'correct': int(row.score or 0),
-                            })
-                            break
-                
-                # بناء الجدول النهائي
-                result = []
-                for uid, data in students.items():
-                    row_data = {
-                        'الاسم': data['الاسم'],
-                        'الصف': data['الصف'],
-                    }
-                    
-                    weekly_avgs = []
-                    for _, _, label in week_ranges:
-                        entries = data['weeks'].get(label, [])
-                        if entries:
-                            avg = round(sum(e['pct'] for e in entries) / len(entries), 1)
-                            count = len(entries)
-                            row_data[f'{label} (%)'] = avg
-                            row_data[f'{label} (عدد)'] = count
-                            weekly_avgs.append(avg)
-                        else:
-                            row_data[f'{label} (%)'] = '—'
-                            row_data[f'{label} (عدد)'] = 0
-                    
-                    # حساب التغيير
-                    if len(weekly_avgs) >= 2:
-                        change = round(weekly_avgs[-1] - weekly_avgs[0], 1)
-                        if change > 0:
-                            row_data['التغيير'] = f"+{change}% 📈"
-                        elif change < 0:
-                            row_data['التغيير'] = f"{change}% 📉"
-                        else:
-                            row_data['التغيير'] = "0% ➡️"
+                weekly_avgs = []
+                for week, label in enumerate(week_labels):
+                    if (uid, week) in week_stats:
+                        mean, count = week_stats[(uid, week)]
+                        avg = round(float(mean), 1)
+                        row_data[f'{label} (%)'] = avg
+                        row_data[f'{label} (عدد)'] = int(count)
+                        weekly_avgs.append(avg)
                     else:
-                        row_data['التغيير'] = '—'
-                    
-                    result.append(row_data)
+                        row_data[f'{label} (%)'] = '—'
+                        row_data[f'{label} (عدد)'] = 0
+                
+                # حساب التغيير
+                if len(weekly_avgs) >= 2:
+                    change = round(weekly_avgs[-1] - weekly_avgs[0], 1)
+                    if change > 0:
+                        row_data['التغيير'] = f"+{change}% 📈"
+                    elif change < 0:
+                        row_data['التغيير'] = f"{change}% 📉"
+                    else:
+                        row_data['التغيير'] = "0% ➡️"
+                else:
+                    row_data['التغيير'] = '—'
                 
-                result.sort(key=lambda x: x['الاسم'])
-                return result
+                result.append(row_data)
+            
+            result.sort(key=lambda x: x['الاسم'])
+            return result
                 
         except Exception as e:
             logger.error(f"خطأ في التتبع الأسبوعي: {e}")
@@ -1659,95 +1945,72 @@ class FinalWeeklyReportGenerator:
     def analyze_speed_accuracy(self, start_date: datetime, end_date: datetime) -> List[Dict]:
         """تحليل علاقة السرعة بالدقة لكل طالب"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        u.user_id, u.full_name, u.grade,
-                        qr.percentage, qr.total_questions,
-                        qr.time_taken_seconds, qr.quiz_name
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                        AND qr.time_taken_seconds > 0
-                        AND qr.total_questions > 0
-                    ORDER BY u.full_name
-                """)
-                rows = conn.execute(query, {
-                    'start_date': start_date, 'end_date': end_date
-                }).fetchall()
-                
-                # تجميع حسب الطالب
-                students = {}
-                for row in rows:
-                    uid = row.user_id
-                    if uid not in students:
-                        students[uid] = {
-                            'name': row.full_name or 'غير محدد',
-                            'grade': row.grade or '-',
-                            'quizzes': []
-                        }
-                    
-                    time_per_q = float(row.time_taken_seconds or 0) / int(row.total_questions or 1)
-                    students[uid]['quizzes'].append({
-                        'pct': float(row.percentage or 0),
-                        'time_per_q': time_per_q,
-                        'questions': int(row.total_questions or 0),
-                    })
-                
-                result = []
-                for uid, data in students.items():
-                    quizzes = data['quizzes']
-                    total_qs = sum(q['questions'] for q in quizzes)
-                    avg_pct = sum(q['pct'] for q in quizzes) / len(quizzes)
-                    avg_time_per_q = sum(q['time_per_q'] for q in quizzes) / len(quizzes)
-                    
-                    # تصنيف: سريع (<30 ثانية/سؤال) vs بطيء (>60 ثانية/سؤال)
-                    # دقيق (>=65%) vs غير دقيق (<65%)
-                    if avg_time_per_q < 30:
-                        speed = "سريع"
-                    elif avg_time_per_q < 60:
-                        speed = "متوسط"
-                    else:
-                        speed = "بطيء"
-                    
-                    accurate = avg_pct >= 65
-                    
-                    # التصنيف المركب
-                    if speed == "سريع" and accurate:
-                        pattern = "متمكن ⭐"
-                        advice = "أعطه تحديات أصعب"
-                    elif speed == "سريع" and not accurate:
-                        pattern = "متسرع ⚡"
-                        advice = "شجعه يتأنى ويراجع قبل التسليم"
-                    elif speed == "بطيء" and accurate:
-                        pattern = "متأنٍ ✅"
-                        advice = "ممتاز — ساعده يزيد سرعته تدريجياً"
-                    elif speed == "بطيء" and not accurate:
-                        pattern = "يحتاج دعم 🔴"
-                        advice = "يحتاج شرح إضافي وتبسيط"
-                    elif speed == "متوسط" and accurate:
-                        pattern = "متوازن 👍"
-                        advice = "أداء جيد — حافظ عليه"
-                    else:
-                        pattern = "يحتاج تركيز ⚠️"
-                        advice = "راجع معاه المفاهيم الأساسية"
-                    
-                    result.append({
-                        'الاسم': data['name'],
-                        'الصف': data['grade'],
-                        'عدد الاختبارات': len(quizzes),
-                        'الأسئلة': total_qs,
-                        'متوسط الدرجة (%)': round(avg_pct, 1),
-                        'ثانية/سؤال': round(avg_time_per_q, 1),
-                        'السرعة': speed,
-                        'النمط': pattern,
-                        'التوصية': advice,
-                    })
-                
-                result.sort(key=lambda x: -x['متوسط الدرجة (%)'])
-                return result
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date)
+            quizzes = quizzes[(quizzes['time_taken_seconds'] > 0) & (quizzes['total_questions'] > 0)]
+            
+            # تجميع حسب الطالب
+            students = quizzes.assign(
+                pct=quizzes['percentage'].fillna(0),
+                time_per_q=quizzes['time_taken_seconds'] / quizzes['total_questions'],
+            ).groupby('user_id', sort=False).agg(
+                name=('full_name', 'first'),
+                grade=('grade', 'first'),
+                quizzes=('result_id', 'size'),
+                questions=('total_questions', 'sum'),
+                avg_pct=('pct', 'mean'),
+                avg_time_per_q=('time_per_q', 'mean'),
+            )
+            
+            result = []
+            for data in students.itertuples(index=False):
+                avg_pct = float(data.avg_pct)
+                avg_time_per_q = float(data.avg_time_per_q)
+                
+                # تصنيف: سريع (<30 ثانية/سؤال) vs بطيء (>60 ثانية/سؤال)
+                # دقيق (>=65%) vs غير دقيق (<65%)
+                if avg_time_per_q < 30:
+                    speed = "سريع"
+                elif avg_time_per_q < 60:
+                    speed = "متوسط"
+                else:
+                    speed = "بطيء"
+                
+                accurate = avg_pct >= 65
+                
+                # التصنيف المركب
+                if speed == "سريع" and accurate:
+                    pattern = "متمكن ⭐"
+                    advice = "أعطه تحديات أصعب"
+                elif speed == "سريع" and not accurate:
+                    pattern = "متسرع ⚡"
+                    advice = "شجعه يتأنى ويراجع قبل التسليم"
+                elif speed == "بطيء" and accurate:
+                    pattern = "متأنٍ ✅"
+                    advice = "ممتاز — ساعده يزيد سرعته تدريجياً"
+                elif speed == "بطيء" and not accurate:
+                    pattern = "يحتاج دعم 🔴"
+                    advice = "يحتاج شرح إضافي وتبسيط"
+                elif speed == "متوسط" and accurate:
+                    pattern = "متوازن 👍"
+                    advice = "أداء جيد — حافظ عليه"
+                else:
+                    pattern = "يحتاج تركيز ⚠️"
+                    advice = "راجع معاه المفاهيم الأساسية"
+                
+                result.append({
+                    'الاسم': _scalar(data.name) or 'غير محدد',
+                    'الصف': _scalar(data.grade) or '-',
+                    'عدد الاختبارات': int(data.quizzes),
+                    'الأسئلة': int(data.questions),
+                    'متوسط الدرجة (%)': round(avg_pct, 1),
+                    'ثانية/سؤال': round(avg_time_per_q, 1),
+                    'السرعة': speed,
+                    'النمط': pattern,
+                    'التوصية': advice,
+                })
+            
+            result.sort(key=lambda x: -x['متوسط الدرجة (%)'])
+            return result
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل السرعة والدقة: {e}")
@@ -1881,71 +2144,38 @@ class FinalWeeklyReportGenerator:
     def analyze_completion_rate(self, start_date: datetime, end_date: datetime) -> List[Dict]:
         """تحليل معدل إكمال الاختبارات (بدأ vs أكمل)"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        u.full_name, u.grade,
-                        qr.quiz_name, qr.total_questions, qr.score,
-                        qr.time_taken_seconds, qr.answers_details,
-                        qr.percentage
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    ORDER BY u.full_name
-                """)
-                rows = conn.execute(query, {
-                    'start_date': start_date, 'end_date': end_date
-                }).fetchall()
-                
-                result = []
-                for row in rows:
-                    total_q = int(row.total_questions or 0)
-                    if total_q == 0:
-                        continue
-                    
-                    # حساب الأسئلة المجابة فعلياً من answers_details
-                    answered = total_q  # افتراضي
-                    if row.answers_details:
-                        try:
-                            import json
-                            details = json.loads(row.answers_details) if isinstance(row.answers_details, str) else row.answers_details
-                            if isinstance(details, list):
-                                real_answers = [a for a in details if isinstance(a, dict) 
-                                              and 'تم إنهاء الاختبار' not in str(a.get('chosen_option_text', ''))]
-                                answered = len(real_answers)
-                        except:
-                            pass
-                    
-                    completion = round(answered / total_q * 100, 1) if total_q > 0 else 0
-                    
-                    if completion >= 100:
-                        status = "أكمل ✅"
-                    elif completion >= 70:
-                        status = "أكمل معظمه"
-                    elif completion >= 40:
-                        status = "أكمل نصفه ⚠️"
-                    else:
-                        status = "ترك مبكراً ❌"
-                    
-                    quiz_name = str(row.quiz_name or '')
-                    if len(quiz_name) > 40:
-                        quiz_name = quiz_name[:40] + '...'
-                    
-                    result.append({
-                        'الاسم': row.full_name or 'غير محدد',
-                        'الصف': row.grade or '-',
-                        'الاختبار': quiz_name,
-                        'إجمالي الأسئلة': total_q,
-                        'أسئلة مجابة': answered,
-                        'نسبة الإكمال (%)': completion,
-                        'الدرجة (%)': round(float(row.percentage or 0), 1),
-                        'الحالة': status,
-                    })
-                
-                result.sort(key=lambda x: x['نسبة الإكمال (%)'])
-                return result
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date)
+            quizzes = quizzes.sort_values('full_name', na_position='last', kind='stable')
+            total_q = quizzes['total_questions'].fillna(0).astype(int)
+            quizzes, total_q = quizzes[total_q > 0], total_q[total_q > 0]
+            
+            # الأسئلة المجابة فعلياً (answered_count محسوب من answers_details عند الاستخراج، افتراضياً كل الأسئلة)
+            answered = quizzes['answered_count'].fillna(total_q).astype(int)
+            completion = (answered / total_q * 100).round(1)
+            status = np.select(
+                [completion >= 100, completion >= 70, completion >= 40],
+                ["أكمل ✅", "أكمل معظمه", "أكمل نصفه ⚠️"], default="ترك مبكراً ❌")
+            
+            result = []
+            for row, questions, answered_count, rate, state in zip(
+                    quizzes.itertuples(index=False), total_q, answered, completion, status):
+                quiz_name = str(row.quiz_name or '')
+                if len(quiz_name) > 40:
+                    quiz_name = quiz_name[:40] + '...'
+                
+                result.append({
+                    'الاسم': row.full_name or 'غير محدد',
+                    'الصف': row.grade or '-',
+                    'الاختبار': quiz_name,
+                    'إجمالي الأسئلة': int(questions),
+                    'أسئلة مجابة': int(answered_count),
+                    'نسبة الإكمال (%)': float(rate),
+                    'الدرجة (%)': round(_number(row.percentage), 1),
+                    'الحالة': str(state),
+                })
+            
+            result.sort(key=lambda x: x['نسبة الإكمال (%)'])
+            return result
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل معدل الإكمال: {e}")
@@ -1957,61 +2187,51 @@ class FinalWeeklyReportGenerator:
     def analyze_day_of_week_patterns(self, start_date: datetime, end_date: datetime) -> List[Dict]:
         """تحليل النشاط حسب يوم الأسبوع"""
         try:
-            with self.engine.connect() as conn:
-                query = text("""
-                    SELECT 
-                        EXTRACT(DOW FROM qr.completed_at) as day_num,
-                        COUNT(*) as quiz_count,
-                        COUNT(DISTINCT qr.user_id) as student_count,
-                        AVG(qr.percentage) as avg_score
-                    FROM quiz_results qr
-                    JOIN users u ON qr.user_id = u.user_id
-                    WHERE qr.completed_at >= :start_date 
-                        AND qr.completed_at <= :end_date
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    GROUP BY EXTRACT(DOW FROM qr.completed_at)
-                    ORDER BY day_num
-                """)
-                rows = conn.execute(query, {
-                    'start_date': start_date, 'end_date': end_date
-                }).fetchall()
-                
-                day_names = {
-                    0: 'الأحد', 1: 'الإثنين', 2: 'الثلاثاء',
-                    3: 'الأربعاء', 4: 'الخميس', 5: 'الجمعة', 6: 'السبت'
+            quizzes = self._frame_for(start_date, end_date).period(start_date, end_date)
+            # ترقيم الأيام مثل EXTRACT(DOW): الأحد = 0
+            day_num = (quizzes['completed_at'].dt.dayofweek + 1) % 7
+            by_day = quizzes.groupby(day_num).agg(
+                quiz_count=('result_id', 'size'),
+                student_count=('user_id', 'nunique'),
+                avg_score=('percentage', 'mean'),
+            )
+            
+            day_names = {
+                0: 'الأحد', 1: 'الإثنين', 2: 'الثلاثاء',
+                3: 'الأربعاء', 4: 'الخميس', 5: 'الجمعة', 6: 'السبت'
+            }
+            
+            # بناء كل أيام الأسبوع
+            all_days = {}
+            for i in range(7):
+                all_days[i] = {
+                    'اليوم': day_names.get(i, f'يوم {i}'),
+                    'الاختبارات': 0,
+                    'الطلاب': 0,
+                    'متوسط الدرجة (%)': 0,
+                    'النشاط': '—'
                 }
-                
-                # بناء كل أيام الأسبوع
-                all_days = {}
-                for i in range(7):
-                    all_days[i] = {
-                        'اليوم': day_names.get(i, f'يوم {i}'),
-                        'الاختبارات': 0,
-                        'الطلاب': 0,
-                        'متوسط الدرجة (%)': 0,
-                        'النشاط': '—'
-                    }
-                
-                max_quizzes = 0
-                for row in rows:
-                    d = int(row.day_num)
-                    all_days[d]['الاختبارات'] = int(row.quiz_count or 0)
-                    all_days[d]['الطلاب'] = int(row.student_count or 0)
-                    all_days[d]['متوسط الدرجة (%)'] = round(float(row.avg_score or 0), 1)
-                    max_quizzes = max(max_quizzes, int(row.quiz_count or 0))
-                
-                for d in all_days.values():
-                    q = d['الاختبارات']
-                    if q == 0:
-                        d['النشاط'] = 'بدون نشاط'
-                    elif max_quizzes > 0 and q >= max_quizzes * 0.7:
-                        d['النشاط'] = 'ذروة 🔥'
-                    elif q >= 2:
-                        d['النشاط'] = 'نشط'
-                    else:
-                        d['النشاط'] = 'خفيف'
-                
-                return list(all_days.values())
+            
+            max_quizzes = 0
+            for row in by_day.itertuples():
+                d = int(row.Index)
+                all_days[d]['الاختبارات'] = int(row.quiz_count)
+                all_days[d]['الطلاب'] = int(row.student_count)
+                all_days[d]['متوسط الدرجة (%)'] = round(_number(row.avg_score), 1)
+                max_quizzes = max(max_quizzes, int(row.quiz_count))
+            
+            for d in all_days.values():
+                q = d['الاختبارات']
+                if q == 0:
+                    d['النشاط'] = 'بدون نشاط'
+                elif max_quizzes > 0 and q >= max_quizzes * 0.7:
+                    d['النشاط'] = 'ذروة 🔥'
+                elif q >= 2:
+                    d['النشاط'] = 'نشط'
+                else:
+                    d['النشاط'] = 'خفيف'
+            
+            return list(all_days.values())
                 
         except Exception as e:
             logger.error(f"خطأ في تحليل أنماط الأسبوع: {e}")
@@ -2024,42 +2244,25 @@ class FinalWeeklyReportGenerator:
         """مقارنة أداء آخر 4 أسابيع"""
         try:
             result = []
-            with self.engine.connect() as conn:
-                for w in range(4, 0, -1):
-                    w_end = end_date - timedelta(weeks=w-1)
-                    w_start = end_date - timedelta(weeks=w)
-                    
-                    query = text("""
-                        SELECT 
-                            COUNT(DISTINCT qr.user_id) as active_students,
-                            COUNT(*) as total_quizzes,
-                            SUM(qr.total_questions) as total_questions,
-                            AVG(qr.percentage) as avg_score,
-                            MAX(qr.percentage) as max_score,
-                            MIN(qr.percentage) as min_score
-                        FROM quiz_results qr
-                        JOIN users u ON qr.user_id = u.user_id
-                        WHERE qr.completed_at >= :start_date 
-                            AND qr.completed_at <= :end_date
-                            AND COALESCE(u.grade, '') != 'معلم'
-                    """)
-                    row = conn.execute(query, {
-                        'start_date': w_start, 'end_date': w_end
-                    }).fetchone()
-                    
-                    label = f"أسبوع {5-w}" if w > 1 else "الأسبوع الحالي"
-                    period = f"{w_start.strftime('%m/%d')} — {w_end.strftime('%m/%d')}"
-                    
-                    result.append({
-                        'الأسبوع': label,
-                        'الفترة': period,
-                        'طلاب نشطين': int(row.active_students or 0) if row else 0,
-                        'اختبارات': int(row.total_quizzes or 0) if row else 0,
-                        'أسئلة مجابة': int(row.total_questions or 0) if row else 0,
-                        'متوسط الدرجة (%)': round(float(row.avg_score or 0), 1) if row and row.avg_score else 0,
-                        'أعلى درجة (%)': round(float(row.max_score or 0), 1) if row and row.max_score else 0,
-                        'أدنى درجة (%)': round(float(row.min_score or 0), 1) if row and row.min_score else 0,
-                    })
+            week_windows = self._week_windows(end_date)
+            frame = self._daily_frame_for(*week_windows)
+            for w, (w_start, w_end) in zip(range(4, 0, -1), week_windows):
+                week = frame.daily_stats(w_start, w_end)
+                percentage_count = week['percentage_count'].sum()
+                
+                label = f"أسبوع {5-w}" if w > 1 else "الأسبوع الحالي"
+                period = f"{w_start.strftime('%m/%d')} — {w_end.strftime('%m/%d')}"
+                
+                result.append({
+                    'الأسبوع': label,
+                    'الفترة': period,
+                    'طلاب نشطين': int(week['user_id'].nunique()),
+                    'اختبارات': int(week['quiz_count'].sum()),
+                    'أسئلة مجابة': int(week['questions_sum'].sum()),
+                    'متوسط الدرجة (%)': round(float(week['percentage_sum'].sum() / percentage_count), 1) if percentage_count else 0.0,
+                    'أعلى درجة (%)': round(_number(week['percentage_max'].max()), 1),
+                    'أدنى درجة (%)': round(_number(week['percentage_min'].min()), 1),
+                })
             
             # إضافة التغيير
             for i in range(1, len(result)):
@@ -2085,72 +2288,57 @@ class FinalWeeklyReportGenerator:
     def detect_early_warnings(self, end_date: datetime) -> List[Dict]:
         """اكتشاف طلاب كانوا نشطين وتوقفوا فجأة"""
         try:
-            with self.engine.connect() as conn:
-                # الأسبوع الحالي
-                current_start = end_date - timedelta(weeks=1)
-                # الأسبوعين السابقين
-                prev_start = end_date - timedelta(weeks=3)
-                
-                query = text("""
-                    WITH current_week AS (
-                        SELECT DISTINCT qr.user_id
-                        FROM quiz_results qr
-                        WHERE qr.completed_at >= :current_start AND qr.completed_at <= :end_date
-                    ),
-                    previous_weeks AS (
-                        SELECT 
-                            qr.user_id,
-                            COUNT(*) as prev_quizzes,
-                            AVG(qr.percentage) as prev_avg,
-                            MAX(qr.completed_at) as last_activity
-                        FROM quiz_results qr
-                        WHERE qr.completed_at >= :prev_start AND qr.completed_at < :current_start
-                        GROUP BY qr.user_id
-                        HAVING COUNT(*) >= 2
-                    )
-                    SELECT 
-                        u.full_name, u.grade,
-                        pw.prev_quizzes, pw.prev_avg, pw.last_activity
-                    FROM previous_weeks pw
-                    JOIN users u ON pw.user_id = u.user_id
-                    LEFT JOIN current_week cw ON pw.user_id = cw.user_id
-                    WHERE cw.user_id IS NULL
-                        AND COALESCE(u.grade, '') != 'معلم'
-                    ORDER BY pw.prev_avg DESC
-                """)
-                rows = conn.execute(query, {
-                    'current_start': current_start,
-                    'end_date': end_date,
-                    'prev_start': prev_start,
-                }).fetchall()
-                
-                result = []
-                for row in rows:
-                    last_active = row.last_activity
-                    if last_active and hasattr(last_active, 'tzinfo') and last_active.tzinfo:
-                        last_active = last_active.replace(tzinfo=None)
-                    
-                    days_inactive = (end_date - last_active).days if last_active else 0
-                    
-                    if days_inactive >= 14:
-                        urgency = "عاجل 🔴"
-                    elif days_inactive >= 10:
-                        urgency = "متوسط 🟡"
-                    else:
-                        urgency = "مبكر 🟢"
-                    
-                    result.append({
-                        'الاسم': row.full_name or 'غير محدد',
-                        'الصف': row.grade or '-',
-                        'اختبارات سابقة': int(row.prev_quizzes or 0),
-                        'متوسط سابق (%)': round(float(row.prev_avg or 0), 1),
-                        'آخر نشاط': last_active.strftime('%Y-%m-%d') if last_active else '—',
-                        'أيام بدون نشاط': days_inactive,
-                        'مستوى الإنذار': urgency,
-                    })
-                
-                result.sort(key=lambda x: -x['أيام بدون نشاط'])
-                return result
+            # الأسبوع الحالي
+            current_start = end_date - timedelta(weeks=1)
+            # الأسبوعين السابقين
+            prev_start = end_date - timedelta(weeks=3)
+            
+            previous_end = current_start - _ONE_MICROSECOND
+            frame = self._daily_frame_for((prev_start, previous_end), (current_start, end_date))
+            
+            # من اختبر هذا الأسبوع (أي نتيجة، حتى بدون مستخدم)
+            current_week = frame.daily_stats(current_start, end_date, students_only=False, joined=False)['user_id'].unique()
+            
+            # نشاط الأسبوعين السابقين لطلاب (بدون معلمين) لم يختبروا هذا الأسبوع
+            previous = frame.daily_stats(prev_start, previous_end)
+            previous = previous[~previous['user_id'].isin(current_week)]
+            previous_weeks = previous.groupby('user_id', sort=False).agg(
+                full_name=('full_name', 'first'),
+                grade=('grade', 'first'),
+                prev_quizzes=('quiz_count', 'sum'),
+                percentage_sum=('percentage_sum', 'sum'),
+                percentage_count=('percentage_count', 'sum'),
+                last_activity=('last_completed_at', 'max'),
+            )
+            previous_weeks['prev_avg'] = previous_weeks['percentage_sum'] / previous_weeks['percentage_count'].where(
+                previous_weeks['percentage_count'] > 0)
+            previous_weeks = previous_weeks[previous_weeks['prev_quizzes'] >= 2].sort_values(
+                'prev_avg', ascending=False, na_position='first', kind='stable')
+            
+            result = []
+            for row in previous_weeks.itertuples(index=False):
+                last_active = _scalar(row.last_activity)
+                days_inactive = (end_date - last_active).days if last_active else 0
+                
+                if days_inactive >= 14:
+                    urgency = "عاجل 🔴"
+                elif days_inactive >= 10:
+                    urgency = "متوسط 🟡"
+                else:
+                    urgency = "مبكر 🟢"
+                
+                result.append({
+                    'الاسم': _scalar(row.full_name) or 'غير محدد',
+                    'الصف': _scalar(row.grade) or '-',
+                    'اختبارات سابقة': int(row.prev_quizzes),
+                    'متوسط سابق (%)': round(_number(row.prev_avg), 1),
+                    'آخر نشاط': last_active.strftime('%Y-%m-%d') if last_active else '—',
+                    'أيام بدون نشاط': days_inactive,
+                    'مستوى الإنذار': urgency,
+                })
+            
+            result.sort(key=lambda x: -x['أيام بدون نشاط'])
+            return result
                 
         except Exception as e:
             logger.error(f"خطأ في اكتشاف الإنذارات المبكرة: {e}")
@@ -2429,7 +2617,7 @@ class FinalWeeklyReportGenerator:
     # ============================================================
     #  12. تقرير شهري مفصّل
     # ============================================================
-    def create_monthly_report(self, end_date: datetime = None) -> str:
+    def create_monthly_report(self, end_date: datetime = None, progress=None) -> str:
         """إنشاء تقرير شهري شامل (30 يوم)"""
         try:
             if not end_date:
@@ -2439,7 +2627,7 @@ class FinalWeeklyReportGenerator:
             logger.info(f"بدء إنشاء التقرير الشهري: {start_date.strftime('%Y-%m-%d')} إلى {end_date.strftime('%Y-%m-%d')}")
             
             # نفس التقرير الأسبوعي لكن بفترة 30 يوم + تحليلات إضافية
-            report_path = self.create_final_excel_report(start_date, end_date)
+            report_path = self.create_final_excel_report(start_date, end_date, progress=progress)
             
             if report_path:
                 # إعادة تسمية الملف
@@ -2457,6 +2645,8 @@ class FinalWeeklyReportGenerator:
             
             return ""
             
+        except ReportCancelled:
+            raise
         except Exception as e:
             logger.error(f"خطأ في إنشاء التقرير الشهري: {e}", exc_info=True)
             return ""
@@ -2674,10 +2864,16 @@ class FinalWeeklyReportGenerator:
     # ============================================================
     #  إنشاء التقرير المحسن
     # ============================================================
-    def create_final_excel_report(self, start_date: datetime, end_date: datetime) -> str:
-        """إنشاء تقرير Excel محسن وشامل"""
+    def create_final_excel_report(self, start_date: datetime, end_date: datetime, progress=None) -> str:
+        """إنشاء تقرير Excel محسن وشامل
+
+        progress(fraction, stage) اختيارية: تُستدعى بين المراحل (0..1) ويمكنها إيقاف التقرير برفع ReportCancelled
+        """
         try:
-            # جمع البيانات
+            # جمع البيانات: استخراج واحد للفترة وفترات المقارنة، ثم كل الأوراق تُحسب منه
+            _report_progress(progress, 0.02, "جمع الإحصائيات العامة")
+            report_started = time.time()
+            self._report_frame = self.load_report_frame(start_date, end_date)
             general_stats = self.get_comprehensive_stats(start_date, end_date)
             user_progress = self.get_user_progress_analysis(start_date, end_date)
             grade_analysis = self.get_grade_performance_analysis(start_date, end_date)
@@ -2686,6 +2882,7 @@ class FinalWeeklyReportGenerator:
             quiz_details = self.get_quiz_details(start_date, end_date)
             time_patterns = self.get_time_patterns_analysis(start_date, end_date)
             
+            _report_progress(progress, 0.25, "المقارنة مع الفترة السابقة")
             previous_stats = self.get_previous_week_stats(start_date, end_date)
             weekly_comparison = self.calculate_weekly_comparison(general_stats, previous_stats)
             kpis = self.calculate_kpis(general_stats, start_date, end_date)
@@ -2702,6 +2899,7 @@ class FinalWeeklyReportGenerator:
                         f"تم تجاوز {total_skipped} سؤال بسبب إنهاء الاختبار مبكراً — قد تكون الاختبارات طويلة")
             
             # ── تحليلات تُستخدم في التوصيات ──
+            _report_progress(progress, 0.35, "الإنذار المبكر ومعدل الإكمال")
             early_warnings = self.detect_early_warnings(end_date)
             completion_rate = self.analyze_completion_rate(start_date, end_date)
             
@@ -2735,11 +2933,14 @@ class FinalWeeklyReportGenerator:
             improvement_trends = self.analyze_student_improvement_trends(students_only)
             
             # ── تحليلات جديدة ──
+            _report_progress(progress, 0.45, "تحليل المواضيع والتتبع الأسبوعي")
             topic_performance = self.analyze_topic_performance(start_date, end_date)
             weekly_tracking = self.get_weekly_student_tracking(end_date, weeks=4)
             speed_accuracy = self.analyze_speed_accuracy(start_date, end_date)
             day_patterns = self.analyze_day_of_week_patterns(start_date, end_date)
             monthly_comparison = self.get_monthly_comparison(end_date)
+            logger.info(f"تم حساب تحليلات التقرير في {time.time() - report_started:.2f} ثانية "
+                        f"(استخراج البيانات {self._report_frame.seconds:.2f} ثانية، {self._report_frame.rows_read} صف)")
             executive_summary = self.generate_executive_summary(
                 general_stats, user_progress, grade_analysis,
                 student_categories, improvement_trends,
@@ -2749,9 +2950,11 @@ class FinalWeeklyReportGenerator:
                 monthly_comparison=monthly_comparison
             )
             
+            _report_progress(progress, 0.6, "إنشاء الرسوم البيانية")
             chart_paths = self.create_performance_charts(students_only, grade_analysis, time_patterns)
             
             # إنشاء ملف Excel
+            _report_progress(progress, 0.7, "كتابة ملف Excel")
             report_filename = f"final_weekly_report_{start_date.strftime('%Y-%m-%d')}.xlsx"
             report_path = os.path.join(self.reports_dir, report_filename)
             days_count = (end_date - start_date).days
@@ -3134,15 +3337,20 @@ class FinalWeeklyReportGenerator:
             logger.info(f"تم إنشاء التقرير المحسن: {report_path}")
             
             # تصدير PDF
+            _report_progress(progress, 0.9, "تصدير PDF")
             pdf_path = self.export_report_pdf(report_path)
             if pdf_path:
                 logger.info(f"تم تصدير PDF: {pdf_path}")
             
             return report_path
             
+        except ReportCancelled:
+            raise
         except Exception as e:
             logger.error(f"خطأ في إنشاء تقرير Excel النهائي: {e}", exc_info=True)
             raise
+        finally:
+            self._report_frame = None
 
 
 
@@ -3225,41 +3433,25 @@ class FinalWeeklyReportGenerator:
             return {}
 
     def _recalc_previous_stats_filtered(self, user_ids, current_start, current_end):
-        """إحصائيات الأسبوع السابق مفلترة"""
+        """إحصائيات الأسبوع السابق مفلترة (من اللقطات اليومية مثل get_previous_week_stats)"""
         try:
-            ids_str = ','.join(str(i) for i in user_ids) if user_ids else '0'
             previous_start = current_start - timedelta(days=7)
             previous_end = current_end - timedelta(days=7)
             
-            with self.engine.connect() as conn:
-                uq = text("""
-                    SELECT 
-                        COUNT(CASE WHEN last_activity >= :start_date THEN 1 END) as active_users_previous_week,
-                        COUNT(CASE WHEN registration_date >= :start_date THEN 1 END) as new_users_previous_week
-                    FROM users WHERE user_id IN ({ids_str})
-                """)
-                ur = conn.execute(uq, {'start_date': previous_start}).fetchone()
-                
-                qq = text("""
-                    SELECT 
-                        COUNT(*) as total_quizzes_previous_week,
-                        COUNT(DISTINCT user_id) as unique_users_previous_week,
-                        AVG(CASE WHEN percentage IS NOT NULL AND percentage > 0 THEN percentage END) as avg_percentage_previous_week,
-                        SUM(total_questions) as total_questions_previous_week
-                    FROM quiz_results 
-                    WHERE completed_at >= :start_date AND completed_at <= :end_date
-                    AND user_id IN ({ids_str})
-                """)
-                qr = conn.execute(qq, {'start_date': previous_start, 'end_date': previous_end}).fetchone()
-                
-                return {
-                    'active_users_previous_week': ur.active_users_previous_week or 0,
-                    'new_users_previous_week': ur.new_users_previous_week or 0,
-                    'total_quizzes_previous_week': qr.total_quizzes_previous_week or 0,
-                    'unique_users_previous_week': qr.unique_users_previous_week or 0,
-                    'avg_percentage_previous_week': self.safe_float(qr.avg_percentage_previous_week),
-                    'total_questions_previous_week': qr.total_questions_previous_week or 0
-                }
+            frame = self._daily_frame_for((previous_start, previous_end))
+            users = frame.users[frame.users['user_id'].isin(user_ids or ())]
+            daily = frame.daily_stats(previous_start, previous_end, students_only=False, joined=False)
+            daily = daily[daily['user_id'].isin(user_ids or ())]
+            positive_count = daily['positive_count'].sum()
+            
+            return {
+                'active_users_previous_week': int((users['last_activity'] >= previous_start).sum()),
+                'new_users_previous_week': int((users['registration_date'] >= previous_start).sum()),
+                'total_quizzes_previous_week': int(daily['quiz_count'].sum()),
+                'unique_users_previous_week': int(daily['user_id'].nunique()),
+                'avg_percentage_previous_week': float(daily['positive_sum'].sum() / positive_count) if positive_count else 0.0,
+                'total_questions_previous_week': int(daily['questions_sum'].sum())
+            }
         except Exception as e:
             logger.error(f"Error recalculating filtered previous stats: {e}")
             return {
@@ -3315,7 +3507,8 @@ class FinalWeeklyReportGenerator:
             filter_label = self._get_filter_label(user_filter)
             logger.info(f"إنشاء تقرير مفلتر: {filter_label} ({len(filtered_ids) if filtered_ids else 'all'} طالب)")
             
-            # 2. جمع البيانات مع الفلتر
+            # 2. جمع البيانات مع الفلتر (الدوال العامة تُحسب من استخراج واحد ثم تُفلتر)
+            self._report_frame = self.load_report_frame(start_date, end_date)
             # إحصائيات شاملة مفلترة
             general_stats = self._recalc_stats_from_filtered(filtered_ids, start_date, end_date)
             
@@ -3512,6 +3705,8 @@ class FinalWeeklyReportGenerator:
         except Exception as e:
             logger.error(f"خطأ في إنشاء التقرير المفلتر: {e}", exc_info=True)
             raise
+        finally:
+            self._report_frame = None
 
 
 class FinalWeeklyReportScheduler:
@@ -3610,24 +3805,35 @@ class FinalWeeklyReportScheduler:
             logger.error(f"خطأ في إرسال التقرير بالإيميل: {e}")
             return False
     
-    def generate_and_send_weekly_report(self):
-        """إنشاء وإرسال التقرير الأسبوعي + الشهادات + الإشعارات"""
+    def generate_and_send_weekly_report(self, progress=None) -> bool:
+        """إنشاء وإرسال التقرير الأسبوعي + الشهادات + الإشعارات
+
+        progress(fraction, stage) اختيارية لعرض التقدم وإلغاء التقرير (ReportCancelled يُمرَّر للمستدعي).
+        يعيد True عند إنشاء التقرير وإرساله بالإيميل.
+        """
+        sent = False
         try:
             end_date = datetime.now()
             start_date = end_date - timedelta(days=7)
             
             logger.info(f"بدء إنشاء التقرير الأسبوعي للفترة: {start_date} إلى {end_date}")
             
-            # 1. إنشاء التقرير
-            report_path = self.report_generator.create_final_excel_report(start_date, end_date)
+            # 1. إنشاء التقرير (80% من التقدم)
+            report_path = self.report_generator.create_final_excel_report(
+                start_date, end_date,
+                progress=(lambda fraction, stage: progress(fraction * 0.8, stage)) if progress else None
+            )
             
             # 2. إرسال التقرير بالإيميل
-            if self.send_email_report(report_path, start_date, end_date):
+            _report_progress(progress, 0.85, "إرسال التقرير بالإيميل")
+            sent = self.send_email_report(report_path, start_date, end_date)
+            if sent:
                 logger.info("تم إنشاء وإرسال التقرير الأسبوعي بنجاح")
             else:
                 logger.error("فشل في إرسال التقرير الأسبوعي")
             
             # 3. إنشاء الشهادات (تُحفظ لإرسالها عبر التليجرام)
+            _report_progress(progress, 0.9, "تجهيز الشهادات")
             try:
                 self._pending_certificates = self.report_generator.generate_certificates(start_date, end_date)
                 logger.info(f"تم تجهيز {len(self._pending_certificates)} شهادة للإرسال")
@@ -3636,6 +3842,7 @@ class FinalWeeklyReportScheduler:
                 self._pending_certificates = []
             
             # 4. تحديد الطلاب اللي يحتاجون إشعارات
+            _report_progress(progress, 0.95, "تحديد الإشعارات")
             try:
                 self._pending_notifications = self.report_generator.get_students_needing_notification(start_date, end_date)
                 logger.info(f"تم تجهيز {len(self._pending_notifications)} إشعار للإرسال")
@@ -3643,25 +3850,35 @@ class FinalWeeklyReportScheduler:
                 logger.error(f"خطأ في تحديد الإشعارات: {ne}")
                 self._pending_notifications = []
                 
+        except ReportCancelled:
+            raise
         except Exception as e:
             logger.error(f"خطأ في إنشاء التقرير الأسبوعي: {e}")
+        return sent
     
-    def generate_and_send_monthly_report(self):
-        """إنشاء وإرسال التقرير الشهري"""
+    def generate_and_send_monthly_report(self, progress=None) -> bool:
+        """إنشاء وإرسال التقرير الشهري (progress كما في generate_and_send_weekly_report)"""
         try:
             end_date = datetime.now()
             
             logger.info("بدء إنشاء التقرير الشهري...")
             
-            report_path = self.report_generator.create_monthly_report(end_date)
+            report_path = self.report_generator.create_monthly_report(
+                end_date,
+                progress=(lambda fraction, stage: progress(fraction * 0.9, stage)) if progress else None
+            )
             
+            _report_progress(progress, 0.92, "إرسال التقرير بالإيميل")
             if report_path and self.send_email_report(report_path, end_date - timedelta(days=30), end_date):
                 logger.info("تم إنشاء وإرسال التقرير الشهري بنجاح")
-            else:
-                logger.error("فشل في إرسال التقرير الشهري")
+                return True
+            logger.error("فشل في إرسال التقرير الشهري")
                 
+        except ReportCancelled:
+            raise
         except Exception as e:
             logger.error(f"خطأ في التقرير الشهري: {e}")
+        return False
     
     def get_pending_certificates(self) -> List[Dict]:
         """الحصول على الشهادات الجاهزة للإرسال عبر التليجرام"""
@@ -3678,13 +3895,18 @@ class FinalWeeklyReportScheduler:
     def start_scheduler(self):
         """بدء جدولة التقارير"""
         try:
+            # التقارير تُضاف إلى REPORT_JOBS (عامل واحد للتقارير) بدل تشغيلها في خيط الجدولة
+            def submit_report(kind):
+                from utils.report_jobs import REPORT_JOBS
+                REPORT_JOBS.submit(kind, requested_by="scheduler")
+            
             # تقرير أسبوعي: كل يوم أحد الساعة 9 صباحاً
-            schedule.every().sunday.at("09:00").do(self.generate_and_send_weekly_report)
+            schedule.every().sunday.at("09:00").do(submit_report, "weekly")
             
             # تقرير شهري: أول يوم من كل شهر (نستخدم فحص يومي)
             def monthly_check():
                 if datetime.now().day == 1:
-                    self.generate_and_send_monthly_report()
+                    submit_report("monthly")
             schedule.every().day.at("10:00").do(monthly_check)
             
             self.running = True
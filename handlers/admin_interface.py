@@ -5,14 +5,14 @@ Handles the admin statistics dashboard interface. This version removes the diagn
 message from v11, assuming the Arabic text processing issue is resolved in the
 imported process_arabic_text function from the admin_dashboard_display module.
 """
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputMediaPhoto
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CommandHandler, CallbackQueryHandler, CallbackContext
 import telegram.error # Import for specific error handling
-import os
 
 from utils.admin_auth import is_admin as is_admin_original # Renamed to avoid conflict
 from database.manager import DB_MANAGER
 from config import logger
+from utils.chart_service import send_chart_photo, send_chart_media_group
 
 # This import will now pull the corrected process_arabic_text from the updated admin_dashboard_display module
 from .admin_dashboard_display import (
@@ -256,7 +256,7 @@ async def send_dashboard_stats_v4(update: Update, context: CallbackContext, stat
             logger.warning(f"[AdminInterfaceV12_ArabicFix] Unknown stat_category: {stat_category}")
             text_response = f"{process_arabic_text('فئة الإحصائيات غير معروفة:')} {processed_stat_category_display_title}"
 
-        if not text_response and not (chart_paths and any(os.path.exists(p) for p in chart_paths if p)):
+        if not text_response and not any(chart_paths):
              time_filter_display_for_message = get_processed_time_filter_display(time_filter)
              text_response = f"{process_arabic_text('لا توجد بيانات لعرضها حالياً لـ')} {processed_stat_category_display_title} {process_arabic_text('عن فترة')} {time_filter_display_for_message}."
 
@@ -269,7 +269,8 @@ async def send_dashboard_stats_v4(update: Update, context: CallbackContext, stat
         MAX_CAPTION_LENGTH = 1000  # Max length for a photo caption
         MAX_MESSAGE_LENGTH = 4000 # Max length for a text message (approx)
 
-        valid_chart_paths = [p for p in chart_paths if p and os.path.exists(p)]
+        # Charts are cached utils.chart_service.Chart objects (PNG bytes or an already uploaded file_id)
+        valid_chart_paths = [chart for chart in chart_paths if chart]
         
         final_caption_for_photo = None
         send_text_separately = False
@@ -283,19 +284,9 @@ async def send_dashboard_stats_v4(update: Update, context: CallbackContext, stat
         
         if valid_chart_paths:
             if len(valid_chart_paths) == 1:
-                await context.bot.send_photo(
-                    chat_id=chat_id, 
-                    photo=open(valid_chart_paths[0], "rb"), 
-                    caption=final_caption_for_photo
-                )
-            else: # Multiple photos
-                media_group_items = []
-                # First photo with caption
-                media_group_items.append(InputMediaPhoto(media=open(valid_chart_paths[0], "rb"), caption=final_caption_for_photo))
-                # Remaining photos without caption
-                for chart_path in valid_chart_paths[1:]:
-                    media_group_items.append(InputMediaPhoto(media=open(chart_path, "rb")))
-                await context.bot.send_media_group(chat_id=chat_id, media=media_group_items)
+                await send_chart_photo(context.bot, chat_id, valid_chart_paths[0], caption=final_caption_for_photo)
+            else: # Multiple photos, caption on the first one
+                await send_chart_media_group(context.bot, chat_id, valid_chart_paths, caption=final_caption_for_photo)
 
             if send_text_separately and text_response:
                 for i in range(0, len(text_response), MAX_MESSAGE_LENGTH):
@@ -309,12 +300,6 @@ async def send_dashboard_stats_v4(update: Update, context: CallbackContext, stat
                     text=process_arabic_text("اختر فلترًا آخر أو عد للقائمة الرئيسية."), 
                     reply_markup=current_reply_markup
                 )
-            
-            for p in valid_chart_paths:
-                try:
-                    os.remove(p)
-                except Exception as e_remove:
-                    logger.error(f"[AdminInterfaceV14_CaptionFix] Error removing chart file {p}: {e_remove}")
         
         elif text_response: # No charts, only text response
             for i in range(0, len(text_response), MAX_MESSAGE_LENGTH):
@@ -12,7 +12,6 @@
 """
 
 import logging
-import asyncio
 import os
 import psycopg2
 import psycopg2.extras
@@ -32,6 +31,12 @@ except ImportError:
         logging.error("CRITICAL: connect_db could not be imported")
         return None
 
+from database import student_search
+from database.async_manager import run_db
+from database.manager import DB_MANAGER, search_students
+from utils.broadcast_engine import BROADCAST_ENGINE
+from utils.user_status_cache import USER_STATUS_CACHE
+
 logger = logging.getLogger(__name__)
 
 # === States ===
@@ -354,43 +359,13 @@ async def search_student_input_handler(update: Update, context: ContextTypes.DEF
     """معالجة البحث عن طالب"""
     search_query = update.message.text.strip()
 
-    conn = None
     try:
-        conn = connect_db()
-        if not conn:
+        # بحث مفهرس (الاسم بعد التطبيع / البريد / الجوال / ID) + تجميعات جاهزة
+        results = await run_db(search_students, search_query)
+        if results is None:
             await update.message.reply_text("❌ خطأ في الاتصال بقاعدة البيانات")
             return ConversationHandler.END
 
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            if search_query.isdigit():
-                cur.execute("""
-                    SELECT u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered,
-                           COALESCE(u.is_my_student, FALSE) as is_my_student,
-                           COUNT(qr.id) as quiz_count,
-                           ROUND(AVG(qr.score_percentage)::numeric, 1) as avg_score,
-                           MAX(qr.completed_at) as last_quiz
-                    FROM users u
-                    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id
-                    WHERE u.user_id = %s
-                    GROUP BY u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered, u.is_my_student
-                """, (int(search_query),))
-            else:
-                cur.execute("""
-                    SELECT u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered,
-                           COALESCE(u.is_my_student, FALSE) as is_my_student,
-                           COUNT(qr.id) as quiz_count,
-                           ROUND(AVG(qr.score_percentage)::numeric, 1) as avg_score,
-                           MAX(qr.completed_at) as last_quiz
-                    FROM users u
-                    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id
-                    WHERE u.is_registered = TRUE AND u.full_name ILIKE %s
-                    GROUP BY u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered, u.is_my_student
-                    ORDER BY u.full_name
-                    LIMIT 10
-                """, (f"%{search_query}%",))
-
-            results = cur.fetchall()
-
         if not results:
             await update.message.reply_text(
                 f"❌ لا توجد نتائج لـ: {search_query}\n\n"
@@ -398,6 +373,10 @@ async def search_student_input_handler(update: Update, context: ContextTypes.DEF
             )
             return SEARCH_STUDENT_INPUT
 
+        # رقم ID مطابق يعرض بطاقته مباشرة حتى لو طابق الرقم جوالات أخرى
+        if search_query.isdigit() and results[0]['user_id'] == int(search_query):
+            results = results[:1]
+
         if len(results) == 1:
             r = results[0]
             msg = _format_student_details(r)
@@ -429,9 +408,6 @@ async def search_student_input_handler(update: Update, context: ContextTypes.DEF
         logger.error(f"Error searching student: {e}", exc_info=True)
         await update.message.reply_text(f"❌ خطأ: {str(e)[:200]}")
         return ConversationHandler.END
-    finally:
-        if conn:
-            conn.close()
 
 
 def _format_student_details(r) -> str:
@@ -518,6 +494,7 @@ async def admin_toggle_my_student_callback(update: Update, context: ContextTypes
                 """, (target_user_id,))
                 result = cur.fetchone()
                 conn.commit()
+                USER_STATUS_CACHE.invalidate(target_user_id, "is_my_student")
 
                 if not result:
                     await query.answer("❌ الطالب غير موجود", show_alert=True)
@@ -530,18 +507,8 @@ async def admin_toggle_my_student_callback(update: Update, context: ContextTypes
                 await query.answer(f"{emoji} {name}: {status_text}", show_alert=True)
 
                 # إعادة عرض تفاصيل الطالب
-                cur.execute("""
-                    SELECT u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered,
-                           COALESCE(u.is_my_student, FALSE) as is_my_student,
-                           COUNT(qr.id) as quiz_count,
-                           ROUND(AVG(qr.score_percentage)::numeric, 1) as avg_score,
-                           MAX(qr.completed_at) as last_quiz
-                    FROM users u
-                    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id
-                    WHERE u.user_id = %s
-                    GROUP BY u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered, u.is_my_student
-                """, (target_user_id,))
-                student = cur.fetchone()
+                student = student_search.get_student_details(
+                    cur, target_user_id, aggregates_ready=DB_MANAGER.user_aggregates_ready())
                 if student:
                     msg = _format_student_details(student)
                     is_tagged = student['is_my_student']
@@ -715,6 +682,7 @@ async def admin_untag_student_from_list_callback(update: Update, context: Contex
                 cur.execute("UPDATE users SET is_my_student = FALSE WHERE user_id = %s RETURNING full_name", (target_user_id,))
                 result = cur.fetchone()
                 conn.commit()
+                USER_STATUS_CACHE.invalidate(target_user_id, "is_my_student")
                 name = result[0] if result else str(target_user_id)
                 await query.answer(f"☆ تم إزالة {name}")
     except Exception as e:
@@ -911,6 +879,7 @@ async def admin_grade_toggle_student_callback(update: Update, context: ContextTy
                 """, (target_user_id,))
                 result = cur.fetchone()
                 conn.commit()
+                USER_STATUS_CACHE.invalidate(target_user_id, "is_my_student")
                 if result:
                     status = "⭐" if result[0] else "☆"
                     name = result[1] or str(target_user_id)
@@ -959,6 +928,7 @@ async def admin_tag_grade_action_callback(update: Update, context: ContextTypes.
                 )
                 count = cur.rowcount
                 conn.commit()
+                USER_STATUS_CACHE.invalidate(None, "is_my_student")
                 await query.answer(f"✅ تم {action_text} {count} طالب في {grade}", show_alert=True)
     except Exception as e:
         logger.error(f"Error bulk tagging: {e}")
@@ -998,6 +968,7 @@ async def admin_untag_all_execute_callback(update: Update, context: ContextTypes
                 cur.execute("UPDATE users SET is_my_student = FALSE WHERE COALESCE(is_my_student, FALSE) = TRUE")
                 count = cur.rowcount
                 conn.commit()
+                USER_STATUS_CACHE.invalidate(None, "is_my_student")
                 await query.answer(f"✅ تم إزالة التمييز عن {count} طالب", show_alert=True)
     except Exception as e:
         logger.error(f"Error untagging all: {e}")
@@ -1272,9 +1243,9 @@ async def broadcast_grade_selected(update: Update, context: ContextTypes.DEFAULT
         if conn:
             with conn.cursor() as cur:
                 if my_students_only:
-                    cur.execute("SELECT COUNT(*) FROM users WHERE is_registered = TRUE AND grade = %s AND COALESCE(is_my_student, FALSE) = TRUE", (grade,))
+                    cur.execute("SELECT COUNT(*) FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE AND grade = %s AND COALESCE(is_my_student, FALSE) = TRUE", (grade,))
                 else:
-                    cur.execute("SELECT COUNT(*) FROM users WHERE is_registered = TRUE AND grade = %s", (grade,))
+                    cur.execute("SELECT COUNT(*) FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE AND grade = %s", (grade,))
                 count = cur.fetchone()[0]
     except Exception:
         pass
@@ -1354,16 +1325,16 @@ async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
                 if my_students_only and grade_filter:
                     # طلابي في صف معين
-                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_my_student, FALSE) = TRUE AND grade = %s", (grade_filter,))
+                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE AND COALESCE(is_my_student, FALSE) = TRUE AND grade = %s", (grade_filter,))
                 elif my_students_only:
                     # طلابي فقط (كل الصفوف)
-                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_my_student, FALSE) = TRUE")
+                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE AND COALESCE(is_my_student, FALSE) = TRUE")
                 elif grade_filter:
                     # كل طلاب صف معين
-                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND grade = %s", (grade_filter,))
+                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE AND grade = %s", (grade_filter,))
                 else:
                     # الكل
-                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE")
+                    cur.execute("SELECT user_id FROM users WHERE is_registered = TRUE AND COALESCE(is_active, TRUE) = TRUE")
                 rows = cur.fetchall()
                 if rows:
                     user_ids = [row['user_id'] for row in rows]
@@ -1382,11 +1353,6 @@ async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes
         _cleanup_broadcast_data(context)
         return ConversationHandler.END
 
-    # إرسال
-    sent_count = 0
-    failed_count = 0
-    failed_users = []
-
     # تسجيل الإشعار في قاعدة البيانات
     try:
         try:
@@ -1398,48 +1364,71 @@ async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes
     except Exception:
         broadcast_id = None
 
-    # زر "قرأت الإشعار"
+    # الإرسال يتم في الخلفية عبر محرك الإرسال، ورسالة الأدمن هذه تُحدَّث بالتقدم ثم بالنتيجة
+    payload = {
+        "text": broadcast_text,
+        "broadcast_id": broadcast_id,
+        "target": _get_broadcast_target_text(my_students_only, grade_filter),
+    }
+    await query.edit_message_text(f"📨 جاري الإرسال إلى {len(user_ids)} مستخدم...")
+    job_id = await BROADCAST_ENGINE.start(
+        context.bot, "broadcast", [(uid, None) for uid in user_ids], payload,
+        admin_chat_id=query.message.chat_id, progress_message_id=query.message.message_id,
+        created_by=update.effective_user.id,
+    )
+    if not job_id:
+        await query.edit_message_text("❌ تعذر بدء الإرسال", reply_markup=get_admin_menu_keyboard())
+    _cleanup_broadcast_data(context)
+    return ConversationHandler.END
+
+
+async def _send_broadcast_message(bot, user_id, job_payload, item):
+    broadcast_id = job_payload.get("broadcast_id")
     read_markup = None
     if broadcast_id:
+        # زر "قرأت الإشعار"
         read_markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ قرأت", callback_data=f"bc_read_{broadcast_id}")]
         ])
-
-    for user_id in user_ids:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=broadcast_text, reply_markup=read_markup)
-            sent_count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed_count += 1
-            failed_users.append({"user_id": user_id, "error": str(e)[:80]})
-
-    # تحديد الهدف للعرض
-    target = _get_broadcast_target_text(my_students_only, grade_filter)
-
+    await bot.send_message(chat_id=user_id, text=job_payload["text"], reply_markup=read_markup)
+
+
+def _format_failures(summary, label):
+    """قائمة أول 15 مستلم فشل الإرسال لهم"""
+    failures = summary.get("failures") or []
+    if not failures:
+        return ""
+    text = "\n\n📋 قائمة المستخدمين الذين فشل الإرسال لهم:\n"
+    for idx, fu in enumerate(failures, 1):
+        reason = "🚫 غير متاح (تم استبعاده من الإرسالات القادمة)" if fu["status"] == "inactive" else f"الخطأ: {(fu['error'] or '')[:80]}..."
+        text += f"{idx}. {label(fu)}\n   {reason}\n"
+    failed_total = summary["counts"].get("failed", 0) + summary["counts"].get("inactive", 0)
+    if failed_total > len(failures):
+        text += f"... و {failed_total - len(failures)} آخرين"
+    return text
+
+
+def _summarize_broadcast(job, summary):
+    counts = summary["counts"]
+    broadcast_id = job.payload.get("broadcast_id")
     result = (
         f"اكتمل الإرسال.\n"
-        f"🎯 الهدف: {target}\n"
-        f"تم الإرسال بنجاح إلى: {sent_count} مستخدم.\n"
-        f"فشل الإرسال لـ: {failed_count} مستخدم."
+        f"🎯 الهدف: {job.payload.get('target', '')}\n"
+        f"تم الإرسال بنجاح إلى: {counts.get('sent', 0)} مستخدم.\n"
+        f"فشل الإرسال لـ: {counts.get('failed', 0) + counts.get('inactive', 0)} مستخدم."
     )
     if broadcast_id:
         result += f"\n\n📊 رقم الإشعار: #{broadcast_id}\nاضغط الزر لمتابعة القراءة."
-
-    if failed_users:
-        result += "\n\n📋 قائمة المستخدمين الذين فشل الإرسال لهم:\n"
-        for idx, fu in enumerate(failed_users[:15], 1):
-            result += f"{idx}. User ID: {fu['user_id']}\n   الخطأ: {fu['error']}...\n"
-        if len(failed_users) > 15:
-            result += f"... و {len(failed_users) - 15} آخرين"
+    result += _format_failures(summary, lambda fu: f"User ID: {fu['user_id']}")
 
     result_keyboard = []
     if broadcast_id:
         result_keyboard.append([InlineKeyboardButton(f"📊 متابعة القراءة #{broadcast_id}", callback_data=f"bc_stats_{broadcast_id}")])
     result_keyboard.append([InlineKeyboardButton("⬅️ لوحة الأدمن", callback_data="admin_show_tools_menu")])
-    await query.message.reply_text(result, reply_markup=InlineKeyboardMarkup(result_keyboard))
-    _cleanup_broadcast_data(context)
-    return ConversationHandler.END
+    return result, InlineKeyboardMarkup(result_keyboard)
+
+
+BROADCAST_ENGINE.register_kind("broadcast", _send_broadcast_message, _summarize_broadcast)
 
 
 async def admin_broadcast_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1475,12 +1464,10 @@ async def broadcast_read_callback(update: Update, context: ContextTypes.DEFAULT_
     broadcast_id = int(query.data.replace("bc_read_", ""))
 
     try:
-        try:
-            from database.manager import record_broadcast_read
-        except ImportError:
-            from manager import record_broadcast_read
+        from database.write_behind import mark_broadcast_read
 
-        record_broadcast_read(broadcast_id, user_id)
+        # يُكتب مع دفعة الـ write-behind التالية (ON CONFLICT DO NOTHING)
+        mark_broadcast_read(broadcast_id, user_id)
         await query.answer("✅ تم تسجيل القراءة")
         # تحديث الزر ليبين إنه قرأ
         await query.edit_message_reply_markup(
@@ -1750,67 +1737,106 @@ async def admin_stats_panel_button_callback(update: Update, context: ContextType
 #  9. التقارير والشهادات والإشعارات
 # ============================================================
 
+_REPORT_TITLES = {"weekly": "التقرير الأسبوعي", "monthly": "التقرير الشهري (30 يوم)"}
+
+
+def _report_job_message(job):
+    """نص ولوحة أزرار رسالة متابعة مهمة التقرير حسب حالتها"""
+    from utils.report_jobs import STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_CANCELLED
+    title = _REPORT_TITLES.get(job.kind, job.kind)
+    if job.status in (STATUS_QUEUED, STATUS_RUNNING):
+        filled = int(job.progress * 10)
+        bar = "▓" * filled + "░" * (10 - filled)
+        status_line = "⏳ في قائمة الانتظار..." if job.status == STATUS_QUEUED else f"⏳ {job.stage}..."
+        text = (
+            f"📊 {title} — المهمة #{job.job_id}\n"
+            f"{bar} {int(job.progress * 100)}%\n"
+            f"{status_line}\n\n"
+            "يمكنك متابعة استخدام البوت، ستُحدَّث هذه الرسالة تلقائياً."
+        )
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✖️ إلغاء التقرير", callback_data=f"admin_report_cancel:{job.job_id}")],
+            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
+        ])
+        return text, keyboard
+
+    rows = []
+    if job.kind == "weekly":
+        rows.append([InlineKeyboardButton("🔄 تقرير جديد", callback_data="admin_report_weekly")])
+    rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")])
+    if job.status == STATUS_DONE:
+        text = f"✅ تم إنشاء وإرسال {title}\n📧 تحقق من إيميلك"
+    elif job.status == STATUS_CANCELLED:
+        text = f"🚫 تم إلغاء {title} (#{job.job_id})"
+    elif job.error:
+        text = f"❌ خطأ في {title}: {job.error[:200]}"
+    else:
+        text = f"⚠️ لم يكتمل {title} أو تعذر إرساله بالإيميل — راجع السجلات (#{job.job_id})"
+    return text, InlineKeyboardMarkup(rows)
+
+
+async def _start_report_job(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str) -> None:
+    """يضيف التقرير إلى قائمة المهام (أو ينضم لمهمة مماثلة جارية) ويتابع تقدمها في رسالة المشرف"""
+    query = update.callback_query
+    from utils.report_jobs import REPORT_JOBS
+
+    chat_id = query.message.chat_id
+    message_id = query.message.message_id
+    try:
+        job, created = REPORT_JOBS.submit(kind, requested_by=update.effective_user.id, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.error(f"خطأ في جدولة {_REPORT_TITLES.get(kind, kind)}: {e}")
+        await query.edit_message_text(f"❌ خطأ: {str(e)[:200]}", reply_markup=get_admin_menu_keyboard())
+        return
+
+    text, keyboard = _report_job_message(job)
+    if not created:
+        text = "ℹ️ يوجد طلب مماثل قيد التنفيذ، ستتابع نفس المهمة.\n\n" + text
+    await query.edit_message_text(text, reply_markup=keyboard)
+    if not created:
+        return
+
+    async def on_update(job):
+        text, keyboard = _report_job_message(job)
+        for sub_chat_id, sub_message_id in list(job.subscribers):
+            try:
+                await context.bot.edit_message_text(chat_id=sub_chat_id, message_id=sub_message_id, text=text, reply_markup=keyboard)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"تعذر تحديث رسالة التقرير {sub_message_id}: {e}")
+
+    context.application.create_task(REPORT_JOBS.watch(job, on_update))
+
+
 async def admin_report_weekly_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """إنشاء تقرير أسبوعي فوري"""
+    """إنشاء تقرير أسبوعي فوري (مهمة في الخلفية مع متابعة التقدم)"""
     query = update.callback_query
     await query.answer()
     if not await check_admin_privileges(update, context):
         return
-    
-    await query.edit_message_text("⏳ جاري إنشاء التقرير الأسبوعي وإرساله بالإيميل...")
-    
-    try:
-        from final_weekly_report import FinalWeeklyReportScheduler
-        scheduler = FinalWeeklyReportScheduler()
-        scheduler.generate_and_send_weekly_report()
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 تقرير جديد", callback_data="admin_report_weekly")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
-        ])
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="✅ تم إنشاء وإرسال التقرير الأسبوعي\n📧 تحقق من إيميلك",
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        logger.error(f"خطأ في التقرير الأسبوعي: {e}")
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"❌ خطأ: {str(e)[:200]}",
-            reply_markup=get_admin_menu_keyboard()
-        )
+    await _start_report_job(update, context, "weekly")
 
 
 async def admin_report_monthly_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """إنشاء تقرير شهري (30 يوم)"""
+    """إنشاء تقرير شهري (30 يوم) كمهمة في الخلفية"""
     query = update.callback_query
     await query.answer()
     if not await check_admin_privileges(update, context):
         return
-    
-    await query.edit_message_text("⏳ جاري إنشاء التقرير الشهري (30 يوم)...")
-    
-    try:
-        from final_weekly_report import FinalWeeklyReportScheduler
-        scheduler = FinalWeeklyReportScheduler()
-        scheduler.generate_and_send_monthly_report()
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
-        ])
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="✅ تم إنشاء وإرسال التقرير الشهري\n📧 تحقق من إيميلك",
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        logger.error(f"خطأ في التقرير الشهري: {e}")
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"❌ خطأ: {str(e)[:200]}",
-            reply_markup=get_admin_menu_keyboard()
-        )
+    await _start_report_job(update, context, "monthly")
+
+
+async def admin_report_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """إلغاء مهمة تقرير (قبل بدئها أو عند المرحلة التالية إن كانت جارية)"""
+    query = update.callback_query
+    if not await check_admin_privileges(update, context):
+        return
+    from utils.report_jobs import REPORT_JOBS
+    job_id = query.data.split(":", 1)[1] if ":" in query.data else ""
+    if REPORT_JOBS.cancel(job_id):
+        await query.answer("🚫 جاري إلغاء التقرير...")
+    else:
+        await query.answer("المهمة انتهت بالفعل أو غير موجودة", show_alert=True)
 
 
 async def admin_report_certificates_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1954,43 +1980,58 @@ async def admin_report_cert_confirm_callback(update: Update, context: ContextTyp
         return
     
     to_send = [c for i, c in enumerate(certificates) if i < len(selected) and selected[i]]
-    
-    await query.edit_message_text(f"📨 جاري إرسال {len(to_send)} شهادة...")
-    
-    sent = 0
-    failed = 0
-    
-    for cert in to_send:
-        try:
-            telegram_id = cert['telegram_id']
-            
-            await context.bot.send_message(chat_id=telegram_id, text=cert['message'])
-            
-            import os
-            if os.path.exists(cert['pdf_path']):
-                with open(cert['pdf_path'], 'rb') as pdf_file:
-                    await context.bot.send_document(
-                        chat_id=telegram_id,
-                        document=pdf_file,
-                        filename=f"شهادة_{cert['name']}.pdf",
-                        caption=f"🏆 شهادة {cert['cert_type']}"
-                    )
-            sent += 1
-        except Exception as se:
-            failed += 1
-            logger.warning(f"فشل إرسال شهادة لـ {cert.get('name', '?')}: {se}")
+    recipients = [
+        (c['telegram_id'], {k: c.get(k) for k in ('message', 'pdf_path', 'name', 'cert_type')})
+        for c in to_send
+    ]
     
     context.user_data['pending_certificates'] = []
     context.user_data['cert_selected'] = []
     
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
-    ])
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text=f"✅ تم إرسال الشهادات\n📨 نجح: {sent}\n❌ فشل: {failed}",
-        reply_markup=keyboard
+    await query.edit_message_text(f"📨 جاري إرسال {len(to_send)} شهادة...")
+    job_id = await BROADCAST_ENGINE.start(
+        context.bot, "certificate", recipients,
+        admin_chat_id=query.message.chat_id, progress_message_id=query.message.message_id,
+        created_by=update.effective_user.id,
     )
+    if not job_id:
+        await query.edit_message_text("❌ تعذر بدء إرسال الشهادات", reply_markup=get_admin_menu_keyboard())
+
+
+async def _send_certificate(bot, telegram_id, job_payload, cert):
+    """رسالة واحدة لكل طالب (الشهادة مع نص التهنئة كتعليق) حتى تكون إعادة المحاولة بلا تكرار"""
+    if not cert.get('pdf_path'):
+        await bot.send_message(chat_id=telegram_id, text=cert['message'])
+        return
+    if not os.path.exists(cert['pdf_path']):
+        # ملفات الـ dyno مؤقتة: بعد إعادة التشغيل قد يختفي ملف الشهادة، فيُسجل المستلم كفاشل
+        raise FileNotFoundError(f"ملف الشهادة غير موجود: {os.path.basename(cert['pdf_path'])}")
+    with open(cert['pdf_path'], 'rb') as pdf_file:
+        await bot.send_document(
+            chat_id=telegram_id,
+            document=pdf_file,
+            filename=f"شهادة_{cert['name']}.pdf",
+            caption=f"🏆 شهادة {cert['cert_type']}\n\n{cert['message']}"[:1024]
+        )
+
+
+def _summarize_student_messages(title):
+    """ملخص إرسال الشهادات / الإشعارات التشجيعية"""
+    def summarize(job, summary):
+        counts = summary["counts"]
+        text = (
+            f"{title}\n📨 نجح: {counts.get('sent', 0)}\n"
+            f"❌ فشل: {counts.get('failed', 0) + counts.get('inactive', 0)}"
+        )
+        text += _format_failures(summary, lambda fu: (fu.get('payload') or {}).get('name') or f"User ID: {fu['user_id']}")
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
+        ])
+        return text, keyboard
+    return summarize
+
+
+BROADCAST_ENGINE.register_kind("certificate", _send_certificate, _summarize_student_messages("✅ تم إرسال الشهادات"))
 
 
 async def admin_report_notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -2134,31 +2175,27 @@ async def admin_report_notify_confirm_callback(update: Update, context: ContextT
     
     # فلترة المحددين فقط
     to_send = [n for i, n in enumerate(notifications) if i < len(selected) and selected[i]]
-    
-    await query.edit_message_text(f"📨 جاري إرسال {len(to_send)} إشعار...")
-    
-    sent = 0
-    failed = 0
-    
-    for notif in to_send:
-        try:
-            await context.bot.send_message(chat_id=notif['telegram_id'], text=notif['message'])
-            sent += 1
-        except Exception as se:
-            failed += 1
-            logger.warning(f"فشل إرسال إشعار لـ {notif.get('name', '?')}: {se}")
+    recipients = [(n['telegram_id'], {'message': n['message'], 'name': n.get('name')}) for n in to_send]
     
     context.user_data['pending_notifications'] = []
     context.user_data['notify_selected'] = []
     
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_show_tools_menu")]
-    ])
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text=f"✅ تم إرسال الإشعارات التشجيعية\n📨 نجح: {sent}\n❌ فشل: {failed}",
-        reply_markup=keyboard
+    await query.edit_message_text(f"📨 جاري إرسال {len(to_send)} إشعار...")
+    job_id = await BROADCAST_ENGINE.start(
+        context.bot, "notification", recipients,
+        admin_chat_id=query.message.chat_id, progress_message_id=query.message.message_id,
+        created_by=update.effective_user.id,
     )
+    if not job_id:
+        await query.edit_message_text("❌ تعذر بدء إرسال الإشعارات", reply_markup=get_admin_menu_keyboard())
+
+
+async def _send_notification(bot, telegram_id, job_payload, notif):
+    await bot.send_message(chat_id=telegram_id, text=notif['message'])
+
+
+BROADCAST_ENGINE.register_kind("notification", _send_notification,
+                               _summarize_student_messages("✅ تم إرسال الإشعارات التشجيعية"))
 
 
 # ============================================================
@@ -82,6 +82,55 @@ async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"حدث خطأ أثناء تصدير بيانات المستخدمين: {e}")
         await update.message.reply_text("حدث خطأ أثناء تصدير بيانات المستخدمين. يرجى المحاولة مرة أخرى لاحقاً.")
 
+async def clear_question_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    أمر مسح ذاكرة التخزين المؤقت لبنك الأسئلة (بعد تحديث الأسئلة في الـ API)
+    متاح للمدير فقط
+    
+    الاستخدام:
+        /clear_cache            مسح كل المدخلات
+        /clear_cache api/v1/units/5   مسح المدخلات التي تبدأ بالمسار المحدد
+    """
+    user_id = update.effective_user.id
+    
+    # التحقق من صلاحيات المدير
+    if not await check_admin_rights(user_id, context):
+        logger.warning(f"محاولة غير مصرح بها لمسح ذاكرة الأسئلة من قبل المستخدم {user_id}")
+        await update.message.reply_text("عذراً، هذا الأمر متاح للمدير فقط.")
+        return
+    
+    try:
+        from utils.api_cache import invalidate_api_cache, get_api_cache_stats
+        
+        stats = get_api_cache_stats()
+        prefix = context.args[0] if context.args else None
+        removed = invalidate_api_cache(prefix)
+        
+        # إعادة بناء فهرس الأسئلة في الخلفية حتى لا يبقى محتفظاً بالأسئلة القديمة
+        from utils.question_catalogue import request_question_catalogue_refresh
+        request_question_catalogue_refresh(context.application)
+        
+        text = f"""🧹 تم مسح ذاكرة بنك الأسئلة
+
+• المدخلات المحذوفة: {removed}
+• النطاق: {prefix or 'الكل'}
+• فهرس الأسئلة: جارٍ إعادة بنائه في الخلفية
+
+📈 الإحصائيات قبل المسح:
+• إصابات: {stats['hits']} (منتهية الصلاحية: {stats['stale_hits']})
+• إخفاقات: {stats['misses']}
+• نسبة الإصابة: {stats['hit_rate']}%
+• طلبات للخادم: {stats['upstream_fetches']} (لم تتغير 304: {stats['not_modified']})
+• طلبات مدمجة: {stats['coalesced']}
+• أخطاء التحديث: {stats['refresh_errors']}"""
+        
+        await update.message.reply_text(text)
+        logger.info(f"تم مسح ذاكرة بنك الأسئلة ({removed} مدخل) بواسطة المدير {user_id}")
+    
+    except Exception as e:
+        logger.error(f"حدث خطأ أثناء مسح ذاكرة بنك الأسئلة: {e}")
+        await update.message.reply_text("حدث خطأ أثناء مسح ذاكرة الأسئلة. يرجى المحاولة مرة أخرى لاحقاً.")
+
 async def check_admin_rights(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     التحقق من صلاحيات المدير للمستخدم
@@ -43,7 +43,10 @@ from config import (
 # إضافة حالة جديدة لاختيار المقرر للاختبار العشوائي
 SELECT_COURSE_FOR_RANDOM_QUIZ = 100
 from utils.helpers import safe_send_message, safe_edit_message_text, get_quiz_type_string, remove_job_if_exists
-from utils.api_client import fetch_from_api, transform_api_question 
+from utils.api_client import fetch_many_from_api
+from utils.api_cache import fetch_from_api_cached
+from utils.question_catalogue import QUESTION_CATALOGUE
+from database.async_manager import run_db
 # MANUS_MODIFIED_V6: Removed problematic import of stats_menu_callback
 from handlers.common import main_menu_callback, start_command 
 from .quiz_logic import QuizLogic
@@ -105,7 +108,7 @@ async def _cleanup_quiz_session_data(
     keys_to_pop = [
         f"quiz_logic_instance_{user_id}",
         "selected_quiz_type_key", "selected_quiz_type_display_name", 
-        "questions_for_quiz", 
+        "questions_for_quiz", "questions_for_quiz_ids", "questions_for_quiz_source",
         "selected_course_id_for_unit_quiz", "available_courses_for_unit_quiz",
         "current_course_page_for_unit_quiz", "selected_course_name_for_unit_quiz",
         "available_units_for_course", "current_unit_page_for_course",
@@ -295,7 +298,7 @@ async def select_quiz_type_handler(update: Update, context: CallbackContext) ->
     api_timeout_message = "انتهت مهلة الاتصال بخادم الأسئلة. يرجى المحاولة مرة أخرى لاحقاً."
 
     if quiz_type_key == QUIZ_TYPE_ALL:
-        api_response = await fetch_from_api("api/v1/questions/all")
+        api_response = await fetch_from_api_cached("api/v1/questions/all")
         if api_response == "TIMEOUT":
             await safe_edit_message_text(context.bot, chat_id, query.message.message_id, api_timeout_message, create_quiz_type_keyboard())
             return SELECT_QUIZ_TYPE 
@@ -303,7 +306,7 @@ async def select_quiz_type_handler(update: Update, context: CallbackContext) ->
             await safe_edit_message_text(context.bot, chat_id, query.message.message_id, error_text_no_data("أسئلة شاملة"), create_quiz_type_keyboard())
             return SELECT_QUIZ_TYPE
         
-        context.user_data["questions_for_quiz"] = api_response 
+        _remember_quiz_questions(context, "api/v1/questions/all", api_response)
         context.user_data["selected_quiz_scope_id"] = "all"
         max_q = len(api_response)
         kbd = create_question_count_keyboard(max_q, quiz_type_key, unit_id="all")
@@ -312,7 +315,7 @@ async def select_quiz_type_handler(update: Update, context: CallbackContext) ->
 
     elif quiz_type_key == "random_course":
         # اختبار عشوائي حسب المقرر
-        courses = await fetch_from_api("api/v1/courses")
+        courses = await fetch_from_api_cached("api/v1/courses")
         if courses == "TIMEOUT":
             await safe_edit_message_text(context.bot, chat_id, query.message.message_id, api_timeout_message, create_quiz_type_keyboard())
             return SELECT_QUIZ_TYPE
@@ -326,7 +329,7 @@ async def select_quiz_type_handler(update: Update, context: CallbackContext) ->
         return SELECT_COURSE_FOR_RANDOM_QUIZ
         
     elif quiz_type_key == QUIZ_TYPE_UNIT:
-        courses = await fetch_from_api("api/v1/courses")
+        courses = await fetch_from_api_cached("api/v1/courses")
         if courses == "TIMEOUT":
             await safe_edit_message_text(context.bot, chat_id, query.message.message_id, api_timeout_message, create_quiz_type_keyboard())
             return SELECT_QUIZ_TYPE
@@ -342,6 +345,20 @@ async def select_quiz_type_handler(update: Update, context: CallbackContext) ->
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, "نوع اختبار غير صالح.", create_quiz_type_keyboard())
         return SELECT_QUIZ_TYPE
 
+def _remember_quiz_questions(context: CallbackContext, source_endpoint: str, api_response: list):
+    """
+    يحفظ معرفات الأسئلة فقط ومصدرها في user_data بدلاً من بنك الأسئلة كاملاً
+    (user_data يُحفظ في ملف الـ persistence، والمحتوى متاح في QUESTION_CATALOGUE).
+    """
+    question_ids = []
+    for q in api_response:
+        q_id = q.get("id", q.get("question_id")) if isinstance(q, dict) else None
+        if q_id is not None:
+            question_ids.append(str(q_id))
+    context.user_data.pop("questions_for_quiz", None) # مفتاح قديم كان يحمل الأسئلة كاملة
+    context.user_data["questions_for_quiz_ids"] = question_ids
+    context.user_data["questions_for_quiz_source"] = source_endpoint
+
 async def select_course_for_random_quiz_handler(update: Update, context: CallbackContext) -> int:
     """معالج اختيار المقرر للاختبار العشوائي"""
     query = update.callback_query
@@ -374,7 +391,7 @@ async def select_course_for_random_quiz_handler(update: Update, context: Callbac
     context.user_data["selected_course_name_for_random_quiz"] = selected_course_name
 
     # جلب جميع الأسئلة للمقرر
-    api_response = await fetch_from_api(f"api/v1/courses/{selected_course_id}/questions")
+    api_response = await fetch_from_api_cached(f"api/v1/courses/{selected_course_id}/questions")
     api_timeout_message = "انتهت مهلة الاتصال بخادم الأسئلة. يرجى المحاولة مرة أخرى لاحقاً."
     
     if api_response == "TIMEOUT":
@@ -389,7 +406,7 @@ async def select_course_for_random_quiz_handler(update: Update, context: Callbac
         return SELECT_COURSE_FOR_RANDOM_QUIZ
 
     # حفظ الأسئلة
-    context.user_data["questions_for_quiz"] = api_response
+    _remember_quiz_questions(context, f"api/v1/courses/{selected_course_id}/questions", api_response)
     context.user_data["selected_quiz_scope_id"] = selected_course_id
     context.user_data["selected_quiz_type_key"] = "random_course"
     context.user_data["selected_quiz_type_display_name"] = f"اختبار عشوائي - {selected_course_name}"
@@ -427,7 +444,7 @@ async def select_course_for_unit_quiz_handler(update: Update, context: CallbackC
     selected_course_name = next((c.get("name") for c in courses if str(c.get("id")) == str(selected_course_id)), "مقرر غير معروف")
     context.user_data["selected_course_name_for_unit_quiz"] = selected_course_name
 
-    units = await fetch_from_api(f"api/v1/courses/{selected_course_id}/units")
+    units = await fetch_from_api_cached(f"api/v1/courses/{selected_course_id}/units")
     api_timeout_message = "انتهت مهلة الاتصال بخادم الأسئلة. يرجى المحاولة مرة أخرى لاحقاً."
     if units == "TIMEOUT":
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, api_timeout_message, create_course_selection_keyboard(courses, context.user_data.get("current_course_page_for_unit_quiz",0)))
@@ -475,7 +492,7 @@ async def select_unit_for_course_handler(update: Update, context: CallbackContex
     selected_unit_name = next((u.get("name") for u in units if str(u.get("id")) == str(selected_unit_id)), "وحدة غير معروفة")
     context.user_data["selected_unit_name"] = selected_unit_name
 
-    api_response = await fetch_from_api(f"api/v1/units/{selected_unit_id}/questions")
+    api_response = await fetch_from_api_cached(f"api/v1/units/{selected_unit_id}/questions")
     api_timeout_message = "انتهت مهلة الاتصال بخادم الأسئلة. يرجى المحاولة مرة أخرى لاحقاً."
     current_unit_page = context.user_data.get("current_unit_page_for_course", 0)
 
@@ -486,7 +503,7 @@ async def select_unit_for_course_handler(update: Update, context: CallbackContex
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, f"لا توجد أسئلة متاحة للوحدة '{selected_unit_name}'.", create_unit_selection_keyboard(units, selected_course_id, current_unit_page))
         return SELECT_UNIT_FOR_COURSE
 
-    context.user_data["questions_for_quiz"] = api_response
+    _remember_quiz_questions(context, f"api/v1/units/{selected_unit_id}/questions", api_response)
     context.user_data["selected_quiz_scope_id"] = selected_unit_id
     max_q = len(api_response)
     kbd = create_question_count_keyboard(max_q, QUIZ_TYPE_UNIT, selected_unit_id, selected_course_id)
@@ -521,9 +538,9 @@ async def enter_question_count_handler(update: Update, context: CallbackContext)
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, "اختر المقرر الدراسي:", kbd)
         return SELECT_COURSE_FOR_UNIT_QUIZ
 
-    raw_questions = context.user_data.get("questions_for_quiz", [])
+    raw_questions = context.user_data.get("questions_for_quiz_ids", [])
     if not raw_questions:
-        logger.error(f"User {user_id} in ENTER_QUESTION_COUNT but no questions_for_quiz in user_data. Returning to type selection.")
+        logger.error(f"User {user_id} in ENTER_QUESTION_COUNT but no questions_for_quiz_ids in user_data. Returning to type selection.")
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, "حدث خطأ في إعداد الاختبار، لا توجد أسئلة. يرجى المحاولة مجدداً.", create_quiz_type_keyboard())
         return SELECT_QUIZ_TYPE
 
@@ -541,13 +558,12 @@ async def enter_question_count_handler(update: Update, context: CallbackContext)
             num_questions = len(raw_questions)
     
     context.user_data["question_count_for_quiz"] = num_questions
-    selected_questions = random.sample(raw_questions, k=min(num_questions, len(raw_questions)))
+    selected_question_ids = random.sample(raw_questions, k=min(num_questions, len(raw_questions)))
     
-    transformed_questions = []
-    for q_data in selected_questions:
-        transformed_q = transform_api_question(q_data) 
-        if transformed_q:
-            transformed_questions.append(transformed_q)
+    # المحتوى يُستخرج من فهرس الأسئلة المشترك (user_data يحتفظ بالمعرفات فقط)
+    transformed_questions = await QUESTION_CATALOGUE.resolve_transformed_questions(
+        selected_question_ids, context.user_data.get("questions_for_quiz_source")
+    )
     
     if not transformed_questions:
         logger.error(f"User {user_id} - No questions available after transformation for quiz type {quiz_type}. Raw count: {len(raw_questions)}")
@@ -578,7 +594,8 @@ async def enter_question_count_handler(update: Update, context: CallbackContext)
         total_questions_for_db_log=len(transformed_questions),
         time_limit_per_question=DEFAULT_QUESTION_TIME_LIMIT,
         quiz_instance_id_for_logging=quiz_instance_id,
-        is_resumable=is_resumable
+        is_resumable=is_resumable,
+        source_endpoint=context.user_data.get("questions_for_quiz_source")
     )
     context.user_data[f"quiz_logic_instance_{user_id}"] = quiz_logic_instance
     
@@ -599,6 +616,8 @@ async def handle_quiz_answer_wrapper(update: Update, context: CallbackContext) -
         return ConversationHandler.END
 
     if quiz_logic_instance.active:
+        # بعد إعادة التشغيل: استرجاع محتوى الأسئلة من الفهرس قبل المتابعة
+        await quiz_logic_instance.ensure_questions_loaded()
         # توجيه الاستجابة إلى الدالة المناسبة حسب نوع الزر المضغوط
         if query.data.startswith("skip_"):
             return await quiz_logic_instance.handle_skip_question(update, context, query.data)
@@ -658,7 +677,7 @@ async def show_saved_quizzes_menu(update: Update, context: CallbackContext) -> i
     # استرجاع الاختبارات المحفوظة من قاعدة البيانات
     try:
         from database.saved_quizzes_db import get_saved_quizzes_for_user
-        saved_quizzes = get_saved_quizzes_for_user(user_id)
+        saved_quizzes = await run_db(get_saved_quizzes_for_user, user_id, default={})
     except Exception as e:
         logger.error(f"[خطأ] فشل استرجاع الاختبارات المحفوظة من قاعدة البيانات: {e}", exc_info=True)
         saved_quizzes = {}
@@ -698,6 +717,43 @@ async def show_saved_quizzes_menu(update: Update, context: CallbackContext) -> i
     return MAIN_MENU
 
 
+async def _resolve_saved_questions(saved_quiz_data: dict):
+    """
+    يعيد بناء أسئلة اختبار محفوظ من معرفاتها عبر QUESTION_CATALOGUE، بترتيب الخيارات نفسه وقت الحفظ.
+    السؤال المُجاب سابقاً الذي حُذف من البنك يبقى في مكانه بلا خيارات (حتى يبقى current_question_index صحيحاً).
+
+    Returns:
+        قائمة الأسئلة، أو None إذا لم يكن الفهرس جاهزاً أو تعذر استعادة سؤال لم يُجب بعد
+        (يبقى الاختبار المحفوظ في قاعدة البيانات ليُعاد المحاولة لاحقاً).
+    """
+    question_ids = saved_quiz_data["question_ids"]
+    option_orders = saved_quiz_data.get("option_orders") or [[] for _ in question_ids]
+    if not await QUESTION_CATALOGUE.wait_until_ready():
+        logger.warning(f"[استكمال] فهرس الأسئلة غير جاهز، لن يُستعاد الاختبار {saved_quiz_data['quiz_id']} الآن")
+        return None
+    resolved = {
+        str(q["question_id"]): q
+        for q in await QUESTION_CATALOGUE.resolve_transformed_questions(question_ids, saved_quiz_data.get("source_endpoint"))
+    }
+    first_pending = saved_quiz_data["current_question_index"]
+    missing = [q_id for q_id in question_ids[first_pending:] if str(q_id) not in resolved]
+    if missing:
+        logger.warning(f"[استكمال] تعذر استعادة {len(missing)} سؤال متبقٍ للاختبار {saved_quiz_data['quiz_id']}")
+        return None
+    questions = []
+    for q_id, option_order in zip(question_ids, option_orders):
+        question = resolved.get(str(q_id))
+        if question is None:
+            questions.append({"question_id": q_id, "question_text": None, "image_url": None, "explanation": None, "options": []})
+            continue
+        question = dict(question)
+        options_by_id = {str(opt["option_id"]): opt for opt in question["options"]}
+        if len(option_order) == len(options_by_id) and all(o_id in options_by_id for o_id in option_order):
+            question["options"] = [options_by_id[o_id] for o_id in option_order]
+        questions.append(question)
+    return questions
+
+
 async def resume_saved_quiz(update: Update, context: CallbackContext) -> int:
     """استكمال اختبار محفوظ"""
     query = update.callback_query
@@ -709,21 +765,32 @@ async def resume_saved_quiz(update: Update, context: CallbackContext) -> int:
     # استخراج معرف الاختبار من callback_data
     quiz_id = query.data.replace("resume_quiz_", "")
     
-    # استرجاع الاختبارات المحفوظة من قاعدة البيانات
+    # استرجاع الاختبار المحفوظ من قاعدة البيانات
     try:
-        from database.saved_quizzes_db import get_saved_quizzes_for_user
-        saved_quizzes = get_saved_quizzes_for_user(user_id)
+        from database.saved_quizzes_db import load_saved_quiz
+        saved_quiz_data = await run_db(load_saved_quiz, user_id, quiz_id)
     except Exception as e:
-        logger.error(f"[خطأ] فشل استرجاع الاختبارات المحفوظة: {e}", exc_info=True)
-        saved_quizzes = {}
+        logger.error(f"[خطأ] فشل استرجاع الاختبار المحفوظ: {e}", exc_info=True)
+        saved_quiz_data = None
     
-    if quiz_id not in saved_quizzes:
+    if not saved_quiz_data:
         await safe_edit_message_text(context.bot, chat_id, query.message.message_id, 
                                      "❌ الاختبار المحفوظ غير موجود أو تم حذفه.",
                                      InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="show_saved_quizzes")]]))
         return MAIN_MENU
     
-    saved_quiz_data = saved_quizzes[quiz_id]
+    # الصفوف الجديدة تحمل المعرفات فقط: المحتوى من فهرس الأسئلة
+    if saved_quiz_data["compact"]:
+        questions = await _resolve_saved_questions(saved_quiz_data)
+    else:
+        questions = saved_quiz_data["questions_data"]
+    
+    if not questions:
+        # الاختبار المحفوظ يبقى كما هو حتى تتوفر أسئلته
+        await safe_edit_message_text(context.bot, chat_id, query.message.message_id,
+                                     "⏳ تعذر تحميل أسئلة هذا الاختبار حالياً. تقدمك محفوظ، يرجى المحاولة مرة أخرى لاحقاً.",
+                                     InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="show_saved_quizzes")]]))
+        return MAIN_MENU
     
     # إعادة بناء QuizLogic من البيانات المحفوظة
     from datetime import datetime, timezone
@@ -731,20 +798,24 @@ async def resume_saved_quiz(update: Update, context: CallbackContext) -> int:
     quiz_logic_instance = QuizLogic(
         user_id=user_id,
         chat_id=chat_id,
-        questions=saved_quiz_data["questions_data"],
+        questions=questions,
         quiz_name=saved_quiz_data["quiz_name"],
         quiz_type_for_db_log=saved_quiz_data["quiz_type"],
         quiz_scope_id=saved_quiz_data["quiz_scope_id"],
         total_questions_for_db_log=saved_quiz_data["total_questions"],
         time_limit_per_question=DEFAULT_QUESTION_TIME_LIMIT,
         quiz_instance_id_for_logging=quiz_id,
-        is_resumable=True
+        is_resumable=True,
+        source_endpoint=saved_quiz_data.get("source_endpoint")
     )
     
     # استعادة الحالة
     quiz_logic_instance.current_question_index = saved_quiz_data["current_question_index"]
     quiz_logic_instance.score = saved_quiz_data["score"]
-    quiz_logic_instance.answers = saved_quiz_data["answers"]
+    if saved_quiz_data["compact"]:
+        quiz_logic_instance.restore_saved_answers(saved_quiz_data["answers"])
+    else:
+        quiz_logic_instance.answers = saved_quiz_data["answers"]
     quiz_logic_instance.active = True
     quiz_logic_instance.db_quiz_session_id = saved_quiz_data.get("db_quiz_session_id")
     
@@ -757,7 +828,7 @@ async def resume_saved_quiz(update: Update, context: CallbackContext) -> int:
     # حذف الاختبار من قاعدة البيانات (سيتم حفظه مرة أخرى إذا اختار الحفظ)
     try:
         from database.saved_quizzes_db import delete_saved_quiz
-        delete_saved_quiz(quiz_id)
+        await run_db(delete_saved_quiz, quiz_id)
         logger.info(f"[استكمال] تم حذف الاختبار {quiz_id} من قاعدة البيانات")
     except Exception as e:
         logger.error(f"[خطأ] فشل حذف الاختبار من قاعدة البيانات: {e}", exc_info=True)
@@ -787,7 +858,7 @@ def _weakness_bar(error_rate: float, width: int = 6) -> str:
 async def _fetch_course_weakness(courses: list, weak_question_ids: set) -> tuple:
     """
     المرحلة 1: جلب أسئلة كل مقرر ومطابقتها مع أسئلة الضعف.
-    يرسل API call واحد لكل مقرر (عادة 2-3 مقررات فقط).
+    طلبات المقررات تُرسل بالتوازي (fetch_many_from_api) بدلاً من واحداً تلو الآخر.
     
     Returns:
         (course_weakness_dict, all_matched_questions_dict)
@@ -797,14 +868,18 @@ async def _fetch_course_weakness(courses: list, weak_question_ids: set) -> tuple
     course_weakness = {}
     all_matched = {}
     
-    for course in courses:
+    # جلب أسئلة كل المقررات دفعة واحدة
+    valid_courses = [c for c in courses if str(c.get("id", ""))]
+    responses = await fetch_many_from_api(
+        [f"api/v1/courses/{c.get('id')}/questions" for c in valid_courses],
+        fetcher=fetch_from_api_cached
+    )
+    
+    for course in valid_courses:
         c_id = str(course.get("id", ""))
         c_name = course.get("name", "")
-        if not c_id:
-            continue
         
-        # جلب كل أسئلة المقرر
-        questions = await fetch_from_api(f"api/v1/courses/{c_id}/questions")
+        questions = responses.get(f"api/v1/courses/{c_id}/questions")
         if not questions or questions == "TIMEOUT" or not isinstance(questions, list):
             logger.warning(f"[Weakness] Could not fetch questions for course {c_id} ({c_name})")
             continue
@@ -834,10 +909,66 @@ async def _fetch_course_weakness(courses: list, weak_question_ids: set) -> tuple
     return course_weakness, all_matched
 
 
+async def _resolve_weak_questions(matched: dict, question_ids, scope_key: str) -> list:
+    """
+    استخراج أسئلة الضعف بصيغة QuizLogic من الفهرس المشترك.
+    matched يحتوي على course_id أو unit_id لكل سؤال (scope_key)، ويُستخدم كمصدر بديل إن لم يكن السؤال في الفهرس.
+    """
+    endpoint_template = "api/v1/courses/{}/questions" if scope_key == "course_id" else "api/v1/units/{}/questions"
+    by_scope = {}
+    for q_id in question_ids:
+        info = matched.get(q_id)
+        if info:
+            by_scope.setdefault(info[scope_key], []).append(q_id)
+    transformed = []
+    for scope_id, ids in by_scope.items():
+        transformed.extend(await QUESTION_CATALOGUE.resolve_transformed_questions(ids, endpoint_template.format(scope_id)))
+    return transformed
+
+
+def _catalogue_course_weakness(weak_question_ids: set) -> tuple:
+    """
+    نسخة المرحلة 1 من الفهرس المحلي: تقاطع مجموعات بدون أي طلب API.
+    تعيد نفس البنية التي تعيدها _fetch_course_weakness.
+    """
+    course_weakness = {}
+    all_matched = {}
+    for c_id, q_ids in QUESTION_CATALOGUE.match_courses(weak_question_ids).items():
+        c_name = QUESTION_CATALOGUE.course_name(c_id)
+        weak_in_course = []
+        for q_id in sorted(q_ids):
+            q = QUESTION_CATALOGUE.get(q_id).question_data
+            weak_in_course.append({"q_id": q_id, "question_data": q})
+            all_matched[q_id] = {"course_id": c_id, "course_name": c_name, "question_data": q}
+        course_weakness[c_id] = {"name": c_name, "weak_count": len(weak_in_course), "weak_q_data": weak_in_course}
+    logger.info(f"[Weakness] Catalogue matched: {len(all_matched)} out of {len(weak_question_ids)} weak IDs")
+    return course_weakness, all_matched
+
+
+def _catalogue_unit_weakness(course_id: str, weak_question_ids: set) -> tuple:
+    """
+    نسخة المرحلة 2 من الفهرس المحلي.
+    تعيد نفس البنية التي تعيدها _fetch_unit_weakness.
+    """
+    unit_weakness = {}
+    unit_matched = {}
+    unit_names = {str(u.get("id")): u.get("name", "") for u in QUESTION_CATALOGUE.units_by_course.get(str(course_id), [])}
+    for u_id, q_ids in QUESTION_CATALOGUE.match_units(course_id, weak_question_ids).items():
+        u_name = unit_names.get(u_id, "")
+        weak_in_unit = []
+        for q_id in sorted(q_ids):
+            q = QUESTION_CATALOGUE.get(q_id).question_data
+            weak_in_unit.append({"q_id": q_id, "question_data": q})
+            unit_matched[q_id] = {"unit_id": u_id, "unit_name": u_name, "question_data": q}
+        unit_weakness[u_id] = {"name": u_name, "weak_count": len(weak_in_unit), "weak_q_data": weak_in_unit}
+    logger.info(f"[Weakness] Course {course_id}: {len(unit_weakness)} units with weak questions (catalogue)")
+    return unit_weakness, unit_matched
+
+
 async def _fetch_unit_weakness(course_id: str, weak_question_ids: set) -> tuple:
     """
     المرحلة 2: جلب وحدات مقرر محدد ومطابقة الأسئلة الضعيفة لكل وحدة.
-    يُستدعى فقط عند اختيار المقرر.
+    يُستدعى فقط عند اختيار المقرر. أسئلة الوحدات تُجلب بالتوازي.
     
     Returns:
         (unit_weakness_dict, unit_matched_questions_dict)
@@ -847,18 +978,22 @@ async def _fetch_unit_weakness(course_id: str, weak_question_ids: set) -> tuple:
     unit_weakness = {}
     unit_matched = {}
     
-    units = await fetch_from_api(f"api/v1/courses/{course_id}/units")
+    units = await fetch_from_api_cached(f"api/v1/courses/{course_id}/units")
     if not units or units == "TIMEOUT" or not isinstance(units, list):
         logger.warning(f"[Weakness] Could not fetch units for course {course_id}")
         return unit_weakness, unit_matched
     
-    for unit in units:
+    valid_units = [u for u in units if str(u.get("id", ""))]
+    responses = await fetch_many_from_api(
+        [f"api/v1/units/{u.get('id')}/questions" for u in valid_units],
+        fetcher=fetch_from_api_cached
+    )
+    
+    for unit in valid_units:
         u_id = str(unit.get("id", ""))
         u_name = unit.get("name", "")
-        if not u_id:
-            continue
         
-        questions = await fetch_from_api(f"api/v1/units/{u_id}/questions")
+        questions = responses.get(f"api/v1/units/{u_id}/questions")
         if not questions or questions == "TIMEOUT" or not isinstance(questions, list):
             continue
         
@@ -915,7 +1050,7 @@ async def start_weakness_quiz(update: Update, context: CallbackContext) -> int:
             message_id = sent.message_id
     
     # 1. جلب نقاط الضعف من قاعدة البيانات
-    weak_questions = DB_MANAGER.get_user_weak_questions(user_id, limit=200)
+    weak_questions = await run_db(DB_MANAGER.get_user_weak_questions, user_id, limit=200, default=[])
     
     if not weak_questions:
         no_data_text = (
@@ -949,8 +1084,8 @@ async def start_weakness_quiz(update: Update, context: CallbackContext) -> int:
     context.user_data["weakness_error_rates"] = weak_error_rates
     logger.info(f"[Weakness] User {user_id}: {len(weak_question_ids)} weak question IDs from DB")
     
-    # 2. جلب المقررات
-    courses = await fetch_from_api("api/v1/courses")
+    # 2. جلب المقررات (من الفهرس المحلي إن كان جاهزاً)
+    courses = QUESTION_CATALOGUE.courses if QUESTION_CATALOGUE.ready else await fetch_from_api_cached("api/v1/courses")
     if not courses or courses == "TIMEOUT" or not isinstance(courses, list):
         kbd = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 القائمة الرئيسية", callback_data="main_menu")]])
         if message_id:
@@ -959,8 +1094,11 @@ async def start_weakness_quiz(update: Update, context: CallbackContext) -> int:
     
     context.user_data["weakness_courses"] = courses
     
-    # 3. جلب أسئلة كل مقرر ومطابقتها (2-3 API calls فقط)
-    course_weakness, all_matched = await _fetch_course_weakness(courses, weak_question_ids)
+    # 3. مطابقة أسئلة الضعف مع بنك الأسئلة (تقاطع مجموعات من الفهرس، أو جلب من API كحل بديل)
+    if QUESTION_CATALOGUE.ready:
+        course_weakness, all_matched = _catalogue_course_weakness(weak_question_ids)
+    else:
+        course_weakness, all_matched = await _fetch_course_weakness(courses, weak_question_ids)
     
     if not course_weakness or not all_matched:
         logger.warning(f"[Weakness] No matches found. weak_ids sample: {list(weak_question_ids)[:3]}")
@@ -978,8 +1116,11 @@ async def start_weakness_quiz(update: Update, context: CallbackContext) -> int:
             await safe_edit_message_text(context.bot, chat_id, message_id, no_match_text, kbd)
         return ConversationHandler.END
     
-    # حفظ البيانات
-    context.user_data["weakness_all_matched"] = all_matched
+    # حفظ البيانات (بدون محتوى الأسئلة — يُستخرج من الفهرس عند بدء الاختبار)
+    context.user_data["weakness_all_matched"] = {
+        q_id: {"course_id": info["course_id"], "course_name": info["course_name"]}
+        for q_id, info in all_matched.items()
+    }
     context.user_data["weakness_weak_ids"] = weak_question_ids
     
     # حساب متوسط نسبة الخطأ لكل مقرر
@@ -1051,11 +1192,7 @@ async def handle_weakness_course_selection(update: Update, context: CallbackCont
     
     # اختبار شامل لكل نقاط الضعف
     if callback_data == "weakness_course_all":
-        all_q = []
-        for q_id, info in all_matched.items():
-            t = transform_api_question(info["question_data"])
-            if t:
-                all_q.append(t)
+        all_q = await _resolve_weak_questions(all_matched, list(all_matched), "course_id")
         return await _start_weakness_quiz_direct(update, context, all_q, message_id)
     
     # استخراج course_id
@@ -1075,20 +1212,21 @@ async def handle_weakness_course_selection(update: Update, context: CallbackCont
         if info["course_id"] == selected_course_id
     )
     
-    unit_weakness, unit_matched = await _fetch_unit_weakness(selected_course_id, course_weak_ids)
+    if QUESTION_CATALOGUE.ready:
+        unit_weakness, unit_matched = _catalogue_unit_weakness(selected_course_id, course_weak_ids)
+    else:
+        unit_weakness, unit_matched = await _fetch_unit_weakness(selected_course_id, course_weak_ids)
     
     if not unit_weakness:
         # ما لقينا وحدات — نبدأ مباشرة بأسئلة المقرر
-        course_q = []
-        for q_id, info in all_matched.items():
-            if info["course_id"] == selected_course_id:
-                t = transform_api_question(info["question_data"])
-                if t:
-                    course_q.append(t)
+        course_q = await _resolve_weak_questions(all_matched, course_weak_ids, "course_id")
         return await _start_weakness_quiz_direct(update, context, course_q, message_id, scope_name=course_name, scope_id=selected_course_id)
     
-    # حفظ بيانات الوحدات
-    context.user_data["weakness_unit_matched"] = unit_matched
+    # حفظ بيانات الوحدات (بدون محتوى الأسئلة)
+    context.user_data["weakness_unit_matched"] = {
+        q_id: {"unit_id": info["unit_id"], "unit_name": info["unit_name"]}
+        for q_id, info in unit_matched.items()
+    }
     
     # حساب متوسط الخطأ لكل وحدة
     for u_data in unit_weakness.values():
@@ -1156,24 +1294,21 @@ async def handle_weakness_unit_selection(update: Update, context: CallbackContex
     
     if callback_data == "weakness_unit_all":
         # كل أسئلة المقرر الضعيفة
-        for q_id, info in all_matched.items():
-            if info["course_id"] == selected_course_id:
-                t = transform_api_question(info["question_data"])
-                if t:
-                    target_questions.append(t)
+        course_weak_ids = [q_id for q_id, info in all_matched.items() if info["course_id"] == selected_course_id]
+        target_questions = await _resolve_weak_questions(all_matched, course_weak_ids, "course_id")
         scope_name = course_name
         scope_id = selected_course_id
     else:
         # وحدة محددة
         selected_unit_id = callback_data.replace("weakness_unit_", "", 1)
         unit_name = "الوحدة المحددة"
+        unit_weak_ids = []
         for q_id, info in unit_matched.items():
             if info["unit_id"] == selected_unit_id:
-                t = transform_api_question(info["question_data"])
-                if t:
-                    target_questions.append(t)
+                unit_weak_ids.append(q_id)
                 if unit_name == "الوحدة المحددة":
                     unit_name = info["unit_name"]
+        target_questions = await _resolve_weak_questions(unit_matched, unit_weak_ids, "unit_id")
         scope_name = f"{course_name} - {unit_name}"
         scope_id = selected_unit_id
     
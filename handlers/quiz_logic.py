@@ -17,7 +17,7 @@ Version History:
 # v2: Fixes for filter_id in DB session and NoneType error in show_results
 # v3: Enhanced support for image questions and image options
 
-import asyncio
+import functools
 import logging
 import time
 import uuid 
@@ -29,11 +29,20 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
 from telegram.ext import ConversationHandler, CallbackContext, JobQueue 
 
 from config import logger, TAKING_QUIZ, END, MAIN_MENU, SHOWING_RESULTS # SHOWING_RESULTS is used by this module
-from utils.helpers import safe_send_message, safe_edit_message_text, safe_edit_message_caption, remove_job_if_exists
+from utils.helpers import safe_send_message, safe_edit_message_text, safe_edit_message_caption, safe_delete_messages
 from utils.helpers import generate_progress_bar
+from utils.question_catalogue import QUESTION_CATALOGUE
+from utils.quiz_timer import QUIZ_TIMERS
+from utils.rate_governor import GOVERNOR, PRIORITY_COUNTDOWN
+from utils.image_cache import is_image_url, send_cached_photo, send_cached_media_group
 
 # +++ MODIFICATION: Import DB_MANAGER directly +++
 from database.manager import DB_MANAGER
+from database.async_manager import run_db
+try:
+    from config import DB_WRITE_TIMEOUT
+except ImportError:
+    DB_WRITE_TIMEOUT = 30
 # +++++++++++++++++++++++++++++++++++++++++++++++
 
 # +++ ENHANCEMENTS: Import validation, exceptions, and structured logging +++
@@ -48,24 +57,6 @@ from utils.structured_logger import quiz_logger
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 MIN_OPTIONS_PER_QUESTION = 2
-IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
-
-def is_image_url(url_string: str) -> bool:
-    """Check if a given string is a valid image URL.
-    
-    Args:
-        url_string: The string to check
-        
-    Returns:
-        True if the string is a valid HTTP(S) URL ending with an image extension,
-        False otherwise
-    """
-    if not isinstance(url_string, str):
-        return False
-    return (
-        (url_string.startswith("http://") or url_string.startswith("https://")) and
-        any(url_string.lower().endswith(ext) for ext in IMAGE_EXTENSIONS)
-    )
 
 class QuizLogic:
     """Main class for managing quiz logic and flow.
@@ -93,6 +84,19 @@ class QuizLogic:
     TIMER_ACTIVE_THRESHOLD = 30  # Only start live timer updates in last 30 seconds
     # ++++++++++++++++++++++++++++++++++
 
+    # خيارات الصور كألبوم واحد (send_media_group) بدلاً من رسالة لكل خيار
+    IMAGE_OPTIONS_MEDIA_GROUP = True
+
+    # نص "الخيار المختار" في سجل الإجابات للحالات التي لا يختار فيها الطالب خياراً
+    NO_CHOICE_TEXTS = {
+        "skipped_auto": "تم تخطي السؤال (خيارات غير كافية)",
+        "error_sending": "خطأ في إرسال السؤال",
+        "skipped_by_user": "تم تخطي السؤال",
+        "timed_out": "انتهى الوقت",
+        "quiz_ended_by_user": "تم إنهاء الاختبار",
+        "not_reached_quiz_ended": "تم إنهاء الاختبار قبل الوصول لهذا السؤال",
+    }
+
     def __init__(
         self,
         user_id: int,
@@ -104,7 +108,8 @@ class QuizLogic:
         total_questions_for_db_log: int,
         time_limit_per_question: int,
         quiz_instance_id_for_logging: str,
-        is_resumable: bool = False
+        is_resumable: bool = False,
+        source_endpoint: str = None
     ):
         """Initialize a new QuizLogic instance.
         
@@ -119,6 +124,7 @@ class QuizLogic:
             time_limit_per_question: Time limit per question (currently ignored, fixed at 180s)
             quiz_instance_id_for_logging: Unique quiz instance identifier
             is_resumable: Whether quiz can be saved and resumed later
+            source_endpoint: API endpoint the questions came from (used to resolve saved quizzes)
         """
         
         self.user_id = user_id
@@ -146,6 +152,7 @@ class QuizLogic:
         self.active = False
         self.db_quiz_session_id = None
         self.is_resumable = is_resumable  # إمكانية حفظ واستكمال الاختبار
+        self.source_endpoint = source_endpoint  # مصدر الأسئلة في الـ API (يُحفظ مع الاختبار المحفوظ)
 
         if not self.db_manager:
             logger.critical(f"[QuizLogic {self.quiz_id}] CRITICAL: Imported DB_MANAGER is None! DB ops will fail.")
@@ -156,6 +163,75 @@ class QuizLogic:
 
         logger.debug(f"[QuizLogic {self.quiz_id}] Initialized. User: {self.user_id}, QuizName: \t'{self.quiz_name}'\t, ActualNumQs: {self.total_questions}.")
 
+    # --- Persistence ---
+    # QuizLogic lives in user_data, which PicklePersistence writes to disk. Only question IDs
+    # (plus the current question's option order) are pickled; content is restored from
+    # QUESTION_CATALOGUE on first access after a restart.
+
+    @property
+    def questions_data(self) -> list:
+        if self._questions_data is None:
+            self._questions_data = self._rehydrate_questions()
+        return self._questions_data
+
+    @questions_data.setter
+    def questions_data(self, value: list):
+        self._questions_data = value
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("db_manager", None)
+        questions = state.pop("_questions_data", None)
+        if questions is not None:
+            question_ids = []
+            inline_questions = {}
+            for q in questions:
+                q_id = str(q.get("question_id"))
+                question_ids.append(q_id)
+                if QUESTION_CATALOGUE.get(q_id) is None:
+                    inline_questions[q_id] = q # Not in the catalogue: keep the content itself
+            displayable = {}
+            if 0 <= self.current_question_index < len(questions):
+                current = questions[self.current_question_index]
+                if "_displayable_options" in current:
+                    displayable[str(current.get("question_id"))] = current["_displayable_options"]
+            state["_persisted_question_ids"] = question_ids
+            state["_persisted_inline_questions"] = inline_questions
+            state["_persisted_displayable_options"] = displayable
+        state["_questions_data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "questions_data" in self.__dict__: # Pickled before questions were stored as IDs
+            self._questions_data = self.__dict__.pop("questions_data")
+        self.__dict__.setdefault("_questions_data", None)
+        self.__dict__.setdefault("source_endpoint", None)
+        self.db_manager = DB_MANAGER
+
+    def _rehydrate_questions(self) -> list:
+        question_ids = self.__dict__.get("_persisted_question_ids") or []
+        inline_questions = self.__dict__.get("_persisted_inline_questions") or {}
+        displayable = self.__dict__.get("_persisted_displayable_options") or {}
+        if question_ids and not QUESTION_CATALOGUE.ready:
+            logger.warning(f"[QuizLogic {self.quiz_id}] Restoring questions before the catalogue is ready.")
+        questions = []
+        for q_id in question_ids:
+            q = inline_questions.get(q_id) or QUESTION_CATALOGUE.transformed_copy(q_id)
+            if q is None:
+                logger.warning(f"[QuizLogic {self.quiz_id}] Question {q_id} no longer in the bank; it will be skipped.")
+                q = {"question_id": q_id, "question_text": None, "image_url": None, "options": []}
+            if q_id in displayable:
+                q["_displayable_options"] = displayable[q_id]
+            questions.append(q)
+        return questions
+
+    async def ensure_questions_loaded(self) -> list:
+        """Waits for the catalogue if this instance was restored from persistence and not yet rehydrated."""
+        if self.__dict__.get("_questions_data") is None and self.__dict__.get("_persisted_question_ids"):
+            await QUESTION_CATALOGUE.wait_until_ready()
+        return self.questions_data
+
     async def start_quiz(self, bot: Bot, context: CallbackContext, update: Update) -> int:
         """Start the quiz and send the first question.
         
@@ -183,7 +259,8 @@ class QuizLogic:
                         logger.error(f"[QuizLogic {self.quiz_id}] Invalid quiz_scope_id_for_db \t'{self.quiz_scope_id_for_db}'\t. Setting to None.")
                         scope_id_for_db_call = None
                 
-                self.db_quiz_session_id = self.db_manager.start_quiz_session_and_get_id(
+                self.db_quiz_session_id = await run_db(
+                    self.db_manager.start_quiz_session_and_get_id, timeout=DB_WRITE_TIMEOUT,
                     user_id=self.user_id, quiz_type=self.quiz_type_for_db, 
                     quiz_scope_id=scope_id_for_db_call, quiz_name=self.quiz_name,
                     total_questions=self.total_questions_for_db, start_time=self.quiz_actual_start_time_dt,
@@ -285,6 +362,11 @@ class QuizLogic:
             
         return InlineKeyboardMarkup(keyboard_buttons), displayable_options
 
+    @property
+    def _timer_key(self) -> tuple:
+        """Key of this quiz's timer in QUIZ_TIMERS (one active question per quiz)."""
+        return (self.chat_id, self.quiz_id)
+
     def _format_time_remaining(self, seconds_remaining: float) -> str:
         """Format remaining time for display.
         
@@ -301,34 +383,31 @@ class QuizLogic:
         seconds = math.floor(seconds_remaining % 60)
         return f"{minutes:02d}:{seconds:02d}"
     
-    async def update_timer_display(self, context: CallbackContext):
+    async def update_timer_display(self, context: CallbackContext, remaining_time: float, timer_data: dict):
         """Update the timer display in the question message.
         
-        This method is called periodically to update the countdown timer
-        shown to the user during a question.
+        Called by QUIZ_TIMERS every TIMER_UPDATE_INTERVAL seconds during the
+        last TIMER_ACTIVE_THRESHOLD seconds of a question.
         
         Args:
-            context: Callback context containing job data
+            context: Callback context for this quiz's chat and user
+            remaining_time: Seconds left before the question times out
+            timer_data: Question data captured by send_question
         """
-        job_data = context.job.data
-        chat_id = job_data["chat_id"]
-        quiz_id_from_job = job_data["quiz_id"]
-        q_idx = job_data["question_index"]
-        msg_id = job_data["message_id"]
-        is_image = job_data["is_image"]
-        question_text = job_data["question_text"]
-        header = job_data["header"]
-        options_keyboard = job_data["options_keyboard"]  # استرجاع لوحة المفاتيح المخزنة
+        chat_id = timer_data["chat_id"]
+        quiz_id_from_job = timer_data["quiz_id"]
+        q_idx = timer_data["question_index"]
+        msg_id = timer_data["main_question_message_id"]
+        is_image = timer_data["is_image"]
+        question_text = timer_data["question_text"]
+        header = timer_data["header"]
+        options_keyboard = timer_data["options_keyboard"]  # استرجاع لوحة المفاتيح المخزنة
         
         # التحقق من أن العداد لا يزال نشطاً للسؤال الحالي
         if not self.active or quiz_id_from_job != self.quiz_id or q_idx != self.current_question_index:
             logger.debug(f"[QuizLogic {self.quiz_id}] Timer update cancelled - question changed or quiz inactive")
             return
         
-        # حساب الوقت المتبقي
-        elapsed_time = time.time() - self.question_start_time
-        remaining_time = max(0, self.question_time_limit - elapsed_time)
-        
         # تنسيق الوقت المتبقي مع تنبيه بصري
         time_display = self._format_time_remaining(remaining_time)
         
@@ -344,31 +423,9 @@ class QuizLogic:
         
         try:
             if is_image:
-                await safe_edit_message_caption(context.bot, chat_id, msg_id, caption=full_text, reply_markup=options_keyboard, parse_mode="HTML")
+                await safe_edit_message_caption(context.bot, chat_id, msg_id, caption=full_text, reply_markup=options_keyboard, parse_mode="HTML", priority=PRIORITY_COUNTDOWN)
             else:
-                await safe_edit_message_text(context.bot, chat_id, msg_id, text=full_text, reply_markup=options_keyboard, parse_mode="HTML")
-                
-            # +++ ENHANCEMENT: Use TIMER_UPDATE_INTERVAL constant +++
-            # جدولة التحديث التالي إذا كان لا يزال هناك وقت متبقي
-            if remaining_time > self.TIMER_UPDATE_INTERVAL:
-                update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-                remove_job_if_exists(update_job_name, context)
-                context.job_queue.run_once(
-                    self.update_timer_display, 
-                    float(self.TIMER_UPDATE_INTERVAL),  # Use configurable interval
-                    data=job_data,
-                    name=update_job_name
-                )
-            # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            elif remaining_time > 0:  # تحديث أخير قبل انتهاء الوقت
-                update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-                remove_job_if_exists(update_job_name, context)
-                context.job_queue.run_once(
-                    self.update_timer_display, 
-                    remaining_time,
-                    data=job_data,
-                    name=update_job_name
-                )
+                await safe_edit_message_text(context.bot, chat_id, msg_id, text=full_text, reply_markup=options_keyboard, parse_mode="HTML", priority=PRIORITY_COUNTDOWN)
         except Exception as e:
             logger.warning(f"[QuizLogic {self.quiz_id}] Failed to update timer display: {e}")
     
@@ -527,12 +584,52 @@ class QuizLogic:
         
         return text
 
+    async def _send_option_images(self, bot: Bot, displayable_options: list, q_id_log) -> list:
+        """Sends the image options of a question, labelled with ARABIC_CHOICE_LETTERS. Returns the sent message IDs.
+
+        With IMAGE_OPTIONS_MEDIA_GROUP the images go out as one album (one
+        send_media_group per 10 images). Telegram only shows a caption when
+        exactly one album item has one, so the first image carries the order
+        ("الخيارات بالترتيب: أ، ب، ج، د"). A single image, or an album Telegram
+        refuses, is sent photo by photo, each captioned "الخيار: أ" ...
+        """
+        image_options = [opt for opt in displayable_options if opt["is_image_option"]]
+        labels = [self.ARABIC_CHOICE_LETTERS[i] if i < len(self.ARABIC_CHOICE_LETTERS) else f"صورة {i + 1}"
+                  for i in range(len(image_options))]
+        photos = [(opt["original_content"], f"الخيار: {label}") for opt, label in zip(image_options, labels)]
+        message_ids = []
+        if self.IMAGE_OPTIONS_MEDIA_GROUP and len(photos) > 1:
+            for start in range(0, len(photos), 10):
+                chunk = photos[start:start + 10]
+                if len(chunk) == 1:
+                    chunk_ids = await self._send_option_images_one_by_one(bot, chunk, q_id_log)
+                else:
+                    order_caption = "الخيارات بالترتيب: " + "، ".join(labels[start:start + 10])
+                    album = [(url, order_caption if i == 0 else None) for i, (url, _) in enumerate(chunk)]
+                    try:
+                        messages = await GOVERNOR.run(self.chat_id, lambda: send_cached_media_group(bot, self.chat_id, album), tokens=len(album))
+                        chunk_ids = [m.message_id for m in messages]
+                    except Exception as e_group:
+                        logger.warning(f"[QuizLogic {self.quiz_id}] Media group of {len(chunk)} option images failed for q_id {q_id_log}: {e_group}. Sending one by one.")
+                        chunk_ids = await self._send_option_images_one_by_one(bot, chunk, q_id_log)
+                message_ids.extend(chunk_ids)
+            return message_ids
+        return await self._send_option_images_one_by_one(bot, photos, q_id_log)
+
+    async def _send_option_images_one_by_one(self, bot: Bot, photos: list, q_id_log) -> list:
+        message_ids = []
+        for url, caption in photos:
+            try:
+                sent_opt_img_msg = await GOVERNOR.run(self.chat_id, lambda: send_cached_photo(bot, self.chat_id, url, caption=caption))
+                message_ids.append(sent_opt_img_msg.message_id)
+            except Exception as e_img_opt:
+                logger.error(f"[QuizLogic {self.quiz_id}] Failed to send image option (URL: {url}), q_id {q_id_log}: {e_img_opt}")
+        return message_ids
+
     async def send_question(self, bot: Bot, context: CallbackContext, update: Update = None):
         if not self.active: return END 
 
-        for msg_id in self.sent_option_image_message_ids:
-            try: await bot.delete_message(chat_id=self.chat_id, message_id=msg_id)
-            except Exception: pass 
+        await safe_delete_messages(bot, self.chat_id, self.sent_option_image_message_ids)
         self.sent_option_image_message_ids = []
 
         while self.current_question_index < self.total_questions:
@@ -550,17 +647,7 @@ class QuizLogic:
             options_keyboard, displayable_options_for_q = self._create_display_options_and_keyboard(api_options)
             current_question_data['_displayable_options'] = displayable_options_for_q
 
-            option_image_counter_for_labeling = 0
-            for option_detail in displayable_options_for_q:
-                if option_detail["is_image_option"]:
-                    try:
-                        display_label = self.ARABIC_CHOICE_LETTERS[option_image_counter_for_labeling] if option_image_counter_for_labeling < len(self.ARABIC_CHOICE_LETTERS) else f"صورة {option_image_counter_for_labeling + 1}"
-                        sent_opt_img_msg = await bot.send_photo(chat_id=self.chat_id, photo=option_detail["original_content"], caption=f"الخيار: {display_label}")
-                        self.sent_option_image_message_ids.append(sent_opt_img_msg.message_id)
-                        option_image_counter_for_labeling += 1
-                        await asyncio.sleep(0.2) 
-                    except Exception as e_img_opt:
-                        logger.error(f"[QuizLogic {self.quiz_id}] Failed to send image option (URL: {option_detail['original_content']}), q_id {q_id_log}: {e_img_opt}")
+            self.sent_option_image_message_ids = await self._send_option_images(bot, displayable_options_for_q, q_id_log)
             
             header = self._build_progress_header()
             main_q_image_url = current_question_data.get("image_url")
@@ -579,9 +666,9 @@ class QuizLogic:
             sent_main_q_message = None
             try:
                 if main_q_image_url:
-                    sent_main_q_message = await bot.send_photo(chat_id=self.chat_id, photo=main_q_image_url, caption=header + full_question_text, reply_markup=options_keyboard, parse_mode="HTML")
+                    sent_main_q_message = await GOVERNOR.run(self.chat_id, lambda: send_cached_photo(bot, self.chat_id, main_q_image_url, caption=header + full_question_text, reply_markup=options_keyboard, parse_mode="HTML"))
                 else:
-                    sent_main_q_message = await bot.send_message(chat_id=self.chat_id, text=header + full_question_text, reply_markup=options_keyboard, parse_mode="HTML")
+                    sent_main_q_message = await GOVERNOR.run(self.chat_id, lambda: bot.send_message(chat_id=self.chat_id, text=header + full_question_text, reply_markup=options_keyboard, parse_mode="HTML"))
             except Exception as e_send_q:
                 logger.error(f"[QuizLogic {self.quiz_id}] Failed to send Q {q_id_log} (idx {self.current_question_index}): {e_send_q}")
                 self.answers.append({"question_id": q_id_log, "question_text": question_display_text, "chosen_option_id": None, "chosen_option_text": "خطأ في إرسال السؤال", "correct_option_id": None, "correct_option_text": self._get_correct_option_display_text(current_question_data, for_skip=True), "is_correct": False, "time_taken": -999, "status": "error_sending"})
@@ -592,38 +679,28 @@ class QuizLogic:
                 self.last_question_message_id = sent_main_q_message.message_id
                 self.question_start_time = time.time()
                 
-                # Set up the timer for this question
-                job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-                remove_job_if_exists(job_name, context)
-                context.job_queue.run_once(
-                    self.question_timeout_callback, 
-                    self.question_time_limit, 
-                    data={"chat_id": self.chat_id, "user_id": self.user_id, "quiz_id": self.quiz_id, "question_index_at_timeout": self.current_question_index, "main_question_message_id": self.last_question_message_id, "option_image_ids": list(self.sent_option_image_message_ids)}, name=job_name)
-                logger.info(f"[QuizLogic {self.quiz_id}] Timer set for Q{self.current_question_index}, job: {job_name}")
-                
-                # إعداد مؤقت تحديث العداد - يبدأ فقط آخر 30 ثانية لتقليل الضغط على API
-                update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-                remove_job_if_exists(update_job_name, context)
-                
-                # حساب متى يبدأ التحديث المرئي
-                time_until_active = max(0, self.question_time_limit - self.TIMER_ACTIVE_THRESHOLD)
-                first_update_delay = max(5.0, time_until_active)
-                
-                context.job_queue.run_once(
-                    self.update_timer_display, 
-                    first_update_delay,
-                    data={
-                        "chat_id": self.chat_id,
-                        "quiz_id": self.quiz_id,
-                        "question_index": self.current_question_index,
-                        "message_id": self.last_question_message_id,
-                        "is_image": bool(main_q_image_url),
-                        "question_text": question_display_text,
-                        "header": header,
-                        "options_keyboard": options_keyboard
-                    },
-                    name=update_job_name
+                # مؤقت السؤال (انتهاء الوقت + العداد المرئي في آخر TIMER_ACTIVE_THRESHOLD ثانية) على المحرك المشترك
+                timer_data = {
+                    "chat_id": self.chat_id,
+                    "user_id": self.user_id,
+                    "quiz_id": self.quiz_id,
+                    "question_index": self.current_question_index,
+                    "main_question_message_id": self.last_question_message_id,
+                    "option_image_ids": list(self.sent_option_image_message_ids),
+                    "is_image": bool(main_q_image_url),
+                    "question_text": question_display_text,
+                    "header": header,
+                    "options_keyboard": options_keyboard
+                }
+                QUIZ_TIMERS.start(
+                    self._timer_key, context.application, self.chat_id, self.user_id,
+                    duration=self.question_time_limit,
+                    on_timeout=functools.partial(self.question_timeout_callback, timer_data=timer_data),
+                    on_countdown=functools.partial(self.update_timer_display, timer_data=timer_data),
+                    countdown_from=self.TIMER_ACTIVE_THRESHOLD,
+                    countdown_every=self.TIMER_UPDATE_INTERVAL,
                 )
+                logger.info(f"[QuizLogic {self.quiz_id}] Timer set for Q{self.current_question_index} ({QUIZ_TIMERS.active_count()} active quiz timers)")
                 
                 return TAKING_QUIZ 
             else: 
@@ -665,13 +742,8 @@ class QuizLogic:
             "status": "skipped_by_user"
         })
         
-        # إلغاء مؤقت السؤال الحالي
-        question_timer_job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(question_timer_job_name, context)
-        
-        # إلغاء مؤقت تحديث العداد
-        update_timer_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(update_timer_job_name, context)
+        # إلغاء مؤقت السؤال الحالي (الانتهاء + العداد)
+        QUIZ_TIMERS.cancel(self._timer_key)
         
         # تعديل رسالة السؤال لإزالة أزرار الإجابة
         if self.last_question_message_id:
@@ -751,16 +823,12 @@ class QuizLogic:
                 "status": "not_reached_quiz_ended"
             })
         
-        # إلغاء مؤقت السؤال الحالي
-        question_timer_job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(question_timer_job_name, context)
-        
-        # إلغاء مؤقت تحديث العداد
-        update_timer_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(update_timer_job_name, context)
+        # إلغاء مؤقت السؤال الحالي (الانتهاء + العداد)
+        QUIZ_TIMERS.cancel(self._timer_key)
         
         # عرض النتائج
         return await self.show_results(context.bot, context)
+
     async def handle_save_and_exit(self, update: Update, context: CallbackContext, callback_data: str) -> int:
         """معالجة حفظ الاختبار والخروج للاستكمال لاحقاً"""
         if not self.active:
@@ -770,6 +838,7 @@ class QuizLogic:
         await query.answer("جاري حفظ الاختبار...")
         
         # حفظ حالة الاختبار في context.user_data
+        questions_in_catalogue = all(QUESTION_CATALOGUE.get(str(q.get("question_id"))) is not None for q in self.questions_data)
         saved_quiz_data = {
             "quiz_id": self.quiz_id,
             "quiz_name": self.quiz_name,
@@ -782,13 +851,15 @@ class QuizLogic:
             "total_questions": self.total_questions,
             "quiz_start_time": self.quiz_actual_start_time_dt.isoformat() if self.quiz_actual_start_time_dt else None,
             "db_quiz_session_id": self.db_quiz_session_id,
+            "source_endpoint": self.source_endpoint,
+            "questions_in_catalogue": questions_in_catalogue,
             "saved_at": datetime.now(timezone.utc).isoformat()
         }
         
         # حفظ البيانات في قاعدة البيانات
         try:
             from database.saved_quizzes_db import save_quiz_to_db
-            save_success = save_quiz_to_db(self.user_id, saved_quiz_data)
+            save_success = await run_db(save_quiz_to_db, self.user_id, saved_quiz_data, timeout=DB_WRITE_TIMEOUT, default=False)
             if save_success:
                 logger.info(f"[QuizLogic {self.quiz_id}] تم حفظ الاختبار في قاعدة البيانات بنجاح")
             else:
@@ -797,11 +868,7 @@ class QuizLogic:
             logger.error(f"[QuizLogic {self.quiz_id}] خطأ في حفظ الاختبار: {e}", exc_info=True)
         
         # إلغاء المؤقتات
-        question_timer_job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(question_timer_job_name, context)
-        
-        update_timer_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(update_timer_job_name, context)
+        QUIZ_TIMERS.cancel(self._timer_key)
         
         # تعديل رسالة السؤال
         current_question_data = self.questions_data[self.current_question_index]
@@ -855,13 +922,8 @@ class QuizLogic:
 
         time_taken = time.time() - self.question_start_time
         
-        # إيقاف مؤقت انتهاء الوقت
-        job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(job_name, context)
-        
-        # إيقاف مؤقت تحديث العداد
-        update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(update_job_name, context)
+        # إيقاف مؤقت السؤال (الانتهاء + العداد)
+        QUIZ_TIMERS.cancel(self._timer_key)
 
         current_question_data = self.questions_data[self.current_question_index]
         q_id_log = current_question_data.get('question_id', f'q_idx_{self.current_question_index}')
@@ -928,21 +990,17 @@ class QuizLogic:
             # Use context.bot here
             return await self.show_results(context.bot, context, update)
 
-    async def question_timeout_callback(self, context: CallbackContext):
-        job_data = context.job.data
-        chat_id = job_data["chat_id"]
-        user_id = job_data["user_id"]
-        quiz_id_from_job = job_data["quiz_id"]
-        q_idx_at_timeout = job_data["question_index_at_timeout"]
-        main_q_msg_id = job_data["main_question_message_id"]
-        option_img_ids_from_job = job_data.get("option_image_ids", [])
+    async def question_timeout_callback(self, context: CallbackContext, timer_data: dict):
+        """Called by QUIZ_TIMERS when the current question's time is up (its timer is already gone)."""
+        chat_id = timer_data["chat_id"]
+        user_id = timer_data["user_id"]
+        quiz_id_from_job = timer_data["quiz_id"]
+        q_idx_at_timeout = timer_data["question_index"]
+        main_q_msg_id = timer_data["main_question_message_id"]
+        option_img_ids_from_job = timer_data.get("option_image_ids", [])
 
         logger.info(f"[QuizLogic {quiz_id_from_job}] Timeout for Q{q_idx_at_timeout}, user {user_id}")
 
-        # إيقاف مؤقت تحديث العداد عند انتهاء الوقت
-        update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{self.current_question_index}"
-        remove_job_if_exists(update_job_name, context)
-
         if not self.active or quiz_id_from_job != self.quiz_id or q_idx_at_timeout != self.current_question_index:
             logger.info(f"[QuizLogic {quiz_id_from_job}] Stale timeout for Q{q_idx_at_timeout}. Current Q_idx: {self.current_question_index}. Ignoring.")
             return
@@ -972,11 +1030,9 @@ class QuizLogic:
             except Exception as e_edit_timeout:
                 logger.warning(f"[QuizLogic {self.quiz_id}] Failed to edit timed-out Q msg: {e_edit_timeout}")
         
-        for opt_img_id in option_img_ids_from_job:
-            try: await context.bot.delete_message(chat_id=chat_id, message_id=opt_img_id)
-            except Exception: pass
-        if main_q_msg_id in self.sent_option_image_message_ids: 
-             self.sent_option_image_message_ids.remove(main_q_msg_id) 
+        await safe_delete_messages(context.bot, chat_id, option_img_ids_from_job)
+        # حُذفت هنا، فلا يعيد send_question حذفها
+        self.sent_option_image_message_ids = [m_id for m_id in self.sent_option_image_message_ids if m_id not in option_img_ids_from_job]
 
         self.current_question_index += 1
         if self.current_question_index < self.total_questions:
@@ -984,6 +1040,35 @@ class QuizLogic:
         else:
             await self.show_results(context.bot, context) 
 
+    def restore_saved_answers(self, packed_answers: list) -> None:
+        """Rebuilds self.answers from saved_quizzes_db.pack_answers rows, taking question and option texts from self.questions_data."""
+        questions_by_id = {str(q.get("question_id")): q for q in self.questions_data}
+        self.answers = []
+        for question_id, chosen_option_id, is_correct, time_taken, status in packed_answers:
+            question_data = questions_by_id.get(str(question_id), {})
+            _, displayable_options = self._create_display_options_and_keyboard(question_data.get("options", []))
+            if status in ("skipped_auto", "error_sending"):
+                # لم يُعرض السؤال: النص الخام للخيار الصحيح كما سُجل وقتها
+                correct_option_text = self._get_correct_option_display_text(question_data, for_skip=True)
+            else:
+                correct_option_text = next((opt["display_text_for_log"] for opt in displayable_options if opt["is_correct"]), "غير متوفر")
+            if status == "answered":
+                chosen_option_text = next((opt["display_text_for_log"] for opt in displayable_options
+                                           if str(opt["option_id"]) == str(chosen_option_id)), "غير محدد")
+            else:
+                chosen_option_text = self.NO_CHOICE_TEXTS.get(status, "غير محدد")
+            self.answers.append({
+                "question_id": question_id,
+                "question_text": question_data.get("question_text") or "نص السؤال غير متوفر",
+                "chosen_option_id": chosen_option_id,
+                "chosen_option_text": chosen_option_text,
+                "correct_option_id": self._get_correct_option_id(question_data) if status in ("answered", "timed_out") else None,
+                "correct_option_text": correct_option_text,
+                "is_correct": bool(is_correct),
+                "time_taken": time_taken,
+                "status": status
+            })
+
     def _get_correct_option_id(self, question_data):
         options = question_data.get("options", [])
         for opt in options:
@@ -1014,8 +1099,7 @@ class QuizLogic:
         self.active = False 
         
         # Cleanup timers and any lingering question messages if not already handled
-        job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{self.current_question_index -1}" # Last active question
-        remove_job_if_exists(job_name, context)
+        QUIZ_TIMERS.cancel(self._timer_key)
         if self.last_question_message_id:
             try: 
                 # Attempt to remove keyboard from the very last question message if it's still there
@@ -1028,9 +1112,7 @@ class QuizLogic:
                     else:
                         await safe_edit_message_text(bot, self.chat_id, self.last_question_message_id, text=q_text_final, parse_mode="HTML", reply_markup=None)
             except Exception: pass # Best effort
-        for msg_id in self.sent_option_image_message_ids:
-            try: await bot.delete_message(chat_id=self.chat_id, message_id=msg_id)
-            except Exception: pass
+        await safe_delete_messages(bot, self.chat_id, self.sent_option_image_message_ids)
         self.sent_option_image_message_ids = []
 
         total_answered = sum(1 for ans in self.answers if ans["status"] == "answered")
@@ -1057,7 +1139,8 @@ class QuizLogic:
                 skipped_answers_calc = total_skipped_questions
                 quiz_end_time_dt_calc = datetime.now(timezone.utc) # To match original variable name for clarity
 
-                self.db_manager.end_quiz_session(
+                await run_db(
+                    self.db_manager.end_quiz_session, timeout=DB_WRITE_TIMEOUT,
                     user_id=self.user_id,
                     quiz_session_uuid=self.db_quiz_session_id,
                     score=self.score,
@@ -1171,12 +1254,8 @@ class QuizLogic:
         logger.info(f"[QuizLogic {self.quiz_id}] Cleaning up quiz data for user {user_id}. Reason: {reason}")
         self.active = False
         
-        # Cancel any active timers for this quiz
-        for q_idx in range(self.total_questions):
-            job_name = f"question_timer_{self.chat_id}_{self.quiz_id}_{q_idx}"
-            remove_job_if_exists(job_name, context)
-            update_job_name = f"timer_update_{self.chat_id}_{self.quiz_id}_{q_idx}"
-            remove_job_if_exists(update_job_name, context)
+        # Cancel the active timer of this quiz
+        QUIZ_TIMERS.cancel(self._timer_key)
         
         # Remove this quiz logic instance from user_data if requested
         if not preserve_current_logic_in_userdata and context and hasattr(context, 'user_data'):
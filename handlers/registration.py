@@ -8,7 +8,6 @@
 
 import logging
 import re
-from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     CallbackContext,
@@ -83,6 +82,13 @@ async def safe_edit_message_text(bot, chat_id, message_id, text, reply_markup=No
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# تنفيذ استعلامات قاعدة البيانات خارج حلقة الأحداث
+from database.async_manager import run_db
+
+# حالة المستخدم المؤقتة في الذاكرة + تجميع تحديثات آخر نشاط
+from utils.user_status_cache import USER_STATUS_CACHE
+from database.write_behind import touch_last_activity
+
 # نظام الحماية والتحقق من التسجيل
 class BotSecurityManager:
     """مدير الحماية للبوت - يتحكم في الوصول للمستخدمين المسجلين فقط"""
@@ -168,11 +174,11 @@ class BotSecurityManager:
             )
             return False
         
-        # الحصول على معلومات المستخدم
-        user_info = get_user_info(db_manager, user_id)
+        # الحصول على حالة المستخدم (من الذاكرة المؤقتة إن كانت حديثة)
+        user_status = await get_user_status_async(db_manager, user_id)
         
         # التحقق من اكتمال التسجيل
-        if not is_user_fully_registered(user_info):
+        if not user_status["registered"]:
             self.record_failed_attempt(user_id)
             await safe_send_message(
                 context.bot,
@@ -184,8 +190,8 @@ class BotSecurityManager:
         # إعادة تعيين المحاولات الفاشلة عند النجاح
         self.reset_failed_attempts(user_id)
         
-        # تحديث آخر نشاط للمستخدم
-        save_user_info(db_manager, user_id, last_activity=datetime.now().isoformat())
+        # تحديث آخر نشاط للمستخدم (يُكتب دفعة واحدة مع غيره كل بضع ثوانٍ)
+        touch_last_activity(user_id)
         
         return True
     
@@ -625,6 +631,10 @@ def save_user_info(db_manager, user_id, **kwargs):
                 
                 conn.commit()
         
+        # أي تعديل غير آخر نشاط قد يغيّر حالة التسجيل أو الصف
+        if set(kwargs) - {'last_activity'}:
+            USER_STATUS_CACHE.invalidate(user_id)
+        
         logger.info(f"تم حفظ/تحديث معلومات المستخدم {user_id} بنجاح")
         return True
     except Exception as e:
@@ -672,6 +682,42 @@ def get_user_info(db_manager, user_id):
         logger.error(f"خطأ في الحصول على معلومات المستخدم {user_id}: {e}")
         return None
 
+# نسخ غير متزامنة تنفذ الاستعلام في منفذ قاعدة البيانات بدلاً من حجب حلقة الأحداث
+async def get_user_info_async(db_manager, user_id):
+    """نسخة غير متزامنة من get_user_info (تعيد None عند انتهاء المهلة)"""
+    return await run_db(get_user_info, db_manager, user_id)
+
+async def save_user_info_async(db_manager, user_id, **kwargs):
+    """نسخة غير متزامنة من save_user_info (تعيد False عند انتهاء المهلة)"""
+    return await run_db(save_user_info, db_manager, user_id, default=False, **kwargs)
+
+def user_status_from_info(user_info):
+    """الحقول المخزنة مؤقتاً من صف المستخدم: registered, grade, is_my_student"""
+    user_info = user_info or {}
+    return {
+        "registered": is_user_fully_registered(user_info),
+        "grade": user_info.get('grade'),
+        "is_my_student": bool(user_info.get('is_my_student')),
+    }
+
+async def get_user_status_async(db_manager, user_id):
+    """
+    حالة المستخدم من الذاكرة المؤقتة، أو من قاعدة البيانات عند غيابها أو انتهاء صلاحيتها
+    
+    يعيد:
+        dict: registered, grade, is_my_student
+    """
+    user_status = USER_STATUS_CACHE.lookup(user_id, "registered", "grade", "is_my_student")
+    if user_status is not None:
+        return user_status
+    generation = USER_STATUS_CACHE.generation
+    user_info = await get_user_info_async(db_manager, user_id)
+    user_status = user_status_from_info(user_info)
+    # لا نخزن غياب الصف: قد يكون خطأ أو انتهاء مهلة، وغير المسجل يمر بالتسجيل على أي حال
+    if user_info:
+        USER_STATUS_CACHE.store(user_id, generation=generation, **user_status)
+    return user_status
+
 # التحقق من اكتمال معلومات المستخدم
 def is_user_fully_registered(user_info):
     """
@@ -738,8 +784,8 @@ async def start_command(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
     
     # التحقق من حالة تسجيل المستخدم
-    user_info = get_user_info(db_manager, user_id)
-    is_registered = is_user_fully_registered(user_info)
+    user_status = await get_user_status_async(db_manager, user_id)
+    is_registered = user_status["registered"]
     
     # تحديث حالة التسجيل في context.user_data
     context.user_data['is_registered'] = is_registered
@@ -752,7 +798,7 @@ async def start_command(update: Update, context: CallbackContext) -> int:
         security_manager.reset_failed_attempts(user_id)
         
         # تحديث آخر نشاط
-        save_user_info(db_manager, user_id, last_activity=datetime.now().isoformat())
+        touch_last_activity(user_id)
         
         # عرض القائمة الرئيسية
         try:
@@ -791,7 +837,7 @@ async def start_command(update: Update, context: CallbackContext) -> int:
                 check_deletion_cooldown = None
         
         if check_deletion_cooldown:
-            cooldown = check_deletion_cooldown(user_id, cooldown_days=7)
+            cooldown = await run_db(check_deletion_cooldown, user_id, cooldown_days=7)
             if cooldown:
                 days = cooldown['remaining_days']
                 hours = cooldown['remaining_hours']
@@ -845,10 +891,7 @@ async def check_registration_status(update: Update, context: CallbackContext, db
     if context.user_data.get('is_registered', False):
         logger.info(f"[SECURITY] المستخدم {user_id} مسجل (من context.user_data)")
         # تحديث آخر نشاط
-        if not db_manager:
-            db_manager = context.bot_data.get("DB_MANAGER")
-        if db_manager:
-            save_user_info(db_manager, user_id, last_activity=datetime.now().isoformat())
+        touch_last_activity(user_id)
         return True
     
     # الحصول على مدير قاعدة البيانات
@@ -863,11 +906,11 @@ async def check_registration_status(update: Update, context: CallbackContext, db
             )
             return False
     
-    # الحصول على معلومات المستخدم من قاعدة البيانات
-    user_info = get_user_info(db_manager, user_id)
+    # الحصول على حالة المستخدم (من الذاكرة المؤقتة إن كانت حديثة)
+    user_status = await get_user_status_async(db_manager, user_id)
     
     # التحقق من اكتمال معلومات المستخدم
-    is_registered = is_user_fully_registered(user_info)
+    is_registered = user_status["registered"]
     
     # تحديث حالة التسجيل في context.user_data
     context.user_data['is_registered'] = is_registered
@@ -885,7 +928,7 @@ async def check_registration_status(update: Update, context: CallbackContext, db
     security_manager.reset_failed_attempts(user_id)
     
     # تحديث آخر نشاط
-    save_user_info(db_manager, user_id, last_activity=datetime.now().isoformat())
+    touch_last_activity(user_id)
     
     return True
 
@@ -904,7 +947,7 @@ async def start_registration(update: Update, context: CallbackContext) -> int:
     db_manager = context.bot_data.get("DB_MANAGER")
     if db_manager:
         # محاولة الحصول على معلومات المستخدم الحالية
-        user_info = get_user_info(db_manager, user.id)
+        user_info = await get_user_info_async(db_manager, user.id)
         if user_info:
             # تخزين المعلومات الحالية في بيانات التسجيل المؤقتة
             context.user_data['registration_data'] = {
@@ -1143,7 +1186,7 @@ async def handle_registration_confirmation(update: Update, context: CallbackCont
         
         # حفظ معلومات التسجيل
         user_data = context.user_data['registration_data']
-        success = save_user_info(
+        success = await save_user_info_async(
             db_manager,
             user_id,
             full_name=user_data.get('full_name'),
@@ -1303,7 +1346,7 @@ async def handle_edit_info_request(update: Update, context: CallbackContext) ->
         return ConversationHandler.END
     
     # الحصول على معلومات المستخدم من قاعدة البيانات
-    user_info = get_user_info(db_manager, user_id)
+    user_info = await get_user_info_async(db_manager, user_id)
     
     if not user_info:
         logger.error(f"لا يمكن الحصول على معلومات المستخدم {user_id} من قاعدة البيانات")
@@ -1404,7 +1447,7 @@ async def handle_edit_info_selection(update: Update, context: CallbackContext) -
         
         db_manager = context.bot_data.get("DB_MANAGER")
         try:
-            stats = db_manager.get_user_overall_stats(user_id) if db_manager else None
+            stats = await run_db(db_manager.get_user_overall_stats, user_id) if db_manager else None
             quiz_count = stats.get('total_quizzes', 0) if stats else 0
         except (AttributeError, Exception):
             quiz_count = 0
@@ -1503,7 +1546,7 @@ async def handle_confirm_delete_account(update: Update, context: CallbackContext
     user_data_for_notify = context.user_data.get('registration_data', {})
     if not user_data_for_notify.get('full_name'):
         try:
-            ui = get_user_info(db_manager, user_id) or {}
+            ui = await get_user_info_async(db_manager, user_id) or {}
             user_data_for_notify = {
                 'full_name': ui.get('full_name', ''),
                 'email': ui.get('email', ''),
@@ -1529,7 +1572,8 @@ async def handle_confirm_delete_account(update: Update, context: CallbackContext
         )
         return ConversationHandler.END
     
-    result = delete_user_account(user_id)
+    result = await run_db(delete_user_account, user_id, default={}) or {}
+    USER_STATUS_CACHE.invalidate(user_id)
     
     if result.get('success'):
         quiz_count = result.get('quizzes_deleted', 0)
@@ -1621,7 +1665,7 @@ async def handle_edit_name_input(update: Update, context: CallbackContext) -> in
         return ConversationHandler.END
     
     # حفظ الاسم الجديد في قاعدة البيانات
-    success = save_user_info(db_manager, user_id, full_name=cleaned_name)
+    success = await save_user_info_async(db_manager, user_id, full_name=cleaned_name)
     
     if success:
         # إعداد نص معلومات المستخدم المحدثة
@@ -1694,7 +1738,7 @@ async def handle_edit_email_input(update: Update, context: CallbackContext) -> i
         return ConversationHandler.END
     
     # حفظ البريد الإلكتروني الجديد في قاعدة البيانات
-    success = save_user_info(db_manager, user_id, email=email)
+    success = await save_user_info_async(db_manager, user_id, email=email)
     
     if success:
         # إعداد نص معلومات المستخدم المحدثة
@@ -1767,7 +1811,7 @@ async def handle_edit_phone_input(update: Update, context: CallbackContext) -> i
         return ConversationHandler.END
     
     # حفظ رقم الجوال الجديد في قاعدة البيانات
-    success = save_user_info(db_manager, user_id, phone=phone)
+    success = await save_user_info_async(db_manager, user_id, phone=phone)
     
     if success:
         # إعداد نص معلومات المستخدم المحدثة
@@ -1853,7 +1897,7 @@ async def handle_edit_grade_selection(update: Update, context: CallbackContext)
         return ConversationHandler.END
     
     # حفظ الصف الدراسي الجديد في قاعدة البيانات
-    success = save_user_info(db_manager, user_id, grade=grade_text)
+    success = await save_user_info_async(db_manager, user_id, grade=grade_text)
     
     if success:
         # إعداد نص معلومات المستخدم المحدثة
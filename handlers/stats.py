@@ -13,6 +13,7 @@
 """
 
 import logging
+import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     CallbackContext,
@@ -21,19 +22,14 @@ from telegram.ext import (
     CommandHandler
 )
 
-import os
 from datetime import datetime
-import matplotlib
-matplotlib.use("Agg") # Use Agg backend for non-interactive plotting
-import matplotlib.pyplot as plt
-from matplotlib import font_manager
 
-# Configure Matplotlib for Arabic text
-plt.rcParams["font.family"] = ["DejaVu Sans", "Amiri", "Arial"] # Add fallbacks
-plt.rcParams["axes.unicode_minus"] = False # Ensure minus sign is displayed correctly
+# Charts are rendered off the event loop (fonts and Arabic shaping are set up in the render workers)
+from utils.chart_service import Chart, get_chart, send_chart_photo
 
 # +++ MODIFICATION: Import DB_MANAGER directly +++
 from database.manager import DB_MANAGER 
+from database.async_manager import run_db
 # +++++++++++++++++++++++++++++++++++++++++++++++
 
 # Import necessary components from other modules
@@ -71,129 +67,28 @@ except ImportError as e:
             return db_manager_instance.is_user_admin(user_id)
         return False
 
-import arabic_reshaper
-from bidi.algorithm import get_display
-
-# Helper function for processing Arabic text for Matplotlib
-def process_arabic_text(text_to_process):
-    text_str = str(text_to_process)
-    is_arabic = False
-    for char_val in text_str:
-        if (
-            "\u0600" <= char_val <= "\u06FF" or # Arabic
-            "\u0750" <= char_val <= "\u077F" or # Arabic Supplement
-            "\u08A0" <= char_val <= "\u08FF" or # Arabic Extended-A
-            "\uFB50" <= char_val <= "\uFDFF" or # Arabic Presentation Forms-A
-            "\uFE70" <= char_val <= "\uFEFF"    # Arabic Presentation Forms-B
-        ):
-            is_arabic = True
-            break
-    if not is_arabic:
-        return text_str
-    try:
-        reshaped_text = arabic_reshaper.reshape(text_str)
-        bidi_text = get_display(reshaped_text)
-        return bidi_text
-    except Exception as ex_arabic:
-        # Using .format() for error logging
-        logger.error("Error processing Arabic text with reshaper/bidi: {}. Text was: {}".format(ex_arabic, text_to_process))
-        return text_str # Fallback
-
-
-# --- Directory for charts ---
-CHARTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_data", "charts")
-os.makedirs(CHARTS_DIR, exist_ok=True)
-
-# --- Chart Generation Functions (Unchanged from v9) ---
-def generate_bar_chart_correct_incorrect(user_id: int, correct: int, incorrect: int) -> str | None:
+# --- Chart Generation Functions ---
+# Rendering runs in the chart process pool (utils/chart_service.py); charts are cached by their input data,
+# so re-opening unchanged stats reuses the Telegram file_id instead of rendering and uploading again
+async def generate_bar_chart_correct_incorrect(user_id: int, correct: int, incorrect: int) -> Chart | None:
     if correct == 0 and incorrect == 0:
         return None
-    fig, ax = plt.subplots(figsize=(8, 6))
-    categories = [process_arabic_text("إجابات صحيحة"), process_arabic_text("إجابات خاطئة")]
-    counts = [correct, incorrect]
-    colors = ["#4CAF50", "#F44336"]
-    bars = ax.bar(categories, counts, color=colors)
-    ax.set_ylabel(process_arabic_text("العدد"))
-    ax.set_title(process_arabic_text("مقارنة الإجابات للمستخدم {}".format(user_id)), pad=20)
-    ax.tick_params(axis="x", labelsize=12)
-    ax.tick_params(axis="y", labelsize=12)
-    for bar in bars:
-        yval = bar.get_height()
-        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 0.05 * max(counts) if max(counts)>0 else 0.5, int(yval), ha="center", va="bottom", fontsize=11)
-    chart_path = os.path.join(CHARTS_DIR, "{}_correct_incorrect_chart.png".format(user_id))
-    try:
-        plt.tight_layout()
-        plt.savefig(chart_path)
-        plt.close(fig)
-        return chart_path
-    except Exception as e:
-        logger.error("Error generating correct/incorrect chart for user {}: {}".format(user_id, e))
-        return None
+    return await get_chart("user_correct_incorrect", user_id=user_id, correct=correct, incorrect=incorrect)
 
-def generate_bar_chart_grades_distribution(user_id: int, quiz_history: list) -> str | None:
+async def generate_bar_chart_grades_distribution(user_id: int, quiz_history: list) -> Chart | None:
     if not quiz_history:
         return None
-    grades = {process_arabic_text("ممتاز (90+)"): 0, process_arabic_text("جيد جداً (80-89)"): 0, process_arabic_text("جيد (70-79)"): 0, process_arabic_text("مقبول (60-69)"): 0, process_arabic_text("يحتاج تحسين (<60)"): 0}
-    for quiz in quiz_history:
-        score = quiz.get("score_percentage") 
-        if score is not None:
-            if score >= 90: grades[process_arabic_text("ممتاز (90+)")] += 1
-            elif score >= 80: grades[process_arabic_text("جيد جداً (80-89)")] += 1
-            elif score >= 70: grades[process_arabic_text("جيد (70-79)")] += 1
-            elif score >= 60: grades[process_arabic_text("مقبول (60-69)")] += 1
-            else: grades[process_arabic_text("يحتاج تحسين (<60)")] += 1
-        else:
-            logger.warning("[Stats Chart] Quiz entry for user {} has None score_percentage. Skipping for grade distribution.".format(user_id))
-    if all(v == 0 for v in grades.values()): return None
-    fig, ax = plt.subplots(figsize=(10, 7))
-    categories = list(grades.keys())
-    counts = list(grades.values())
-    colors = ["#4CAF50", "#8BC34A", "#CDDC39", "#FFEB3B", "#FFC107", "#F44336"][::-1]
-    bars = ax.barh(categories, counts, color=colors[:len(categories)])
-    ax.set_xlabel(process_arabic_text("عدد الاختبارات"))
-    ax.set_title(process_arabic_text("توزيع تقديرات الاختبارات للمستخدم {}".format(user_id)), pad=20)
-    ax.tick_params(axis="x", labelsize=12)
-    ax.tick_params(axis="y", labelsize=12)
-    for i, bar in enumerate(bars):
-        xval = bar.get_width()
-        ax.text(xval + 0.02 * max(counts) if max(counts)>0 else 0.2, i, int(xval), ha="left", va="center", fontsize=11)
-    chart_path = os.path.join(CHARTS_DIR, "{}_grades_dist_chart.png".format(user_id))
-    try:
-        plt.tight_layout()
-        plt.savefig(chart_path)
-        plt.close(fig)
-        return chart_path
-    except Exception as e:
-        logger.error("Error generating grades distribution chart for user {}: {}".format(user_id, e))
-        return None
-
-def generate_line_chart_performance_trend(user_id: int, quiz_history: list) -> str | None:
-    valid_quiz_history = [quiz for quiz in quiz_history if quiz.get("score_percentage") is not None]
-    if not valid_quiz_history or len(valid_quiz_history) < 2:
+    scores = [quiz.get("score_percentage") for quiz in quiz_history]
+    if any(score is None for score in scores):
+        logger.warning("[Stats Chart] Quiz entries for user {} have None score_percentage. Skipping them for grade distribution.".format(user_id))
+    return await get_chart("user_grades_distribution", user_id=user_id, scores=scores)
+
+async def generate_line_chart_performance_trend(user_id: int, quiz_history: list) -> Chart | None:
+    scores = [quiz.get("score_percentage") for quiz in quiz_history if quiz.get("score_percentage") is not None]
+    if len(scores) < 2:
         logger.info("[Stats Chart] Not enough valid data points to generate performance trend for user {} after filtering None scores.".format(user_id))
         return None
-    scores = [quiz.get("score_percentage") for quiz in valid_quiz_history] 
-    test_numbers = list(range(1, len(valid_quiz_history) + 1))
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(test_numbers, scores, marker="o", linestyle="-", color="#007BFF", linewidth=2, markersize=8)
-    ax.set_xlabel(process_arabic_text("رقم الاختبار (الأحدث على اليمين)"))
-    ax.set_ylabel(process_arabic_text("النتيجة (%)"))
-    ax.set_title(process_arabic_text("تطور الأداء للمستخدم {} (آخر {} اختبارات صالحة)".format(user_id, len(valid_quiz_history))), pad=20)
-    ax.grid(True, linestyle="--", alpha=0.7)
-    ax.tick_params(axis="both", labelsize=12)
-    ax.set_ylim(0, 105)
-    ax.set_xticks(test_numbers)
-    for i, score_val in enumerate(scores):
-        ax.text(test_numbers[i], score_val + 2, "{:.1f}%".format(score_val), ha="center", fontsize=10)
-    chart_path = os.path.join(CHARTS_DIR, "{}_performance_trend_chart.png".format(user_id))
-    try:
-        plt.tight_layout()
-        plt.savefig(chart_path)
-        plt.close(fig)
-        return chart_path
-    except Exception as e:
-        logger.error("Error generating performance trend chart for user {}: {}".format(user_id, e))
-        return None
+    return await get_chart("user_performance_trend", user_id=user_id, scores=scores)
 
 # --- Helper Functions (User Stats - Unchanged from v9) ---
 def create_stats_menu_keyboard() -> InlineKeyboardMarkup:
@@ -243,8 +138,10 @@ async def show_my_stats(update: Update, context: CallbackContext) -> int:
         stats_text += "عذراً، خدمة الإحصائيات غير متاحة حالياً بسبب مشكلة في الاتصال بقاعدة البيانات."
         logger.critical("[Stats] CRITICAL: Imported DB_MANAGER is None or not initialized! Database operations will fail for user {}.".format(user_id))
     else:
-        user_overall_stats = db_manager.get_user_overall_stats(user_id)
-        user_quiz_history_raw = db_manager.get_user_recent_quiz_history(user_id, limit=LEADERBOARD_LIMIT)
+        user_overall_stats, user_quiz_history_raw = await asyncio.gather(
+            run_db(db_manager.get_user_overall_stats, user_id),
+            run_db(db_manager.get_user_recent_quiz_history, user_id, limit=LEADERBOARD_LIMIT, default=[])
+        )
         if not user_overall_stats or user_overall_stats.get("total_quizzes_taken", 0) == 0:
             stats_text += "لم تقم بإكمال أي اختبارات بعد. ابدأ اختباراً لتظهر إحصائياتك هنا!"
         else:
@@ -257,8 +154,6 @@ async def show_my_stats(update: Update, context: CallbackContext) -> int:
             total_incorrect = total_questions_attempted - total_correct
             stats_text += "✅ مجموع الإجابات الصحيحة: {}\n".format(total_correct)
             stats_text += "❌ مجموع الإجابات الخاطئة: {}\n".format(total_incorrect)
-            chart1_path = generate_bar_chart_correct_incorrect(user_id, total_correct, total_incorrect)
-            if chart1_path: attachments.append(chart1_path)
             quiz_history_for_charts = []
             if user_quiz_history_raw:
                 for qh_entry in user_quiz_history_raw:
@@ -271,10 +166,12 @@ async def show_my_stats(update: Update, context: CallbackContext) -> int:
                         "total_questions": total_q_in_quiz,
                         "date": qh_entry.get("completion_timestamp").strftime("%Y-%m-%d %H:%M:%S") if qh_entry.get("completion_timestamp") else "N/A"
                     })
-            chart2_path = generate_bar_chart_grades_distribution(user_id, quiz_history_for_charts)
-            if chart2_path: attachments.append(chart2_path)
-            chart3_path = generate_line_chart_performance_trend(user_id, quiz_history_for_charts)
-            if chart3_path: attachments.append(chart3_path)
+            charts = await asyncio.gather(
+                generate_bar_chart_correct_incorrect(user_id, total_correct, total_incorrect),
+                generate_bar_chart_grades_distribution(user_id, quiz_history_for_charts),
+                generate_line_chart_performance_trend(user_id, quiz_history_for_charts)
+            )
+            attachments.extend(chart for chart in charts if chart)
             if user_quiz_history_raw:
                 stats_text += "\n══════════════════════\n📜 سجل آخر اختباراتك:\n"
                 for i, test_entry in enumerate(user_quiz_history_raw):
@@ -297,13 +194,13 @@ async def show_my_stats(update: Update, context: CallbackContext) -> int:
         logger.warning("show_my_stats: No message to edit for user {}. Sending new message.".format(user_id))
         await safe_send_message(context.bot, query.message.chat_id if query and query.message else update.effective_chat.id, text=stats_text, reply_markup=keyboard, parse_mode="Markdown")
     if attachments:
-        for attachment_path in attachments:
+        for chart_index, chart in enumerate(attachments, start=1):
             try:
-                with open(attachment_path, "rb") as photo_file:
-                    await context.bot.send_photo(chat_id=query.message.chat_id, photo=photo_file)
-                logger.info("Sent chart {} to user {}".format(attachment_path, user_id))
+                source = "cached file_id" if chart.file_id else "{} bytes".format(len(chart.png))
+                await send_chart_photo(context.bot, query.message.chat_id, chart)
+                logger.info("Sent chart {} ({}) to user {}".format(chart_index, source, user_id))
             except Exception as e:
-                logger.error("Failed to send chart {} to user {}: {}".format(attachment_path, user_id, e))
+                logger.error("Failed to send chart {} to user {}: {}".format(chart_index, user_id, e))
     return STATS_MENU
 
 def _format_leaderboard_name(full_name: str, max_len: int = 22) -> str:
@@ -330,6 +227,8 @@ def _build_score_bar(score: float, width: int = 8) -> str:
     empty = width - filled
     return "█" * filled + "░" * empty
 
+_EMPTY_RANK = {"rank": 0, "total_users": 0, "avg_score": 0, "total_quizzes": 0, "total_correct": 0}
+
 def _build_leaderboard_text(leaderboard_data: list, user_rank_data: dict, user_id: int, title: str, subtitle: str = "") -> str:
     """Build formatted leaderboard text."""
     
@@ -397,8 +296,10 @@ async def show_leaderboard(update: Update, context: CallbackContext) -> int:
         text = "🏆 *لوحة الصدارة* 🏆\n\nعذراً، الخدمة غير متاحة حالياً."
         logger.critical("[Leaderboard] DB_MANAGER is None!")
     else:
-        leaderboard_data = db_manager.get_leaderboard(limit=LEADERBOARD_LIMIT)
-        user_rank = db_manager.get_user_rank(user_id, weekly=False)
+        leaderboard_data, user_rank = await asyncio.gather(
+            run_db(db_manager.get_leaderboard, limit=LEADERBOARD_LIMIT, default=[]),
+            run_db(db_manager.get_user_rank, user_id, weekly=False, default=dict(_EMPTY_RANK))
+        )
         text = _build_leaderboard_text(
             leaderboard_data, user_rank, user_id,
             title="لوحة الصدارة",
@@ -424,8 +325,10 @@ async def show_weekly_leaderboard(update: Update, context: CallbackContext) -> i
     if not db_manager:
         text = "🏆 *لوحة الصدارة الأسبوعية* 🏆\n\nعذراً، الخدمة غير متاحة حالياً."
     else:
-        leaderboard_data = db_manager.get_weekly_leaderboard(limit=LEADERBOARD_LIMIT)
-        user_rank = db_manager.get_user_rank(user_id, weekly=True)
+        leaderboard_data, user_rank = await asyncio.gather(
+            run_db(db_manager.get_weekly_leaderboard, limit=LEADERBOARD_LIMIT, default=[]),
+            run_db(db_manager.get_user_rank, user_id, weekly=True, default=dict(_EMPTY_RANK))
+        )
         text = _build_leaderboard_text(
             leaderboard_data, user_rank, user_id,
             title="لوحة الصدارة الأسبوعية",
@@ -443,6 +346,14 @@ async def show_weekly_leaderboard(update: Update, context: CallbackContext) -> i
 # --- Admin Statistics --- 
 ADMIN_STATS_STATE, ADMIN_STATS_FILTER_STATE = range(ADMIN_STATS_MENU, ADMIN_STATS_MENU + 2)
 
+# The admin panel issues many queries per click; cap how many it runs at once so it
+# never takes over the shared DB executor that quiz writes also use
+ADMIN_STATS_DB_CONCURRENCY = 3
+
+async def _run_db_limited(semaphore: asyncio.Semaphore, func, *args, **kwargs):
+    async with semaphore:
+        return await run_db(func, *args, **kwargs)
+
 async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     user_id = update.effective_user.id
@@ -456,7 +367,7 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     # Use DB_MANAGER.is_user_admin for checking admin status
-    if not db_manager.is_user_admin(user_id):
+    if not await run_db(db_manager.is_user_admin, user_id, default=False):
         await safe_send_message(context.bot, chat_id, "عذراً، هذه اللوحة مخصصة للمشرفين فقط.")
         logger.warning("[AdminStats] Non-admin user {} tried to access admin panel.".format(user_id))
         return ConversationHandler.END
@@ -466,22 +377,33 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
 
     stats_text = "📊 *لوحة التحكم الإدارية* ({}) 📊\n\n".format(time_filter.replace("_", " ").capitalize())
     
-    # Fetch all stats directly from DB_MANAGER
+    # Fetch all stats from DB_MANAGER, at most ADMIN_STATS_DB_CONCURRENCY queries at a time
+    db_slots = asyncio.Semaphore(ADMIN_STATS_DB_CONCURRENCY)
+    (total_users, active_users_general, total_quizzes_completed, avg_quizzes_per_active_user,
+     avg_correct_rate, unit_engagement, difficult_units_data, easiest_units_data,
+     avg_quiz_duration_secs, completion_stats, question_difficulty_data) = await asyncio.gather(
+        _run_db_limited(db_slots, db_manager.get_total_users_count, default=0), # No filter for total users
+        _run_db_limited(db_slots, db_manager.get_active_users_count, time_filter=time_filter, default=0),
+        _run_db_limited(db_slots, db_manager.get_total_quizzes_count, time_filter=time_filter, default=0),
+        _run_db_limited(db_slots, db_manager.get_average_quizzes_per_active_user, time_filter=time_filter, default=0.0),
+        _run_db_limited(db_slots, db_manager.get_overall_average_score, time_filter=time_filter, default=0.0),
+        _run_db_limited(db_slots, db_manager.get_unit_engagement_stats, time_filter=time_filter, limit=3, default={}),
+        _run_db_limited(db_slots, db_manager.get_most_difficult_units, time_filter=time_filter, limit=3, default=[]),
+        _run_db_limited(db_slots, db_manager.get_easiest_units, time_filter=time_filter, limit=3, default=[]),
+        _run_db_limited(db_slots, db_manager.get_average_quiz_duration, time_filter=time_filter, default=0),
+        _run_db_limited(db_slots, db_manager.get_quiz_completion_rate_stats, time_filter=time_filter, default={}),
+        _run_db_limited(db_slots, db_manager.get_question_difficulty_stats, time_filter=time_filter, limit=3, default={})
+    )
+
     stats_text += "*نظرة عامة على الاستخدام: *\n"
-    total_users = db_manager.get_total_users_count() # No filter for total users
-    active_users_general = db_manager.get_active_users_count(time_filter=time_filter)
-    total_quizzes_completed = db_manager.get_total_quizzes_count(time_filter=time_filter)
-    avg_quizzes_per_active_user = db_manager.get_average_quizzes_per_active_user(time_filter=time_filter)
     stats_text += "- إجمالي المستخدمين (الكلي): {}\n".format(total_users)
     stats_text += "- المستخدمون النشطون: {}\n".format(active_users_general)
     stats_text += "- إجمالي الاختبارات التي تم إجراؤها: {}\n".format(total_quizzes_completed)
     stats_text += "- متوسط الاختبارات لكل مستخدم نشط: {:.2f}\n\n".format(avg_quizzes_per_active_user)
 
     stats_text += "*أداء الاختبارات: *\n"
-    avg_correct_rate = db_manager.get_overall_average_score(time_filter=time_filter)
     stats_text += "- متوسط نسبة الإجابات الصحيحة: {:.2f}%\n".format(avg_correct_rate)
     
-    unit_engagement = db_manager.get_unit_engagement_stats(time_filter=time_filter, limit=3)
     popular_units = unit_engagement.get("popular_units", [])
     stats_text += "- الوحدات/الاختبارات الأكثر شعبية (أعلى 3 حسب عدد مرات اللعب):\n"
     if popular_units:
@@ -493,7 +415,6 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
     else:
         stats_text += "  لا توجد بيانات\n"
 
-    difficult_units_data = db_manager.get_most_difficult_units(time_filter=time_filter, limit=3)
     stats_text += "- الوحدات/الاختبارات الأكثر صعوبة (أقل 3 متوسط نتيجة):\n"
     if difficult_units_data:
         for i, unit_stat in enumerate(difficult_units_data):
@@ -504,7 +425,6 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
     else:
         stats_text += "  لا توجد بيانات\n"
 
-    easiest_units_data = db_manager.get_easiest_units(time_filter=time_filter, limit=3)
     stats_text += "- الوحدات/الاختبارات الأسهل (أعلى 3 متوسط نتيجة):\n"
     if easiest_units_data:
         for i, unit_stat in enumerate(easiest_units_data):
@@ -517,9 +437,7 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
     stats_text += "\n"
     
     stats_text += "*تفاعل المستخدمين: *\n"
-    avg_quiz_duration_secs = db_manager.get_average_quiz_duration(time_filter=time_filter)
     stats_text += "- متوسط وقت إكمال الاختبار: {}\n".format(format_duration(avg_quiz_duration_secs))
-    completion_stats = db_manager.get_quiz_completion_rate_stats(time_filter=time_filter)
     completion_rate_val = completion_stats.get("completion_rate", 0.0)
     completed_quizzes_val = completion_stats.get("completed_quizzes", 0)
     started_quizzes_val = completion_stats.get("started_quizzes", 0)
@@ -531,7 +449,6 @@ async def admin_stats_panel(update: Update, context: CallbackContext) -> int:
     stats_text += line_text_completion_rate
 
     stats_text += "*إحصائيات الأسئلة: *\n"
-    question_difficulty_data = db_manager.get_question_difficulty_stats(time_filter=time_filter, limit=3)
     most_difficult_questions = question_difficulty_data.get("most_difficult", [])
     easiest_questions = question_difficulty_data.get("easiest", [])
 
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Difficult questions sheet: per-answer Python loop vs the report_answers table.
+
+Loads a synthetic history of quiz results (~10 answers each in the JSONB
+answers_details, some quizzes ended early) into the database of DATABASE_URL
+and computes the per-question attempt/correct/wrong/skipped counts of the
+weekly report three ways:
+
+- "loop": the old get_individual_difficult_questions body - every
+  answers_details of the period fetched into Python, then dict bookkeeping
+  per answer with a substring test on 'تم إنهاء الاختبار' for skipped ones.
+- "details": report_answers flattened from answers_details inside the
+  database (fallback while the quiz_answers backfill is running), then one
+  GROUP BY (question_answer_stats).
+- "quiz_answers": report_answers read from quiz_answers (steady state).
+
+The data lives in TEMP tables named quiz_results/quiz_answers, which shadow
+the real tables for this session only and are dropped when it ends. Counts
+are compared before timings are printed.
+
+Usage:
+    DATABASE_URL=... python -m utils.answers_benchmark [quizzes=100000]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from final_weekly_report import _ANSWERS_FROM_DETAILS_SQL, create_report_answers, question_answer_stats
+
+QUESTIONS = 2000
+ENDED_TEXT = "تم إنهاء الاختبار"
+COUNT_COLUMNS = ("total_attempts", "correct_attempts", "wrong_attempts", "skipped_count")
+
+_TEMP_TABLES_SQL = """
+    CREATE TEMP TABLE quiz_results (
+        result_id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        quiz_name TEXT,
+        completed_at TIMESTAMPTZ,
+        answers_details JSONB
+    );
+    CREATE TEMP TABLE quiz_answers (
+        result_id BIGINT NOT NULL,
+        answer_index INTEGER NOT NULL,
+        user_id BIGINT,
+        question_id TEXT NOT NULL,
+        is_correct BOOLEAN NOT NULL DEFAULT FALSE,
+        status TEXT,
+        answered_at TIMESTAMPTZ,
+        PRIMARY KEY (result_id, answer_index)
+    );
+    CREATE INDEX ON quiz_results (completed_at);
+    CREATE INDEX ON quiz_answers (answered_at);
+"""
+
+
+def _sample_answers(rng: random.Random) -> list:
+    answers = []
+    count = rng.randint(5, 15)
+    ended_at = rng.randint(1, count) if rng.random() < 0.2 else None
+    for index in range(count):
+        question_id = str(rng.randint(1, QUESTIONS))
+        if ended_at is not None and index >= ended_at:
+            status = "quiz_ended_by_user" if index == ended_at else "not_reached_quiz_ended"
+            answers.append({"question_id": question_id, "question_text": "سؤال " + question_id,
+                            "chosen_option_text": ENDED_TEXT, "correct_option_text": "أ",
+                            "is_correct": False, "time_taken": -1, "status": status})
+            continue
+        is_correct = rng.random() < 0.6
+        answers.append({"question_id": question_id, "question_text": "سؤال " + question_id,
+                        "chosen_option_text": "أ" if is_correct else rng.choice("بجد"),
+                        "correct_option_text": "أ", "is_correct": is_correct,
+                        "time_taken": round(rng.uniform(2, 60), 1), "status": "answered"})
+    return answers
+
+
+def build_dataset(quizzes: int, now: datetime, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    return [
+        {"result_id": result_id, "user_id": rng.randint(1, 5000),
+         "completed_at": now - timedelta(minutes=rng.randint(0, 7 * 24 * 60)),
+         "answers_details": json.dumps(_sample_answers(rng), ensure_ascii=False)}
+        for result_id in range(1, quizzes + 1)
+    ]
+
+
+def load_dataset(conn, rows: list, now: datetime) -> None:
+    conn.exec_driver_sql(_TEMP_TABLES_SQL)
+    conn.execute(text("""
+        INSERT INTO quiz_results (result_id, user_id, completed_at, answers_details)
+        VALUES (:result_id, :user_id, :completed_at, CAST(:answers_details AS jsonb))
+    """), rows)
+    # quiz_answers كما يملؤه مسار الإدراج/النسخ (نفس قواعد فك answers_details)
+    conn.execute(text("INSERT INTO quiz_answers " + _ANSWERS_FROM_DETAILS_SQL),
+                 {"start_date": now - timedelta(days=8), "end_date": now})
+    conn.exec_driver_sql("ANALYZE quiz_results; ANALYZE quiz_answers")
+
+
+def loop_stats(conn, start_date: datetime, end_date: datetime) -> dict:
+    question_stats = {}
+    rows = conn.execute(text("""
+        SELECT answers_details FROM quiz_results
+        WHERE completed_at >= :start_date AND completed_at <= :end_date
+    """), {"start_date": start_date, "end_date": end_date})
+    for (answers_details,) in rows:
+        for answer in answers_details:
+            if not isinstance(answer, dict):
+                continue
+            question_id = answer.get("question_id")
+            if not question_id:
+                continue
+            stats = question_stats.setdefault(question_id, {
+                "total_attempts": 0, "correct_attempts": 0, "wrong_attempts": 0,
+                "skipped_count": 0, "wrong_answers": []})
+            chosen_option_text = answer.get("chosen_option_text", "غير محدد")
+            if ENDED_TEXT in str(chosen_option_text):
+                stats["skipped_count"] += 1
+                continue
+            stats["total_attempts"] += 1
+            if answer.get("is_correct", False):
+                stats["correct_attempts"] += 1
+            else:
+                stats["wrong_attempts"] += 1
+                if chosen_option_text and chosen_option_text not in stats["wrong_answers"]:
+                    stats["wrong_answers"].append(chosen_option_text)
+    return question_stats
+
+
+def table_stats(conn, start_date: datetime, end_date: datetime, from_details: bool) -> list:
+    create_report_answers(conn, [(start_date, end_date)], from_details=from_details)
+    stats = question_answer_stats(conn, min_attempts=2, limit=QUESTIONS)
+    conn.exec_driver_sql("DROP TABLE report_answers")
+    return stats
+
+
+def _same_counts(loop: dict, rows: list) -> bool:
+    expected = {q: tuple(s[c] for c in COUNT_COLUMNS) for q, s in loop.items() if s["total_attempts"] >= 2}
+    actual = {row.question_id: tuple(getattr(row, c) for c in COUNT_COLUMNS) for row in rows}
+    return expected == actual
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main(quizzes: int) -> None:
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise SystemExit("DATABASE_URL is required")
+    now = datetime.now().replace(microsecond=0)
+    start_date = now - timedelta(days=7)
+
+    engine = create_engine(database_url)
+    with engine.begin() as conn:
+        rows, build_s = _timed(build_dataset, quizzes, now)
+        _, load_s = _timed(load_dataset, conn, rows, now)
+        print("{} synthetic quizzes generated in {:.1f}s, loaded in {:.1f}s".format(quizzes, build_s, load_s))
+
+        loop, loop_s = _timed(loop_stats, conn, start_date, now)
+        details, details_s = _timed(table_stats, conn, start_date, now, True)
+        answers, answers_s = _timed(table_stats, conn, start_date, now, False)
+
+        if not (_same_counts(loop, details) and _same_counts(loop, answers)):
+            raise SystemExit("per-question counts differ between loop and report_answers")
+        print("{} questions, counts identical".format(len(answers)))
+        print("{:<14}{:>10}".format("mode", "time"))
+        for mode, seconds in (("loop", loop_s), ("details", details_s), ("quiz_answers", answers_s)):
+            print("{:<14}{:>9.2f}s".format(mode, seconds))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""In-process cache for read-mostly Chemistry API endpoints (question bank, courses, units).
+
+- Fresh entries (younger than API_CACHE_TTL) are served from memory.
+- Stale entries (up to API_CACHE_TTL + API_CACHE_STALE_TTL) are served
+  immediately while one background task revalidates them.
+- Revalidation uses conditional GET (If-None-Match / If-Modified-Since), so
+  an unchanged bank costs a 304 instead of the full question list.
+- Concurrent misses for the same endpoint share one upstream request
+  (single-flight): 200 students starting a quiz together cost one fetch.
+- If a refresh fails, the last good copy keeps being served.
+
+Return values match fetch_from_api: JSON data, "TIMEOUT" or None.
+"""
+
+import asyncio
+import logging
+import time
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import API_CACHE_TTL, API_CACHE_STALE_TTL, API_CACHE_MAX_ENTRIES
+except ImportError:
+    API_CACHE_TTL = 900
+    API_CACHE_STALE_TTL = 86400
+    API_CACHE_MAX_ENTRIES = 500
+
+from utils.api_client import fetch_from_api_conditional, NOT_MODIFIED
+
+
+class _CacheEntry:
+    __slots__ = ("data", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, data, etag=None, last_modified=None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+
+class ApiResponseCache:
+    """TTL + ETag cache with stale-while-revalidate and single-flight refreshes."""
+
+    def __init__(self, ttl=API_CACHE_TTL, stale_ttl=API_CACHE_STALE_TTL, max_entries=API_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = {}         # key -> _CacheEntry
+        self._inflight = {}        # key -> asyncio.Task of the running refresh
+        self._background = set()   # strong refs to revalidation tasks
+        self._generation = 0       # bumped by invalidate() so in-flight refreshes don't repopulate
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "upstream_fetches": 0,
+            "not_modified": 0,
+            "refresh_errors": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def _key(endpoint, params):
+        endpoint = endpoint.strip("/")
+        if not params:
+            return endpoint
+        return endpoint + "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+
+    @staticmethod
+    def _copy(data):
+        # Callers keep results in user_data and may reorder them; never hand out the cached list itself
+        return list(data) if isinstance(data, list) else data
+
+    async def get(self, endpoint: str, params: dict = None, revalidate: bool = False):
+        """Returns the cached response for endpoint, fetching or revalidating as needed.
+
+        revalidate=True skips the fresh/stale shortcuts and waits for a conditional
+        refresh (a 304 when unchanged), for callers that must see current data;
+        if upstream fails it returns None instead of the last good copy.
+        """
+        key = self._key(endpoint, params)
+        entry = self._entries.get(key)
+        if revalidate:
+            self._stats["misses"] += 1
+            started = time.monotonic()
+            data = await self._refresh(key, endpoint, params)
+            current = self._entries.get(key)
+            if current is None or current.fetched_at < started:
+                return None
+            return self._copy(data)
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self._stats["hits"] += 1
+                return self._copy(entry.data)
+            if age < self.ttl + self.stale_ttl:
+                self._stats["stale_hits"] += 1
+                self._revalidate_in_background(key, endpoint, params)
+                return self._copy(entry.data)
+
+        self._stats["misses"] += 1
+        return self._copy(await self._refresh(key, endpoint, params))
+
+    def _revalidate_in_background(self, key, endpoint, params):
+        if key in self._inflight:
+            return
+        task = asyncio.create_task(self._refresh(key, endpoint, params))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _refresh(self, key, endpoint, params):
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(task)
+        task = asyncio.create_task(self._fetch(key, endpoint, params))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._clear_inflight(key, t))
+        return await asyncio.shield(task)
+
+    def _clear_inflight(self, key, task):
+        # A newer refresh may already be registered under the same key; leave it alone
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _fetch(self, key, endpoint, params):
+        entry = self._entries.get(key)
+        generation = self._generation
+        self._stats["upstream_fetches"] += 1
+        result, validators = await fetch_from_api_conditional(
+            endpoint, params,
+            etag=entry.etag if entry else None,
+            last_modified=entry.last_modified if entry else None,
+        )
+
+        if result == NOT_MODIFIED and entry is not None:
+            self._stats["not_modified"] += 1
+            entry.fetched_at = time.monotonic()
+            return entry.data
+
+        if result is None or result == "TIMEOUT" or result == NOT_MODIFIED:
+            self._stats["refresh_errors"] += 1
+            if entry is not None:
+                logger.warning(f"[API-CACHE] Refresh of {key} failed ({result}); serving last good copy.")
+                return entry.data
+            return None if result == NOT_MODIFIED else result
+
+        if generation == self._generation:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k].fetched_at)
+                self._entries.pop(oldest, None)
+            self._entries[key] = _CacheEntry(result, validators.get("etag"), validators.get("last_modified"))
+        return result
+
+    def invalidate(self, prefix: str = None) -> int:
+        """Drops cached entries (all, or those whose key starts with prefix). Returns the number removed."""
+        self._generation += 1
+        self._stats["invalidations"] += 1
+        if not prefix:
+            removed = len(self._entries)
+            self._entries.clear()
+        else:
+            prefix = prefix.strip("/")
+            keys = [k for k in self._entries if k.startswith(prefix)]
+            for k in keys:
+                self._entries.pop(k, None)
+            removed = len(keys)
+        logger.info(f"[API-CACHE] Invalidated {removed} entries (prefix={prefix or '*'}).")
+        return removed
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups * 100, 1) if lookups else 0.0
+        stats["entries"] = len(self._entries)
+        stats["inflight"] = len(self._inflight)
+        return stats
+
+
+API_CACHE = ApiResponseCache()
+
+async def fetch_from_api_cached(endpoint: str, params: dict = None):
+    """Drop-in replacement for fetch_from_api for read-mostly endpoints."""
+    return await API_CACHE.get(endpoint, params)
+
+async def fetch_from_api_revalidated(endpoint: str, params: dict = None):
+    """Like fetch_from_api_cached, but always revalidates upstream (conditional GET) before returning."""
+    return await API_CACHE.get(endpoint, params, revalidate=True)
+
+def invalidate_api_cache(prefix: str = None) -> int:
+    return API_CACHE.invalidate(prefix)
+
+def get_api_cache_stats() -> dict:
+    return API_CACHE.stats()
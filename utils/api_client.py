@@ -2,9 +2,16 @@
 """Handles communication with the external Chemistry API.
 MODIFIED v2: Converted to async using aiohttp for better performance.
              Kept sync fallback (fetch_from_api_sync) for backward compatibility.
+MODIFIED v3: fetch_from_api reuses one application-scoped ClientSession
+             (keep-alive, connection limits, DNS cache) opened in post_init
+             and closed on shutdown; latency/in-flight counters in get_api_stats().
+MODIFIED v4: fetch_many_from_api fans out many endpoints concurrently under a cap.
 """
 
+import asyncio
 import logging
+import time
+from collections import deque
 import aiohttp
 import uuid
 
@@ -18,6 +25,19 @@ except ImportError:
     API_BASE_URL = "http://localhost:8000/api"
     API_TIMEOUT = 10
 
+try:
+    from config import API_CONNECTOR_LIMIT, API_CONNECTOR_LIMIT_PER_HOST, API_KEEPALIVE_TIMEOUT, API_DNS_CACHE_TTL
+except ImportError:
+    API_CONNECTOR_LIMIT = 100
+    API_CONNECTOR_LIMIT_PER_HOST = 30
+    API_KEEPALIVE_TIMEOUT = 30
+    API_DNS_CACHE_TTL = 300
+
+try:
+    from config import API_FETCH_CONCURRENCY
+except ImportError:
+    API_FETCH_CONCURRENCY = 8
+
 # === Synchronous fallback using requests (kept for backward compatibility) ===
 import requests
 from requests.exceptions import RequestException, Timeout
@@ -46,7 +66,70 @@ def fetch_from_api_sync(endpoint: str, params: dict = None):
         return None
 
 
+# === Shared aiohttp session ===
+_session: aiohttp.ClientSession | None = None
+_session_lock = asyncio.Lock()
+_recent_latencies = deque(maxlen=500) # seconds, most recent requests only
+_stats = {
+    "requests": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+    "errors": 0,
+    "timeouts": 0,
+    "total_seconds": 0.0,
+}
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=API_CONNECTOR_LIMIT,
+        limit_per_host=API_CONNECTOR_LIMIT_PER_HOST,
+        keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=API_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+
+async def init_api_session() -> aiohttp.ClientSession:
+    """Opens the shared API session (call from the PTB post_init hook)."""
+    global _session
+    async with _session_lock:
+        if _session is None or _session.closed:
+            _session = _create_session()
+            logger.info(f"[API-ASYNC] Shared session opened (limit={API_CONNECTOR_LIMIT}, per_host={API_CONNECTOR_LIMIT_PER_HOST}, "
+                        f"keepalive={API_KEEPALIVE_TIMEOUT}s, dns_ttl={API_DNS_CACHE_TTL}s).")
+    return _session
+
+async def get_api_session() -> aiohttp.ClientSession:
+    """Returns the shared session, opening it lazily if post_init has not run (e.g. standalone scripts)."""
+    if _session is None or _session.closed:
+        return await init_api_session()
+    return _session
+
+async def close_api_session():
+    """Closes the shared API session (call on shutdown)."""
+    global _session
+    async with _session_lock:
+        if _session is not None and not _session.closed:
+            await _session.close()
+            logger.info("[API-ASYNC] Shared session closed.")
+        _session = None
+
+def get_api_stats() -> dict:
+    """Request count, in-flight requests and latency figures for the external API."""
+    stats = dict(_stats)
+    requests_count = stats["requests"]
+    stats["avg_latency_ms"] = round(stats.pop("total_seconds") / requests_count * 1000, 2) if requests_count else 0.0
+    latencies = sorted(_recent_latencies)
+    stats["p95_latency_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2) if latencies else 0.0
+    if _session is not None and not _session.closed and _session.connector is not None:
+        stats["connector_limit"] = _session.connector.limit
+        stats["connector_limit_per_host"] = _session.connector.limit_per_host
+    return stats
+
+
 # === Async version using aiohttp ===
+NOT_MODIFIED = "NOT_MODIFIED" # Returned by fetch_from_api_conditional on HTTP 304
+
 async def fetch_from_api(endpoint: str, params: dict = None):
     """Fetches data from the specified API endpoint asynchronously.
 
@@ -59,40 +142,116 @@ async def fetch_from_api(endpoint: str, params: dict = None):
         "TIMEOUT" if the request times out,
         None if any other error occurs.
     """
+    result, _ = await fetch_from_api_conditional(endpoint, params)
+    return result
+
+
+async def fetch_from_api_conditional(endpoint: str, params: dict = None, etag: str = None, last_modified: str = None):
+    """Like fetch_from_api, but sends If-None-Match / If-Modified-Since when validators are given.
+
+    Returns:
+        (result, validators) where result is the JSON response, NOT_MODIFIED,
+        "TIMEOUT" or None, and validators is {"etag": ..., "last_modified": ...}
+        taken from the response headers.
+    """
+    validators = {"etag": None, "last_modified": None}
     if not API_BASE_URL or API_BASE_URL.startswith("http://your-api-base-url.com"):
         logger.error(f"[API-ASYNC] Invalid API_BASE_URL: '{API_BASE_URL}'")
-        return None
+        return None, validators
 
     url = f"{API_BASE_URL.rstrip('/')}/{endpoint.lstrip('/')}"
     logger.debug(f"[API-ASYNC] Fetching: {url} params: {params}")
 
-    timeout = aiohttp.ClientTimeout(total=API_TIMEOUT)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    started = time.monotonic()
+    _stats["requests"] += 1
+    _stats["in_flight"] += 1
+    _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
 
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, params=params) as response:
-                logger.debug(f"[API-ASYNC] Status: {response.status}")
-
-                if response.status >= 400:
-                    logger.error(f"[API-ASYNC] HTTP {response.status} from {url}")
-                    return None
-
-                try:
-                    return await response.json()
-                except Exception:
-                    text = await response.text()
-                    logger.error(f"[API-ASYNC] JSON decode failed: {url}. Text: {text[:200]}")
-                    return None
-
-    except aiohttp.ServerTimeoutError:
+        session = await get_api_session()
+        async with session.get(url, params=params, headers=headers or None) as response:
+            logger.debug(f"[API-ASYNC] Status: {response.status}")
+            validators["etag"] = response.headers.get("ETag")
+            validators["last_modified"] = response.headers.get("Last-Modified")
+
+            if response.status == 304:
+                return NOT_MODIFIED, validators
+
+            if response.status >= 400:
+                _stats["errors"] += 1
+                logger.error(f"[API-ASYNC] HTTP {response.status} from {url}")
+                return None, validators
+
+            try:
+                return await response.json(), validators
+            except Exception:
+                _stats["errors"] += 1
+                text = await response.text()
+                logger.error(f"[API-ASYNC] JSON decode failed: {url}. Text: {text[:200]}")
+                return None, validators
+
+    except (aiohttp.ServerTimeoutError, asyncio.TimeoutError):
+        _stats["timeouts"] += 1
         logger.error(f"[API-ASYNC] Timeout: {url} after {API_TIMEOUT}s")
-        return "TIMEOUT"
+        return "TIMEOUT", validators
     except aiohttp.ClientError as e:
+        _stats["errors"] += 1
         logger.error(f"[API-ASYNC] Client error: {url}: {e}")
-        return None
+        return None, validators
     except Exception as e:
+        _stats["errors"] += 1
         logger.exception(f"[API-ASYNC] Unexpected: {url}: {e}")
-        return None
+        return None, validators
+    finally:
+        elapsed = time.monotonic() - started
+        _stats["in_flight"] -= 1
+        _stats["total_seconds"] += elapsed
+        _recent_latencies.append(elapsed)
+
+
+async def fetch_many_from_api(endpoints, concurrency: int = None, timeout: float = None, fetcher=None) -> dict:
+    """Fetches several endpoints concurrently, at most ``concurrency`` at a time.
+
+    Args:
+        endpoints: Iterable of endpoint paths (duplicates are fetched once).
+        concurrency: Max simultaneous requests (API_FETCH_CONCURRENCY by default).
+        timeout: Per-request timeout in seconds (API_TIMEOUT by default).
+        fetcher: Coroutine function used per endpoint (fetch_from_api by default,
+                 e.g. utils.api_cache.fetch_from_api_cached).
+
+    Returns:
+        {endpoint: result} for every endpoint, where result is what the fetcher
+        returned, "TIMEOUT", or None. One failure never fails the batch.
+    """
+    endpoints = list(dict.fromkeys(endpoints))
+    if not endpoints:
+        return {}
+    semaphore = asyncio.Semaphore(max(1, concurrency or API_FETCH_CONCURRENCY))
+    timeout = timeout or API_TIMEOUT
+    fetcher = fetcher or fetch_from_api
+
+    async def _one(endpoint):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(fetcher(endpoint), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"[API-ASYNC] Batch timeout: {endpoint} after {timeout}s")
+                return "TIMEOUT"
+            except Exception as e:
+                logger.exception(f"[API-ASYNC] Batch error: {endpoint}: {e}")
+                return None
+
+    started = time.monotonic()
+    results = await asyncio.gather(*[_one(ep) for ep in endpoints])
+    failed = sum(1 for r in results if r is None or r == "TIMEOUT")
+    logger.info(f"[API-ASYNC] Batch of {len(endpoints)} endpoints in {time.monotonic() - started:.2f}s ({failed} failed).")
+    return dict(zip(endpoints, results))
 
 
 def transform_api_question(api_question: dict) -> dict | None:
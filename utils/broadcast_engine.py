@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""Rate-aware broadcast engine with persistent per-recipient progress.
+
+admin_broadcast_confirm_callback used to send to every target serially
+(with asyncio.sleep(0.05)) inside the admin's callback: no handling of
+Telegram's 429 retry_after, nothing survived a restart, and the admin saw
+nothing until the end. Certificates and student notifications had the
+same loop.
+
+BROADCAST_ENGINE runs every bulk send:
+
+- start() stores the job and its recipients (broadcast_jobs /
+  broadcast_recipients) and returns immediately; the job runs as a
+  background task on the event loop.
+- A shared TokenBucket keeps all jobs together under BROADCAST_RATE
+  messages/s; BROADCAST_CONCURRENCY senders pull recipients from a queue.
+  Each send then goes through utils/rate_governor.py at PRIORITY_BULK, so
+  quiz traffic is served first and the per-chat limits hold.
+- RetryAfter pauses the whole bucket for retry_after and retries the same
+  recipient; network timeouts are retried up to BROADCAST_MAX_ATTEMPTS.
+- Forbidden (bot blocked, user deactivated) and "chat not found" end the
+  recipient as 'inactive' and set users.is_active = FALSE, so later
+  broadcasts skip them.
+- Results are saved in batches every BROADCAST_PERSIST_INTERVAL seconds
+  (and on shutdown); after a restart, resume() continues every unfinished
+  job with its pending recipients. Delivery is at-least-once: after a
+  crash, the last unsaved batch is sent again.
+- The admin's message is edited with live progress every
+  BROADCAST_PROGRESS_INTERVAL seconds, then replaced by the kind's summary.
+
+Each kind (broadcast, certificate, notification) registers how one
+recipient is sent and how the final summary looks (register_kind).
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import (
+        BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_MAX_ATTEMPTS,
+        BROADCAST_PERSIST_INTERVAL, BROADCAST_PROGRESS_INTERVAL, BROADCAST_RESUME_DELAY,
+    )
+except ImportError:
+    BROADCAST_RATE = 25
+    BROADCAST_CONCURRENCY = 8
+    BROADCAST_MAX_ATTEMPTS = 3
+    BROADCAST_PERSIST_INTERVAL = 2
+    BROADCAST_PROGRESS_INTERVAL = 3
+    BROADCAST_RESUME_DELAY = 10
+
+from database.async_manager import run_db
+from utils.rate_governor import GOVERNOR, PRIORITY_BULK, SKIPPED, TokenBucket, retry_after_seconds
+from database.manager import (
+    create_broadcast_job, finish_broadcast_job, get_pending_broadcast_recipients,
+    get_unfinished_broadcast_jobs, record_broadcast_results, set_broadcast_job_message,
+)
+
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+STATUS_INACTIVE = "inactive"
+
+_UNREACHABLE_ERRORS = ("chat not found", "user not found", "peer_id_invalid")
+
+
+class _BroadcastKind:
+    __slots__ = ("name", "send", "summarize", "messages_per_recipient")
+
+    def __init__(self, name, send, summarize, messages_per_recipient):
+        self.name = name
+        self.send = send                      # async send(bot, user_id, job_payload, recipient_payload)
+        self.summarize = summarize            # summarize(job, summary) -> (text, reply_markup)
+        self.messages_per_recipient = messages_per_recipient
+
+
+class BroadcastJob:
+    """Live state of one running job; the database holds the authoritative per-recipient status."""
+
+    def __init__(self, job_id: int, kind: str, payload: dict, total: int, admin_chat_id=None, progress_message_id=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.payload = payload or {}
+        self.total = total
+        self.admin_chat_id = admin_chat_id
+        self.progress_message_id = progress_message_id
+        self.already_done = 0      # recipients finished before this run (resume)
+        self.sent = 0
+        self.failed = 0
+        self.inactive = 0
+        self.retries = 0
+        self.started_at = time.monotonic()
+        self.finished = False
+        self._results = []         # (seq, status, attempts, error) not saved yet
+        self._inactive_users = []
+
+    @property
+    def done(self) -> int:
+        return self.already_done + self.sent + self.failed + self.inactive
+
+    def record(self, seq, user_id, status, attempts, error=None) -> None:
+        if status == STATUS_SENT:
+            self.sent += 1
+        elif status == STATUS_INACTIVE:
+            self.inactive += 1
+            self._inactive_users.append(user_id)
+        else:
+            self.failed += 1
+        self._results.append((seq, status, attempts, (error or "")[:200] or None))
+
+    def take_results(self) -> tuple:
+        results, inactive = self._results, self._inactive_users
+        self._results, self._inactive_users = [], []
+        return results, inactive
+
+    def progress_text(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        processed = self.sent + self.failed + self.inactive
+        remaining = self.total - self.done
+        eta = f"\n⏱️ المتبقي تقريباً: {int(remaining * elapsed / processed)} ث" if processed and remaining else ""
+        return (
+            f"📨 جاري الإرسال (مهمة #{self.job_id})...\n"
+            f"{self.done}/{self.total}\n"
+            f"✅ {self.sent + self.already_done}  ❌ {self.failed}  🚫 {self.inactive}"
+            f"{eta}"
+        )
+
+    def snapshot(self) -> tuple:
+        return (self.done, self.sent, self.failed, self.inactive)
+
+
+class BroadcastEngine:
+    """Runs bulk sends as background tasks sharing one rate limiter."""
+
+    def __init__(self, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, max_attempts=BROADCAST_MAX_ATTEMPTS):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._kinds = {}
+        self._jobs = {}            # job_id -> BroadcastJob (running)
+        self._tasks = set()
+
+    def register_kind(self, name: str, send, summarize, messages_per_recipient: int = 1) -> None:
+        self._kinds[name] = _BroadcastKind(name, send, summarize, messages_per_recipient)
+
+    def running_jobs(self) -> list:
+        return list(self._jobs.values())
+
+    async def start(self, bot, kind: str, recipients: list, payload: dict | None = None,
+                    admin_chat_id=None, progress_message_id=None, created_by=None) -> int | None:
+        """Saves the job and starts sending in the background. recipients: [(user_id, payload or None)]."""
+        if kind not in self._kinds:
+            raise ValueError(f"Unknown broadcast kind: {kind}")
+        job_id = await run_db(create_broadcast_job, kind, recipients, payload,
+                              admin_chat_id, progress_message_id, created_by)
+        if not job_id:
+            return None
+        job = BroadcastJob(job_id, kind, payload, len(recipients), admin_chat_id, progress_message_id)
+        pending = [(seq, user_id, item) for seq, (user_id, item) in enumerate(recipients)]
+        self._launch(bot, job, pending)
+        return job_id
+
+    async def resume(self, bot) -> int:
+        """Continues every job left unfinished by a restart. Returns the number of resumed jobs."""
+        jobs = await run_db(get_unfinished_broadcast_jobs, default=[]) or []
+        resumed = 0
+        for row in jobs:
+            if row["id"] in self._jobs:
+                continue
+            pending = await run_db(get_pending_broadcast_recipients, row["id"])
+            if pending is None:
+                continue
+            job = BroadcastJob(row["id"], row["kind"], row["payload"], row["total"], row["admin_chat_id"])
+            job.already_done = job.total - len(pending)
+            if row["kind"] not in self._kinds:
+                logger.error(f"[Broadcast] Job {job.job_id} has unknown kind {row['kind']}; marking it failed.")
+                await run_db(finish_broadcast_job, job.job_id, "failed")
+                continue
+            if job.admin_chat_id and pending:
+                try:
+                    message = await bot.send_message(
+                        chat_id=job.admin_chat_id,
+                        text=f"♻️ استئناف الإرسال (مهمة #{job.job_id}) بعد إعادة التشغيل: متبقي {len(pending)} من {job.total}",
+                    )
+                    job.progress_message_id = message.message_id
+                    await run_db(set_broadcast_job_message, job.job_id, job.admin_chat_id, message.message_id)
+                except Exception as e:
+                    logger.warning(f"[Broadcast] Could not notify admin about resuming job {job.job_id}: {e}")
+            logger.info(f"[Broadcast] Resuming job {job.job_id} ({job.kind}): {len(pending)}/{job.total} recipients left.")
+            self._launch(bot, job, [(seq, user_id, item) for seq, user_id, item in pending])
+            resumed += 1
+        return resumed
+
+    def _launch(self, bot, job: BroadcastJob, pending: list) -> None:
+        self._jobs[job.job_id] = job
+        task = asyncio.create_task(self._run(bot, job, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, bot, job: BroadcastJob, pending: list) -> None:
+        kind = self._kinds[job.kind]
+        queue = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+        monitor = asyncio.create_task(self._monitor(bot, job))
+        senders = [asyncio.create_task(self._sender(bot, job, kind, queue))
+                   for _ in range(min(self.concurrency, len(pending)))]
+        completed = False
+        try:
+            if senders:
+                await asyncio.gather(*senders)
+            completed = True
+        except Exception as e:
+            logger.error(f"[Broadcast] Job {job.job_id} stopped: {e}", exc_info=True)
+        finally:
+            for sender in senders:
+                sender.cancel()
+            job.finished = True
+            monitor.cancel()
+            await self._persist(job)
+            self._jobs.pop(job.job_id, None)
+        if not completed:
+            # المهمة تبقى غير منتهية في القاعدة: resume() يكمل المستلمين المتبقين بعد إعادة التشغيل
+            await self._edit_progress(bot, job, job.progress_text() + "\n\n⚠️ توقف الإرسال بسبب خطأ؛ سيُستأنف بعد إعادة التشغيل.")
+            return
+        summary = await run_db(finish_broadcast_job, job.job_id, "done")
+        elapsed = time.monotonic() - job.started_at
+        logger.info(f"[Broadcast] Job {job.job_id} ({job.kind}) done in {elapsed:.1f}s: "
+                    f"sent={job.sent} failed={job.failed} inactive={job.inactive} retries={job.retries}")
+        await self._report_summary(bot, job, kind, summary)
+
+    async def _sender(self, bot, job: BroadcastJob, kind: _BroadcastKind, queue: asyncio.Queue) -> None:
+        while True:
+            try:
+                seq, user_id, item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, attempts, error = await self._deliver(bot, job, kind, user_id, item)
+            job.record(seq, user_id, status, attempts, error)
+
+    async def _deliver(self, bot, job: BroadcastJob, kind: _BroadcastKind, user_id, item) -> tuple:
+        """Sends to one recipient. Returns (status, attempts, error)."""
+        attempts = 0
+        while True:
+            attempts += 1
+            await self.bucket.acquire(kind.messages_per_recipient)
+            try:
+                # retries=0: the flood limit is handled below by pausing every job
+                await GOVERNOR.run(user_id, lambda: kind.send(bot, user_id, job.payload, item or {}),
+                                   priority=PRIORITY_BULK, tokens=kind.messages_per_recipient, retries=0)
+                return STATUS_SENT, attempts, None
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"[Broadcast] Job {job.job_id}: flood limit, pausing all sends for {delay:.0f}s.")
+                self.bucket.pause(delay + 1)
+                job.retries += 1
+                attempts -= 1        # the limit is not the recipient's fault
+            except Forbidden as e:
+                return STATUS_INACTIVE, attempts, str(e)
+            except BadRequest as e:
+                if any(marker in str(e).lower() for marker in _UNREACHABLE_ERRORS):
+                    return STATUS_INACTIVE, attempts, str(e)
+                return STATUS_FAILED, attempts, str(e)
+            except (TimedOut, NetworkError) as e:
+                if attempts >= self.max_attempts:
+                    return STATUS_FAILED, attempts, str(e)
+                job.retries += 1
+                await asyncio.sleep(2 ** attempts)
+            except Exception as e:
+                return STATUS_FAILED, attempts, str(e)
+
+    async def _persist(self, job: BroadcastJob) -> None:
+        results, inactive = job.take_results()
+        if not results:
+            return
+        saved = await run_db(record_broadcast_results, job.job_id, results, inactive, default=False)
+        if not saved:
+            # تبقى في الذاكرة للمحاولة التالية؛ عند التوقف قبلها يُعاد إرسالها بعد الاستئناف
+            job._results[:0] = results
+            job._inactive_users[:0] = inactive
+
+    async def _monitor(self, bot, job: BroadcastJob) -> None:
+        last_progress = 0.0
+        last_snapshot = None
+        while not job.finished:
+            await asyncio.sleep(BROADCAST_PERSIST_INTERVAL)
+            await self._persist(job)
+            now = time.monotonic()
+            if now - last_progress >= BROADCAST_PROGRESS_INTERVAL and job.snapshot() != last_snapshot:
+                last_progress, last_snapshot = now, job.snapshot()
+                await self._edit_progress(bot, job, job.progress_text())
+
+    async def _edit_progress(self, bot, job: BroadcastJob, text: str, reply_markup=None) -> bool:
+        if not job.admin_chat_id or not job.progress_message_id:
+            return False
+        try:
+            result = await GOVERNOR.run(
+                job.admin_chat_id,
+                lambda: bot.edit_message_text(chat_id=job.admin_chat_id, message_id=job.progress_message_id,
+                                              text=text, reply_markup=reply_markup),
+                coalesce_key=(job.admin_chat_id, job.progress_message_id))
+            return result is not SKIPPED
+        except BadRequest as e:
+            return "not modified" in str(e).lower()
+        except Exception as e:
+            logger.warning(f"[Broadcast] Progress update for job {job.job_id} failed: {e}")
+            return False
+
+    async def _report_summary(self, bot, job: BroadcastJob, kind: _BroadcastKind, summary) -> None:
+        if not job.admin_chat_id:
+            return
+        if summary is None:
+            summary = {"counts": {STATUS_SENT: job.sent + job.already_done, STATUS_FAILED: job.failed,
+                                  STATUS_INACTIVE: job.inactive}, "failures": []}
+        try:
+            text, reply_markup = kind.summarize(job, summary)
+        except Exception as e:
+            logger.error(f"[Broadcast] Summary of job {job.job_id} failed: {e}", exc_info=True)
+            return
+        if not await self._edit_progress(bot, job, text, reply_markup):
+            try:
+                await bot.send_message(chat_id=job.admin_chat_id, text=text, reply_markup=reply_markup)
+            except Exception as e:
+                logger.error(f"[Broadcast] Could not send summary of job {job.job_id}: {e}")
+
+    def persist_now(self) -> int:
+        """Blocking save of every running job's unsaved results (post_shutdown). Returns the rows saved."""
+        saved = 0
+        for job in list(self._jobs.values()):
+            results, inactive = job.take_results()
+            if results and record_broadcast_results(job.job_id, results, inactive):
+                saved += len(results)
+        return saved
+
+    def stats(self) -> dict:
+        return {
+            "running_jobs": len(self._jobs),
+            "jobs": {job_id: {"kind": job.kind, "done": job.done, "total": job.total, "retries": job.retries}
+                     for job_id, job in self._jobs.items()},
+        }
+
+
+BROADCAST_ENGINE = BroadcastEngine()
+
+
+async def resume_broadcasts_job(context) -> None:
+    resumed = await BROADCAST_ENGINE.resume(context.bot)
+    if resumed:
+        logger.info(f"[Broadcast] Resumed {resumed} unfinished job(s).")
+
+
+def schedule_broadcast_resume(application) -> None:
+    """Resumes broadcasts interrupted by the last shutdown, shortly after startup."""
+    if application.job_queue:
+        application.job_queue.run_once(resume_broadcasts_job, when=BROADCAST_RESUME_DELAY, name="broadcast_resume")
+    else:
+        logger.warning("[Broadcast] No JobQueue; unfinished broadcasts will not be resumed.")
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Latency of concurrent "my stats" chart requests: inline rendering vs the chart process pool.
+
+Each simulated request draws the three charts of show_my_stats. "inline" is
+the old path (pyplot-style rendering on the event loop, PNG written to
+user_data/charts and read back); "pool" awaits utils.chart_service. A
+heartbeat task measures how long the event loop was blocked, i.e. how long
+every other chat would have waited.
+
+Usage:
+    python -m utils.chart_benchmark [requests=50]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from utils.chart_service import render_chart, render_chart_sync, CHART_SERVICE
+
+HEARTBEAT_INTERVAL = 0.01
+
+
+def _sample_request(user_id: int) -> list:
+    scores = [round(random.uniform(20, 100), 1) for _ in range(10)]
+    correct = random.randint(10, 200)
+    return [
+        ("user_correct_incorrect", {"user_id": user_id, "correct": correct, "incorrect": random.randint(0, 100)}),
+        ("user_grades_distribution", {"user_id": user_id, "scores": scores}),
+        ("user_performance_trend", {"user_id": user_id, "scores": scores}),
+    ]
+
+
+async def _inline_request(charts: list, charts_dir: str) -> None:
+    for index, (name, data) in enumerate(charts):
+        png = render_chart_sync(name, data)
+        path = os.path.join(charts_dir, "{}_{}.png".format(data["user_id"], index))
+        with open(path, "wb") as f:
+            f.write(png)
+        with open(path, "rb") as f:
+            f.read()
+        os.remove(path)
+
+
+async def _pool_request(charts: list, charts_dir: str) -> None:
+    await asyncio.gather(*(render_chart(name, **data) for name, data in charts))
+
+
+async def _heartbeat(stop: asyncio.Event, lags: list) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + HEARTBEAT_INTERVAL
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def run_scenario(mode: str, requests: int) -> dict:
+    handler = _inline_request if mode == "inline" else _pool_request
+    payloads = [_sample_request(user_id) for user_id in range(1, requests + 1)]
+    latencies, lags = [], []
+    stop = asyncio.Event()
+
+    # All requests arrive together; latency is arrival -> last chart ready
+    async def timed(charts, charts_dir, arrived):
+        await handler(charts, charts_dir)
+        latencies.append(time.perf_counter() - arrived)
+
+    with tempfile.TemporaryDirectory() as charts_dir:
+        heartbeat = asyncio.create_task(_heartbeat(stop, lags))
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(timed(charts, charts_dir, wall_started) for charts in payloads))
+        wall = time.perf_counter() - wall_started
+        stop.set()
+        await heartbeat
+
+    ordered = sorted(latencies)
+    return {
+        "mode": mode,
+        "requests": requests,
+        "wall_s": wall,
+        "p50_s": statistics.median(ordered),
+        "p95_s": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max_s": ordered[-1],
+        "max_loop_block_s": max(lags) if lags else 0.0,
+    }
+
+
+def format_results(results: list) -> str:
+    lines = ["{:<8}{:>10}{:>10}{:>10}{:>10}{:>18}".format("mode", "wall", "p50", "p95", "max", "max loop block")]
+    for r in results:
+        lines.append("{:<8}{:>9.2f}s{:>9.2f}s{:>9.2f}s{:>9.2f}s{:>17.3f}s".format(
+            r["mode"], r["wall_s"], r["p50_s"], r["p95_s"], r["max_s"], r["max_loop_block_s"]))
+    return "\n".join(lines)
+
+
+async def main(requests: int) -> None:
+    await CHART_SERVICE.warm_up()
+    try:
+        results = [await run_scenario("inline", requests), await run_scenario("pool", requests)]
+    finally:
+        CHART_SERVICE.shutdown()
+    print("{} concurrent 'my stats' requests (3 charts each), {} render workers".format(requests, CHART_SERVICE.workers))
+    print(format_results(results))
+
+
+if __name__ == "__main__":
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
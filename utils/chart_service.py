@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+"""Chart rendering off the event loop.
+
+Stats charts used to be drawn with pyplot inside the async handlers and
+written to user_data/charts before being read back for send_photo; every
+chart blocked all chats for a few hundred milliseconds of CPU. Charts are
+now rendered by name in a small process pool:
+
+    png = await render_chart("user_correct_incorrect", user_id=1, correct=7, incorrect=3)
+    if png:
+        await bot.send_photo(chat_id, photo=png)
+
+- Workers come from a "forkserver" context (never forked from the threaded
+  bot process; importing the bot's modules there opens no connections), set up the Arabic-capable font once (initializer) and keep one
+  Agg Figure per template size, cleared and reused for every render.
+- PNGs are written to an in-memory buffer and returned as bytes.
+- Drawing functions receive raw Arabic text and shape it (reshaper + bidi)
+  themselves, so callers pass plain data.
+- If the pool breaks, rendering falls back to a thread in this process.
+
+Handlers use get_chart(), which addresses charts by a hash of their inputs
+(ChartCache, LRU with entry and byte caps). After the first upload only the
+Telegram file_id is kept, so re-opening unchanged stats neither renders nor
+uploads again:
+
+    chart = await get_chart("user_correct_incorrect", user_id=1, correct=7, incorrect=3)
+    if chart:
+        await send_chart_photo(bot, chat_id, chart)
+
+Run ``python -m utils.chart_benchmark`` for the 50-concurrent-requests benchmark.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import CHART_RENDER_WORKERS, CHART_RENDER_TIMEOUT, CHART_CACHE_MAX_ENTRIES, CHART_CACHE_MAX_BYTES
+except ImportError:
+    CHART_RENDER_WORKERS = 2
+    CHART_RENDER_TIMEOUT = 20
+    CHART_CACHE_MAX_ENTRIES = 2000
+    CHART_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import font_manager
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+
+# Preferred fonts with Arabic glyphs; the first installed one is used, DejaVu Sans as last resort
+_ARABIC_FONT_CANDIDATES = ["Noto Naskh Arabic", "Noto Sans Arabic", "Amiri", "Arial", "DejaVu Sans"]
+
+# Figure templates: one reusable Figure per size in every worker
+TEMPLATE_SQUARE = (8, 6)
+TEMPLATE_WIDE = (10, 7)
+TEMPLATE_TREND = (10, 6)
+TEMPLATE_LARGE = (12, 8)
+
+
+# --- worker-side setup (runs in the forkserver workers; keep it to matplotlib) ---
+
+_worker_figures = {}   # figsize -> Figure (only reused inside pool workers)
+_fonts_configured = False
+
+
+def _configure_fonts():
+    global _fonts_configured
+    if _fonts_configured:
+        return
+    families = []
+    for name in _ARABIC_FONT_CANDIDATES:
+        try:
+            font_manager.findfont(font_manager.FontProperties(family=name), fallback_to_default=False)
+            families.append(name)
+        except Exception:
+            continue
+    matplotlib.rcParams["font.family"] = families or ["DejaVu Sans"]
+    matplotlib.rcParams["axes.unicode_minus"] = False
+    _fonts_configured = True
+
+
+def _init_worker():
+    _configure_fonts()
+
+
+def shape_arabic(text) -> str:
+    """Reshapes and reorders Arabic text for Matplotlib (no-op for non-Arabic text)."""
+    text_str = "" if text is None else str(text)
+    if not any(
+        "\u0600" <= ch <= "\u06FF" or "\u0750" <= ch <= "\u077F" or "\u08A0" <= ch <= "\u08FF"
+        or "\uFB50" <= ch <= "\uFDFF" or "\uFE70" <= ch <= "\uFEFF"
+        for ch in text_str
+    ):
+        return text_str
+    try:
+        return get_display(arabic_reshaper.reshape(text_str))
+    except Exception:
+        return text_str
+
+
+_ar = shape_arabic
+
+TIME_FILTERS_DISPLAY_RAW = {
+    "today": "اليوم",
+    "last_7_days": "آخر 7 أيام",
+    "last_30_days": "آخر 30 يومًا",
+    "all_time": "كل الوقت"
+}
+
+
+def _filter_title(base, time_filter):
+    return f"{_ar(base)} ({_ar(TIME_FILTERS_DISPLAY_RAW.get(time_filter, time_filter))})"
+
+
+# --- drawing functions: draw on ax, return False when there is nothing to plot ---
+
+def _draw_user_correct_incorrect(ax, user_id, correct, incorrect):
+    if correct == 0 and incorrect == 0:
+        return False
+    counts = [correct, incorrect]
+    bars = ax.bar([_ar("إجابات صحيحة"), _ar("إجابات خاطئة")], counts, color=["#4CAF50", "#F44336"])
+    ax.set_ylabel(_ar("العدد"))
+    ax.set_title(_ar("مقارنة الإجابات للمستخدم {}".format(user_id)), pad=20)
+    ax.tick_params(axis="x", labelsize=12)
+    ax.tick_params(axis="y", labelsize=12)
+    for bar in bars:
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 0.05 * max(counts) if max(counts) > 0 else 0.5, int(yval), ha="center", va="bottom", fontsize=11)
+    return True
+
+
+_GRADE_BANDS = ["ممتاز (90+)", "جيد جداً (80-89)", "جيد (70-79)", "مقبول (60-69)", "يحتاج تحسين (<60)"]
+
+
+def _draw_user_grades_distribution(ax, user_id, scores):
+    grades = dict.fromkeys(_GRADE_BANDS, 0)
+    for score in scores:
+        if score is None:
+            continue
+        if score >= 90: grades["ممتاز (90+)"] += 1
+        elif score >= 80: grades["جيد جداً (80-89)"] += 1
+        elif score >= 70: grades["جيد (70-79)"] += 1
+        elif score >= 60: grades["مقبول (60-69)"] += 1
+        else: grades["يحتاج تحسين (<60)"] += 1
+    if all(v == 0 for v in grades.values()):
+        return False
+    categories = [_ar(k) for k in grades]
+    counts = list(grades.values())
+    colors = ["#4CAF50", "#8BC34A", "#CDDC39", "#FFEB3B", "#FFC107", "#F44336"][::-1]
+    bars = ax.barh(categories, counts, color=colors[:len(categories)])
+    ax.set_xlabel(_ar("عدد الاختبارات"))
+    ax.set_title(_ar("توزيع تقديرات الاختبارات للمستخدم {}".format(user_id)), pad=20)
+    ax.tick_params(axis="x", labelsize=12)
+    ax.tick_params(axis="y", labelsize=12)
+    for i, bar in enumerate(bars):
+        xval = bar.get_width()
+        ax.text(xval + 0.02 * max(counts) if max(counts) > 0 else 0.2, i, int(xval), ha="left", va="center", fontsize=11)
+    return True
+
+
+def _draw_user_performance_trend(ax, user_id, scores):
+    scores = [s for s in scores if s is not None]
+    if len(scores) < 2:
+        return False
+    test_numbers = list(range(1, len(scores) + 1))
+    ax.plot(test_numbers, scores, marker="o", linestyle="-", color="#007BFF", linewidth=2, markersize=8)
+    ax.set_xlabel(_ar("رقم الاختبار (الأحدث على اليمين)"))
+    ax.set_ylabel(_ar("النتيجة (%)"))
+    ax.set_title(_ar("تطور الأداء للمستخدم {} (آخر {} اختبارات صالحة)".format(user_id, len(scores))), pad=20)
+    ax.grid(True, linestyle="--", alpha=0.7)
+    ax.tick_params(axis="both", labelsize=12)
+    ax.set_ylim(0, 105)
+    ax.set_xticks(test_numbers)
+    for i, score_val in enumerate(scores):
+        ax.text(test_numbers[i], score_val + 2, "{:.1f}%".format(score_val), ha="center", fontsize=10)
+    return True
+
+
+def _draw_admin_usage_overview(ax, active_users, total_quizzes, time_filter):
+    if active_users == 0 and total_quizzes == 0:
+        return False
+    counts = [active_users, total_quizzes]
+    bars = ax.bar([_ar("المستخدمون النشطون"), _ar("الاختبارات المجراة")], counts, color=["#1f77b4", "#ff7f0e"], width=0.5)
+    ax.set_ylabel(_ar("العدد"))
+    ax.set_title(_filter_title("نظرة عامة على الاستخدام", time_filter), pad=20)
+    ax.tick_params(axis="x", labelsize=12)
+    ax.tick_params(axis="y", labelsize=12)
+    for bar in bars:
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 0.02 * max(counts) if max(counts) > 0 else 0.5,
+                str(int(yval)), ha="center", va="bottom", fontsize=11)
+    return True
+
+
+def _draw_admin_quiz_performance(ax, score_distribution, time_filter):
+    if not score_distribution or not any(score_distribution.values()):
+        return False
+    labels = [_ar(label) for label in score_distribution.keys()]
+    values = list(score_distribution.values())
+    bars = ax.bar(labels, values, color="#2ca02c", width=0.6)
+    ax.set_ylabel(_ar("عدد المستخدمين"))
+    ax.set_xlabel(_ar("نطاق الدرجات"))
+    ax.set_title(_filter_title("توزيع درجات الاختبارات", time_filter), pad=20)
+    ax.tick_params(axis="x", labelsize=10, rotation=45)
+    ax.tick_params(axis="y", labelsize=10)
+    for bar in bars:
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 0.02 * max(values) if max(values) > 0 else 0.5,
+                str(int(yval)), ha="center", va="bottom", fontsize=9)
+    return True
+
+
+def _draw_admin_user_interaction(ax, interaction_data, time_filter):
+    if not interaction_data:
+        return False
+    labels = [_ar(label) for label in interaction_data.keys()]
+    values = []
+    for value in interaction_data.values():
+        try:
+            values.append(float(value))
+        except (ValueError, TypeError):
+            values.append(0.0)
+    bars = ax.bar(labels, values, color=["#ff7f0e", "#d62728"], width=0.5)
+    ax.set_ylabel(_ar("النسبة المئوية (%)"))
+    ax.set_title(_filter_title("معدلات إكمال الاختبارات", time_filter), pad=20)
+    ax.tick_params(axis="x", labelsize=12)
+    ax.tick_params(axis="y", labelsize=10)
+    ax.set_ylim(0, 100)
+    for bar in bars:
+        yval = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 2, "{:.1f}%".format(yval), ha="center", va="bottom", fontsize=10)
+    return True
+
+
+def _short_question_label(question_text):
+    text = str(question_text if question_text is not None else "سؤال غير معروف")
+    return _ar(text[:30] + "..." if len(text) > 30 else text)
+
+
+def _draw_admin_question_correctness(ax, questions, time_filter):
+    if not questions:
+        return False
+    labels = [_short_question_label(q.get("question_text")) for q in questions]
+    percentages = [q.get("correct_percentage", 0.0) for q in questions]
+    bars = ax.barh(labels, percentages, color="#9467bd")
+    ax.set_xlabel(_ar("نسبة الإجابة الصحيحة (%)"))
+    ax.set_title(_filter_title("نسبة الإجابات الصحيحة للأسئلة", time_filter), pad=20)
+    ax.set_xlim(0, 100)
+    for i, bar in enumerate(bars):
+        ax.text(bar.get_width() + 1, bar.get_y() + bar.get_height()/2.0, f"{percentages[i]:.1f}%", va="center", ha="left", fontsize=9)
+    return True
+
+
+def _draw_admin_question_avg_time(ax, questions, time_filter):
+    avg_times = [q.get("avg_time_seconds", 0.0) or 0.0 for q in questions or []]
+    if not any(t > 0 for t in avg_times):
+        return False
+    labels = [_short_question_label(q.get("question_text")) for q in questions]
+    bars = ax.barh(labels, avg_times, color="#8c564b")
+    ax.set_xlabel(_ar("متوسط الوقت المستغرق (ثواني)"))
+    ax.set_title(_filter_title("متوسط الوقت المستغرق لكل سؤال", time_filter), pad=20)
+    for i, bar in enumerate(bars):
+        ax.text(bar.get_width() + 0.5, bar.get_y() + bar.get_height()/2.0, _ar(f"{avg_times[i]:.1f} ث"), va="center", ha="left", fontsize=9)
+    return True
+
+
+# chart name -> (figure template, drawing function)
+CHARTS = {
+    "user_correct_incorrect": (TEMPLATE_SQUARE, _draw_user_correct_incorrect),
+    "user_grades_distribution": (TEMPLATE_WIDE, _draw_user_grades_distribution),
+    "user_performance_trend": (TEMPLATE_TREND, _draw_user_performance_trend),
+    "admin_usage_overview": (TEMPLATE_SQUARE, _draw_admin_usage_overview),
+    "admin_quiz_performance": (TEMPLATE_WIDE, _draw_admin_quiz_performance),
+    "admin_user_interaction": (TEMPLATE_SQUARE, _draw_admin_user_interaction),
+    "admin_question_correctness": (TEMPLATE_LARGE, _draw_admin_question_correctness),
+    "admin_question_avg_time": (TEMPLATE_LARGE, _draw_admin_question_avg_time),
+}
+
+
+def render_chart_sync(chart_name: str, data: dict, reuse_figure: bool = False) -> bytes | None:
+    """Renders one chart to PNG bytes in the calling process. None if there is nothing to plot.
+
+    reuse_figure keeps one Figure per template size; only safe in a single-threaded worker.
+    """
+    _configure_fonts()
+    template, draw = CHARTS[chart_name]
+    if reuse_figure:
+        fig = _worker_figures.get(template)
+        if fig is None:
+            fig = _worker_figures[template] = Figure(figsize=template)
+            FigureCanvasAgg(fig)
+        fig.clf()
+    else:
+        fig = Figure(figsize=template)
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if not draw(ax, **data):
+        return None
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    if reuse_figure:
+        fig.clf()
+    return buffer.getvalue()
+
+
+def _render_in_worker(chart_name, data):
+    return render_chart_sync(chart_name, data, reuse_figure=True)
+
+
+# --- parent-side service ---
+
+class ChartRenderService:
+    """Process pool rendering named charts to PNG bytes."""
+
+    def __init__(self, workers=CHART_RENDER_WORKERS, timeout=CHART_RENDER_TIMEOUT):
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self._pool = None
+        self._stats = {"renders": 0, "empty": 0, "errors": 0, "timeouts": 0, "fallbacks": 0, "total_seconds": 0.0}
+
+    def _get_pool(self):
+        if self._pool is None:
+            # forkserver: workers are forked from a clean single-threaded server that only loaded this
+            # module (and matplotlib), never from the bot process with its event loop and DB threads.
+            # multiprocessing still re-imports the bot's main script in each worker (as __mp_main__);
+            # that import has no side effects (schema setup runs in post_init, pools open lazily).
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+            )
+            logger.info(f"[Charts] Started chart render pool with {self.workers} workers.")
+        return self._pool
+
+    async def warm_up(self):
+        """Starts the workers and renders one chart so fonts are resolved before the first request."""
+        await self.render("user_correct_incorrect", user_id=0, correct=1, incorrect=1)
+
+    async def render(self, chart_name: str, **data) -> bytes | None:
+        """PNG bytes for chart_name, or None if there is nothing to plot or rendering failed."""
+        if chart_name not in CHARTS:
+            logger.error(f"[Charts] Unknown chart {chart_name}.")
+            return None
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            try:
+                future = loop.run_in_executor(self._get_pool(), _render_in_worker, chart_name, data)
+                png = await asyncio.wait_for(future, timeout=self.timeout)
+            except BrokenProcessPool:
+                logger.error("[Charts] Render pool broken; restarting it and rendering this chart in a thread.")
+                self._stats["fallbacks"] += 1
+                self.shutdown(wait=False)
+                png = await asyncio.wait_for(loop.run_in_executor(None, render_chart_sync, chart_name, data), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            logger.error(f"[Charts] Rendering {chart_name} timed out after {self.timeout}s.")
+            return None
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"[Charts] Rendering {chart_name} failed: {e}", exc_info=True)
+            return None
+        finally:
+            self._stats["total_seconds"] += time.monotonic() - started
+        self._stats["renders"] += 1
+        if png is None:
+            self._stats["empty"] += 1
+        return png
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
+            logger.info("[Charts] Chart render pool shut down.")
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        renders = stats["renders"]
+        stats["avg_ms"] = round(stats.pop("total_seconds") / renders * 1000, 1) if renders else 0.0
+        stats["workers"] = self.workers
+        return stats
+
+
+class Chart:
+    """A rendered chart: PNG bytes until Telegram has stored it, then its file_id."""
+
+    __slots__ = ("key", "png", "file_id", "source")
+
+    def __init__(self, key: str, png: bytes | None = None, file_id: str | None = None, source: tuple | None = None):
+        self.key = key
+        self.png = png
+        self.file_id = file_id
+        self.source = source  # (chart_name, data), to render again if a file_id is rejected
+
+    @property
+    def photo(self):
+        """Value for send_photo / InputMediaPhoto: the cached file_id if known, else the PNG bytes."""
+        return self.file_id or self.png
+
+    @property
+    def size(self) -> int:
+        return len(self.png or b"") + len(self.file_id or "")
+
+
+def chart_key(chart_name: str, data: dict) -> str:
+    """Content address of a chart: hash of its name and every input it is drawn from."""
+    payload = json.dumps([chart_name, data], sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ChartCache:
+    """LRU of rendered charts keyed by chart_key, capped by entry count and bytes.
+
+    Once a chart has been uploaded its PNG is dropped and only the Telegram
+    file_id is kept, so repeat views cost neither rendering nor upload.
+    """
+
+    def __init__(self, max_entries=CHART_CACHE_MAX_ENTRIES, max_bytes=CHART_CACHE_MAX_BYTES):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()   # key -> Chart
+        self._bytes = 0
+        self._inflight = {}             # key -> asyncio.Future of a render in progress
+        self._stats = {"hits": 0, "file_id_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: str) -> Chart | None:
+        chart = self._entries.get(key)
+        if chart is not None:
+            self._entries.move_to_end(key)
+        return chart
+
+    def put(self, chart: Chart) -> None:
+        old = self._entries.pop(chart.key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[chart.key] = chart
+        self._bytes += chart.size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self._stats["evictions"] += 1
+
+    def set_file_id(self, key: str, file_id: str) -> None:
+        chart = self._entries.get(key)
+        if chart is None or not file_id:
+            return
+        self._bytes -= chart.size
+        chart.file_id, chart.png = file_id, None
+        self._bytes += chart.size
+
+    def forget_file_id(self, key: str) -> None:
+        """Drops the entry so the next get_or_render uploads fresh PNG bytes."""
+        chart = self._entries.pop(key, None)
+        if chart is not None:
+            self._bytes -= chart.size
+
+    async def get_or_render(self, service, chart_name: str, data: dict) -> Chart | None:
+        key = chart_key(chart_name, data)
+        chart = self.get(key)
+        if chart is not None:
+            self._stats["file_id_hits" if chart.file_id else "hits"] += 1
+            return chart
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Same chart already being rendered (e.g. a double tap): share that render
+            self._stats["hits"] += 1
+            return await asyncio.shield(inflight)
+        self._stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        chart = None
+        try:
+            png = await service.render(chart_name, **data)
+            if png is not None:
+                chart = Chart(key, png=png, source=(chart_name, data))
+                self.put(chart)
+        finally:
+            self._inflight.pop(key, None)
+            future.set_result(chart)
+        return chart
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats.update(entries=len(self._entries), bytes=self._bytes)
+        return stats
+
+
+CHART_SERVICE = ChartRenderService()
+CHART_CACHE = ChartCache()
+
+async def render_chart(chart_name: str, **data) -> bytes | None:
+    return await CHART_SERVICE.render(chart_name, **data)
+
+async def init_chart_service() -> None:
+    await CHART_SERVICE.warm_up()
+
+def shutdown_chart_service(wait=True) -> None:
+    CHART_SERVICE.shutdown(wait=wait)
+
+def get_chart_stats() -> dict:
+    stats = CHART_SERVICE.stats()
+    stats["cache"] = CHART_CACHE.stats()
+    return stats
+
+async def get_chart(chart_name: str, **data) -> Chart | None:
+    """Cached chart for these inputs, rendering it on first use. None if there is nothing to plot."""
+    return await CHART_CACHE.get_or_render(CHART_SERVICE, chart_name, data)
+
+def remember_uploaded_chart(chart: Chart, message) -> None:
+    """Stores the file_id Telegram assigned to chart from the Message returned by send_photo/send_media_group."""
+    try:
+        if chart is not None and message is not None and message.photo:
+            CHART_CACHE.set_file_id(chart.key, message.photo[-1].file_id)
+    except Exception as e:
+        logger.debug(f"[Charts] Could not read file_id of uploaded chart: {e}")
+
+async def send_chart_photo(bot, chat_id, chart: Chart, **kwargs):
+    """send_photo for a cached chart; renders and uploads again if Telegram rejects a stale file_id."""
+    if chart.file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=chart.file_id, **kwargs)
+        except Exception as e:
+            logger.warning(f"[Charts] Cached file_id rejected ({e}); rendering chart again.")
+            CHART_CACHE.forget_file_id(chart.key)
+            if not chart.source:
+                raise
+            chart = await get_chart(chart.source[0], **chart.source[1])
+            if chart is None:
+                return None
+    message = await bot.send_photo(chat_id=chat_id, photo=chart.png, **kwargs)
+    remember_uploaded_chart(chart, message)
+    return message
+
+async def send_chart_media_group(bot, chat_id, charts: list, caption: str | None = None):
+    """send_media_group for cached charts (caption on the first one); same file_id handling as send_chart_photo."""
+    from telegram import InputMediaPhoto
+
+    def build_media(items):
+        return [InputMediaPhoto(media=chart.photo, caption=caption if i == 0 else None) for i, chart in enumerate(items)]
+
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(charts))
+    except Exception as e:
+        if not any(chart.file_id for chart in charts) or not all(chart.source for chart in charts):
+            raise
+        logger.warning(f"[Charts] Cached file_id rejected in media group ({e}); rendering charts again.")
+        for chart in charts:
+            CHART_CACHE.forget_file_id(chart.key)
+        charts = [c for c in await asyncio.gather(*(get_chart(c.source[0], **c.source[1]) for c in charts)) if c]
+        if not charts:
+            return []
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(charts))
+    for chart, message in zip(charts, messages or []):
+        if not chart.file_id:
+            remember_uploaded_chart(chart, message)
+    return messages
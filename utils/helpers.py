@@ -1,5 +1,6 @@
 """Utility functions for the Chemistry Telegram Bot."""
 
+import asyncio
 import logging
 import re
 import telegram
@@ -7,16 +8,22 @@ from telegram import Update, InlineKeyboardMarkup, Bot
 from telegram.ext import CallbackContext
 
 from config import logger
+from utils.rate_governor import GOVERNOR, PRIORITY_INTERACTIVE, SKIPPED
 
-async def safe_send_message(bot: Bot, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None):
+# الرسائل والتعديلات تمر عبر GOVERNOR (utils/rate_governor.py): حدود تيليجرام العامة ولكل محادثة،
+# أولوية التفاعل على العد التنازلي والبث، ودمج التعديلات المتتالية لنفس الرسالة
+
+async def safe_send_message(bot: Bot, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None,
+                            priority: int = PRIORITY_INTERACTIVE):
     """Safely send a message, handling potential Telegram errors."""
     try:
-        return await bot.send_message(
+        message = await GOVERNOR.run(chat_id, lambda: bot.send_message(
             chat_id=chat_id,
             text=text,
             reply_markup=reply_markup,
             parse_mode=parse_mode
-        )
+        ), priority=priority)
+        return None if message is SKIPPED else message
     except telegram.error.BadRequest as e:
         logger.error(f"BadRequest sending message to {chat_id}: {e}")
     except telegram.error.TelegramError as e:
@@ -31,7 +38,8 @@ async def safe_edit_message_text(
     message_id: int,
     text: str,
     reply_markup: InlineKeyboardMarkup = None,
-    parse_mode: str = "HTML"
+    parse_mode: str = "HTML",
+    priority: int = PRIORITY_INTERACTIVE
 ) -> bool | str:
     """Safely edits a message text, handling potential errors.
     Returns True if successful.
@@ -39,13 +47,16 @@ async def safe_edit_message_text(
     Returns False for other errors.
     """
     try:
-        await bot.edit_message_text(
+        result = await GOVERNOR.run(chat_id, lambda: bot.edit_message_text(
             text=text,
             chat_id=chat_id,
             message_id=message_id,
             reply_markup=reply_markup,
             parse_mode=parse_mode
-        )
+        ), priority=priority, coalesce_key=(chat_id, message_id))
+        if result is SKIPPED:
+            logger.debug(f"Edit of message {message_id} in chat {chat_id} dropped (superseded or expired).")
+            return False
         logger.debug(f"Message {message_id} in chat {chat_id} edited successfully.")
         return True
     except telegram.error.BadRequest as e:
@@ -68,19 +79,23 @@ async def safe_edit_message_text(
         logger.error(f"Unexpected error editing message {message_id} in chat {chat_id}: {e}", exc_info=True)
         return False
 
-async def safe_edit_message_caption(bot: Bot, chat_id: int, message_id: int, caption: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None):
+async def safe_edit_message_caption(bot: Bot, chat_id: int, message_id: int, caption: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None,
+                                    priority: int = PRIORITY_INTERACTIVE):
     """
     Safely edits the caption of a message.
     Returns True if successful, False otherwise.
     """
     try:
-        await bot.edit_message_caption(
+        result = await GOVERNOR.run(chat_id, lambda: bot.edit_message_caption(
             chat_id=chat_id,
             message_id=message_id,
             caption=caption,
             reply_markup=reply_markup,
             parse_mode=parse_mode
-        )
+        ), priority=priority, coalesce_key=(chat_id, message_id))
+        if result is SKIPPED:
+            logger.debug(f"Caption edit of message {message_id} in chat {chat_id} dropped (superseded or expired).")
+            return False
         logger.debug(f"Caption of message {message_id} in chat {chat_id} edited successfully.")
         return True
     except telegram.error.BadRequest as e:
@@ -159,6 +174,29 @@ async def safe_delete_message(bot: Bot, chat_id: int, message_id: int) -> bool:
         logger.exception(f"Unexpected error deleting message {message_id} in chat {chat_id}: {e}")
     return False
 
+async def safe_delete_messages(bot: Bot, chat_id: int, message_ids: list) -> bool:
+    """Deletes several messages of one chat in one request (deleteMessages, up to 100 per call).
+
+    Messages that are already gone are skipped by Telegram. Falls back to
+    concurrent delete_message calls on library versions without delete_messages.
+    """
+    message_ids = [m_id for m_id in dict.fromkeys(message_ids or []) if m_id]
+    if not message_ids:
+        return True
+    try:
+        if hasattr(bot, "delete_messages"):
+            for start in range(0, len(message_ids), 100):
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids[start:start + 100])
+        else:
+            await asyncio.gather(*(bot.delete_message(chat_id=chat_id, message_id=m_id) for m_id in message_ids),
+                                 return_exceptions=True)
+        return True
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Failed to delete messages {message_ids} in chat {chat_id}: {e}")
+    except Exception as e:
+        logger.exception(f"Unexpected error deleting messages {message_ids} in chat {chat_id}: {e}")
+    return False
+
 def get_quiz_type_string(type_display_name: str) -> str:
     """Returns the quiz type display string, possibly with minor formatting."""
     if not type_display_name:
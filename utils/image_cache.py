@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""Telegram file_id cache for question and option images.
+
+QuizLogic.send_question passed the raw image URL to send_photo for the
+question and for every image option, so each send made Telegram download
+the image from the question bank again, and a slow or unreachable image
+host delayed (or failed) the question.
+
+IMAGE_CACHE maps image URL -> Telegram file_id (plus the sha256 of the
+image when it was downloaded by the prewarm job):
+
+- send_cached_photo() sends the cached file_id; on a miss it sends the URL
+  once and keeps the file_id of the resulting photo. A file_id Telegram
+  rejects (BadRequest) is forgotten and the URL is sent instead.
+  send_cached_media_group() does the same for an album of option images.
+- The map lives in telegram_image_cache and is loaded at startup; writes go
+  through the write-behind queue (channel image_file_id).
+- The prewarm job (IMAGE_STORAGE_CHAT_ID) walks every image URL of the
+  question catalogue, downloads the uncached ones through the shared API
+  session and uploads them to the storage chat in media groups of
+  IMAGE_PREWARM_BATCH, IMAGE_PREWARM_PAUSE seconds apart, so students get
+  file_ids from their first question on. An image whose content hash is
+  already known (same picture under another URL) reuses that file_id
+  without uploading. After IMAGE_REVALIDATE_AFTER seconds an image is
+  downloaded again and uploaded anew only if its hash changed, so a
+  picture replaced under the same URL is picked up.
+
+Without a storage chat the cache still fills from live sends.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import (
+        IMAGE_STORAGE_CHAT_ID, IMAGE_PREWARM_START_DELAY, IMAGE_PREWARM_INTERVAL, IMAGE_PREWARM_BATCH,
+        IMAGE_PREWARM_PAUSE, IMAGE_DOWNLOAD_CONCURRENCY, IMAGE_REVALIDATE_AFTER,
+    )
+except ImportError:
+    IMAGE_STORAGE_CHAT_ID = None
+    IMAGE_PREWARM_START_DELAY = 120
+    IMAGE_PREWARM_INTERVAL = 3600
+    IMAGE_PREWARM_BATCH = 10
+    IMAGE_PREWARM_PAUSE = 3
+    IMAGE_DOWNLOAD_CONCURRENCY = 5
+    IMAGE_REVALIDATE_AFTER = 7 * 86400
+
+from database.async_manager import run_db
+from database.manager import get_telegram_image_cache
+from database.write_behind import store_image_file_id
+from utils.rate_governor import retry_after_seconds
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+MAX_PHOTO_BYTES = 10 * 1024 * 1024   # حد تيليجرام لرفع الصور
+
+
+def is_image_url(url_string: str) -> bool:
+    """Check if a given string is a valid image URL.
+
+    Args:
+        url_string: The string to check
+
+    Returns:
+        True if the string is a valid HTTP(S) URL ending with an image extension,
+        False otherwise
+    """
+    if not isinstance(url_string, str):
+        return False
+    return (
+        (url_string.startswith("http://") or url_string.startswith("https://")) and
+        any(url_string.lower().endswith(ext) for ext in IMAGE_EXTENSIONS)
+    )
+
+
+def _is_remote(url) -> bool:
+    return isinstance(url, str) and (url.startswith("http://") or url.startswith("https://"))
+
+
+def _storage_chat_id(value):
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+class ImageRef:
+    __slots__ = ("file_id", "content_hash", "checked_at")
+
+    def __init__(self, file_id, content_hash=None, checked_at=None):
+        self.file_id = file_id
+        self.content_hash = content_hash
+        self.checked_at = checked_at or time.time()
+
+
+class TelegramImageCache:
+    """URL -> Telegram file_id for bank images, persisted in telegram_image_cache."""
+
+    def __init__(self, batch_size=IMAGE_PREWARM_BATCH, pause=IMAGE_PREWARM_PAUSE,
+                 download_concurrency=IMAGE_DOWNLOAD_CONCURRENCY, revalidate_after=IMAGE_REVALIDATE_AFTER):
+        self.batch_size = max(1, min(int(batch_size), 10))
+        self.pause = pause
+        self.revalidate_after = revalidate_after
+        self._download_slots = asyncio.Semaphore(max(1, download_concurrency))
+        self._by_url = {}       # url -> ImageRef
+        self._by_hash = {}      # sha256 -> file_id
+        self._failed_at = {}    # url -> time.time() of the last failed upload (not retried before revalidate_after)
+        self._prewarm_lock = asyncio.Lock()
+        self.loaded = False
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "rejected": 0,
+            "prewarm_runs": 0,
+            "prewarm_uploaded": 0,
+            "prewarm_reused": 0,
+            "prewarm_unchanged": 0,
+            "prewarm_failed": 0,
+        }
+
+    async def load(self) -> bool:
+        """Loads the stored map (call once at startup)."""
+        rows = await run_db(get_telegram_image_cache, default=None)
+        if rows is None:
+            logger.warning("[ImageCache] Could not load telegram_image_cache; starting empty.")
+            return False
+        for url, file_id, content_hash, checked_at in rows:
+            # ما سُجّل أثناء التحميل أحدث من المخزّن
+            if url not in self._by_url:
+                self._by_url[url] = ImageRef(file_id, content_hash, checked_at)
+                if content_hash:
+                    self._by_hash.setdefault(content_hash, file_id)
+        self.loaded = True
+        logger.info(f"[ImageCache] Loaded {len(rows)} cached image file_ids.")
+        return True
+
+    # --- lookups ---
+    def photo_for(self, url):
+        """The cached file_id for url, or None."""
+        ref = self._by_url.get(url)
+        if ref is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return ref.file_id
+
+    def remember(self, url, file_id, content_hash=None) -> None:
+        if not _is_remote(url) or not file_id:
+            return
+        ref = ImageRef(file_id, content_hash)
+        self._by_url[url] = ref
+        if content_hash:
+            self._by_hash.setdefault(content_hash, file_id)
+        store_image_file_id(url, file_id, content_hash, ref.checked_at)
+
+    def remember_message(self, url, message, content_hash=None) -> None:
+        """Keeps the file_id of a sent photo message (largest size)."""
+        photo = getattr(message, "photo", None)
+        if photo:
+            self.remember(url, photo[-1].file_id, content_hash)
+
+    def forget(self, url) -> None:
+        """Drops a file_id Telegram rejected."""
+        ref = self._by_url.pop(url, None)
+        if ref is None:
+            return
+        self._stats["rejected"] += 1
+        if ref.content_hash and self._by_hash.get(ref.content_hash) == ref.file_id:
+            del self._by_hash[ref.content_hash]
+        store_image_file_id(url, None)
+
+    # --- prewarm ---
+    def _needs_check(self, url, now) -> bool:
+        if now - self._failed_at.get(url, 0) < self.revalidate_after:
+            return False
+        ref = self._by_url.get(url)
+        return ref is None or now - ref.checked_at >= self.revalidate_after
+
+    async def _download(self, url):
+        from utils.api_client import get_api_session
+
+        async with self._download_slots:
+            try:
+                session = await get_api_session()
+                async with session.get(url) as response:
+                    if response.status != 200:
+                        logger.warning(f"[ImageCache] Download of {url} returned HTTP {response.status}.")
+                        return None
+                    if (response.content_length or 0) > MAX_PHOTO_BYTES:
+                        logger.warning(f"[ImageCache] {url} is larger than {MAX_PHOTO_BYTES} bytes; not prewarmed.")
+                        return None
+                    data = await response.read()
+                    return data if len(data) <= MAX_PHOTO_BYTES else None
+            except Exception as e:
+                logger.warning(f"[ImageCache] Could not download {url}: {e}")
+                return None
+
+    async def prewarm(self, bot, chat_id, urls) -> dict:
+        """Uploads new or changed images among urls to chat_id. Returns a summary of the pass."""
+        summary = {"checked": 0, "uploaded": 0, "reused": 0, "unchanged": 0, "failed": 0}
+        if self._prewarm_lock.locked():
+            logger.debug("[ImageCache] Prewarm already running, skipping.")
+            return summary
+        async with self._prewarm_lock:
+            now = time.time()
+            todo = [url for url in dict.fromkeys(urls) if _is_remote(url) and self._needs_check(url, now)]
+            summary["checked"] = len(todo)
+            for start in range(0, len(todo), self.batch_size):
+                batch = todo[start:start + self.batch_size]
+                payloads = await asyncio.gather(*(self._download(url) for url in batch))
+                uploads, duplicates = [], []
+                for url, data in zip(batch, payloads):
+                    ref = self._by_url.get(url)
+                    if data is None:
+                        if ref is None:
+                            uploads.append((url, None, url))     # تيليجرام يجلب الرابط بنفسه
+                        else:
+                            summary["failed"] += 1               # نحتفظ بالقديم ونعيد المحاولة لاحقاً
+                        continue
+                    digest = hashlib.sha256(data).hexdigest()
+                    if ref is not None and ref.content_hash in (None, digest):
+                        self.remember(url, ref.file_id, digest)
+                        summary["unchanged"] += 1
+                    elif digest in self._by_hash:
+                        self.remember(url, self._by_hash[digest], digest)
+                        summary["reused"] += 1
+                    elif any(digest == pending for _, pending, _ in uploads):
+                        duplicates.append((url, digest))        # نفس الصورة في هذه الدفعة: رفع واحد
+                    else:
+                        uploads.append((url, digest, data))
+                if uploads:
+                    await self._upload(bot, chat_id, uploads, summary)
+                    await asyncio.sleep(self.pause)
+                for url, digest in duplicates:
+                    if digest in self._by_hash:
+                        self.remember(url, self._by_hash[digest], digest)
+                        summary["reused"] += 1
+            self._stats["prewarm_runs"] += 1
+            for key in ("uploaded", "reused", "unchanged", "failed"):
+                self._stats[f"prewarm_{key}"] += summary[key]
+            return summary
+
+    async def _upload(self, bot, chat_id, uploads, summary) -> None:
+        """uploads = [(url, sha256 or None, bytes or url)]: one media group (or one photo)."""
+        from telegram import InputMediaPhoto
+
+        for _ in range(3):
+            try:
+                if len(uploads) == 1:
+                    messages = [await bot.send_photo(chat_id=chat_id, photo=uploads[0][2], disable_notification=True)]
+                else:
+                    messages = await bot.send_media_group(
+                        chat_id=chat_id, media=[InputMediaPhoto(media=payload) for _, _, payload in uploads],
+                        disable_notification=True)
+                break
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"[ImageCache] Flood limit while prewarming, waiting {delay:.0f}s.")
+                await asyncio.sleep(delay + 1)
+            except Exception as e:
+                if len(uploads) == 1:
+                    logger.warning(f"[ImageCache] Could not upload {uploads[0][0]}: {e}")
+                    self._failed_at[uploads[0][0]] = time.time()
+                    summary["failed"] += 1
+                    return
+                # صورة واحدة غير صالحة تُفشل المجموعة كلها → رفع كل صورة وحدها
+                logger.warning(f"[ImageCache] Media group of {len(uploads)} images failed ({e}); uploading one by one.")
+                for item in uploads:
+                    await self._upload(bot, chat_id, [item], summary)
+                    await asyncio.sleep(self.pause / len(uploads))
+                return
+        else:
+            summary["failed"] += len(uploads)
+            return
+        for (url, digest, _), message in zip(uploads, messages or []):
+            self.remember_message(url, message, digest)
+            summary["uploaded"] += 1
+
+    def stats(self) -> dict:
+        return dict(self._stats, cached=len(self._by_url), hashes=len(self._by_hash), loaded=self.loaded)
+
+
+IMAGE_CACHE = TelegramImageCache()
+
+
+async def send_cached_photo(bot, chat_id, url, **kwargs):
+    """send_photo for a bank image: the cached file_id when there is one, the URL otherwise."""
+    if not _is_remote(url):
+        return await bot.send_photo(chat_id=chat_id, photo=url, **kwargs)
+    file_id = IMAGE_CACHE.photo_for(url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"[ImageCache] Cached file_id for {url} rejected ({e}); sending the URL.")
+            IMAGE_CACHE.forget(url)
+    message = await bot.send_photo(chat_id=chat_id, photo=url, **kwargs)
+    IMAGE_CACHE.remember_message(url, message)
+    return message
+
+
+async def send_cached_media_group(bot, chat_id, photos: list, **kwargs) -> list:
+    """send_media_group for bank images: photos = [(url, caption)], 2-10 items; same file_id handling as send_cached_photo."""
+    from telegram import InputMediaPhoto
+
+    def build_media(use_cache):
+        file_ids = [IMAGE_CACHE.photo_for(url) if use_cache and _is_remote(url) else None for url, _ in photos]
+        return file_ids, [InputMediaPhoto(media=file_id or url, caption=caption)
+                          for file_id, (url, caption) in zip(file_ids, photos)]
+
+    file_ids, media = build_media(use_cache=True)
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+    except BadRequest as e:
+        if not any(file_ids):
+            raise
+        # لا نعرف أي file_id رُفض → نعيد الإرسال بالروابط
+        logger.warning(f"[ImageCache] Cached file_id rejected in media group ({e}); sending the URLs.")
+        for (url, _), file_id in zip(photos, file_ids):
+            if file_id:
+                IMAGE_CACHE.forget(url)
+        file_ids, media = build_media(use_cache=False)
+        messages = await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+    for (url, _), file_id, message in zip(photos, file_ids, messages or []):
+        if not file_id:
+            IMAGE_CACHE.remember_message(url, message)
+    return list(messages or [])
+
+
+def catalogue_image_urls() -> list:
+    """Question and option image URLs of the whole question bank (QUESTION_CATALOGUE)."""
+    from utils.question_catalogue import QUESTION_CATALOGUE
+
+    urls = []
+    for entry in list(QUESTION_CATALOGUE.questions.values()):
+        question = entry.transformed
+        if not question:
+            continue
+        if _is_remote(question.get("image_url")):
+            urls.append(question["image_url"])
+        urls.extend(o.get("option_text") for o in question.get("options", []) if is_image_url(o.get("option_text")))
+    return list(dict.fromkeys(urls))
+
+
+async def prewarm_images_job(context) -> None:
+    """JobQueue callback: uploads new or changed bank images to the storage chat."""
+    from utils.question_catalogue import QUESTION_CATALOGUE
+
+    chat_id = _storage_chat_id(IMAGE_STORAGE_CHAT_ID)
+    if chat_id is None:
+        return
+    if not IMAGE_CACHE.loaded:
+        await IMAGE_CACHE.load()
+    if not await QUESTION_CATALOGUE.wait_until_ready(timeout=60):
+        logger.info("[ImageCache] Question catalogue not ready; prewarm postponed to the next run.")
+        return
+    started = time.monotonic()
+    summary = await IMAGE_CACHE.prewarm(context.bot, chat_id, catalogue_image_urls())
+    if summary["checked"]:
+        logger.info(f"[ImageCache] Prewarm done in {time.monotonic() - started:.1f}s: {summary}")
+
+
+def schedule_image_cache(application) -> None:
+    """Loads the stored file_ids and schedules the prewarm job (call from post_init)."""
+    application.create_task(IMAGE_CACHE.load())
+    if _storage_chat_id(IMAGE_STORAGE_CHAT_ID) is None:
+        logger.info("[ImageCache] IMAGE_STORAGE_CHAT_ID not set; images are cached from live sends only.")
+        return
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            prewarm_images_job,
+            interval=IMAGE_PREWARM_INTERVAL,
+            first=IMAGE_PREWARM_START_DELAY,
+            name="image_prewarm",
+        )
+    else:
+        logger.warning("[ImageCache] No JobQueue; image prewarm disabled.")
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Per-user footprint of user_data in the PicklePersistence file.
+
+user_data used to carry whole question banks (questions_for_quiz, weakness_*
+matches with question dicts, QuizLogic instances with every question). It now
+keeps question IDs only; compact_user_data() converts entries written by the
+old code, and build_footprint_report() shows the size per user before and
+after that conversion.
+
+Usage:
+    python -m utils.persistence_report [persistence/bot_conversation_persistence.pkl]
+"""
+
+import io
+import logging
+import pickle
+import re
+import statistics
+import sys
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+DEFAULT_PERSISTENCE_FILE = "persistence/bot_conversation_persistence.pkl"
+
+_LEGACY_WEAKNESS_KEYS = ("weakness_all_matched", "weakness_unit_matched")
+
+
+class _AsStoredPickler(pickle.Pickler):
+    """Pickles objects with their current __dict__, bypassing custom __getstate__ compaction."""
+
+    def reducer_override(self, obj):
+        cls = type(obj)
+        if getattr(cls, "__getstate__", None) is not object.__getstate__ and hasattr(obj, "__dict__") \
+                and not isinstance(obj, type):
+            return (object.__new__, (cls,), dict(obj.__dict__))
+        return NotImplemented
+
+
+def _pickled_size(value, as_stored: bool = False) -> int:
+    try:
+        if not as_stored:
+            return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        buffer = io.BytesIO()
+        _AsStoredPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+        return buffer.tell()
+    except Exception as e:
+        logger.debug(f"[PersistenceReport] Could not pickle value of type {type(value)}: {e}")
+        return 0
+
+
+def compact_user_data(user_data: dict, inplace: bool = False) -> dict:
+    """Replaces legacy full-content entries with their ID-only form. Returns the compacted dict."""
+    target = user_data if inplace else dict(user_data)
+
+    raw_questions = target.get("questions_for_quiz")
+    if isinstance(raw_questions, list):
+        target.pop("questions_for_quiz", None)
+        target["questions_for_quiz_ids"] = [
+            str(q.get("id", q.get("question_id"))) for q in raw_questions
+            if isinstance(q, dict) and q.get("id", q.get("question_id")) is not None
+        ]
+        target.setdefault("questions_for_quiz_source", None)
+
+    for key in _LEGACY_WEAKNESS_KEYS:
+        matched = target.get(key)
+        if isinstance(matched, dict) and any(isinstance(v, dict) and "question_data" in v for v in matched.values()):
+            target[key] = {
+                q_id: {k: v for k, v in info.items() if k != "question_data"}
+                for q_id, info in matched.items()
+            }
+    return target
+
+
+def _normalize_key(key) -> str:
+    # quiz_logic_instance_12345 / last_quiz_interaction_message_id_-100... -> one bucket per key family
+    return re.sub(r"_-?\d+", "_<id>", str(key))
+
+
+def _summarize(sizes: list) -> dict:
+    if not sizes:
+        return {"users": 0, "total_bytes": 0, "avg_bytes": 0, "median_bytes": 0, "p95_bytes": 0, "max_bytes": 0}
+    ordered = sorted(sizes)
+    return {
+        "users": len(ordered),
+        "total_bytes": sum(ordered),
+        "avg_bytes": round(sum(ordered) / len(ordered)),
+        "median_bytes": round(statistics.median(ordered)),
+        "p95_bytes": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max_bytes": ordered[-1],
+    }
+
+
+def build_footprint_report(all_user_data: dict, top: int = 10) -> dict:
+    """Per-user pickled size of user_data as stored ("before") and after compaction ("after")."""
+    before_sizes, after_sizes = [], []
+    per_user = []
+    key_before, key_after = {}, {}
+    for user_id, user_data in all_user_data.items():
+        if not isinstance(user_data, dict):
+            continue
+        compacted = compact_user_data(user_data)
+        before = _pickled_size(dict(user_data), as_stored=True)
+        after = _pickled_size(compacted)
+        before_sizes.append(before)
+        after_sizes.append(after)
+        per_user.append((user_id, before, after))
+        for key, value in user_data.items():
+            bucket = _normalize_key(key)
+            key_before[bucket] = key_before.get(bucket, 0) + _pickled_size(value, as_stored=True)
+        for key, value in compacted.items():
+            bucket = _normalize_key(key)
+            key_after[bucket] = key_after.get(bucket, 0) + _pickled_size(value)
+
+    heaviest_keys = sorted(key_before, key=key_before.get, reverse=True)[:top]
+    return {
+        "before": _summarize(before_sizes),
+        "after": _summarize(after_sizes),
+        "largest_users": sorted(per_user, key=lambda row: row[1], reverse=True)[:top],
+        "heaviest_keys": [(k, key_before.get(k, 0), key_after.get(k, 0)) for k in heaviest_keys],
+    }
+
+
+def format_footprint_report(report: dict) -> str:
+    def kb(n):
+        return f"{n / 1024:,.1f} KB"
+
+    before, after = report["before"], report["after"]
+    lines = [
+        f"user_data footprint ({before['users']} users)",
+        f"{'':<14}{'before':>14}{'after':>14}",
+    ]
+    for label, key in (("total", "total_bytes"), ("avg/user", "avg_bytes"), ("median/user", "median_bytes"),
+                       ("p95/user", "p95_bytes"), ("max/user", "max_bytes")):
+        lines.append(f"{label:<14}{kb(before[key]):>14}{kb(after[key]):>14}")
+    lines.append("")
+    lines.append("heaviest keys (all users):")
+    for key, b, a in report["heaviest_keys"]:
+        lines.append(f"  {key:<45}{kb(b):>14}{kb(a):>14}")
+    lines.append("")
+    lines.append("largest users:")
+    for user_id, b, a in report["largest_users"]:
+        lines.append(f"  {str(user_id):<45}{kb(b):>14}{kb(a):>14}")
+    return "\n".join(lines)
+
+
+def load_persisted_user_data(path: str = DEFAULT_PERSISTENCE_FILE) -> dict:
+    """Reads user_data from a PicklePersistence file (single-file mode)."""
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    return data.get("user_data", {}) if isinstance(data, dict) else {}
+
+
+async def _build_catalogue():
+    # QuizLogic pickles question IDs only for questions the catalogue knows about
+    from utils.question_catalogue import QUESTION_CATALOGUE
+    from utils.api_client import close_api_session
+    try:
+        await QUESTION_CATALOGUE.refresh()
+    finally:
+        await close_api_session()
+
+
+if __name__ == "__main__":
+    import asyncio
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PERSISTENCE_FILE
+    try:
+        asyncio.run(_build_catalogue())
+    except Exception as e:
+        logger.warning(f"[PersistenceReport] Question catalogue unavailable, 'after' sizes keep inline questions: {e}")
+    print(format_footprint_report(build_footprint_report(load_persisted_user_data(path))))
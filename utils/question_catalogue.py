@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of the whole question bank.
+
+QUESTION_CATALOGUE maps question_id -> (course, unit, raw API question,
+transformed question) and keeps per-course / per-unit id sets, so weakness
+analysis is a set intersection instead of N+M sequential API round-trips.
+
+The catalogue is warmed up from post_init and refreshed periodically by a
+JobQueue job (a failed refresh is retried after QUESTION_CATALOGUE_RETRY_DELAY
+seconds); every endpoint is revalidated upstream, and a refresh builds a complete new index and swaps it in, so
+readers never see a half-built catalogue. Until the first refresh succeeds
+``ready`` is False and callers fall back to fetching from the API.
+
+Because content can always be looked up here, user_data only needs to keep
+question IDs (see resolve_questions / resolve_transformed_questions).
+"""
+
+import asyncio
+import logging
+import time
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import QUESTION_CATALOGUE_REFRESH_INTERVAL, QUESTION_CATALOGUE_FETCH_CONCURRENCY, QUESTION_CATALOGUE_RETRY_DELAY
+except ImportError:
+    QUESTION_CATALOGUE_REFRESH_INTERVAL = 1800
+    QUESTION_CATALOGUE_FETCH_CONCURRENCY = 8
+    QUESTION_CATALOGUE_RETRY_DELAY = 60
+
+from utils.api_client import transform_api_question, fetch_many_from_api
+from utils.api_cache import fetch_from_api_cached, fetch_from_api_revalidated
+
+
+class CatalogueEntry:
+    __slots__ = ("question_id", "course_id", "course_name", "unit_id", "unit_name", "question_data", "_transformed")
+
+    def __init__(self, question_id, course_id, course_name, question_data):
+        self.question_id = question_id
+        self.course_id = course_id
+        self.course_name = course_name
+        self.unit_id = None
+        self.unit_name = None
+        self.question_data = question_data
+        self._transformed = None
+
+    @property
+    def transformed(self):
+        """The question in QuizLogic format (transformed once, on first use)."""
+        if self._transformed is None:
+            self._transformed = transform_api_question(self.question_data) or False
+        return self._transformed or None
+
+
+def _question_id(q: dict) -> str:
+    return str(q.get("id", q.get("question_id", "")))
+
+
+class QuestionCatalogue:
+    """Pre-indexed question bank: id lookups and per-course / per-unit id sets."""
+
+    def __init__(self, fetch_concurrency=QUESTION_CATALOGUE_FETCH_CONCURRENCY):
+        self.fetch_concurrency = fetch_concurrency
+        self._refresh_lock = asyncio.Lock()
+        self.courses = []               # raw course dicts, API order
+        self.units_by_course = {}       # course_id -> [raw unit dicts]
+        self.questions = {}             # question_id -> CatalogueEntry
+        self.course_question_ids = {}   # course_id -> frozenset(question_id)
+        self.unit_question_ids = {}     # unit_id -> frozenset(question_id)
+        self.built_at = None            # time.time() of the last successful refresh
+        self.last_refresh_seconds = None
+        self._ready_event = asyncio.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.built_at is not None
+
+    @property
+    def refreshing(self) -> bool:
+        return self._refresh_lock.locked()
+
+    # --- building ---
+    async def refresh(self) -> bool:
+        """Rebuilds the index from the API. Returns False (keeping the old index) on failure."""
+        if self._refresh_lock.locked():
+            logger.debug("[Catalogue] Refresh already running, skipping.")
+            return False
+        async with self._refresh_lock:
+            started = time.monotonic()
+            courses = await fetch_from_api_revalidated("api/v1/courses")
+            if not courses or courses == "TIMEOUT" or not isinstance(courses, list):
+                logger.warning(f"[Catalogue] Could not fetch courses ({courses}); keeping previous index.")
+                return False
+
+            async def fetch_lists(endpoints):
+                results = await fetch_many_from_api(endpoints, concurrency=self.fetch_concurrency, fetcher=fetch_from_api_revalidated)
+                return [r if isinstance(r, list) else None for r in (results.get(ep) for ep in endpoints)]
+
+            course_ids = [str(c.get("id", "")) for c in courses if c.get("id") is not None]
+            course_results = await fetch_lists(
+                [f"api/v1/courses/{c_id}/questions" for c_id in course_ids] +
+                [f"api/v1/courses/{c_id}/units" for c_id in course_ids]
+            )
+            course_questions = dict(zip(course_ids, course_results[:len(course_ids)]))
+            course_units = dict(zip(course_ids, course_results[len(course_ids):]))
+
+            if any(v is None for v in course_questions.values()):
+                failed = [c_id for c_id, v in course_questions.items() if v is None]
+                logger.warning(f"[Catalogue] Question fetch failed for courses {failed}; keeping previous index.")
+                return False
+
+            unit_refs = [(c_id, u) for c_id, units in course_units.items() for u in (units or []) if u.get("id") is not None]
+            unit_results = await fetch_lists([f"api/v1/units/{u.get('id')}/questions" for _, u in unit_refs])
+
+            course_names = {str(c.get("id")): c.get("name", "") for c in courses}
+            questions = {}
+            course_question_ids = {}
+            for c_id, qs in course_questions.items():
+                ids = set()
+                for q in qs:
+                    q_id = _question_id(q)
+                    if not q_id:
+                        continue
+                    ids.add(q_id)
+                    questions.setdefault(q_id, CatalogueEntry(q_id, c_id, course_names.get(c_id, ""), q))
+                course_question_ids[c_id] = frozenset(ids)
+
+            unit_question_ids = {}
+            for (c_id, unit), qs in zip(unit_refs, unit_results):
+                u_id = str(unit.get("id"))
+                ids = set()
+                for q in qs or []:
+                    q_id = _question_id(q)
+                    if not q_id:
+                        continue
+                    ids.add(q_id)
+                    entry = questions.get(q_id)
+                    if entry is None:
+                        entry = questions[q_id] = CatalogueEntry(q_id, c_id, course_names.get(c_id, ""), q)
+                    entry.unit_id = u_id
+                    entry.unit_name = unit.get("name", "")
+                unit_question_ids[u_id] = frozenset(ids)
+
+            # Swap in the complete index
+            self.courses = courses
+            self.units_by_course = {c_id: units or [] for c_id, units in course_units.items()}
+            self.questions = questions
+            self.course_question_ids = course_question_ids
+            self.unit_question_ids = unit_question_ids
+            self.built_at = time.time()
+            self.last_refresh_seconds = round(time.monotonic() - started, 2)
+            self._ready_event.set()
+            logger.info(f"[Catalogue] Indexed {len(questions)} questions in {len(course_question_ids)} courses / "
+                        f"{len(unit_question_ids)} units in {self.last_refresh_seconds}s.")
+            return True
+
+    async def wait_until_ready(self, timeout: float = 10) -> bool:
+        """Waits (up to timeout seconds) for the first successful build, e.g. right after a restart."""
+        if self.ready:
+            return True
+        try:
+            await asyncio.wait_for(self._ready_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Catalogue] Not ready after waiting {timeout}s.")
+        return self.ready
+
+    # --- lookups ---
+    def get(self, question_id):
+        return self.questions.get(str(question_id))
+
+    async def resolve_questions(self, question_ids, source_endpoint: str = None) -> list:
+        """Raw API question dicts for question_ids, in the given order.
+
+        IDs missing from the catalogue (not built yet, or added to the bank
+        since the last refresh) are looked up in ``source_endpoint`` through
+        the question-bank cache. Unknown IDs are dropped.
+        """
+        question_ids = [str(q_id) for q_id in question_ids]
+        found = {}
+        for q_id in question_ids:
+            entry = self.questions.get(q_id)
+            if entry is not None:
+                found[q_id] = entry.question_data
+        missing = [q_id for q_id in question_ids if q_id not in found]
+        if missing and source_endpoint:
+            response = await fetch_from_api_cached(source_endpoint)
+            if isinstance(response, list):
+                wanted = set(missing)
+                for q in response:
+                    q_id = _question_id(q)
+                    if q_id in wanted:
+                        found[q_id] = q
+        if len(found) < len(question_ids):
+            logger.warning(f"[Catalogue] Could not resolve {len(question_ids) - len(found)} of {len(question_ids)} question IDs.")
+        return [found[q_id] for q_id in question_ids if q_id in found]
+
+    async def resolve_transformed_questions(self, question_ids, source_endpoint: str = None) -> list:
+        """Like resolve_questions, but returns questions in QuizLogic format (fresh copies)."""
+        transformed = []
+        for q in await self.resolve_questions(question_ids, source_endpoint):
+            entry = self.questions.get(_question_id(q))
+            t = entry.transformed if entry is not None and entry.question_data is q else transform_api_question(q)
+            if t:
+                # Fresh copy: QuizLogic stores per-user keys (_displayable_options) on the question
+                transformed.append(dict(t))
+        return transformed
+
+    def transformed_copy(self, question_id):
+        """A fresh copy of one transformed question, or None if unknown."""
+        entry = self.questions.get(str(question_id))
+        t = entry.transformed if entry is not None else None
+        return dict(t) if t else None
+
+    def course_name(self, course_id) -> str:
+        return next((c.get("name", "") for c in self.courses if str(c.get("id")) == str(course_id)), "")
+
+    def match_courses(self, question_ids) -> dict:
+        """{course_id: set(question_id)} for the given ids, courses without matches omitted."""
+        ids = set(map(str, question_ids))
+        matched = {}
+        for c_id, course_ids in self.course_question_ids.items():
+            hit = course_ids & ids
+            if hit:
+                matched[c_id] = hit
+        return matched
+
+    def match_units(self, course_id, question_ids) -> dict:
+        """{unit_id: set(question_id)} within one course for the given ids."""
+        ids = set(map(str, question_ids))
+        matched = {}
+        for unit in self.units_by_course.get(str(course_id), []):
+            u_id = str(unit.get("id"))
+            hit = self.unit_question_ids.get(u_id, frozenset()) & ids
+            if hit:
+                matched[u_id] = hit
+        return matched
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "questions": len(self.questions),
+            "courses": len(self.course_question_ids),
+            "units": len(self.unit_question_ids),
+            "built_at": self.built_at,
+            "last_refresh_seconds": self.last_refresh_seconds,
+        }
+
+
+QUESTION_CATALOGUE = QuestionCatalogue()
+
+async def refresh_question_catalogue_job(context) -> None:
+    """JobQueue callback: catalogue refresh; a failed one is retried after QUESTION_CATALOGUE_RETRY_DELAY."""
+    if not await QUESTION_CATALOGUE.refresh() and not QUESTION_CATALOGUE.refreshing:
+        _schedule_retry(context.job_queue)
+
+def _schedule_retry(job_queue) -> None:
+    if job_queue is None or job_queue.get_jobs_by_name("question_catalogue_retry"):
+        return
+    logger.info(f"[Catalogue] Retrying the build in {QUESTION_CATALOGUE_RETRY_DELAY}s.")
+    job_queue.run_once(refresh_question_catalogue_job, when=QUESTION_CATALOGUE_RETRY_DELAY, name="question_catalogue_retry")
+
+def request_question_catalogue_refresh(application) -> None:
+    """Starts a catalogue rebuild in the background now (e.g. after /clear_cache)."""
+    if application.job_queue:
+        if QUESTION_CATALOGUE.refreshing:
+            # The running build may predate the change; rebuild again once it is done
+            _schedule_retry(application.job_queue)
+        else:
+            application.job_queue.run_once(refresh_question_catalogue_job, when=0, name="question_catalogue_manual")
+    else:
+        application.create_task(QUESTION_CATALOGUE.refresh())
+
+def schedule_question_catalogue(application) -> None:
+    """Warms the catalogue up in the background and schedules periodic refreshes (plus short retries after failures)."""
+    request_question_catalogue_refresh(application)
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            refresh_question_catalogue_job,
+            interval=QUESTION_CATALOGUE_REFRESH_INTERVAL,
+            first=QUESTION_CATALOGUE_REFRESH_INTERVAL,
+            name="question_catalogue_refresh",
+        )
+    else:
+        logger.warning("[Catalogue] No JobQueue; the catalogue will only be built once at startup.")
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""One shared timer engine for every running quiz.
+
+QuizLogic.send_question used to schedule two JobQueue jobs per question
+(question_timer_* for the timeout and timer_update_* for the countdown,
+which re-scheduled itself every TIMER_UPDATE_INTERVAL seconds), and every
+answer, skip or cleanup looked them up by name to remove them. With
+1,000 students in a quiz that is thousands of APScheduler jobs created and
+removed per minute.
+
+QUIZ_TIMERS is a hashed timing wheel driven by a single asyncio task that
+ticks every QUIZ_TIMER_TICK seconds:
+
+- start(key, ...) arms the deadline of the current question of one quiz
+  (key = (chat_id, quiz_id)); arming again replaces the previous question's
+  timer, cancel(key) drops it. Both are O(1) dict operations.
+- A timer sits in the wheel slot of its next event only: the first
+  countdown edit (countdown_from seconds before the deadline), the next
+  edit (every countdown_every seconds) or the deadline itself.
+- Each tick collects the countdown edits of every due quiz and sends them
+  together (gather, QUIZ_TIMER_EDIT_CONCURRENCY at a time); timeouts run as
+  their own tasks, since they move the quiz to the next question.
+- Callbacks receive a fresh CallbackContext of the application for the
+  quiz's chat and user, as a JobQueue job would.
+
+stats() reports active timers, timers in their countdown phase, fired
+events and tick lag.
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import QUIZ_TIMER_TICK, QUIZ_TIMER_WHEEL_SIZE, QUIZ_TIMER_EDIT_CONCURRENCY
+except ImportError:
+    QUIZ_TIMER_TICK = 1.0
+    QUIZ_TIMER_WHEEL_SIZE = 512
+    QUIZ_TIMER_EDIT_CONCURRENCY = 20
+
+
+class _Timer:
+    __slots__ = ("key", "application", "chat_id", "user_id", "deadline", "due_tick",
+                 "on_timeout", "on_countdown", "countdown_from", "countdown_every")
+
+    def __init__(self, key, application, chat_id, user_id, deadline, on_timeout, on_countdown,
+                 countdown_from, countdown_every):
+        self.key = key
+        self.application = application
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.deadline = deadline            # time.monotonic()
+        self.due_tick = None
+        self.on_timeout = on_timeout        # async (context)
+        self.on_countdown = on_countdown    # async (context, remaining_seconds) or None
+        self.countdown_from = countdown_from
+        self.countdown_every = countdown_every
+
+
+class QuizTimerEngine:
+    """Deadlines and countdown edits of all active quizzes on one timing wheel."""
+
+    def __init__(self, tick=QUIZ_TIMER_TICK, wheel_size=QUIZ_TIMER_WHEEL_SIZE,
+                 edit_concurrency=QUIZ_TIMER_EDIT_CONCURRENCY):
+        self.tick = float(tick)
+        self.wheel_size = max(8, int(wheel_size))
+        self._slots = [{} for _ in range(self.wheel_size)]   # slot -> {key: _Timer}
+        self._timers = {}                                     # key -> _Timer
+        self._edit_slots = asyncio.Semaphore(max(1, edit_concurrency))
+        self._origin = time.monotonic()
+        self._last_tick = 0
+        self._task = None
+        self._background = set()
+        self._stats = {
+            "started": 0,
+            "cancelled": 0,
+            "timeouts": 0,
+            "countdown_edits": 0,
+            "callback_errors": 0,
+            "ticks": 0,
+            "max_tick_lag_ms": 0.0,
+            "last_tick_ms": 0.0,
+        }
+
+    # --- wheel ---
+    def _tick_for(self, at: float) -> int:
+        return max(self._last_tick + 1, math.ceil((at - self._origin) / self.tick))
+
+    def _place(self, timer: _Timer, at: float) -> None:
+        timer.due_tick = self._tick_for(at)
+        self._slots[timer.due_tick % self.wheel_size][timer.key] = timer
+
+    def _unplace(self, timer: _Timer) -> None:
+        if timer.due_tick is not None:
+            self._slots[timer.due_tick % self.wheel_size].pop(timer.key, None)
+
+    # --- API ---
+    def start(self, key, application, chat_id, user_id, duration: float, on_timeout,
+              on_countdown=None, countdown_from: float = 30, countdown_every: float = 5) -> None:
+        """Arms (or re-arms) the timer of key: on_timeout after duration seconds, countdown edits before that."""
+        self.cancel(key, count=False)
+        now = time.monotonic()
+        timer = _Timer(key, application, chat_id, user_id, now + duration, on_timeout, on_countdown,
+                       countdown_from, countdown_every)
+        self._timers[key] = timer
+        # أول تحديث مرئي: قبل الموعد بـ countdown_from ثانية (وليس قبل countdown_every)
+        first = now + max(countdown_every, duration - countdown_from) if on_countdown else timer.deadline
+        self._place(timer, min(first, timer.deadline))
+        self._stats["started"] += 1
+        self._ensure_running()
+
+    def cancel(self, key, count: bool = True) -> bool:
+        """Drops the timer of key (answer, skip, end, save). Returns whether one was active."""
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        self._unplace(timer)
+        if count:
+            self._stats["cancelled"] += 1
+        return True
+
+    def remaining(self, key):
+        """Seconds left for key, or None when no timer is active."""
+        timer = self._timers.get(key)
+        return max(0.0, timer.deadline - time.monotonic()) if timer else None
+
+    def active_count(self) -> int:
+        return len(self._timers)
+
+    # --- ticking ---
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            next_at = self._origin + (self._last_tick + 1) * self.tick
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            started = time.monotonic()
+            current = int((started - self._origin) / self.tick)
+            self._stats["max_tick_lag_ms"] = max(self._stats["max_tick_lag_ms"], round((started - next_at) * 1000, 1))
+            try:
+                # يلحق بالنبضات الفائتة إن تأخرت الحلقة
+                for tick_no in range(self._last_tick + 1, current + 1):
+                    self._last_tick = tick_no
+                    self._process_tick(tick_no, started)
+            except Exception as e:
+                logger.error(f"[QuizTimer] Tick failed: {e}", exc_info=True)
+            self._stats["ticks"] += 1
+            self._stats["last_tick_ms"] = round((time.monotonic() - started) * 1000, 2)
+
+    def _process_tick(self, tick_no: int, now: float) -> None:
+        slot = self._slots[tick_no % self.wheel_size]
+        if not slot:
+            return
+        countdowns = []
+        for key, timer in list(slot.items()):
+            if timer.due_tick > tick_no:     # دورة لاحقة من العجلة
+                continue
+            del slot[key]
+            timer.due_tick = None
+            remaining = timer.deadline - now
+            if remaining <= self.tick / 2:
+                self._timers.pop(key, None)
+                self._stats["timeouts"] += 1
+                self._spawn(self._call(timer, timer.on_timeout))
+            else:
+                countdowns.append((timer, remaining))
+                self._place(timer, min(now + timer.countdown_every, timer.deadline))
+        if countdowns:
+            self._stats["countdown_edits"] += len(countdowns)
+            self._spawn(self._send_countdowns(countdowns))
+
+    async def _send_countdowns(self, countdowns: list) -> None:
+        async def edit(timer, remaining):
+            async with self._edit_slots:
+                if self._timers.get(timer.key) is timer:     # أُلغي أثناء الانتظار
+                    await self._call(timer, timer.on_countdown, remaining)
+
+        await asyncio.gather(*(edit(timer, remaining) for timer, remaining in countdowns))
+
+    async def _call(self, timer: _Timer, callback, *args) -> None:
+        try:
+            application = timer.application
+            context = application.context_types.context(application, chat_id=timer.chat_id, user_id=timer.user_id)
+            await callback(context, *args)
+        except Exception as e:
+            self._stats["callback_errors"] += 1
+            logger.error(f"[QuizTimer] Callback for {timer.key} failed: {e}", exc_info=True)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def stop(self) -> None:
+        """Stops ticking (shutdown); pending timers are dropped."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return dict(
+            self._stats,
+            active=len(self._timers),
+            counting_down=sum(1 for timer in self._timers.values()
+                              if timer.on_countdown and timer.deadline - now <= timer.countdown_from),
+            background_tasks=len(self._background),
+        )
+
+
+QUIZ_TIMERS = QuizTimerEngine()
+
+
+def get_quiz_timer_stats() -> dict:
+    """Active quiz timers and tick figures for monitoring."""
+    return QUIZ_TIMERS.stats()
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""Central scheduler for outbound Telegram calls.
+
+Quiz questions, answer edits, countdown edits (utils/quiz_timer.py) and
+bulk sends (utils/broadcast_engine.py) all competed for the same limits
+without knowing about each other: about 30 messages/s per bot, about one
+message/s per private chat and 20/minute per group. At peak the first
+sign of trouble was a 429.
+
+GOVERNOR.run(chat_id, call, priority) runs one API call when both a global
+token (OUTBOUND_GLOBAL_RATE) and a token of that chat (OUTBOUND_CHAT_RATE
+with OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_PER_MINUTE for groups) are free:
+
+- Priority classes: PRIORITY_INTERACTIVE (questions, answers, menus) is
+  served before PRIORITY_COUNTDOWN (timer edits), which goes before
+  PRIORITY_BULK (broadcasts, certificates, notifications). Within a class
+  requests keep their arrival order; a chat that is out of tokens does not
+  hold up other chats.
+- Edits of the same message (coalesce_key) that are still waiting are
+  merged: only the newest content is sent and every caller gets its result.
+- Countdown edits that waited longer than OUTBOUND_COUNTDOWN_MAX_WAIT are
+  dropped (run() returns SKIPPED); the next one carries the fresh time.
+- RetryAfter pauses the chat for retry_after and re-queues the call up to
+  OUTBOUND_MAX_RETRIES times before the error reaches the caller.
+
+When nothing is waiting and tokens are available the call runs at once;
+otherwise a single dispatcher task grants tokens. safe_send_message,
+safe_edit_message_text and safe_edit_message_caption (utils/helpers.py)
+go through GOVERNOR; stats() reports queue depth per class, waits,
+coalesced and dropped requests and flood pauses.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import (
+        OUTBOUND_GOVERNOR_ENABLED, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+        OUTBOUND_GROUP_PER_MINUTE, OUTBOUND_MAX_RETRIES, OUTBOUND_COUNTDOWN_MAX_WAIT,
+    )
+except ImportError:
+    OUTBOUND_GOVERNOR_ENABLED = True
+    OUTBOUND_GLOBAL_RATE = 28
+    OUTBOUND_CHAT_RATE = 1.0
+    OUTBOUND_CHAT_BURST = 3
+    OUTBOUND_GROUP_PER_MINUTE = 20
+    OUTBOUND_MAX_RETRIES = 2
+    OUTBOUND_COUNTDOWN_MAX_WAIT = 4
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_COUNTDOWN = 1
+PRIORITY_BULK = 2
+_PRIORITY_NAMES = ("interactive", "countdown", "bulk")
+
+# run() result for requests dropped before being sent
+SKIPPED = object()
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """retry_after as float seconds (int in older library versions, timedelta in newer ones)."""
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class TokenBucket:
+    """Async token bucket; pause() honours Telegram's retry_after."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = float(rate)
+        # سعة صغيرة: أي ثانية لا تتجاوز rate + burst رسالة (حد تيليجرام ~30/ث)
+        self.capacity = float(burst if burst is not None else max(2.0, rate / 5))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Takes tokens if available and returns 0; otherwise returns the seconds to wait."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        tokens = min(tokens, self.capacity)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class _ChatLimit:
+    __slots__ = ("tokens", "updated", "paused_until")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.paused_until = 0.0
+
+
+class _Request:
+    __slots__ = ("seq", "priority", "chat_id", "tokens", "call", "coalesce_key", "expires_at",
+                 "enqueued_at", "granted", "result")
+
+    def __init__(self, seq, priority, chat_id, tokens, call, coalesce_key, expires_at, loop):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.tokens = tokens
+        self.call = call                    # zero-argument coroutine function
+        self.coalesce_key = coalesce_key
+        self.expires_at = expires_at
+        self.enqueued_at = time.monotonic()
+        self.granted = loop.create_future()  # True = send now, False = dropped
+        self.result = loop.create_future()   # outcome shared with coalesced callers
+
+
+class OutboundGovernor:
+    """Global and per-chat token buckets with priority classes, edit coalescing and RetryAfter backoff."""
+
+    def __init__(self, rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 group_per_minute=OUTBOUND_GROUP_PER_MINUTE, max_retries=OUTBOUND_MAX_RETRIES,
+                 countdown_max_wait=OUTBOUND_COUNTDOWN_MAX_WAIT, enabled=OUTBOUND_GOVERNOR_ENABLED):
+        self.enabled = enabled
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = float(chat_rate)
+        self.group_rate = float(group_per_minute) / 60.0
+        self.chat_burst = float(chat_burst)
+        self.max_retries = max_retries
+        self.countdown_max_wait = countdown_max_wait
+        self._chats = {}                                         # chat_id -> _ChatLimit
+        self._waiting = [OrderedDict() for _ in _PRIORITY_NAMES]  # per class: seq -> _Request
+        self._coalescing = {}                                    # coalesce_key -> waiting _Request
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._last_prune = time.monotonic()
+        self._stats = {
+            "immediate": 0,
+            "queued": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "retry_after": 0,
+            "peak_waiting": 0,
+            "max_wait_ms": 0.0,
+            "total_wait_ms": 0.0,
+        }
+
+    # --- per-chat buckets ---
+    def _chat_rate(self, chat_id) -> float:
+        # المعرفات السالبة وأسماء القنوات (@name) مجموعات/قنوات: 20 رسالة في الدقيقة
+        return self.chat_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+
+    def _chat_ready_at(self, chat_id, tokens, now) -> float:
+        limit = self._chats.get(chat_id)
+        if limit is None:
+            return now
+        if now < limit.paused_until:
+            return limit.paused_until
+        rate = self._chat_rate(chat_id)
+        available = min(self.chat_burst, limit.tokens + (now - limit.updated) * rate)
+        needed = min(tokens, self.chat_burst)
+        return now if available >= needed else now + (needed - available) / rate
+
+    def _chat_take(self, chat_id, tokens, now) -> None:
+        limit = self._chats.get(chat_id)
+        if limit is None:
+            limit = self._chats[chat_id] = _ChatLimit(self.chat_burst, now)
+        limit.tokens = min(self.chat_burst, limit.tokens + (now - limit.updated) * self._chat_rate(chat_id))
+        limit.tokens -= min(tokens, self.chat_burst)
+        limit.updated = now
+
+    def pause_chat(self, chat_id, seconds: float) -> None:
+        now = time.monotonic()
+        limit = self._chats.get(chat_id)
+        if limit is None:
+            limit = self._chats[chat_id] = _ChatLimit(0.0, now)
+        limit.paused_until = max(limit.paused_until, now + seconds)
+        limit.tokens = 0.0
+        limit.updated = now
+
+    def _prune_chats(self, now) -> None:
+        # حالة المحادثات الممتلئة والخاملة لا حاجة لها
+        idle = [chat_id for chat_id, limit in self._chats.items()
+                if limit.paused_until < now and now - limit.updated > self.chat_burst / self._chat_rate(chat_id)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        self._last_prune = now
+
+    # --- queue ---
+    def _waiting_count(self) -> int:
+        return sum(len(queue) for queue in self._waiting)
+
+    def _enqueue(self, chat_id, call, priority, tokens, coalesce_key, max_wait):
+        """Returns (request, owner). owner is False when the call was merged into a waiting edit."""
+        if coalesce_key is not None:
+            pending = self._coalescing.get(coalesce_key)
+            if pending is not None and not pending.granted.done():
+                pending.call = call                 # المحتوى الأحدث يحل محل القديم
+                if priority < pending.priority:
+                    del self._waiting[pending.priority][pending.seq]
+                    pending.priority = priority
+                    self._waiting[priority][pending.seq] = pending
+                if max_wait is None:
+                    pending.expires_at = None
+                self._stats["coalesced"] += 1
+                return pending, False
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        request = _Request(next(self._seq), priority, chat_id, tokens, call, coalesce_key,
+                           now + max_wait if max_wait else None, loop)
+        if not self._waiting_count() and self._chat_ready_at(chat_id, tokens, now) <= now \
+                and self.bucket.try_acquire(tokens) == 0:
+            self._chat_take(chat_id, tokens, now)
+            request.granted.set_result(True)
+            self._stats["immediate"] += 1
+            return request, True
+        self._queue(request)
+        return request, True
+
+    def _queue(self, request: _Request) -> None:
+        self._waiting[request.priority][request.seq] = request
+        if request.coalesce_key is not None:
+            self._coalescing[request.coalesce_key] = request
+        self._stats["queued"] += 1
+        self._stats["peak_waiting"] = max(self._stats["peak_waiting"], self._waiting_count())
+        self._ensure_dispatcher()
+        self._wakeup.set()
+
+    def _release(self, request: _Request, granted: bool) -> None:
+        self._waiting[request.priority].pop(request.seq, None)
+        if request.coalesce_key is not None and self._coalescing.get(request.coalesce_key) is request:
+            del self._coalescing[request.coalesce_key]
+        if not request.granted.done():
+            request.granted.set_result(granted)
+        if granted:
+            waited = (time.monotonic() - request.enqueued_at) * 1000
+            self._stats["total_wait_ms"] += waited
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], round(waited, 1))
+        else:
+            self._stats["dropped"] += 1
+
+    # --- dispatcher ---
+    def _ensure_dispatcher(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _sleep(self, seconds: float) -> None:
+        """Sleeps up to seconds; a new request wakes the dispatcher early."""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.001, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    def _next_request(self, now):
+        """Highest-priority waiting request whose chat has tokens, and the earliest time another one could go."""
+        next_at = float("inf")
+        for queue in self._waiting:
+            for request in list(queue.values()):
+                if request.expires_at is not None and now >= request.expires_at:
+                    self._release(request, granted=False)
+                    continue
+                ready_at = self._chat_ready_at(request.chat_id, request.tokens, now)
+                if ready_at <= now:
+                    return request, now
+                next_at = min(next_at, ready_at, request.expires_at or next_at)
+        return None, next_at
+
+    async def _dispatch(self) -> None:
+        while True:
+            try:
+                now = time.monotonic()
+                if now - self._last_prune > 60:
+                    self._prune_chats(now)
+                if not self._waiting_count():
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                request, next_at = self._next_request(now)
+                if request is None:
+                    if next_at != float("inf"):
+                        await self._sleep(next_at - now)
+                    continue
+                wait = self.bucket.try_acquire(request.tokens)
+                if wait > 0:
+                    await self._sleep(wait)      # قد يصل طلب أعلى أولوية خلال الانتظار
+                    continue
+                self._chat_take(request.chat_id, request.tokens, time.monotonic())
+                self._release(request, granted=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[Governor] Dispatcher error: {e}", exc_info=True)
+                await asyncio.sleep(0.1)
+
+    # --- API ---
+    async def run(self, chat_id, call, priority: int = PRIORITY_INTERACTIVE, tokens: int = 1,
+                  coalesce_key=None, max_wait: float | None = None, retries: int | None = None):
+        """Runs call() (a zero-argument coroutine function) within the limits. Returns its result or SKIPPED."""
+        if not self.enabled:
+            return await call()
+        if max_wait is None and priority == PRIORITY_COUNTDOWN:
+            max_wait = self.countdown_max_wait
+        retries = self.max_retries if retries is None else retries
+        request, owner = self._enqueue(chat_id, call, priority, tokens, coalesce_key, max_wait)
+        if not owner:
+            return await asyncio.shield(request.result)
+        try:
+            outcome = await self._execute(request, retries)
+        except asyncio.CancelledError:
+            self._release(request, granted=False)
+            if not request.result.done():
+                request.result.set_result(SKIPPED)
+            raise
+        except Exception as e:
+            if not request.result.done():
+                request.result.set_exception(e)
+                request.result.exception()       # retrieved: no "never retrieved" warning without coalesced callers
+            raise
+        if not request.result.done():
+            request.result.set_result(outcome)
+        return outcome
+
+    async def _execute(self, request: _Request, retries: int):
+        attempt = 0
+        while True:
+            if not await request.granted:
+                return SKIPPED
+            try:
+                return await request.call()
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self._stats["retry_after"] += 1
+                self.pause_chat(request.chat_id, delay + 1)
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logger.warning(f"[Governor] Flood limit in chat {request.chat_id}; retrying in {delay:.0f}s "
+                               f"({_PRIORITY_NAMES[request.priority]}, attempt {attempt}/{retries}).")
+                key = request.coalesce_key
+                if key is not None and key in self._coalescing:
+                    return SKIPPED                   # تعديل أحدث لنفس الرسالة ينتظر بالفعل
+                request.granted = asyncio.get_running_loop().create_future()
+                request.enqueued_at = time.monotonic()
+                self._queue(request)
+
+    async def stop(self) -> None:
+        """Stops the dispatcher (shutdown); waiting requests are dropped."""
+        for queue in self._waiting:
+            for request in list(queue.values()):
+                self._release(request, granted=False)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def stats(self) -> dict:
+        granted = self._stats["immediate"] + self._stats["queued"] - self._stats["dropped"] - self._waiting_count()
+        return dict(
+            self._stats,
+            total_wait_ms=round(self._stats["total_wait_ms"], 1),
+            avg_wait_ms=round(self._stats["total_wait_ms"] / granted, 2) if granted > 0 else 0.0,
+            waiting={name: len(queue) for name, queue in zip(_PRIORITY_NAMES, self._waiting)},
+            tracked_chats=len(self._chats),
+        )
+
+
+GOVERNOR = OutboundGovernor()
+
+
+def get_governor_stats() -> dict:
+    """Queue depth per priority class, waits, coalescing and flood pauses for monitoring."""
+    return GOVERNOR.stats()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Weekly/monthly report generation as background jobs.
+
+The admin report buttons used to build a new FinalWeeklyReportScheduler (and
+SQLAlchemy engine) and run the whole pipeline - dozens of queries, 300 dpi
+charts, openpyxl, PDF, SMTP - inside the PTB coroutine, so the bot stopped
+answering everyone until the email was sent.
+
+Reports now go through REPORT_JOBS:
+
+- submit() queues a ReportJob with a short job id on a single worker thread
+  (pyplot, used by the report charts, is not thread-safe, so reports run one
+  at a time). One FinalWeeklyReportScheduler is created on first use and
+  reused, together with its engine.
+- Every report goes through that worker: the scheduled weekly/monthly
+  reports (FinalWeeklyReportScheduler.start_scheduler only submits them),
+  the /final_report commands, and the custom-period Excel report, which
+  uses run() to await one blocking call on the same thread.
+- An identical request while a job of the same kind is queued or running is
+  attached to that job instead of starting another one.
+- The pipeline reports progress at its stage boundaries; watch() calls an
+  async callback on the event loop whenever progress changes (throttled to
+  REPORT_PROGRESS_INTERVAL) and once more when the job ends.
+- cancel() stops a queued job before it starts, or a running one at its next
+  stage boundary (ReportCancelled).
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import REPORT_PROGRESS_INTERVAL
+except ImportError:
+    REPORT_PROGRESS_INTERVAL = 3
+
+REPORT_KINDS = ("weekly", "monthly")
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+_FINISHED_JOBS_KEPT = 20
+
+
+class ReportJob:
+    """State of one report request; written by the worker thread, read by the event loop."""
+
+    def __init__(self, kind: str, requested_by=None):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.kind = kind
+        self.requested_by = requested_by
+        self.status = STATUS_QUEUED
+        self.progress = 0.0
+        self.stage = "في قائمة الانتظار"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.subscribers = []   # (chat_id, message_id) of admin messages showing this job
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+    def add_subscriber(self, chat_id, message_id) -> None:
+        if chat_id is not None and (chat_id, message_id) not in self.subscribers:
+            self.subscribers.append((chat_id, message_id))
+
+    def snapshot(self) -> tuple:
+        return (self.status, round(self.progress, 2), self.stage)
+
+
+class ReportJobManager:
+    """Queue of report jobs run by one background worker thread."""
+
+    def __init__(self):
+        self._executor = None
+        self._scheduler = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()   # job_id -> ReportJob (active + last finished ones)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-worker")
+        return self._executor
+
+    def _get_scheduler(self):
+        # Created in the worker thread on first use, then reused (one SQLAlchemy engine for all reports)
+        if self._scheduler is None:
+            from final_weekly_report import FinalWeeklyReportScheduler
+            self._scheduler = FinalWeeklyReportScheduler()
+        return self._scheduler
+
+    def get(self, job_id: str) -> ReportJob | None:
+        return self._jobs.get(job_id)
+
+    def active_job(self, kind: str) -> ReportJob | None:
+        for job in self._jobs.values():
+            if job.kind == kind and job.active:
+                return job
+        return None
+
+    def submit(self, kind: str, requested_by=None, chat_id=None, message_id=None) -> tuple:
+        """Queues a report of this kind, or joins the one already queued/running.
+
+        Returns (job, created) where created is False for a de-duplicated request.
+        """
+        if kind not in REPORT_KINDS:
+            raise ValueError(f"Unknown report kind: {kind}")
+        with self._lock:
+            job = self.active_job(kind)
+            if job is not None:
+                job.add_subscriber(chat_id, message_id)
+                logger.info(f"[ReportJobs] {kind} report requested by {requested_by} joined running job {job.job_id}.")
+                return job, False
+            job = ReportJob(kind, requested_by=requested_by)
+            job.add_subscriber(chat_id, message_id)
+            self._jobs[job.job_id] = job
+            self._trim_finished()
+            job.future = self._get_executor().submit(self._run, job)
+        logger.info(f"[ReportJobs] Queued {kind} report job {job.job_id} for {requested_by}.")
+        return job, True
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking report function on the report worker (after any queued job) and awaits its result."""
+        with self._lock:
+            future = self._get_executor().submit(func, *args, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    def cancel(self, job_id: str) -> bool:
+        """Requests cancellation. Returns False if the job is unknown or already finished."""
+        job = self._jobs.get(job_id)
+        if job is None or not job.active:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, STATUS_CANCELLED)
+        logger.info(f"[ReportJobs] Cancellation requested for job {job_id} ({job.status}).")
+        return True
+
+    def _trim_finished(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - _FINISHED_JOBS_KEPT)]:
+            self._jobs.pop(job_id, None)
+
+    def _finish(self, job: ReportJob, status: str, error=None) -> None:
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+
+    def _run(self, job: ReportJob) -> None:
+        from final_weekly_report import ReportCancelled
+
+        if job.cancel_event.is_set():
+            self._finish(job, STATUS_CANCELLED)
+            return
+        job.status = STATUS_RUNNING
+        job.started_at = time.time()
+        job.stage = "بدء التقرير"
+
+        def progress(fraction, stage):
+            if job.cancel_event.is_set():
+                raise ReportCancelled(job.job_id)
+            job.progress = max(job.progress, min(1.0, float(fraction)))
+            job.stage = stage
+
+        try:
+            scheduler = self._get_scheduler()
+            if job.kind == "weekly":
+                job.result = scheduler.generate_and_send_weekly_report(progress=progress)
+            else:
+                job.result = scheduler.generate_and_send_monthly_report(progress=progress)
+            job.progress = 1.0
+            self._finish(job, STATUS_DONE if job.result else STATUS_FAILED)
+        except ReportCancelled:
+            self._finish(job, STATUS_CANCELLED)
+        except Exception as e:
+            logger.error(f"[ReportJobs] Job {job.job_id} ({job.kind}) failed: {e}", exc_info=True)
+            self._finish(job, STATUS_FAILED, error=str(e))
+        duration = job.finished_at - job.started_at
+        logger.info(f"[ReportJobs] Job {job.job_id} ({job.kind}) {job.status} after {duration:.1f}s.")
+
+    async def watch(self, job: ReportJob, on_update, interval: float = REPORT_PROGRESS_INTERVAL) -> None:
+        """Awaits on_update(job) on every progress change (at most once per interval) and when the job ends."""
+        last = None
+        while True:
+            current = job.snapshot()
+            if current != last:
+                last = current
+                try:
+                    await on_update(job)
+                except Exception as e:
+                    logger.warning(f"[ReportJobs] Progress update for job {job.job_id} failed: {e}")
+            if not job.active:
+                return
+            await asyncio.sleep(interval)
+
+    def shutdown(self) -> None:
+        """Cancels queued and running jobs and stops the worker thread without waiting for it."""
+        for job in list(self._jobs.values()):
+            if job.active:
+                self.cancel(job.job_id)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+REPORT_JOBS = ReportJobManager()
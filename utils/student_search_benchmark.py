@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Admin student search: ILIKE + live quiz_results join vs the indexed search.
+
+Loads synthetic students (Arabic names written with and without hamza,
+ta marbuta and diacritics, emails, phones) and their quiz history into the
+database of DATABASE_URL and times a set of searches three ways:
+
+- "ilike_join": the old search_student_input_handler query - full_name
+  ILIKE '%q%' LEFT JOINed to quiz_results with a GROUP BY per user.
+- "indexed_live": database/student_search.py (trigram or tsvector index on
+  the normalized name), quiz aggregates from a LATERAL over quiz_results for
+  the returned page only (while the user_quiz_aggregates backfill runs).
+- "indexed": the same search joined to user_quiz_aggregates (steady state).
+
+The data lives in TEMP tables named users/quiz_results/user_quiz_aggregates,
+which shadow the real tables for this session only and are dropped when it
+ends; the search indexes are built on them. normalize_arabic/normalize_phone
+and pg_trgm are created in the database exactly as the bot does at startup.
+The total matches of both searches (without LIMIT) are printed next to
+the timings, so the effect of the spelling folding is visible.
+
+Usage:
+    DATABASE_URL=... python -m utils.student_search_benchmark [users=50000] [quizzes_per_user=10]
+"""
+
+import os
+import random
+import sys
+import time
+
+import psycopg2.extras
+from sqlalchemy import create_engine
+
+from database.student_search import build_search_sql, create_search_objects, search_params
+
+FIRST_NAMES = ["أحمد", "احمد", "إبراهيم", "ابراهيم", "أسامة", "اسامه", "عائشة", "عايشه", "فاطمة", "فاطمه",
+               "مُحَمَّد", "محمد", "يوسف", "مريم", "نورة", "نوره", "سارة", "ساره", "عبدالله", "عبد الله",
+               "خالد", "ريم", "هيا", "لؤلؤة", "ليلى", "ليلي", "مصطفى", "مصطفي", "آمنة", "امنه"]
+FAMILY_NAMES = ["الأحمدي", "الاحمدي", "القحطاني", "العتيبي", "الشمري", "الزهراني", "الغامدي", "المطيري",
+                "الدوسري", "الحربي", "السبيعي", "العنزي", "البقمي", "الشهري", "الأنصاري", "الانصاري"]
+GRADES = ["ثانوي 1", "ثانوي 2", "ثانوي 3"]
+
+# (label, query): تهجئات مختلفة لنفس الاسم + بريد + جوال + ID
+SEARCHES = [
+    ("name", "احمد"),
+    ("name", "أحمد القحطاني"),
+    ("hamza", "ابراهيم"),
+    ("ta marbuta", "فاطمه"),
+    ("diacritics", "مُحمّد"),
+    ("family", "الانصاري"),
+    ("word prefix", "عبدال"),
+    ("rare", "لولوه"),
+    ("email", "student123"),
+    ("phone", "05512"),
+    ("user_id", "1000042"),
+]
+
+_OLD_SEARCH_SQL = """
+    SELECT u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered,
+           COALESCE(u.is_my_student, FALSE) as is_my_student,
+           COUNT(qr.id) as quiz_count,
+           ROUND(AVG(qr.score_percentage)::numeric, 1) as avg_score,
+           MAX(qr.completed_at) as last_quiz
+    FROM users u
+    LEFT JOIN quiz_results qr ON u.user_id = qr.user_id
+    WHERE u.is_registered = TRUE AND u.full_name ILIKE %s
+    GROUP BY u.user_id, u.full_name, u.email, u.phone, u.grade, u.is_registered, u.is_my_student
+    ORDER BY u.full_name
+    LIMIT 10
+"""
+
+_TEMP_TABLES_SQL = """
+    CREATE TEMP TABLE users (
+        user_id BIGINT PRIMARY KEY,
+        full_name TEXT,
+        email TEXT,
+        phone TEXT,
+        grade TEXT,
+        is_registered BOOLEAN DEFAULT FALSE,
+        is_my_student BOOLEAN DEFAULT FALSE
+    );
+    CREATE TEMP TABLE quiz_results (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        score_percentage DOUBLE PRECISION,
+        completed_at TIMESTAMP
+    );
+    CREATE INDEX ON quiz_results (user_id);
+    CREATE TEMP TABLE user_quiz_aggregates (
+        user_id BIGINT PRIMARY KEY,
+        total_quizzes INTEGER NOT NULL DEFAULT 0,
+        avg_percentage DOUBLE PRECISION NOT NULL DEFAULT 0,
+        last_completed_at TIMESTAMP
+    );
+"""
+
+
+def _diacritize(name: str, rng: random.Random) -> str:
+    return "".join(ch + ("َ" if rng.random() < 0.3 else "") for ch in name) if rng.random() < 0.05 else name
+
+
+def build_users(count: int, seed: int = 11) -> list:
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        user_id = 1000000 + index
+        name = " ".join([
+            _diacritize(rng.choice(FIRST_NAMES), rng), rng.choice(FIRST_NAMES).replace("مُحَمَّد", "محمد"),
+            rng.choice(FAMILY_NAMES),
+        ])
+        rows.append((user_id, name, f"student{index}@example.com", "05" + "".join(rng.choice("0123456789") for _ in range(8)),
+                     rng.choice(GRADES), rng.random() < 0.9, rng.random() < 0.1))
+    return rows
+
+
+def load_dataset(cur, users: list, quizzes_per_user: int) -> bool:
+    cur.execute(_TEMP_TABLES_SQL)
+    psycopg2.extras.execute_values(cur, "INSERT INTO users VALUES %s", users, page_size=5000)
+    cur.execute("""
+        INSERT INTO quiz_results (user_id, score_percentage, completed_at)
+        SELECT u.user_id, random() * 100, NOW() - random() * INTERVAL '120 days'
+        FROM users u, generate_series(1, %s)
+        WHERE random() < 0.8
+    """, (quizzes_per_user,))
+    cur.execute("""
+        INSERT INTO user_quiz_aggregates (user_id, total_quizzes, avg_percentage, last_completed_at)
+        SELECT user_id, COUNT(*), AVG(score_percentage), MAX(completed_at) FROM quiz_results GROUP BY user_id
+    """)
+    trgm = create_search_objects(cur)
+    cur.execute("ANALYZE users; ANALYZE quiz_results; ANALYZE user_quiz_aggregates")
+    return trgm
+
+
+def _timed_search(cur, sql, params, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    return rows, (time.perf_counter() - started) / repeat
+
+
+def main(users: int, quizzes_per_user: int, repeat: int = 5) -> None:
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise SystemExit("DATABASE_URL is required")
+    conn = create_engine(database_url).raw_connection()
+    try:
+        cur = conn.cursor()
+        started = time.perf_counter()
+        rows = build_users(users)
+        trgm = load_dataset(cur, rows, quizzes_per_user)
+        cur.execute("SELECT COUNT(*) FROM quiz_results")
+        print("{} synthetic users, {} quizzes loaded and indexed in {:.1f}s ({})".format(
+            users, cur.fetchone()[0], time.perf_counter() - started, "pg_trgm" if trgm else "tsvector prefix"))
+
+        modes = (("ilike_join", None), ("indexed_live", False), ("indexed", True))
+        totals = dict.fromkeys((name for name, _ in modes), 0.0)
+        print("{:<12}{:<16}{:>8}{:>8}{:>14}{:>14}{:>10}".format(
+            "search", "query", "old", "new", "ilike_join", "indexed_live", "indexed"))
+        for label, query in SEARCHES:
+            timings, hits = {}, {}
+            for name, aggregates_ready in modes:
+                if aggregates_ready is None:
+                    found, seconds = _timed_search(cur, _OLD_SEARCH_SQL, (f"%{query}%",), repeat)
+                else:
+                    params = search_params(query, 10)
+                    found, seconds = _timed_search(cur, build_search_sql(params, trgm, aggregates_ready), params, repeat)
+                timings[name], hits[name] = seconds, len(found)
+                totals[name] += seconds
+            if hits["indexed_live"] != hits["indexed"]:
+                raise SystemExit(f"indexed modes disagree for {query!r}")
+            # كل المطابقات (بدون LIMIT) لإظهار أثر التطبيع
+            cur.execute("SELECT COUNT(*) FROM users WHERE is_registered = TRUE AND full_name ILIKE %s", (f"%{query}%",))
+            hits["ilike_join"] = cur.fetchone()[0]
+            params = search_params(query, users)
+            cur.execute(build_search_sql(params, trgm, aggregates_ready=True), params)
+            hits["indexed"] = len(cur.fetchall())
+            print("{:<12}{:<16}{:>8}{:>8}{:>12.1f}ms{:>12.1f}ms{:>8.1f}ms".format(
+                label, query, hits["ilike_join"], hits["indexed"],
+                timings["ilike_join"] * 1000, timings["indexed_live"] * 1000, timings["indexed"] * 1000))
+        print("{:<36}{:>12.1f}ms{:>12.1f}ms{:>8.1f}ms".format(
+            "total", *(totals[name] * 1000 for name, _ in modes)))
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10)
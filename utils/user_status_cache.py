@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""In-process user access status cache.
+
+Every guarded interaction used to read the whole users row
+(BotSecurityManager.check_user_access, start_command,
+check_registration_status), then write last_activity through
+save_user_info (another SELECT, an UPDATE and a COMMIT), and
+AdminSecurityManager.is_user_blocked opened a new session per check.
+
+- USER_STATUS_CACHE keeps registered / grade / is_my_student / blocked per
+  user for USER_STATUS_CACHE_TTL seconds. Each field carries its own
+  timestamp because they come from different queries (users row vs
+  blocked_users).
+- Writers invalidate the entry: registration saves and edits, account
+  deletion, my-student tagging and admin block/unblock. invalidate() bumps
+  a generation so a lookup that started before it does not store old data.
+- last_activity is not buffered here: guarded interactions call
+  database.write_behind.touch_last_activity, the "last_activity" channel
+  of the shared WRITE_BEHIND queue, which batches it with the other
+  write-behind columns. This module only caches reads.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    from config import logger
+except ImportError:
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger(__name__)
+
+try:
+    from config import USER_STATUS_CACHE_TTL, USER_STATUS_CACHE_MAX_ENTRIES
+except ImportError:
+    USER_STATUS_CACHE_TTL = 120
+    USER_STATUS_CACHE_MAX_ENTRIES = 20000
+
+STATUS_FIELDS = ("registered", "grade", "is_my_student", "blocked")
+
+
+class UserStatusCache:
+    """Per-user status fields with a TTL, shared by the event loop and DB executor threads."""
+
+    def __init__(self, ttl=USER_STATUS_CACHE_TTL, max_entries=USER_STATUS_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}          # user_id -> {field: (value, stored_at)}
+        self._lock = threading.Lock()
+        self._generation = 0        # bumped by invalidate() so in-flight lookups don't store stale rows
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def lookup(self, user_id: int, *fields) -> dict | None:
+        """Returns {field: value} when every requested field is fresh, else None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            found = {}
+            for field in fields:
+                cached = entry.get(field) if entry else None
+                if cached is None or now - cached[1] > self.ttl:
+                    self._stats["misses"] += 1
+                    return None
+                found[field] = cached[0]
+            self._stats["hits"] += 1
+            return found
+
+    def store(self, user_id: int, generation: int | None = None, **fields) -> bool:
+        """Stores fields unless an invalidation happened since `generation` was read."""
+        unknown = set(fields) - set(STATUS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user status fields: {sorted(unknown)}")
+        now = time.monotonic()
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            entry = self._entries.pop(user_id, None) or {}
+            for field, value in fields.items():
+                entry[field] = (value, now)
+            self._entries[user_id] = entry   # re-inserted: dict order is least recently stored first
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._stats["stores"] += 1
+        return True
+
+    def invalidate(self, user_id: int | None = None, *fields) -> None:
+        """Drops the given fields (all of them by default) of one user, or of everyone when user_id is None."""
+        with self._lock:
+            self._generation += 1
+            self._stats["invalidations"] += 1
+            if user_id is None:
+                if fields:
+                    for entry in self._entries.values():
+                        for field in fields:
+                            entry.pop(field, None)
+                else:
+                    self._entries.clear()
+                return
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if fields:
+                for field in fields:
+                    entry.pop(field, None)
+            else:
+                del self._entries[user_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+
+USER_STATUS_CACHE = UserStatusCache()